@@ -0,0 +1,206 @@
+# Tests for toddocumentupdater.py that need no Word, browser or chat:
+#   python -m pytest assets
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+import toddocumentupdater as tdu
+import toddocumentupdater_bench as bench
+
+def convert_lists(markup):
+    return tdu.run_html_stages(markup, [tdu.UnwrapListParagraphStage(), tdu.ListMarkerStage()])
+
+# ---------- ListMarkerStage ----------
+LIST_CASES = [
+    ("<p>• a</p>\n<p>• b</p>",
+     '<ul><li><p class="BulletedList">a</p></li><li><p class="BulletedList">b</p></li></ul>'),
+    ("<p>1. a</p><p>2) b</p><p>text</p>",
+     '<ol><li class="MsoListParagraph">a</li><li class="MsoListParagraph">b</li></ol><p class="MsoNormal">text</p>'),
+    ("<p>3. c</p><p>c) d</p>",
+     '<ol start="3"><li class="MsoListParagraph">c</li><li class="MsoListParagraph">d</li></ol>'),
+    ("<p>- a</p><p>1. b</p>",
+     '<ul><li><p class="BulletedList">a</p></li></ul><ol><li class="MsoListParagraph">b</li></ol>'),
+    ("<p>&amp; 1. no</p><p class=Note>- note</p>",
+     '<p class="MsoNormal">&amp; 1. no</p><ul><li><p class="BulletedList">note</p></li></ul>'),
+    ("<ul><li>x<ul><li>y</li></ul></li></ul>",
+     '<ul><li><p class="BulletedList">x</p><ul><li><p class="BulletedList">y</p></li></ul></li></ul>'),
+    ("<ol><li>x</li></ol><ul><li><p class=MsoNormal>y</p></li></ul>",
+     '<ol><li class="MsoListParagraph">x</li></ol><ul><li><p class="BulletedList">y</p></li></ul>'),
+    ("<p>- open<div>x</div>", '<ul><li><p class="BulletedList">open</p></li></ul><div>x</div>'),
+]
+
+@pytest.mark.parametrize("markup, expected", LIST_CASES)
+def test_list_markers(markup, expected):
+    assert convert_lists(markup) == expected
+
+def test_formatting_that_held_only_the_marker_is_dropped():
+    assert convert_lists("<p><b>&#8226;</b>&nbsp;bold</p>") == '<ul><li><p class="BulletedList">bold</p></li></ul>'
+    assert convert_lists("<p><span><b>•</b></span> x</p><p><i>-</i> y</p>") == (
+        '<ul><li><p class="BulletedList">x</p></li><li><p class="BulletedList">y</p></li></ul>')
+
+def test_formatting_around_item_text_is_kept():
+    assert convert_lists("<p><b>• Bold</b> rest</p>") == (
+        '<ul><li><p class="BulletedList"><b>Bold</b> rest</p></li></ul>')
+    assert convert_lists("<p>1. <a name=\"_Toc1\"></a>Step</p>") == (
+        '<ol><li class="MsoListParagraph"><a name="_Toc1"></a>Step</li></ol>')
+
+def test_table_cells_are_not_lists():
+    markup = "<table><tr><td><p>- cell one</p></td><th><p>1. cell two</p></th></tr></table>"
+    assert convert_lists(markup) == (
+        '<table><tr><td><p class="MsoNormal">- cell one</p></td>'
+        '<th><p class="MsoNormal">1. cell two</p></th></tr></table>')
+    assert convert_lists("<h2>1. Heading</h2><table><tr><td><p>- cell</p></td></tr></table>") == (
+        '<h2>1. Heading</h2><table><tr><td><p class="MsoNormal">- cell</p></td></tr></table>')
+
+def test_real_lists_inside_cells_are_still_mapped():
+    assert convert_lists("<table><tr><td><ul><li>x</li></ul></td></tr></table>") == (
+        '<table><tr><td><ul><li><p class="BulletedList">x</p></li></ul></td></tr></table>')
+
+def test_lists_resume_after_a_table():
+    markup = "<table><tr><td><p>- cell</p></td></tr></table><p>- a</p><p>- b</p>"
+    assert convert_lists(markup) == (
+        '<table><tr><td><p class="MsoNormal">- cell</p></td></tr></table>'
+        '<ul><li><p class="BulletedList">a</p></li><li><p class="BulletedList">b</p></li></ul>')
+
+def test_unclosed_cell_paragraph_ends_at_the_cell():
+    assert convert_lists("<table><tr><td><p>- a</td><td>b</td></tr></table><p>- c</p>") == (
+        '<table><tr><td><p class="MsoNormal">- a</td><td>b</td></tr></table>'
+        '<ul><li><p class="BulletedList">c</p></li></ul>')
+
+def test_counts():
+    stage = tdu.ListMarkerStage()
+    tdu.run_html_stages("<p>• a</p><p>• b</p><p>x</p><p>1. c</p><table><tr><td><p>- d</p></td></tr></table>",
+                        [stage])
+    assert stage.counts == {"bullet": 2, "numbered": 1, "lists": 2}
+
+# ---------- Reply validation ----------
+def _reply(body, title="Guide"):
+    return (f"<html lang=\"en\"><head><meta charset=\"utf-8\"><title>{title}</title>"
+            f"<style>\n{tdu.STYLE_BRIDGES}\n</style></head><body>\n{body}\n</body></html>")
+
+SENT = "<h1>Guide</h1>" + "".join(
+    f"<h2>Part {n}</h2><p>Open the record number {n} and review the {n}th entry before saving it.</p>"
+    f"<p>Then close record {n} from the file menu of section {n}.</p>" for n in range(300))
+
+def test_coverage_checks_every_merged_run():
+    # Paragraphs merged into one run are no longer found whole; all 600 are still checked
+    merged = _reply(SENT.replace("</p><p>", " "))
+    _, report = tdu.validate_reply(merged, SENT, tdu.split_sections(SENT), "Guide")
+    assert report["coverage"] == 1.0 and report["failing"] == []
+
+def test_coverage_flags_the_lost_section():
+    lost = SENT.replace("<p>Open the record number 7 and review the 7th entry before saving it.</p>"
+                        "<p>Then close record 7 from the file menu of section 7.</p>", "")
+    sections = tdu.split_sections(SENT)
+    _, report = tdu.validate_reply(_reply(lost), SENT, sections, "Guide")
+    assert [sections[i][1].count("record number 7 ") for i in report["failing"]] == [1]
+
+def test_one_section_reply_is_resent_whole():
+    body = "<h1>Guide</h1><p>Open the record and review every entry before saving it.</p>"
+    job = tdu.DocJob("Guide.docx")
+    job.body = body
+    job.ai_html_clean = _reply("<h1>Guide</h1>")
+    sent = []
+
+    def submit(prompt):
+        sent.append(prompt)
+        return _reply(body)
+
+    doc, report = tdu.check_and_repair(job, [], submit, instructions=False)
+    assert len(sent) == 1 and body in sent[0]
+    assert report["resent"] == 1 and report["failing"] == [] and "review every entry" in doc
+
+def test_reply_that_lost_a_heading_is_resent_whole():
+    lost = SENT.replace("<h2>Part 7</h2><p>Open the record number 7 and review the 7th entry before saving it.</p>"
+                        "<p>Then close record 7 from the file menu of section 7.</p>", "")
+    job = tdu.DocJob("Guide.docx")
+    job.body = SENT
+    job.ai_html_clean = _reply(lost)
+    sent = []
+
+    def submit(prompt):
+        sent.append(prompt)
+        return _reply(SENT)
+
+    doc, report = tdu.check_and_repair(job, tdu.split_sections(SENT), submit, instructions=False,
+                                       chunk_chars=len(SENT) + 1)
+    assert len(sent) == 1 and report["resent"] == len(tdu.split_sections(SENT))
+    assert report["failing"] == [] and "<h2>Part 7</h2>" in doc
+
+def test_only_applied_fixes_count_as_repairs():
+    # No <h1> and no title to insert: reported, not repaired
+    _, report = tdu.validate_reply(_reply("<p>Text</p>", title=""), "<p>Text</p>", None, "")
+    assert "no <h1>" in report["issues"] and report["repairs"] == 0
+    _, report = tdu.validate_reply(_reply("<p>Text</p>", title=""), "<p>Text</p>", None, "Guide")
+    assert report["repairs"] == 2    # <h1> inserted, <title> set from it
+
+# ---------- AI conversion cache ----------
+def test_section_lookups_do_not_count_as_document_hits(tmp_path):
+    cache = tdu.AiCache(root=str(tmp_path))
+    assert cache.get("<p>doc</p>") is None
+    cache.put("<p>doc</p>", "raw", "clean")
+    cache.put("<p>section</p>", "frag", "frag", part=True)
+    assert cache.get("<p>section</p>", part=True) == ("frag", "frag")
+    assert cache.get("<p>other section</p>", part=True) is None
+    assert cache.get("<p>doc</p>") == ("raw", "clean")
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+    assert cache.parts == {"hits": 1, "misses": 1, "stores": 1}
+    assert "(50% hit rate)" in cache.summary().split("\n")[0]
+
+# ---------- HTTP chat transport ----------
+PROMPT = "Convert this.\n<BEGIN_HTML>\n<h1>Guide</h1><p>Open the record.</p>\n</END_HTML>"
+
+def _stub(**kw):
+    return bench.StubChatServer(first_token_delay=0, chars_per_second=0, chunk_chars=40, **kw)
+
+def test_stream_deltas_always_append():
+    out = ""
+    for piece in ["<", "<!DOCTYPE html>", "\n", "<!DOCTYPE html>\n<html>"]:
+        out = tdu.add_stream_piece(out, '{"choices": [{"delta": {"content": %s}}]}' % tdu.json.dumps(piece),
+                                   resent=False)
+    assert out == "<<!DOCTYPE html>\n<!DOCTYPE html>\n<html>"
+    # Captured chat apps resend the whole text so far
+    out = tdu.add_stream_piece("<h1>G", '{"text": "<h1>Guide"}')
+    assert out == "<h1>Guide"
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_stream_and_json_replies(stream):
+    with _stub() as srv:
+        ai = tdu.HttpChatTransport(srv.url + "v1", stream=stream, retries=0)
+        doc = ai.submit_and_get_html(PROMPT, wait_seconds=10)
+        ai.stop()
+    assert "<h1>Guide</h1><p>Open the record.</p>" in doc and doc.endswith("</html>")
+
+def test_busy_endpoint_is_retried_after_the_given_delay():
+    with _stub() as srv:
+        srv.fail_next, srv.retry_after = 2, 0.05
+        ai = tdu.HttpChatTransport(srv.url + "v1", retries=2, backoff=5)
+        t0 = tdu.time.perf_counter()
+        assert "Open the record." in ai.submit_and_get_html(PROMPT, wait_seconds=10)
+        assert tdu.time.perf_counter() - t0 < 2    # Retry-After, not the 5 s backoff
+        assert (srv.requests, ai.retried) == (3, 2)
+        srv.fail_next = 3
+        with pytest.raises(RuntimeError, match="after 3 attempt"):
+            ai.submit_and_get_html(PROMPT, wait_seconds=10)
+        ai.stop()
+    assert srv.requests == 6
+
+def test_sequential_requests_reuse_one_connection():
+    with _stub() as srv:
+        ai = tdu.HttpChatTransport(srv.url + "v1", max_parallel=1)
+        for _ in range(4):
+            ai.submit_and_get_html(PROMPT, wait_seconds=10)
+        ai.stop()
+    assert srv.requests == 4 and srv.connections == 1 and ai.connections == 1
+
+def test_stream_is_cut_at_the_deadline():
+    with _stub(respond=lambda text: bench.canned_ai_html(text) + " " * 40000) as srv:
+        srv.chars_per_second = 8000    # five seconds of reply
+        ai = tdu.HttpChatTransport(srv.url + "v1")
+        t0 = tdu.time.perf_counter()
+        with pytest.raises(TimeoutError):
+            ai.submit_and_get_html(PROMPT, wait_seconds=1)
+        assert tdu.time.perf_counter() - t0 < 3
+        ai.stop()
@@ -2,6 +2,7 @@
 # - Drag-and-drop Word files/folders or browse to pick them
 # - Exports to Filtered HTML, sends to Navigator Chat via Playwright, reimports to DOCX using a seed template
 # - Forces Word "Print Layout" view in the saved DOCX
+# - Headless: python toddocumentupdater.py batch FOLDER... --jobs 4 --backend native --report-dir DIR
 #
 # Dev/build prerequisites:
 #   pip install pywin32 playwright pyinstaller tkinterdnd2
@@ -16,22 +17,70 @@ import tempfile
 import traceback
 import datetime
 import html
+import json
+import queue
+import argparse
+import hashlib
 import shutil
+import signal
+import asyncio
+import random
+import math
+import bisect
+import http.client
+import struct
+import zipfile
+import posixpath
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+import urllib.parse
+from urllib.parse import urlparse
 
-import pythoncom
-import pywintypes
-import win32com.client as win32
-from playwright.sync_api import sync_playwright
+# ---------- Windows COM (optional so the pool/benchmarks can run elsewhere) ----------
+try:
+    import pythoncom
+    import pywintypes
+    import win32com.client as win32
+    ComError = pywintypes.com_error
+    WIN32_AVAILABLE = True
+except Exception:
+    pythoncom = None
+    pywintypes = None
+    win32 = None
+    WIN32_AVAILABLE = False
+
+    class ComError(Exception):
+        pass
 
-# ---------- GUI (Tkinter + tkinterdnd2 for drag-and-drop) ----------
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
 try:
-    from tkinterdnd2 import DND_FILES, TkinterDnD
-    TKDND_AVAILABLE = True
+    from playwright.sync_api import sync_playwright
+    from playwright.async_api import async_playwright
+    PLAYWRIGHT_AVAILABLE = True
 except Exception:
-    TKDND_AVAILABLE = False
+    sync_playwright = None
+    async_playwright = None
+    PLAYWRIGHT_AVAILABLE = False
+
+# ---------- GUI (Tkinter + tkinterdnd2 for drag-and-drop) ----------
+# Loaded by main() only, so the headless batch and worker processes never import Tk
+tk = ttk = filedialog = messagebox = None
+DND_FILES = TkinterDnD = None
+TKDND_AVAILABLE = False
+
+def load_gui():
+    global tk, ttk, filedialog, messagebox, DND_FILES, TkinterDnD, TKDND_AVAILABLE
+    if tk is not None:
+        return
+    import tkinter
+    from tkinter import ttk as tk_ttk, filedialog as tk_filedialog, messagebox as tk_messagebox
+    tk, ttk, filedialog, messagebox = tkinter, tk_ttk, tk_filedialog, tk_messagebox
+    try:
+        from tkinterdnd2 import DND_FILES, TkinterDnD
+        TKDND_AVAILABLE = True
+    except Exception:
+        TKDND_AVAILABLE = False
 
 # ---------- Ensure Playwright uses the bundled Chromium ----------
 def setup_playwright_browsers_path():
@@ -55,6 +104,8 @@ WD_STYLE_TYPE_PARAGRAPH = 1
 WD_VIEW_PRINT           = 3
 RPC_E_CALL_REJECTED     = -2147418111  # 0x80010001
 RPC_E_RETRY_LATER       = -2147417848  # 0x8001010A
+RPC_E_SERVER_DIED       = -2147418105  # 0x80010007
+RPC_S_SERVER_UNAVAILABLE = -2147023174 # 0x800706BA
 
 # ---------- Navigator Chat URL ----------
 NAVIGATOR_CHAT_URL = "https://chat.ai.it.ufl.edu/"
@@ -114,7 +165,13 @@ Self-check:
 """
 
 # ---------- Sign-in flow (browser opens after instructions) ----------
-def ensure_profile_signed_in_gui(user_data_dir: str, log_fn):
+def ensure_profile_signed_in_gui(user_data_dir: str, log_fn, chat=None):
+    if chat is not None:
+        # The batch keeps this browser open; sign-in happens in the same page it will use
+        chat.ensure_ready()
+        log_fn("Navigator Chat opened with your persistent profile. Complete sign-in and set the default model if needed.")
+        messagebox.showinfo("After sign-in", "When the chat input is visible and you’ve finished the setup in the browser,\nclick OK here to begin processing.")
+        return chat
     play = sync_playwright().start()
     context = play.chromium.launch_persistent_context(
         user_data_dir=user_data_dir,
@@ -144,24 +201,186 @@ def timestamp():
     return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
 def norm_path(p: str) -> str:
-    return os.path.normpath(os.path.abspath(p)).replace("/", "\\")
+    # normpath already yields backslashes on Windows; avoids mangling POSIX paths
+    return os.path.normpath(os.path.abspath(p))
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, "") or default)
+    except ValueError:
+        return default
+
+def com_hresult(e):
+    hr = getattr(e, "hresult", None)
+    if hr is None and e.args:
+        hr = e.args[0]
+    return hr
 
 def with_retry(fn, *args, **kwargs):
     backoff = 0.1
     for _ in range(50):
         try:
             return fn(*args, **kwargs)
-        except pywintypes.com_error as e:
-            hr = getattr(e, "hresult", None)
-            if hr is None and e.args:
-                hr = e.args[0]
+        except ComError as e:
+            hr = com_hresult(e)
             if hr in (RPC_E_CALL_REJECTED, RPC_E_RETRY_LATER):
-                pythoncom.PumpWaitingMessages()
+                trace_count("retries")
+                if pythoncom is not None:
+                    pythoncom.PumpWaitingMessages()
                 time.sleep(backoff)
                 backoff = min(backoff * 1.5, 1.5)
                 continue
             raise
 
+# ---------- Tracing ----------
+# Per-document spans; ADA_TRACE=1 or --trace writes a chrome://tracing file and a p50/p95 table.
+TRACE_ENABLED = os.environ.get("ADA_TRACE", "").strip().lower() in ("1", "true", "yes", "on")
+TRACER = None
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __bool__(self):
+        return False
+
+    def set(self, **kw):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("tracer", "name", "doc", "args", "start")
+
+    def __init__(self, tracer, name: str, doc: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.doc = doc
+        self.args = args
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if not self.doc and stack:
+            self.doc = stack[-1].doc
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        stack = self.tracer._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add(self.name, self.start, end, self.doc, self.args)
+        return False
+
+    def set(self, **kw):
+        self.args.update(kw)
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []       # (name, start, end, doc, args, thread id)
+        self.threads = {}
+        self.origin = time.perf_counter()
+
+    def _stack(self) -> list:
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def add(self, name: str, start: float, end: float, doc: str = "", args=None):
+        tid = threading.get_ident()
+        with self.lock:
+            self.events.append((name, start, end, doc, args or {}, tid))
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+
+    def count(self, key: str, n: int = 1):
+        # Adds to a counter (e.g. retries) on the innermost open span of this thread
+        stack = self._stack()
+        if stack:
+            args = stack[-1].args
+            args[key] = args.get(key, 0) + n
+
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "T_ODDocumentUpdater"}}]
+        with self.lock:
+            for tid, name in self.threads.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+            for name, start, end, doc, args, tid in self.events:
+                a = dict(args)
+                if doc:
+                    a["doc"] = doc
+                events.append({"name": name, "cat": name.split("_", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                               "ts": round((start - self.origin) * 1e6, 1),
+                               "dur": round((end - start) * 1e6, 1), "args": a})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str) -> str:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False)
+        return path
+
+    def summary(self) -> list:
+        # One row per span name in first-seen order: count, p50, p95, max and total seconds
+        durations = {}
+        with self.lock:
+            for name, start, end, _, _, _ in self.events:
+                durations.setdefault(name, []).append(end - start)
+        rows = []
+        for name, values in durations.items():
+            values.sort()
+            pick = lambda q: values[max(0, math.ceil(q * len(values)) - 1)]
+            rows.append({"span": name, "count": len(values), "p50_s": pick(0.50), "p95_s": pick(0.95),
+                         "max_s": values[-1], "total_s": sum(values)})
+        return rows
+
+    def summary_lines(self) -> list:
+        lines = [f"  {'span':<30} {'count':>6} {'p50':>9} {'p95':>9} {'max':>9} {'total':>9}"]
+        for r in self.summary():
+            lines.append(f"  {r['span']:<30} {r['count']:>6} {r['p50_s']:>8.3f}s {r['p95_s']:>8.3f}s "
+                         f"{r['max_s']:>8.3f}s {r['total_s']:>8.2f}s")
+        return lines
+
+def start_tracing() -> Tracer:
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+def stop_tracing():
+    global TRACER
+    tracer, TRACER = TRACER, None
+    return tracer
+
+def span(name: str, doc: str = "", **args):
+    tracer = TRACER
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, doc, args)
+
+def trace_add(name: str, start: float, doc: str = "", end=None, **args):
+    # A finished span from start (a time.perf_counter() value) to end, default now
+    tracer = TRACER
+    if tracer is not None:
+        if not doc:
+            stack = tracer._stack()
+            doc = stack[-1].doc if stack else ""
+        tracer.add(name, start, time.perf_counter() if end is None else end, doc, args)
+
+def trace_count(key: str, n: int = 1):
+    tracer = TRACER
+    if tracer is not None:
+        tracer.count(key, n)
+
 # ---------- High-quality image settings ----------
 def set_high_quality(word, doc=None):
     try:
@@ -198,7 +417,7 @@ def open_word_document_forgiving(word, path: str):
             OpenAndRepair=False,
             NoEncodingDialog=True
         )
-    except pywintypes.com_error:
+    except ComError:
         try:
             pv = with_retry(word.ProtectedViewWindows.Open, FileName=p, AddToRecentFiles=False)
             time.sleep(0.25)
@@ -218,22 +437,19 @@ def save_as_filtered_html(doc, html_path: str):
     except AttributeError:
         with_retry(doc.SaveAs, FileName=html_path, FileFormat=WD_FORMAT_FILTERED_HTML)
 
-def export_doc_to_filtered_html(docx_path: str):
-    pythoncom.CoInitialize()
-    word = None
+def _export_with_word(word, docx_path: str):
     doc = None
     try:
-        word = win32.Dispatch("Word.Application")
-        word.Visible = False
-        word.DisplayAlerts = 0
-        doc = open_word_document_forgiving(word, docx_path)
+        with span("word_open"):
+            doc = open_word_document_forgiving(word, docx_path)
         set_high_quality(word, doc)
         base = os.path.splitext(os.path.basename(docx_path))[0]
         short_base = re.sub(r"[^A-Za-z0-9._-]+", "_", base)[:40] or "doc"
         out_dir = os.path.join(tempfile.gettempdir(), f"html_{short_base}_{timestamp()}")
         os.makedirs(out_dir, exist_ok=True)
         html_path = os.path.join(out_dir, f"{short_base}.html")
-        save_as_filtered_html(doc, html_path)
+        with span("word_save_html"):
+            save_as_filtered_html(doc, html_path)
         assets_dir_guess = os.path.join(out_dir, f"{short_base}_files")
         assets_dir = assets_dir_guess if os.path.isdir(assets_dir_guess) else out_dir
         return html_path, assets_dir, short_base
@@ -243,24 +459,41 @@ def export_doc_to_filtered_html(docx_path: str):
                 doc.Close(False)
         except Exception:
             pass
-        try:
-            if word is not None:
-                word.Quit()
-        except Exception:
-            pass
-        try:
-            pythoncom.CoUninitialize()
-        except Exception:
-            pass
+
+def export_doc_to_filtered_html(docx_path: str, word_pool=None, native_pool=None):
+    # .docx goes to the native reader when that backend is selected (in native_pool's worker
+    # processes when given); legacy .doc and unreadable packages still go to Word
+    if EXPORT_BACKEND == "native" and native_export_supported(docx_path):
+        if native_pool is not None:
+            return native_pool.export(docx_path)
+        return export_docx_to_html(docx_path)
+    if word_pool is not None:
+        return word_pool.export(docx_path)
+    session = WordSession(preload_template=False)
+    session.backend.thread_init()
+    try:
+        session.open()
+        return session.export(docx_path)
+    finally:
+        session.close()
+        session.backend.thread_uninit()
 
 # ---------- HTML extraction ----------
+_BODY_START_RE = re.compile(r'(?is)<body\b[^>]*>')
+_BODY_END_RE = re.compile(r'(?i)</body\s*>')
+_NON_CONTENT_RES = (re.compile(r"(?is)<style[^>]*>.*?</style>"), re.compile(r"(?is)<script[^>]*>.*?</script>"),
+                    re.compile(r"(?is)<link[^>]*?>"), re.compile(r"(?is)<!--.*?-->"))
+
 def extract_relevant_html_for_ai(full_html: str) -> str:
-    body_match = re.search(r"(?is)<body[^>]*>(.*?)</body>", full_html)
-    body_html = body_match.group(1) if body_match else full_html
-    body_html = re.sub(r"(?is)<style[^>]*>.*?</style>", "", body_html)
-    body_html = re.sub(r"(?is)<script[^>]*>.*?</script>", "", body_html)
-    body_html = re.sub(r"(?is)<link[^>]*?>", "", body_html)
-    body_html = re.sub(r"(?is)<!--.*?-->", "", body_html)
+    # A reply cut off before </body> keeps everything after <body>
+    body_match = _BODY_START_RE.search(full_html)
+    if body_match:
+        end = _BODY_END_RE.search(full_html, body_match.end())
+        body_html = full_html[body_match.end():end.start() if end else len(full_html)]
+    else:
+        body_html = full_html
+    for rx in _NON_CONTENT_RES:
+        body_html = rx.sub("", body_html)
     return body_html.strip()
 
 # ---------- Work staging (images) ----------
@@ -283,42 +516,234 @@ def copy_all(src_dir: str, dst_dir: str):
             except Exception:
                 pass
 
-def relativize_img_src_to_folder(body_html: str, target_dir: str, original_assets_dir: str) -> str:
+def _relativized_src(src: str, target_dir: str, original_assets_dir: str):
+    if re.match(r'(?i)^data:', src):
+        return None
+    local = None
+    if re.match(r'(?i)^[A-Za-z]:', src) and os.path.isfile(src):
+        local = src
+    elif src.startswith("file:///"):
+        p = src.replace("file:///", "").replace("/", "\\")
+        if os.path.isfile(p):
+            local = p
+    else:
+        cand = norm_path(os.path.join(original_assets_dir, src))
+        if os.path.isfile(cand):
+            local = cand
+        else:
+            b = os.path.basename(src)
+            cand2 = norm_path(os.path.join(original_assets_dir, b))
+            if os.path.isfile(cand2):
+                local = cand2
+    if local and os.path.isfile(local):
+        fname = os.path.basename(local)
+        dst_path = os.path.join(target_dir, fname)
+        try:
+            if norm_path(local) != norm_path(dst_path):
+                shutil.copy2(local, dst_path)
+        except Exception:
+            pass
+        return fname
+    return None
+
+_SRC_ATTR_RE = re.compile(r'(?is)\bsrc="([^"]+)"')
+
+def relativize_img_src_to_folder(body_html: str, target_dir: str, original_assets_dir: str, resolve=None) -> str:
+    # resolve (an ImageIndex's) replaces the copy-and-probe lookup; each src resolves once
+    memo = {}
+
     def repl(m):
         src = m.group(1).strip()
-        if re.match(r'(?i)^data:', src):
-            return m.group(0)
-        local = None
-        if re.match(r'(?i)^[A-Za-z]:', src) and os.path.isfile(src):
-            local = src
-        elif src.startswith("file:///"):
-            p = src.replace("file:///", "").replace("/", "\\")
-            if os.path.isfile(p):
-                local = p
-        else:
-            cand = norm_path(os.path.join(original_assets_dir, src))
-            if os.path.isfile(cand):
-                local = cand
-            else:
-                b = os.path.basename(src)
-                cand2 = norm_path(os.path.join(original_assets_dir, b))
-                if os.path.isfile(cand2):
-                    local = cand2
-        if local and os.path.isfile(local):
-            fname = os.path.basename(local)
-            dst_path = os.path.join(target_dir, fname)
-            try:
-                if norm_path(local) != norm_path(dst_path):
-                    shutil.copy2(local, dst_path)
-            except Exception:
-                pass
-            return f'src="{fname}"'
-        return m.group(0)
-    return re.sub(r'(?is)\bsrc="([^"]+)"', repl, body_html)
+        if src not in memo:
+            memo[src] = resolve(src) if resolve else _relativized_src(src, target_dir, original_assets_dir)
+        return f'src="{memo[src]}"' if memo[src] else m.group(0)
+    return _SRC_ATTR_RE.sub(repl, body_html)
+
+def build_prompt(body_html: str) -> str:
+    return f"{PROMPT_TEXT}\n\n<BEGIN_HTML>\n{body_html}\n</END_HTML>\n"
 
 def package_for_ai(body_html: str, assets_dir: str, work_dir: str) -> str:
     body_html = relativize_img_src_to_folder(body_html, work_dir, assets_dir)
-    return f"{PROMPT_TEXT}\n\n<BEGIN_HTML>\n{body_html}\n</END_HTML>\n"
+    return build_prompt(body_html)
+
+# ---------- Batch image store ----------
+# One blob per unique image per batch, hardlinked into work dirs; ImageIndex resolves src values.
+IMAGE_HASH_CHUNK = 1024 * 1024
+_DATA_URI_RE = re.compile(r'(?i)^data:')
+_DRIVE_PATH_RE = re.compile(r'(?i)^[A-Za-z]:')
+
+def _path_key(p: str) -> str:
+    return os.path.normcase(norm_path(p))
+
+def new_image_stats() -> dict:
+    # syscalls counts the filesystem calls the staging code makes (scandir, stat, open, link, copy)
+    return {"files": 0, "unique": 0, "bytes_hashed": 0, "bytes_copied": 0, "links": 0, "syscalls": 0}
+
+class ImageIndex:
+    # src -> file name in one document's work dir
+    def __init__(self, store, work_dir: str, assets_dir: str, stats: dict):
+        self.store = store
+        self.work_dir = work_dir
+        self.assets_dir = assets_dir or ""
+        self.stats = stats
+        self.names = {}
+        self.paths = {}
+
+    def add(self, name: str, source_path: str = ""):
+        self.names.setdefault(os.path.normcase(name), name)
+        self.paths[_path_key(os.path.join(self.work_dir, name))] = name
+        if source_path:
+            self.paths[_path_key(source_path)] = name
+
+    def _local_path(self, src: str):
+        if _DRIVE_PATH_RE.match(src) or os.path.isabs(src):
+            return src
+        if src.startswith("file:///"):
+            return src.replace("file:///", "").replace("/", os.sep)
+        return None
+
+    def resolve(self, src: str):
+        if not src or _DATA_URI_RE.match(src):
+            return None
+        local = self._local_path(src)
+        if local is None:
+            for cand in (src, urllib.parse.unquote(src)):
+                for base in (self.assets_dir, self.work_dir):
+                    name = self.paths.get(_path_key(os.path.join(base, cand)))
+                    if name:
+                        return name
+                name = self.names.get(os.path.normcase(os.path.basename(cand.replace("/", os.sep))))
+                if name:
+                    return name
+            return None
+        name = self.paths.get(_path_key(local))
+        if name:
+            return name
+        # Linked picture outside the export folder: stage it once like the others
+        return self.store.stage_file(self, local)
+
+class ImageStore:
+    def __init__(self, root: str = ""):
+        self.owned = not root
+        self.root = root or tempfile.mkdtemp(prefix="ADA_images_")
+        self.lock = threading.Lock()
+        self.blobs = {}          # sha256 -> blob path
+        self.hashed = {}         # (path key, size, mtime_ns) -> sha256
+        self.totals = new_image_stats()
+
+    def _hash(self, path: str, stats: dict) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(IMAGE_HASH_CHUNK), b""):
+                h.update(chunk)
+        stats["syscalls"] += 1
+        return h.hexdigest()
+
+    def _place(self, src: str, dst: str, size: int, stats: dict):
+        # Hardlink when the filesystem allows it, otherwise one copy
+        for _ in range(2):
+            stats["syscalls"] += 1
+            try:
+                os.link(src, dst)
+                stats["links"] += 1
+                return
+            except FileExistsError:
+                stats["syscalls"] += 1
+                os.remove(dst)
+            except OSError:
+                break
+        stats["syscalls"] += 1
+        shutil.copyfile(src, dst)
+        stats["bytes_copied"] += size
+
+    def _blob(self, path: str, size: int, mtime_ns: int, stats: dict) -> str:
+        key = (_path_key(path), size, mtime_ns)
+        sha = self.hashed.get(key)
+        if sha is None:
+            sha = self._hash(path, stats)
+            stats["bytes_hashed"] += size
+            self.hashed[key] = sha
+        blob = self.blobs.get(sha)
+        if blob is None:
+            blob = os.path.join(self.root, sha[:2], sha + os.path.splitext(path)[1].lower())
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            stats["syscalls"] += 1
+            self._place(path, blob, size, stats)
+            self.blobs[sha] = blob
+            stats["unique"] += 1
+        return blob
+
+    def stage(self, assets_dir: str, work_dir: str) -> ImageIndex:
+        stats = new_image_stats()
+        index = ImageIndex(self, work_dir, assets_dir, stats)
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            stats["syscalls"] += 1
+            entries = list(os.scandir(assets_dir)) if assets_dir and os.path.isdir(assets_dir) else []
+        except OSError:
+            entries = []
+        with self.lock:
+            for e in entries:
+                try:
+                    if not e.is_file():
+                        continue
+                    st = e.stat()
+                    stats["syscalls"] += 1
+                    blob = self._blob(e.path, st.st_size, st.st_mtime_ns, stats)
+                    self._place(blob, os.path.join(work_dir, e.name), st.st_size, stats)
+                    stats["files"] += 1
+                    index.add(e.name, e.path)
+                except OSError:
+                    pass
+            self._add_totals(stats)
+        return index
+
+    def stage_file(self, index: ImageIndex, path: str):
+        with self.lock:
+            stats = new_image_stats()
+            try:
+                stats["syscalls"] += 1
+                st = os.stat(path)
+                blob = self._blob(path, st.st_size, st.st_mtime_ns, stats)
+                name = os.path.basename(path)
+                self._place(blob, os.path.join(index.work_dir, name), st.st_size, stats)
+                stats["files"] += 1
+            except OSError:
+                name = None
+            for k, v in stats.items():
+                index.stats[k] += v
+            self._add_totals(stats)
+        if name:
+            index.add(name, path)
+        return name
+
+    def index_existing(self, work_dir: str, assets_dir: str) -> ImageIndex:
+        # A resumed document: its work dir was staged by an earlier run
+        index = ImageIndex(self, work_dir, assets_dir, new_image_stats())
+        try:
+            index.stats["syscalls"] += 1
+            for e in os.scandir(work_dir):
+                index.add(e.name)
+        except OSError:
+            pass
+        return index
+
+    def _add_totals(self, stats: dict):
+        for k, v in stats.items():
+            self.totals[k] += v
+
+    def summary(self) -> str:
+        t = self.totals
+        return (f"Images: {t['files']} staged, {len(self.blobs)} unique, {t['bytes_copied'] / 1e6:.1f} MB copied, "
+                f"{t['links']} hardlinks, {t['syscalls']} filesystem calls")
+
+    def close(self):
+        if self.owned:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+def image_stats_line(stats: dict) -> str:
+    return (f"Images: {stats['files']} ({stats['unique']} new), {stats['bytes_copied'] / 1e3:.0f} KB copied, "
+            f"{stats['links']} hardlinks, {stats['syscalls']} filesystem calls")
 
 # ---------- Post-AI cleanup ----------
 _PROMPT_SIGNS = [
@@ -326,116 +751,378 @@ _PROMPT_SIGNS = [
     "structure and mapping", "list detection", "self-check"
 ]
 
-def strip_leaked_prompt_from_html(ai_html: str) -> str:
+def _find_existing_src(src: str, work_dir: str, original_assets_dir: str):
+    if re.match(r'(?i)^data:', src):
+        return None
+    if re.match(r'(?i)^[A-Za-z]:', src) and os.path.isfile(src):
+        return src
+    if src.startswith("file:///"):
+        p = src.replace("file:///", "").replace("/", "\\")
+        if os.path.isfile(p):
+            return p
+    cand = norm_path(os.path.join(work_dir, src))
+    if os.path.isfile(cand):
+        return cand
+    cand2 = norm_path(os.path.join(original_assets_dir, src))
+    if os.path.isfile(cand2):
+        return cand2
+    b = os.path.basename(src)
+    for root in (work_dir, original_assets_dir):
+        hit = norm_path(os.path.join(root, b))
+        if os.path.isfile(hit):
+            return hit
+    return None
+
+def _rebased_src(src: str, work_dir: str, original_assets_dir: str):
+    found = _find_existing_src(src, work_dir, original_assets_dir)
+    if not found:
+        return None
+    fname = os.path.basename(found)
+    dst = os.path.join(work_dir, fname)
     try:
-        m = re.search(r'(?is)<body[^>]*>(.*)</body>', ai_html)
-        if not m:
-            return ai_html
-        body = m.group(1)
-        h1m = re.search(r'(?is)<h1\b', body)
-        if h1m:
-            prefix = body[:h1m.start()]
-            if any(sig in prefix.lower() for sig in _PROMPT_SIGNS):
-                body = body[h1m.start():]
-        for sig in _PROMPT_SIGNS:
-            rx = re.compile(rf'(?is)<(p|li)[^>]*>[^<]*{re.escape(sig)}[^<]*</\1>')
-            body = rx.sub("", body)
-        body = re.sub(r'(?is)^\s*(<ul>.*?</ul>\s*)+', "", body)
-        return re.sub(r'(?is)(<body[^>]*>).*?(</body>)', rf"\1{body}\2", ai_html)
+        if norm_path(found) != norm_path(dst):
+            shutil.copy2(found, dst)
     except Exception:
-        return ai_html
+        pass
+    return fname
 
-def rebase_img_src_to_existing(ai_html: str, work_dir: str, original_assets_dir: str) -> str:
-    def find_existing(src: str):
-        if re.match(r'(?i)^data:', src):
-            return None
-        if re.match(r'(?i)^[A-Za-z]:', src) and os.path.isfile(src):
-            return src
-        if src.startswith("file:///"):
-            p = src.replace("file:///", "").replace("/", "\\")
-            if os.path.isfile(p):
-                return p
-        cand = norm_path(os.path.join(work_dir, src))
-        if os.path.isfile(cand):
-            return cand
-        cand2 = norm_path(os.path.join(original_assets_dir, src))
-        if os.path.isfile(cand2):
-            return cand2
-        b = os.path.basename(src)
-        for root in (work_dir, original_assets_dir):
-            hit = norm_path(os.path.join(root, b))
-            if os.path.isfile(hit):
-                return hit
-        return None
-    def repl(m):
+_IMG_SRC_RE = re.compile(r'(?is)<img[^>]+src="([^"]+)"')
+
+# ---------- Streaming HTML transforms ----------
+# Markup is tokenized once (linear scan, chunked input allowed); each transform is a stage
+HT_TEXT, HT_START, HT_END, HT_COMMENT, HT_OTHER = range(5)
+_HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+
+_TAG_START_RE = re.compile(r'<(?:!--|[A-Za-z/!?])')
+_TAG_NAME_RE = re.compile(r'</?\s*([A-Za-z][^\s/>]*)')
+_RAWTEXT_END_RE = {
+    "style": re.compile(r'(?i)</style'),
+    "script": re.compile(r'(?i)</script'),
+}
+_BULLETED_CLASS_RE = re.compile(r'(?is)\bclass\s*=\s*["\'][^"\']*\bBulletedList\b')
+HTML_CHUNK_SIZE = 1024 * 1024
+
+def iter_html_tokens(source):
+    # Yields (kind, raw, lowercase tag name); "".join(raw) reproduces the input exactly
+    chunks = (source,) if isinstance(source, str) else source
+    it = iter(chunks)
+    buf = ""
+    raw_end = None
+    final = False
+    while not final:
+        chunk = next(it, None)
+        if chunk is None:
+            final = True
+        else:
+            buf += chunk
+        pos = 0
+        n = len(buf)
+        while pos < n:
+            if raw_end is not None:
+                m = raw_end.search(buf, pos)
+                if m is None:
+                    break
+                if m.start() > pos:
+                    yield (HT_TEXT, buf[pos:m.start()], "")
+                pos = m.start()
+                raw_end = None
+            m = _TAG_START_RE.search(buf, pos)
+            if m is None:
+                break
+            if m.start() > pos:
+                yield (HT_TEXT, buf[pos:m.start()], "")
+                pos = m.start()
+            if buf.startswith("<!--", pos):
+                end = buf.find("-->", pos + 4)
+                if end == -1:
+                    break
+                yield (HT_COMMENT, buf[pos:end + 3], "")
+                pos = end + 3
+                continue
+            if not final and pos + 4 > n and "<!--".startswith(buf[pos:]):
+                break
+            end = buf.find(">", pos)
+            if end == -1:
+                break
+            raw = buf[pos:end + 1]
+            pos = end + 1
+            c = raw[1]
+            if c in "!?":
+                yield (HT_OTHER, raw, "")
+                continue
+            nm = _TAG_NAME_RE.match(raw)
+            name = nm.group(1).lower() if nm else ""
+            if c == "/":
+                yield (HT_END, raw, name)
+            else:
+                yield (HT_START, raw, name)
+                raw_end = _RAWTEXT_END_RE.get(name)
+        if final:
+            if pos < n:
+                yield (HT_TEXT, buf[pos:], "")
+            return
+        buf = buf[pos:]
+
+def iter_file_chunks(path: str, size: int = HTML_CHUNK_SIZE):
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+class HtmlStage:
+    # feed() receives one token and passes zero or more tokens on through self.emit
+    emit = None
+
+    def feed(self, tok):
+        self.emit(tok)
+
+    def close(self):
+        pass
+
+def run_html_stages(source, stages) -> str:
+    out = []
+    emit = lambda tok: out.append(tok[1])
+    for st in reversed(stages):
+        st.emit = emit
+        emit = st.feed
+    for tok in iter_html_tokens(source):
+        emit(tok)
+    for st in stages:
+        st.close()
+    return "".join(out)
+
+class SrcRewriteStage(HtmlStage):
+    # Applies a src= rewrite to start tags only; resolved names are memoized per document
+    def __init__(self, pattern, resolve, tag=None):
+        self.pattern = pattern
+        self.resolve = resolve
+        self.tag = tag
+        self.memo = {}
+
+    def _lookup(self, src):
+        if src not in self.memo:
+            self.memo[src] = self.resolve(src)
+        return self.memo[src]
+
+    def feed(self, tok):
+        if tok[0] == HT_START and (self.tag is None or tok[2] == self.tag) and 'src="' in tok[1].lower():
+            raw = self.pattern.sub(self._repl, tok[1])
+            if raw != tok[1]:
+                tok = (HT_START, raw, tok[2])
+        self.emit(tok)
+
+class RebaseImgStage(SrcRewriteStage):
+    def __init__(self, work_dir: str, original_assets_dir: str, resolve=None):
+        super().__init__(_IMG_SRC_RE, resolve or (lambda src: _rebased_src(src, work_dir, original_assets_dir)),
+                         tag="img")
+
+    def _repl(self, m):
         raw = m.group(0)
         src = m.group(1).strip()
-        found = find_existing(src)
-        if not found:
-            return raw
-        fname = os.path.basename(found)
-        dst = os.path.join(work_dir, fname)
-        try:
-            if norm_path(found) != norm_path(dst):
-                shutil.copy2(found, dst)
-        except Exception:
-            pass
-        return raw.replace(src, fname)
-    return re.sub(r'(?is)<img[^>]+src="([^"]+)"', repl, ai_html)
+        fname = self._lookup(src)
+        return raw.replace(src, fname) if fname else raw
 
-# ---------- HTML preprocessing ----------
-_LI_SINGLE_P_NOT_BULLET_RE = re.compile(
-    r'(?is)<li>\s*<p(?![^>]*\bclass\s*=\s*["\'][^"\']*\bBulletedList\b)[^>]*>(.*?)</p>\s*</li>'
-)
+class _PromptSignFilter:
+    # Drops text-only <p>/<li> elements mentioning one prompt sign; chaining one filter per
+    # sign reproduces the sequential re.sub passes (a removal can expose its parent).
+    def __init__(self, sign, emit):
+        self.sign = sign
+        self.emit = emit
+        self.held = []
 
-def preprocess_html_for_word(html_in: str) -> str:
-    try:
-        return _LI_SINGLE_P_NOT_BULLET_RE.sub(r"<li>\1</li>", html_in)
-    except Exception:
-        return html_in
+    def feed(self, tok):
+        kind, raw, name = tok
+        held = self.held
+        if held:
+            if kind == HT_TEXT and "<" not in raw:
+                held.append(tok)
+                return
+            if (kind == HT_END and len(held) > 1 and name == held[0][2] and raw.lower() == f"</{name}>"
+                    and self.sign in "".join(t[1] for t in held[1:]).lower()):
+                self.held = []
+                return
+            self.flush()
+        if kind == HT_START and name in ("p", "li"):
+            self.held = [tok]
+            return
+        self.emit(tok)
 
-# ---------- Post-import fixes ----------
-def flatten_image_only_tables(doc_out):
-    try:
-        for i in range(doc_out.Tables.Count, 0, -1):
-            t = doc_out.Tables(i)
-            try:
-                if t.Rows.Count != 1 or t.Columns.Count != 1:
-                    continue
-                cell_rng = t.Cell(1, 1).Range
-                txt = cell_rng.Text.replace("\r", "").replace("\x07", "").strip()
-                has_text = bool(txt)
-                has_pics = (cell_rng.InlineShapes.Count > 0) or (cell_rng.Shapes.Count > 0)
-                if not has_pics or has_text:
-                    continue
-                after_rng = t.Range
-                after_rng.Collapse(0)
-                for n in range(cell_rng.Shapes.Count, 0, -1):
-                    shp = cell_rng.Shapes(n)
-                    try:
-                        ish = shp.ConvertToInlineShape()
-                        ish.Range.Cut()
-                        with_retry(after_rng.Paste)
-                        after_rng.Collapse(0)
-                    except Exception:
-                        pass
-                for n in range(cell_rng.InlineShapes.Count, 0, -1):
-                    ish = cell_rng.InlineShapes(n)
-                    try:
-                        ish.Range.Cut()
-                        with_retry(after_rng.Paste)
-                        after_rng.Collapse(0)
-                    except Exception:
-                        pass
-                t.Delete()
-            except Exception:
-                pass
-    except Exception:
-        pass
+    def flush(self):
+        held, self.held = self.held, []
+        for t in held:
+            self.emit(t)
+
+class StripLeakedPromptStage(HtmlStage):
+    # Drops a pre-<h1> prefix that quotes the prompt, text-only <p>/<li> elements that
+    # quote it, and leading bare <ul> blocks.
+    def __init__(self, signs=None):
+        self.signs = tuple(_PROMPT_SIGNS if signs is None else signs)
+        self.state = "head"
+        self.prefix = []
+        self.lead = True
+        self.lead_ws = []
+        self.ul_buf = None
+        self.removed_ul = False
+        self.filters = []
+        emit = self._lead
+        for sig in reversed(self.signs):
+            f = _PromptSignFilter(sig, emit)
+            self.filters.insert(0, f)
+            emit = f.feed
+        self._filter = emit
+
+    def feed(self, tok):
+        kind, name = tok[0], tok[2]
+        if self.state == "head":
+            self.emit(tok)
+            if kind == HT_START and name == "body":
+                self.state = "prefix"
+            return
+        if self.state == "after":
+            self.emit(tok)
+            return
+        if kind == HT_END and name == "body":
+            self._finish_body()
+            self.state = "after"
+            self.emit(tok)
+            return
+        if self.state == "prefix":
+            if kind == HT_START and name == "h1":
+                low = "".join(t[1] for t in self.prefix).lower()
+                prefix, self.prefix = self.prefix, []
+                if not any(sig in low for sig in self.signs):
+                    for t in prefix:
+                        self._filter(t)
+                self.state = "body"
+                self._filter(tok)
+            else:
+                self.prefix.append(tok)
+            return
+        self._filter(tok)
+
+    def _lead(self, tok):
+        if not self.lead:
+            self.emit(tok)
+            return
+        kind, raw = tok[0], tok[1]
+        if self.ul_buf is not None:
+            self.ul_buf.append(tok)
+            if kind == HT_END and raw.lower() == "</ul>":
+                self.ul_buf = None
+                self.lead_ws = []
+                self.removed_ul = True
+            return
+        if kind == HT_TEXT and not raw.strip():
+            self.lead_ws.append(tok)
+            return
+        if kind == HT_START and raw.lower() == "<ul>":
+            self.ul_buf = [tok]
+            return
+        self.lead = False
+        if kind == HT_TEXT and self.removed_ul:
+            tok = (HT_TEXT, raw.lstrip(), "")
+        elif not self.removed_ul:
+            for t in self.lead_ws:
+                self.emit(t)
+        self.lead_ws = []
+        self.emit(tok)
+
+    def _finish_body(self):
+        if self.state == "prefix":
+            prefix, self.prefix = self.prefix, []
+            for t in prefix:
+                self._filter(t)
+        for f in self.filters:
+            f.flush()
+        if self.lead:
+            if not self.removed_ul:
+                for t in self.lead_ws:
+                    self.emit(t)
+            for t in self.ul_buf or ():
+                self.emit(t)
+            self.lead = False
+            self.lead_ws = []
+            self.ul_buf = None
+
+    def close(self):
+        if self.state in ("prefix", "body"):
+            self._finish_body()
+            self.state = "after"
+
+def leaked_prompt_stage(ai_html: str) -> StripLeakedPromptStage:
+    # A filter per sign costs a call per token, so only the signs the reply contains get one
+    low = ai_html.lower()
+    return StripLeakedPromptStage([sig for sig in _PROMPT_SIGNS if sig in low])
+
+class UnwrapListParagraphStage(HtmlStage):
+    # <li><p>…</p></li> -> <li>…</li> unless the paragraph is class="BulletedList"
+    def __init__(self):
+        self.state = 0
+        self.held = []
+        self.inner = []
+
+    def _release(self):
+        held = self.held
+        self.state, self.held, self.inner = 0, [], []
+        for t in held:
+            self.emit(t)
+
+    def feed(self, tok):
+        kind, raw, name = tok
+        state = self.state
+        if state == 0:
+            if kind == HT_START and raw.lower() == "<li>":
+                self.state, self.held = 1, [tok]
+            else:
+                self.emit(tok)
+            return
+        if state == 1:
+            if kind == HT_TEXT and not raw.strip():
+                self.held.append(tok)
+                return
+            if kind == HT_START and name == "p" and not _BULLETED_CLASS_RE.search(raw):
+                self.state = 2
+                self.held.append(tok)
+                return
+        elif state == 2:
+            if kind == HT_END and raw.lower() == "</p>":
+                self.state = 3
+                self.held.append(tok)
+                return
+            if not (kind == HT_START and name in ("p", "li")):
+                self.held.append(tok)
+                self.inner.append(tok)
+                return
+        elif state == 3:
+            if kind == HT_TEXT and not raw.strip():
+                self.held.append(tok)
+                return
+            if kind == HT_END and raw.lower() == "</li>":
+                inner = self.inner
+                self.state, self.held, self.inner = 0, [], []
+                self.emit((HT_START, "<li>", "li"))
+                for t in inner:
+                    self.emit(t)
+                self.emit((HT_END, "</li>", "li"))
+                return
+        self._release()
+        self.feed(tok)
+
+    def close(self):
+        self._release()
 
+# Lists and paragraph styles are set in the markup, so Word imports them finished.
 _BULLET_CHARS = "\u2022•\u00B7-"
 _BULLET_RE = re.compile(r'^\s*([%s])\s+' % re.escape(_BULLET_CHARS))
 _NUMBER_RE = re.compile(r'^\s*((\(?\d+[\.\)])|([A-Za-z][\.\)]))\s+')
+_CLASS_ATTR_RE = re.compile(r'(?is)\sclass\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)')
+_MARKER_START_RE = re.compile(r'\(?(\d+|[A-Za-z])')
+_LIST_ITEM_BLOCKS = ("p", "div", "table", "ul", "ol") + _HEADING_TAGS
+_PARA_BREAKS = _LIST_ITEM_BLOCKS + ("li", "body", "tr", "td", "th")
+_TABLE_CELLS = ("td", "th")
+_INLINE_FORMATTING = ("b", "strong", "i", "em", "u", "s", "strike", "span", "font", "sup", "sub", "small", "big")
 
 def _classify_marker(text: str):
     t = text.rstrip("\r\n")
@@ -447,115 +1134,918 @@ def _classify_marker(text: str):
         return "numbered", len(m.group(0))
     return None, 0
 
-def enforce_lists(doc_out):
-    try:
-        i = 1
-        while i <= doc_out.Paragraphs.Count:
-            p = doc_out.Paragraphs(i)
-            try:
-                lt = p.Range.ListFormat.ListType
-                if lt in (WD_LIST_BULLET, WD_LIST_NUMBERED):
-                    i += 1
-                    continue
-            except Exception:
-                pass
-            text = p.Range.Text
-            kind, prelen = _classify_marker(text)
-            if not kind:
-                i += 1
+def _with_class(tok, cls: str, replace: bool = True):
+    kind, raw, name = tok
+    if _CLASS_ATTR_RE.search(raw):
+        if not replace:
+            return tok
+        raw = _CLASS_ATTR_RE.sub(f' class="{cls}"', raw, count=1)
+    else:
+        end = len(raw) - 2 if raw.endswith("/>") else len(raw) - 1
+        raw = f'{raw[:end]} class="{cls}"{raw[end:]}'
+    return (kind, raw, name)
+
+def _strip_marker_tokens(tokens, n: int) -> list:
+    # Drops the first n characters of text (as the unescaped text counts them), then any
+    # formatting element that held only the marker (<b>&#8226;</b>)
+    out = []
+    for tok in tokens:
+        if n > 0 and tok[0] == HT_TEXT:
+            text = html.unescape(tok[1])
+            if len(text) <= n:
+                n -= len(text)
                 continue
-            start = i
-            j = i + 1
-            while j <= doc_out.Paragraphs.Count:
-                pj = doc_out.Paragraphs(j)
-                try:
-                    ltj = pj.Range.ListFormat.ListType
-                    if ltj in (WD_LIST_BULLET, WD_LIST_NUMBERED):
-                        break
-                except Exception:
-                    pass
-                kindj, _ = _classify_marker(pj.Range.Text)
-                if kindj != kind:
-                    break
-                j += 1
-            end = j - 1
-            for k in range(start, end + 1):
-                pk = doc_out.Paragraphs(k)
-                kindk, prelenk = _classify_marker(pk.Range.Text)
-                if kindk and prelenk > 0:
-                    try:
-                        del_range = doc_out.Range(Start=pk.Range.Start, End=pk.Range.Start + prelenk)
-                        del_range.Text = ""
-                    except Exception:
-                        pass
-            try:
-                grp = doc_out.Range(Start=doc_out.Paragraphs(start).Range.Start,
-                                    End=doc_out.Paragraphs(end).Range.End)
-                if kind == "bullet":
-                    with_retry(grp.ListFormat.ApplyBulletDefault)
-                else:
-                    with_retry(grp.ListFormat.ApplyNumberDefault)
-            except Exception:
-                pass
-            i = end + 1
-    except Exception:
-        pass
+            tok = (HT_TEXT, html.escape(text[n:], quote=False), "")
+            n = 0
+        if (tok[0] == HT_END and tok[2] in _INLINE_FORMATTING and out and out[-1][0] == HT_START
+                and out[-1][2] == tok[2]):
+            out.pop()
+            continue
+        out.append(tok)
+    return out
 
-def apply_bulleted_list_style(doc_out, style_name="Bulleted List"):
-    try:
-        s = doc_out.Styles(style_name)
-    except Exception:
-        return
-    for p in doc_out.Paragraphs:
-        try:
-            lt = p.Range.ListFormat.ListType
-            if lt == WD_LIST_BULLET:
-                p.Style = s
-        except Exception:
-            pass
+def _ol_start_tag(marker: str) -> str:
+    m = _MARKER_START_RE.match(marker.strip())
+    if not m:
+        return "<ol>"
+    v = m.group(1)
+    if v.isdigit():
+        return "<ol>" if int(v) == 1 else f'<ol start="{int(v)}">'
+    start = ord(v.lower()) - ord("a") + 1
+    attrs = f' type="{"a" if v.islower() else "A"}"'
+    return f'<ol{attrs}>' if start == 1 else f'<ol{attrs} start="{start}">'
 
-def ensure_numbered_list_paragraphs(doc_out):
-    try:
-        list_para = doc_out.Styles("List Paragraph")
-    except Exception:
-        try:
-            list_para = with_retry(doc_out.Styles.Add, "List Paragraph", WD_STYLE_TYPE_PARAGRAPH)
-        except Exception:
-            list_para = None
-    if list_para is None:
-        return
-    for p in doc_out.Paragraphs:
-        try:
-            lt = p.Range.ListFormat.ListType
-            if lt == WD_LIST_NUMBERED:
-                p.Style = list_para
-        except Exception:
-            pass
+class ListMarkerStage(HtmlStage):
+    def __init__(self):
+        self.para = None     # tokens of the <p> being read (outside lists)
+        self.group = []      # (marker, inner tokens) of the current run
+        self.kind = None
+        self.gap = []        # whitespace between paragraphs of the run
+        self.lists = []      # open <ul>/<ol>: [name, wrap pending, wrap open]
+        self.cells = 0       # open <td>/<th>; a dash in a table cell is not a list
+        self.counts = {"bullet": 0, "numbered": 0, "lists": 0}
 
-def ensure_normal_paragraphs(doc_out):
-    try:
-        normal_style = doc_out.Styles("Normal")
-    except Exception:
-        return
-    for p in doc_out.Paragraphs:
+    def feed(self, tok):
+        kind, raw, name = tok
+        if self.para is not None:
+            if kind == HT_END and name == "p":
+                self.para.append(tok)
+                self._end_para()
+                return
+            if not (kind == HT_START and name in _PARA_BREAKS) and not (kind == HT_END and name in _PARA_BREAKS):
+                self.para.append(tok)
+                return
+            self._end_para(closed=False)
+        if name in _TABLE_CELLS:
+            if kind == HT_START:
+                self.cells += 1
+            elif kind == HT_END and self.cells:
+                self.cells -= 1
+        if self.group:
+            if kind == HT_TEXT and not raw.strip():
+                self.gap.append(tok)
+                return
+            if not (kind == HT_START and name == "p"):
+                self._flush()
+        if kind == HT_START and name == "p" and not self.lists:
+            self.para = [tok]
+            return
+        self._list_token(tok)
+
+    def _end_para(self, closed=True):
+        para, self.para = self.para, None
+        text = html.unescape("".join(t[1] for t in para if t[0] == HT_TEXT))
+        kind, prelen = _classify_marker(text) if not self.cells else (None, 0)
+        if not kind:
+            self._flush()
+            self._emit_plain(para)
+            return
+        if self.group and kind != self.kind:
+            self._flush()
+        self.kind = kind
+        self.group.append((text[:prelen], _strip_marker_tokens(para[1:-1] if closed else para[1:], prelen)))
+        self.gap = []
+
+    def _emit_plain(self, para):
+        self.emit(_with_class(para[0], "MsoNormal", replace=False))
+        for t in para[1:]:
+            self.emit(t)
+
+    def _flush(self):
+        group, gap = self.group, self.gap
+        self.group, self.gap = [], []
+        if group:
+            self.counts[self.kind] += len(group)
+            self.counts["lists"] += 1
+            emit = self.emit
+            if self.kind == "bullet":
+                emit((HT_START, "<ul>", "ul"))
+                for _, inner in group:
+                    emit((HT_START, "<li>", "li"))
+                    emit((HT_START, '<p class="BulletedList">', "p"))
+                    for t in inner:
+                        emit(t)
+                    emit((HT_END, "</p>", "p"))
+                    emit((HT_END, "</li>", "li"))
+                emit((HT_END, "</ul>", "ul"))
+            else:
+                emit((HT_START, _ol_start_tag(group[0][0]), "ol"))
+                for _, inner in group:
+                    emit((HT_START, '<li class="MsoListParagraph">', "li"))
+                    for t in inner:
+                        emit(t)
+                    emit((HT_END, "</li>", "li"))
+                emit((HT_END, "</ol>", "ol"))
+        for t in gap:
+            self.emit(t)
+
+    def _close_wrap(self):
+        if self.lists and self.lists[-1][2]:
+            self.lists[-1][2] = False
+            self.emit((HT_END, "</p>", "p"))
+
+    def _list_token(self, tok):
+        kind, raw, name = tok
+        if name in ("ul", "ol") and kind in (HT_START, HT_END):
+            self._close_wrap()
+            if kind == HT_START:
+                self.lists.append([name, False, False])
+            elif self.lists:
+                self.lists.pop()
+            self.emit(tok)
+            return
+        if self.lists:
+            top = self.lists[-1]
+            if name == "li" and kind in (HT_START, HT_END):
+                self._close_wrap()
+                top[1] = kind == HT_START and top[0] == "ul"
+                if kind == HT_START and top[0] == "ol":
+                    tok = _with_class(tok, "MsoListParagraph", replace=False)
+                self.emit(tok)
+                return
+            if top[1]:
+                if kind == HT_TEXT and not raw.strip():
+                    self.emit(tok)
+                    return
+                top[1] = False
+                if kind == HT_START and name == "p":
+                    self.emit(_with_class(tok, "BulletedList"))
+                    return
+                if not (kind == HT_START and name in _LIST_ITEM_BLOCKS):
+                    self.emit((HT_START, '<p class="BulletedList">', "p"))
+                    top[2] = True
+            elif top[2] and kind in (HT_START, HT_END) and name in _LIST_ITEM_BLOCKS:
+                self._close_wrap()
+        self.emit(tok)
+
+    def close(self):
+        if self.para is not None:
+            self._end_para(closed=False)
+        self._flush()
+        while self.lists:
+            self._close_wrap()
+            self.lists.pop()
+
+def extract_body_for_ai(source: str, target_dir: str = "", original_assets_dir: str = "", images=None,
+                        minimizer=None, scorer=None) -> str:
+    # extract_relevant_html_for_ai, then relativize_img_src_to_folder when target_dir is set (src
+    # values resolve through images, an ImageIndex, when given). Only the body is tokenized, and
+    # only for a ComplexityStage (scorer) or a MinimizeForAiStage, which see the relativized tags.
+    body = extract_relevant_html_for_ai(source)
+    if target_dir:
+        body = relativize_img_src_to_folder(body, target_dir, original_assets_dir, images.resolve if images else None)
+    stages = [st for st in (scorer, minimizer) if st is not None]
+    return run_html_stages(body, stages).strip() if stages else body
+
+def clean_ai_html(ai_html: str, work_dir: str, original_assets_dir: str, strip_prompt: bool = True,
+                  images=None, placeholders=None, staged=None) -> str:
+    # One pass: leaked prompt, image rebase, <li><p> unwrap, then the list/style mapping Word used
+    # to do after the import. placeholders are the original image tags from MinimizeForAiStage;
+    # they go back in before the rebase. staged: src -> resolved name for the images already
+    # staged while the reply streamed.
+    stages = [leaked_prompt_stage(ai_html)] if strip_prompt else []
+    if placeholders:
+        stages.append(RestorePlaceholderStage(placeholders))
+    rebase = RebaseImgStage(work_dir, original_assets_dir, images.resolve if images else None)
+    if staged:
+        rebase.memo.update(staged)
+    stages += [rebase, UnwrapListParagraphStage(), ListMarkerStage()]
+    return run_html_stages(ai_html, stages)
+
+# ---------- Prompt minimizer ----------
+# Drops formatting the prompt discards and swaps images for placeholders; ADA_PROMPT_MINIMIZE=0 skips it.
+PROMPT_MINIMIZE = os.environ.get("ADA_PROMPT_MINIMIZE", "1").strip().lower() not in ("0", "false", "no", "off")
+PLACEHOLDER_PREFIX = "ada-img-"
+_PLACEHOLDER_RE = re.compile(r'(?i)\bsrc\s*=\s*["\']?ada-img-(\d+)')
+_IMG_TAG_RE = re.compile(r'(?is)<img\b[^>]*>')
+_MIN_DROP_ATTRS = ("style", "lang", "clear")
+_MIN_TABLE_TAGS = ("table", "tr", "td", "th", "col", "colgroup", "thead", "tbody")
+_MIN_TABLE_ATTRS = ("width", "height", "valign", "border", "cellspacing", "cellpadding", "nowrap", "bgcolor")
+
+def _minimized_class(value: str) -> str:
+    # Word's own Mso* classes go except the list and title ones the model (and the local
+    # converter) read as hints; custom style names (Note, ...) stay
+    return " ".join(c for c in value.split()
+                    if not c.lower().startswith("mso") or "list" in c.lower() or "title" in c.lower())
+
+def minimize_tag(raw: str, name: str) -> str:
+    nm = _TAG_NAME_RE.match(raw)
+    if nm is None or nm.end() >= len(raw) - 1:
+        return raw
+    kept = []
+    for m in _HTML_ATTR_RE.finditer(raw, nm.end()):
+        attr = m.group(1).lower()
+        if attr in _MIN_DROP_ATTRS or ":" in attr or (name in _MIN_TABLE_TAGS and attr in _MIN_TABLE_ATTRS):
+            continue
+        if attr == "class":
+            v = m.group(2)
+            v = _minimized_class(v[1:-1] if v[:1] in "\"'" else v)
+            if v:
+                kept.append(f'class="{v}"' if " " in v else f"class={v}")
+            continue
+        kept.append(m.group(0))
+    return "<" + nm.group(1) + "".join(" " + a for a in kept) + ("/>" if raw.endswith("/>") else ">")
+
+class MinimizeForAiStage(HtmlStage):
+    # Strips formatting from body tokens, drops attribute-less <span>s and Office-namespace
+    # tags (o:p, ...) and swaps each image for a placeholder; placeholders[n] is the original
+    # markup behind src="ada-img-n". Counts bytes in and out for the savings report.
+    def __init__(self):
+        self.placeholders = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.capture = None
+        self.depth = 0
+        self.spans = []
+
+    def _out(self, tok):
+        self.bytes_out += len(tok[1])
+        self.emit(tok)
+
+    def _placeholder(self, markup: str):
+        self._out((HT_START, f'<img src="{PLACEHOLDER_PREFIX}{len(self.placeholders)}">', "img"))
+        self.placeholders.append(markup)
+
+    def feed(self, tok):
+        kind, raw, name = tok
+        self.bytes_in += len(raw)
+        if self.capture is not None:
+            self.capture.append(raw)
+            if name.startswith("v:"):
+                if kind == HT_START and not raw.endswith("/>"):
+                    self.depth += 1
+                elif kind == HT_END:
+                    self.depth -= 1
+            if self.depth == 0:
+                markup, self.capture = "".join(self.capture), None
+                self._placeholder(markup)
+            return
+        if kind == HT_OTHER:
+            return
+        if kind == HT_START:
+            if name == "img":
+                self._placeholder(raw)
+                return
+            if name.startswith("v:"):
+                if raw.endswith("/>"):
+                    self._placeholder(raw)
+                else:
+                    self.capture = [raw]
+                    self.depth = 1
+                return
+            if ":" in name:
+                return
+            raw = minimize_tag(raw, name)
+            if name == "span":
+                keep = raw.lower() != "<span>"
+                self.spans.append(keep)
+                if not keep:
+                    return
+            self._out((kind, raw, name))
+            return
+        if kind == HT_END:
+            if ":" in name:
+                return
+            if name == "span" and self.spans and not self.spans.pop():
+                return
+        self._out(tok)
+
+    def close(self):
+        if self.capture is not None:
+            markup, self.capture = "".join(self.capture), None
+            self._placeholder(markup)
+
+    def stats(self) -> dict:
+        return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out, "images": len(self.placeholders),
+                "tokens_in": self.bytes_in // CHUNK_CHARS_PER_TOKEN,
+                "tokens_out": self.bytes_out // CHUNK_CHARS_PER_TOKEN}
+
+class RestorePlaceholderStage(HtmlStage):
+    # Each placeholder <img> the model returned becomes the original markup again, as tokens,
+    # so the src rebase after it sees real image tags
+    def __init__(self, placeholders):
+        self.placeholders = placeholders
+        self.restored = set()
+
+    def feed(self, tok):
+        if tok[0] == HT_START and tok[2] == "img":
+            m = _PLACEHOLDER_RE.search(tok[1])
+            if m and int(m.group(1)) < len(self.placeholders):
+                n = int(m.group(1))
+                self.restored.add(n)
+                for t in iter_html_tokens(self.placeholders[n]):
+                    self.emit(t)
+                return
+        self.emit(tok)
+
+    def close(self):
+        lost = len(self.placeholders) - len(self.restored)
+        if lost > 0:
+            trace_count("placeholders_lost", lost)
+
+def minimize_stats_line(stats: dict) -> str:
+    saved = stats["bytes_in"] - stats["bytes_out"]
+    pct = 100 * saved / stats["bytes_in"] if stats["bytes_in"] else 0
+    return (f"Prompt minimized: {stats['bytes_in'] // 1024} KB -> {stats['bytes_out'] // 1024} KB "
+            f"(-{pct:.0f}%, ~{stats['tokens_in'] - stats['tokens_out']} tokens), "
+            f"{stats['images']} image(s) held back.")
+
+# ---------- Local conversion ----------
+# Simple documents are converted here and only hard ones go to the AI (ADA_ROUTE=auto, ai or local).
+AI_ROUTE = os.environ.get("ADA_ROUTE", "auto").strip().lower()
+ROUTE_HARD_FEATURES = ("text_tables", "nested_lists", "preformatted", "embedded")
+_EMBED_TAGS = ("iframe", "object", "embed", "form", "input", "select", "textarea", "svg", "math", "frameset")
+_PRE_TAGS = ("pre", "xmp", "listing", "code")
+_LIST_LEVEL_RE = re.compile(r'(?i)\blevel(\d)|margin-left:\s*(\d*\.?\d+)in')
+
+class ComplexityStage(HtmlStage):
+    # Pass-through counter of what the local rules can't convert; sees the export's own
+    # attributes, so it runs ahead of MinimizeForAiStage
+    def __init__(self):
+        self.features = {"headings": 0, "paragraphs": 0, "image_tables": 0, "text_tables": 0,
+                         "nested_lists": 0, "preformatted": 0, "embedded": 0}
+        self.table_depth = 0
+        self.table_text = False
+        self.table_img = False
+        self.list_depth = 0
+
+    def feed(self, tok):
+        kind, raw, name = tok
+        f = self.features
+        if kind == HT_START:
+            if name == "table":
+                if self.table_depth == 0:
+                    self.table_text = self.table_img = False
+                self.table_depth += 1
+            elif name in ("ul", "ol"):
+                self.list_depth += 1
+                if self.list_depth > 1:
+                    f["nested_lists"] += 1
+            elif name == "p":
+                f["paragraphs"] += 1
+                if "list" in raw.lower() and self._nested(raw):
+                    f["nested_lists"] += 1
+            elif name in _HEADING_TAGS:
+                f["headings"] += 1
+            elif name in _PRE_TAGS:
+                f["preformatted"] += 1
+            elif name in _EMBED_TAGS:
+                f["embedded"] += 1
+            elif name == "img" or name.startswith("v:"):
+                self.table_img = self.table_img or self.table_depth > 0
+        elif kind == HT_END:
+            if name == "table" and self.table_depth:
+                self.table_depth -= 1
+                if self.table_depth == 0:
+                    f["image_tables" if self.table_img and not self.table_text else "text_tables"] += 1
+            elif name in ("ul", "ol") and self.list_depth:
+                self.list_depth -= 1
+        elif kind == HT_TEXT and self.table_depth and not self.table_text:
+            self.table_text = bool(re.sub(r'&nbsp;|\s', "", raw))
+        self.emit(tok)
+
+    @staticmethod
+    def _nested(raw: str) -> bool:
+        # Word writes list level 2+ as mso-list levelN, or (filtered) as a deeper margin
+        for m in _LIST_LEVEL_RE.finditer(raw):
+            if (m.group(1) and int(m.group(1)) > 1) or (m.group(2) and float(m.group(2)) >= 0.75):
+                return True
+        return False
+
+def choose_route(features) -> str:
+    if AI_ROUTE in ("ai", "local"):
+        return AI_ROUTE
+    if not features or any(features.get(k) for k in ROUTE_HARD_FEATURES):
+        return "ai"
+    return "local"
+
+_LOCAL_TAGS = ("p", "ul", "ol", "li", "table", "thead", "tbody", "tfoot", "tr", "td", "th", "caption",
+               "blockquote", "br", "a", "strong", "em", "sup", "sub", "code")
+_LOCAL_INLINE = ("a", "strong", "em", "sup", "sub", "code", "span")
+_LOCAL_RENAME = {"b": "strong", "i": "em"}
+_LOCAL_ATTRS = {"a": ("href", "title"), "td": ("colspan", "rowspan"), "th": ("colspan", "rowspan"),
+                "ol": ("start", "type")}
+_LOCAL_CLASSES = ("Note", "BulletedList", "ClicksChar")
+_NOTE_RE = re.compile(r'(?is)^\s*((?:<(?:strong|em)>\s*)*)(Note|Warning)\s*:\s*((?:</(?:strong|em)>\s*)*)')
+
+class LocalConvertStage(HtmlStage):
+    # The PROMPT_TEXT rules on an extracted body: one <h1> title and no skipped heading
+    # levels, <b>/<i> -> <strong>/<em>, no styles or non-semantic classes, Note paragraphs,
+    # image-only tables unwrapped into plain <p>s. Typed bullets and numbers are left to
+    # ListMarkerStage, which clean_ai_html runs on every document anyway.
+    def __init__(self, title: str = ""):
+        self.fallback_title = title
+        self.title = None
+        self.title_text = None
+        self.level = 0
+        self.open = {}
+        self.para = None
+        self.para_start = "<p>"
+        self.table = None
+        self.table_depth = 0
+
+    def feed(self, tok):
+        kind, name = tok[0], tok[2]
+        if self.table is not None:
+            self.table.append(tok)
+            if kind == HT_START and name == "table":
+                self.table_depth += 1
+            elif kind == HT_END and name == "table":
+                self.table_depth -= 1
+                if self.table_depth == 0:
+                    self._end_table()
+            return
+        if kind == HT_START and name == "table":
+            self._end_para()
+            self.table = [tok]
+            self.table_depth = 1
+            return
+        self._convert(tok)
+
+    def _end_table(self):
+        table, self.table = self.table, None
+        text = any(t[0] == HT_TEXT and re.sub(r'&nbsp;|\s', "", t[1]) for t in table)
+        images = [t for t in table if t[0] == HT_START and t[2] == "img"]
+        if images and not text:
+            # Images never sit in layout tables: one plain paragraph each
+            for t in images:
+                self._out("<p>")
+                self._out(t[1])
+                self._out("</p>")
+            return
+        for t in table:
+            self._convert(t)
+
+    def _out(self, raw: str):
+        if self.para is not None:
+            self.para.append(raw)
+        else:
+            self.emit((HT_OTHER, raw, ""))
+
+    def _start(self, raw: str, name: str) -> str:
+        attrs = _html_attrs(raw)
+        parts = [name]
+        cls = " ".join(c for c in attrs.get("class", "").split() if c in _LOCAL_CLASSES)
+        if cls and name in ("p", "span"):
+            parts.append(f'class="{cls}"')
+        for a in _LOCAL_ATTRS.get(name, ()):
+            if a in attrs:
+                parts.append(f'{a}="{html.escape(attrs[a], quote=True)}"')
+        return "<" + " ".join(parts) + ">"
+
+    def _convert(self, tok):
+        kind, raw, name = tok
+        if kind == HT_TEXT:
+            if self.title_text is not None:
+                self.title_text.append(raw)
+            self._out(raw)
+            return
+        if kind == HT_START:
+            if name == "img" or name.startswith("v:"):
+                self._out(raw)
+                return
+            if name in _HEADING_TAGS or (name == "p" and self.title is None
+                                         and "MsoTitle" in _html_attrs(raw).get("class", "").split()):
+                self._heading(int(name[1]) if name != "p" else 1, name)
+                return
+            out = _LOCAL_RENAME.get(name, name)
+            keep = out in _LOCAL_TAGS or (out == "span" and "ClicksChar" in raw)
+            if out == "a" and "href" not in raw.lower():
+                keep = False
+            if out == "br":
+                self._out("<br>")
+                return
+            self.open.setdefault(name, []).append(f"</{out}>" if keep else "")
+            if not keep:
+                return
+            if out not in _LOCAL_INLINE:
+                self._end_para()
+            if out == "p":
+                self.para = []
+                self.para_start = self._start(raw, "p")
+                return
+            self._out(self._start(raw, out))
+            return
+        if kind == HT_END:
+            if name.startswith("v:"):
+                self._out(raw)
+                return
+            stack = self.open.get(name)
+            end = stack.pop() if stack else ""
+            if not end:
+                return
+            if end == "</p>":
+                self._end_para()
+            elif end.startswith("</h"):
+                self._end_heading(end)
+            else:
+                self._out(end)
+
+    def _heading(self, orig: int, name: str):
+        if self.title is None and orig > 1 and self.fallback_title:
+            self.title = self.fallback_title
+            self._out(f"<h1>{html.escape(self.title, quote=False)}</h1>")
+            self.level = 1
+        if self.title is None:
+            level = 1
+            self.title_text = []
+        else:
+            level = max(2, min(orig, self.level + 1))
+        self.level = level
+        self._end_para()
+        self.open.setdefault(name, []).append(f"</h{level}>")
+        self._out(f"<h{level}>")
+
+    def _end_heading(self, end: str):
+        self._out(end)
+        if self.title_text is not None:
+            self.title = " ".join(html.unescape("".join(self.title_text)).split()) or self.fallback_title
+            self.title_text = None
+
+    def _end_para(self):
+        if self.para is None:
+            return
+        inner, self.para = "".join(self.para), None
+        start = self.para_start
+        m = _NOTE_RE.match(inner)
+        if m and m.group(1).count("<") == m.group(3).count("<"):
+            start = '<p class="Note">'
+            inner = f"<strong>{m.group(2).capitalize()}:</strong> " + inner[m.end():]
+        self._out(start + inner + "</p>")
+
+    def close(self):
+        if self.table is not None:
+            self.table_depth = 0
+            self._end_table()
+        self._end_para()
+
+def convert_locally(body_html: str, title: str = "") -> str:
+    # The whole document the AI would have returned, from the extracted (or minimized) body
+    stage = LocalConvertStage(title)
+    body = run_html_stages(body_html, [stage]).strip()
+    title = stage.title or title
+    if stage.title is None and title:
+        body = f"<h1>{html.escape(title, quote=False)}</h1>\n{body}"
+    return html5_document(title, body)
+
+def route_summary(jobs) -> str:
+    # Documents per route and the AI time the local ones did not spend, estimated from the
+    # AI-routed documents of the same batch
+    routes = {}
+    for j in jobs:
+        if j.route:
+            routes[j.route] = routes.get(j.route, 0) + 1
+    if not routes:
+        return ""
+    line = "Routes: " + ", ".join(f"{n} {r}" for r, n in sorted(routes.items()))
+    ai_times = [j.timings["ai"] for j in jobs if j.route == "ai" and "ai" in j.timings]
+    local_times = [j.timings["ai"] for j in jobs if j.route == "local" and "ai" in j.timings]
+    if ai_times and local_times:
+        saved = len(local_times) * sum(ai_times) / len(ai_times) - sum(local_times)
+        line += f"; about {saved:.0f}s of AI time saved"
+    return line
+
+# ---------- Section chunking ----------
+# Bodies over the budget are split at <h1>/<h2>, converted per chunk and stitched back.
+CHUNK_MAX_CHARS = 60000
+CHUNK_CHARS_PER_TOKEN = 4           # rough estimate for a token budget
+CHUNK_RETRIES = 2
+CHUNK_SPLIT_TAGS = ("h1", "h2")
+# A single section over budget is split again before these (outside tables and lists)
+CHUNK_FALLBACK_TAGS = ("h3", "h4", "h5", "h6", "p", "table", "ul", "ol")
+_CHUNK_NEST_TAGS = ("table", "ul", "ol")
+STYLE_BRIDGES = (
+    'p.Note { mso-style-name:"Note"; }\n'
+    'span.ClicksChar { mso-style-name:"Clicks Char"; }\n'
+    'p.BulletedList { mso-style-name:"Bulleted List"; }'
+)
+CHUNK_NOTE = ("The HTML below is part {part} of {total} of one long document. The parts are converted separately "
+              "and joined afterwards, so convert only this part.")
+CHUNK_NOTE_FIRST = " It starts the document and keeps the title <h1>."
+CHUNK_NOTE_LATER = " Do not add a title <h1>; start with this part's own headings."
+
+def _split_html_before(body_html: str, names, divs=()) -> list:
+    # Cut before each start tag in names that is not inside a table or list. Returns
+    # (piece, open <div> start tags at the piece's start) so chunks can be rebalanced.
+    pieces = []
+    cur = []
+    divs = list(divs)
+    start_divs = tuple(divs)
+    nest = 0
+    for kind, raw, name in iter_html_tokens(body_html):
+        if kind == HT_START:
+            if name in names and nest == 0 and cur:
+                pieces.append(("".join(cur), start_divs))
+                cur = []
+                start_divs = tuple(divs)
+            if name in _CHUNK_NEST_TAGS:
+                nest += 1
+            elif name == "div":
+                divs.append(raw)
+        elif kind == HT_END:
+            if name in _CHUNK_NEST_TAGS:
+                nest = max(0, nest - 1)
+            elif name == "div" and divs:
+                divs.pop()
+        cur.append(raw)
+    if cur:
+        pieces.append(("".join(cur), start_divs))
+    return pieces
+
+def _has_content(fragment: str) -> bool:
+    return "<img" in fragment.lower() or bool(re.sub(r'<[^>]*>|&nbsp;|\s', "", fragment))
+
+def split_body_into_chunks(body_html: str, max_chars: int = CHUNK_MAX_CHARS, max_tokens: int = 0) -> list:
+    budget = max_chars
+    if max_tokens:
+        budget = min(budget, max_tokens * CHUNK_CHARS_PER_TOKEN) if budget else max_tokens * CHUNK_CHARS_PER_TOKEN
+    if not budget or len(body_html) <= budget:
+        return [body_html]
+    pieces = []
+    for section, divs in _split_html_before(body_html, CHUNK_SPLIT_TAGS):
+        if len(section) > budget:
+            pieces.extend(_split_html_before(section, CHUNK_FALLBACK_TAGS, divs))
+        else:
+            pieces.append((section, divs))
+    # Greedy packing; a chunk reopens the <div>s open at its start and closes those still
+    # open at its end, so each chunk is balanced on its own
+    chunks = []
+    cur = []
+    size = 0
+    for i, (piece, divs) in enumerate(pieces):
+        if cur and size + len(piece) > budget:
+            chunks.append("".join(pieces[cur[0]][1]) + "".join(pieces[j][0] for j in cur) + "</div>" * len(divs))
+            cur = []
+            size = 0
+        cur.append(i)
+        size += len(piece)
+    if cur:
+        chunks.append("".join(pieces[cur[0]][1]) + "".join(pieces[j][0] for j in cur))
+    chunks = [c.strip() for c in chunks if _has_content(c)]
+    return chunks or [body_html]
+
+def build_chunk_prompt(body_html: str, index: int, total: int, instructions: bool = True, note: str = "") -> str:
+    # instructions=False: the chat session already has PROMPT_TEXT; note replaces the part note
+    if not note:
+        note = CHUNK_NOTE.format(part=index + 1, total=total) + (CHUNK_NOTE_FIRST if index == 0 else CHUNK_NOTE_LATER)
+    if not instructions:
+        return build_payload(body_html, note)
+    return f"{PROMPT_TEXT}\n{note}\n\n<BEGIN_HTML>\n{body_html}\n</END_HTML>\n"
+
+def check_chunk_reply(chunk_html: str, reply_html: str):
+    if "<body" not in reply_html.lower():
+        raise ValueError("reply has no <body>")
+    missing = set(_IMG_SRC_RE.findall(chunk_html)) - set(_IMG_SRC_RE.findall(reply_html))
+    if missing:
+        raise ValueError(f"reply dropped {len(missing)} image(s)")
+
+def convert_chunks(chunks, submit, workers: int = 1, retries: int = CHUNK_RETRIES, cache=None,
+                   instructions: bool = True, notes=None):
+    # submit(prompt) -> raw reply. Returns (cleaned fragments, retries used). Every chunk is
+    # attempted even when one fails, so the cache holds the good ones for the next run.
+    total = len(chunks)
+
+    def one(i):
+        key = f"<!-- part {i + 1}/{total} -->\n{notes[i] if notes else ''}{chunks[i]}"
+        if cache is not None:
+            hit = cache.get(key, part=True)
+            if hit is not None:
+                return hit[1], 0
+        prompt = build_chunk_prompt(chunks[i], i, total, instructions, notes[i] if notes else "")
+        attempt = 0
+        while True:
+            try:
+                raw = submit(prompt)
+                clean = run_html_stages(raw, [leaked_prompt_stage(raw)])
+                check_chunk_reply(chunks[i], clean)
+                break
+            except Exception as e:
+                if attempt >= retries:
+                    raise RuntimeError(f"Section {i + 1} of {total} failed after {attempt + 1} attempt(s): {e}")
+                attempt += 1
+        if cache is not None:
+            cache.put(key, raw, clean, part=True)
+        return clean, attempt
+
+    results = [None] * total
+    errors = []
+
+    def run(i):
         try:
+            results[i] = one(i)
+        except Exception as e:
+            errors.append(e)
+
+    if workers <= 1 or total == 1:
+        for i in range(total):
+            run(i)
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, total)) as ex:
+            list(ex.map(run, range(total)))
+    if errors:
+        raise errors[0] if len(errors) == 1 else RuntimeError(f"{len(errors)} of {total} sections failed; first: {errors[0]}")
+    return [r[0] for r in results], sum(r[1] for r in results)
+
+class StitchHeadingsStage(HtmlStage):
+    # The first <h1> seen across all fragments is the title; a later <h1> that repeats it
+    # is dropped and any other becomes <h2>, so the stitched document has a single <h1>.
+    def __init__(self, state: dict):
+        self.state = state
+        self.buf = None
+
+    def feed(self, tok):
+        kind, name = tok[0], tok[2]
+        if self.buf is None:
+            if kind == HT_START and name == "h1":
+                self.buf = [tok]
+            else:
+                self.emit(tok)
+            return
+        self.buf.append(tok)
+        if kind == HT_END and name == "h1":
+            self._release()
+
+    def _release(self):
+        buf, self.buf = self.buf, None
+        text = " ".join(html.unescape("".join(t[1] for t in buf if t[0] == HT_TEXT)).split())
+        if self.state.get("title") is None:
+            self.state["title"] = text
+        elif text.lower() == self.state["title"].lower():
+            return
+        else:
+            buf[0] = (HT_START, "<h2" + buf[0][1][3:], "h2")
+            if buf[-1][0] == HT_END:
+                buf[-1] = (HT_END, "</h2>", "h2")
+        for t in buf:
+            self.emit(t)
+
+    def close(self):
+        if self.buf is not None:
+            self._release()
+
+def stitch_chunk_html(fragments) -> str:
+    state = {"title": None}
+    bodies = []
+    for frag in fragments:
+        bodies.append(run_html_stages(extract_relevant_html_for_ai(frag), [StitchHeadingsStage(state)]).strip())
+    title = state["title"]
+    if title is None:
+        m = re.search(r'(?is)<title[^>]*>(.*?)</title>', fragments[0]) if fragments else None
+        title = " ".join(html.unescape(m.group(1)).split()) if m else ""
+        if title:
+            bodies.insert(0, f"<h1>{html.escape(title, quote=False)}</h1>")
+    return html5_document(title, "\n".join(b for b in bodies if b))
+
+def html5_document(title: str, body: str) -> str:
+    # The document shape PROMPT_TEXT asks for: lang, charset, <title> = the <h1>, the bridges
+    return ('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n'
+            f'<title>{html.escape(title, quote=False)}</title>\n<style>\n{STYLE_BRIDGES}\n</style>\n</head>\n'
+            '<body>\n' + body + '\n</body>\n</html>\n')
+
+# ---------- Post-import fixes ----------
+def flatten_image_only_tables(doc_out):
+    try:
+        for i in range(doc_out.Tables.Count, 0, -1):
+            t = doc_out.Tables(i)
             try:
-                name = str(p.Style.NameLocal)
+                if t.Rows.Count != 1 or t.Columns.Count != 1:
+                    continue
+                cell_rng = t.Cell(1, 1).Range
+                txt = cell_rng.Text.replace("\r", "").replace("\x07", "").strip()
+                has_text = bool(txt)
+                has_pics = (cell_rng.InlineShapes.Count > 0) or (cell_rng.Shapes.Count > 0)
+                if not has_pics or has_text:
+                    continue
+                after_rng = t.Range
+                after_rng.Collapse(0)
+                for n in range(cell_rng.Shapes.Count, 0, -1):
+                    shp = cell_rng.Shapes(n)
+                    try:
+                        ish = shp.ConvertToInlineShape()
+                        ish.Range.Cut()
+                        with_retry(after_rng.Paste)
+                        after_rng.Collapse(0)
+                    except Exception:
+                        pass
+                for n in range(cell_rng.InlineShapes.Count, 0, -1):
+                    ish = cell_rng.InlineShapes(n)
+                    try:
+                        ish.Range.Cut()
+                        with_retry(after_rng.Paste)
+                        after_rng.Collapse(0)
+                    except Exception:
+                        pass
+                t.Delete()
             except Exception:
-                name = ""
-            name_lower = name.lower()
+                pass
+    except Exception:
+        pass
+
+# One read per paragraph, then one Range restyle per run of paragraphs needing the same style.
+_KEEP_STYLES = ("List Paragraph", "Note", "Bulleted List")
+
+def snapshot_paragraphs(doc_out) -> list:
+    # [(list_type, style name, paragraph)], None for a paragraph that could not be read
+    rows = []
+    for p in doc_out.Paragraphs:
+        try:
             try:
                 lt = p.Range.ListFormat.ListType
-                if lt in (WD_LIST_BULLET, WD_LIST_NUMBERED):
-                    continue
             except Exception:
-                pass
-            if name_lower.startswith("heading") or name in ("List Paragraph", "Note", "Bulleted List"):
-                continue
-            if name != "Normal" and ("normal" in name_lower or name in ("", "HTML Normal", "Normal (Web)")):
-                with_retry(setattr, p, "Style", normal_style)
+                lt = 0
+            try:
+                name = str(p.Style.NameLocal)
+            except Exception:
+                name = ""
+            rows.append((lt, name, p))
+        except Exception:
+            rows.append(None)
+    return rows
+
+def _target_style(list_type, name: str):
+    if list_type == WD_LIST_BULLET:
+        return "Bulleted List"
+    if list_type == WD_LIST_NUMBERED:
+        return "List Paragraph"
+    name_lower = name.lower()
+    if name_lower.startswith("heading") or name in _KEEP_STYLES:
+        return None
+    if name != "Normal" and ("normal" in name_lower or name in ("", "HTML Normal", "Normal (Web)")):
+        return "Normal"
+    return None
+
+def plan_paragraph_styles(rows) -> list:
+    # [(style name, first paragraph, last paragraph)] for runs of adjacent paragraphs
+    # that need the same new style
+    runs = []
+    last = -2
+    for i, row in enumerate(rows):
+        if row is None:
+            continue
+        lt, name, p = row
+        target = _target_style(lt, name)
+        if not target or target == name:
+            continue
+        if runs and last == i - 1 and runs[-1][0] == target:
+            runs[-1][2] = p
+        else:
+            runs.append([target, p, p])
+        last = i
+    return [tuple(r) for r in runs]
+
+def _fixup_style(doc_out, name: str):
+    try:
+        return doc_out.Styles(name)
+    except Exception:
+        pass
+    if name == "List Paragraph":
+        try:
+            return with_retry(doc_out.Styles.Add, name, WD_STYLE_TYPE_PARAGRAPH)
         except Exception:
             pass
+    return None
+
+def fix_paragraph_styles(doc_out) -> dict:
+    rows = snapshot_paragraphs(doc_out)
+    runs = plan_paragraph_styles(rows)
+    styles = {}
+    applied = 0
+    for name, first, last in runs:
+        if name not in styles:
+            styles[name] = _fixup_style(doc_out, name)
+        style = styles[name]
+        if style is None:
+            continue
+        try:
+            if first is last:
+                with_retry(setattr, first, "Style", style)
+            else:
+                rng = doc_out.Range(Start=first.Range.Start, End=last.Range.End)
+                with_retry(setattr, rng, "Style", style)
+            applied += 1
+        except Exception:
+            pass
+    return {"paragraphs": len(rows), "runs": len(runs), "applied": applied}
 
 def embed_images_and_break_links(doc_out):
     try:
@@ -612,37 +2102,27 @@ def embed_images_and_break_links(doc_out):
         pass
 
 # ---------- Import AI HTML ----------
-def import_ai_html_to_docx(ai_html_path: str, out_docx_path: str):
-    pythoncom.CoInitialize()
-    word = None
+def resolve_import_template(word) -> str:
+    if SEED_TEMPLATE_PATH and os.path.isfile(SEED_TEMPLATE_PATH):
+        return SEED_TEMPLATE_PATH
+    return word.NormalTemplate.FullName
+
+def _import_with_word(word, ai_html_path: str, out_docx_path: str, template_path: str = ""):
     doc_out = None
     html_doc = None
-    old_save_normal_prompt = None
-    old_confirm_conversions = None
     try:
-        word = win32.Dispatch("Word.Application")
-        word.Visible = False
-        word.DisplayAlerts = 0
-        try:
-            old_save_normal_prompt = word.Options.SaveNormalPrompt
-            word.Options.SaveNormalPrompt = False
-        except Exception:
-            pass
-        try:
-            old_confirm_conversions = word.Options.ConfirmConversions
-            word.Options.ConfirmConversions = False
-        except Exception:
-            pass
-        html_doc = with_retry(
-            word.Documents.Open,
-            FileName=norm_path(ai_html_path),
-            ConfirmConversions=False,
-            ReadOnly=True,
-            AddToRecentFiles=False
-        )
-        template_path = SEED_TEMPLATE_PATH if (SEED_TEMPLATE_PATH and os.path.isfile(SEED_TEMPLATE_PATH)) else word.NormalTemplate.FullName
+        with span("word_open_html"):
+            html_doc = with_retry(
+                word.Documents.Open,
+                FileName=norm_path(ai_html_path),
+                ConfirmConversions=False,
+                ReadOnly=True,
+                AddToRecentFiles=False
+            )
+        template_path = template_path or resolve_import_template(word)
         print(f"Using Word template: {template_path}")
-        doc_out = with_retry(word.Documents.Add, Template=template_path)
+        with span("word_new_document"):
+            doc_out = with_retry(word.Documents.Add, Template=template_path)
         try:
             win = None
             try:
@@ -660,25 +2140,33 @@ def import_ai_html_to_docx(ai_html_path: str, out_docx_path: str):
             pass
         set_high_quality(word, doc_out)
         time.sleep(0.2)
-        dst = with_retry(doc_out.Range, Start=0, End=0)
-        dst.FormattedText = html_doc.Content.FormattedText
-        flatten_image_only_tables(doc_out)
-        enforce_lists(doc_out)
-        apply_bulleted_list_style(doc_out)
-        ensure_numbered_list_paragraphs(doc_out)
-        ensure_normal_paragraphs(doc_out)
-        embed_images_and_break_links(doc_out)
+        with span("word_formatted_text"):
+            dst = with_retry(doc_out.Range, Start=0, End=0)
+            dst.FormattedText = html_doc.Content.FormattedText
+        with span("flatten_image_only_tables"):
+            flatten_image_only_tables(doc_out)
+        with span("fix_paragraph_styles") as sp:
+            sp.set(**fix_paragraph_styles(doc_out))
+        with span("embed_images_and_break_links") as sp:
+            embed_images_and_break_links(doc_out)
+            if sp:
+                try:
+                    sp.set(images=doc_out.InlineShapes.Count)
+                except Exception:
+                    pass
         out_norm = norm_path(out_docx_path)
         out_dir = os.path.dirname(out_norm)
         if out_dir and not os.path.isdir(out_dir):
             os.makedirs(out_dir, exist_ok=True)
-        try:
-            with_retry(doc_out.SaveAs2, FileName=out_norm, FileFormat=WD_FORMAT_XML_DOCUMENT)
-        except AttributeError:
-            with_retry(doc_out.SaveAs, FileName=out_norm, FileFormat=WD_FORMAT_XML_DOCUMENT)
+        with span("word_save"):
+            try:
+                with_retry(doc_out.SaveAs2, FileName=out_norm, FileFormat=WD_FORMAT_XML_DOCUMENT)
+            except AttributeError:
+                with_retry(doc_out.SaveAs, FileName=out_norm, FileFormat=WD_FORMAT_XML_DOCUMENT)
         try:
             doc_out.Saved = True
             doc_out.Close(SaveChanges=False)
+            doc_out = None
         except Exception:
             pass
         return out_norm
@@ -689,292 +2177,4348 @@ def import_ai_html_to_docx(ai_html_path: str, out_docx_path: str):
         except Exception:
             pass
         try:
-            if word is not None:
-                try:
-                    if old_save_normal_prompt is not None:
-                        word.Options.SaveNormalPrompt = old_save_normal_prompt
-                except Exception:
-                    pass
-                try:
-                    if old_confirm_conversions is not None:
-                        word.Options.ConfirmConversions = old_confirm_conversions
-                except Exception:
-                    pass
-                word.Quit()
-        except Exception:
-            pass
-        try:
-            pythoncom.CoUninitialize()
+            if doc_out is not None:
+                doc_out.Close(SaveChanges=False)
         except Exception:
             pass
 
-# ---------- Browser automation ----------
-class NavigatorChat:
-    def __init__(self, user_data_dir: str):
-        self.user_data_dir = user_data_dir
-        self.play = None
-        self.context = None
-        self.page = None
+def import_ai_html_to_docx(ai_html_path: str, out_docx_path: str, word_pool=None):
+    # word_pool is anything with import_html(): a WordPool or a DocxWriterPool
+    if word_pool is not None:
+        return word_pool.import_html(ai_html_path, out_docx_path)
+    if IMPORT_BACKEND == "native":
+        return write_docx_from_html(ai_html_path, out_docx_path)
+    session = WordSession(preload_template=False)
+    session.backend.thread_init()
+    try:
+        session.open()
+        return session.import_html(ai_html_path, out_docx_path)
+    finally:
+        session.close()
+        session.backend.thread_uninit()
 
-    def start(self):
-        self.play = sync_playwright().start()
-        self.context = self.play.chromium.launch_persistent_context(
-            user_data_dir=self.user_data_dir,
-            headless=False,
-            args=["--disable-features=IsolateOrigins,site-per-process"]
-        )
-        self.page = self.context.new_page()
-        self.page.goto(NAVIGATOR_CHAT_URL, wait_until="load")
-        try:
-            self.page.wait_for_load_state("networkidle", timeout=10000)
-        except Exception:
-            pass
+# ---------- Native DOCX writer ----------
+# Cleaned AI HTML to WordprocessingML on the seed template's parts; ADA_IMPORT_BACKEND=native.
+IMPORT_BACKEND = os.environ.get("ADA_IMPORT_BACKEND", "word" if WIN32_AVAILABLE else "native").strip().lower()
+IMPORT_PROCESSES = _env_int("ADA_IMPORT_PROCESSES", min(4, os.cpu_count() or 1))
+DOCX_MAX_IMAGE_PX = 624     # 6.5 in at 96 dpi: the text width of a Letter page with 1 in margins
+DOCX_TEXT_WIDTH = 9360      # the same width in twentieths of a point, for table grids
 
-    def stop(self):
-        try:
-            if self.context:
-                self.context.close()
-        except Exception:
-            pass
-        try:
-            if self.play:
-                self.play.stop()
-        except Exception:
-            pass
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_DOC_NAMESPACES = {
+    "w": _W_NS,
+    "r": _R_NS,
+    "wp": "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing",
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "pic": "http://schemas.openxmlformats.org/drawingml/2006/picture",
+}
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+_MAIN_CT = "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+_TEMPLATE_MAIN_CT = "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml"
+_NUMBERING_CT = "application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"
+_IMAGE_CT = {
+    ".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".gif": "image/gif",
+    ".bmp": "image/bmp", ".tif": "image/tiff", ".tiff": "image/tiff", ".emf": "image/x-emf", ".wmf": "image/x-wmf",
+}
+_STORED_EXTS = (".png", ".jpg", ".jpeg", ".gif")
+_TEMPLATE_BODY_RELS = ("image", "hyperlink")
+_DOCX_STYLE_FALLBACKS = {
+    "bulleted list": ("list bullet", "list paragraph"),
+    "list paragraph": ("list number",),
+}
+_OL_FORMATS = {"1": "decimal", "a": "lowerLetter", "A": "upperLetter", "i": "lowerRoman", "I": "upperRoman"}
+_INLINE_PROPS = {
+    "strong": "b", "b": "b", "em": "i", "i": "i", "u": "u", "ins": "u",
+    "s": "strike", "strike": "strike", "del": "strike", "sup": "sup", "sub": "sub",
+}
+_INLINE_TAGS = tuple(_INLINE_PROPS) + ("span", "a", "font", "small", "big", "code", "abbr", "cite", "q", "mark", "label")
+_CONTAINER_TAGS = ("body", "div", "section", "article", "main", "header", "footer", "aside", "nav",
+                   "blockquote", "center", "figure", "figcaption", "caption", "dl", "dt", "dd", "pre", "address")
+_SKIP_TAGS = ("style", "script", "xml", "noscript", "template")
 
-    def _find_composer(self):
-        page = self.page
-        frame = page
-        for f in page.frames[::-1]:
-            try:
-                if "chat.ai.it.ufl.edu" in (f.url or ""):
-                    frame = f
-                    break
-            except Exception:
-                pass
-        selectors = [
-            'textarea',
-            '[contenteditable="true"]',
-            '[role="textbox"]',
-            'div[aria-label*="Message"]',
-            'div[aria-label*="Type"]',
-        ]
-        input_el = None
-        matched_selector = None
-        for sel in selectors:
-            loc = frame.locator(sel)
-            if loc.count() > 0:
-                input_el = loc.first
-                matched_selector = sel
-                try:
-                    input_el.wait_for(state="visible", timeout=5000)
-                except Exception:
-                    pass
-                break
-        if input_el is None:
-            try:
-                frame.locator("body").first.click(timeout=3000)
-                for _ in range(6):
-                    page.keyboard.press("Tab")
-                    time.sleep(0.1)
-                for sel in selectors:
-                    loc = frame.locator(sel)
-                    if loc.count() > 0:
-                        input_el = loc.first
-                        matched_selector = sel
+_XML_ILLEGAL_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_HTML_WS_RE = re.compile(r'[ \t\r\n\f]+')
+_HTML_ATTR_RE = re.compile(r'([A-Za-z_:][\w:.-]*)\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+)')
+_XML_STYLE_RE = re.compile(r'(?s)<w:style\b([^>]*)>(.*?)</w:style>')
+_XML_NUM_RE = re.compile(r'(?s)<w:num\s+w:numId="(\d+)"[^>]*>.*?<w:abstractNumId\s+w:val="(\d+)"')
+_XML_ABSTRACT_RE = re.compile(r'<w:abstractNum\b[^>]*\bw:abstractNumId="(\d+)"')
+_XML_REL_RE = re.compile(r'<Relationship\b[^>]*/>')
+_XML_SECTPR_RE = re.compile(r'(?s)<w:sectPr\b(?:(?!<w:sectPr\b).)*?</w:sectPr>\s*</w:body>')
+
+def _xml_text(text: str) -> str:
+    return _XML_ILLEGAL_RE.sub("", html.escape(text, quote=False))
+
+def _xml_attr_value(text: str) -> str:
+    return _XML_ILLEGAL_RE.sub("", html.escape(text, quote=True))
+
+def _xml_attr(tag: str, name: str) -> str:
+    m = re.search(r'\b%s="([^"]*)"' % re.escape(name), tag)
+    return html.unescape(m.group(1)) if m else ""
+
+def _html_attrs(raw: str) -> dict:
+    attrs = {}
+    nm = _TAG_NAME_RE.match(raw)
+    for m in _HTML_ATTR_RE.finditer(raw, nm.end() if nm else 0):
+        v = m.group(2)
+        if v[:1] in "\"'":
+            v = v[1:-1]
+        attrs.setdefault(m.group(1).lower(), html.unescape(v))
+    return attrs
+
+def _html_px(value) -> float:
+    m = re.match(r'\s*(\d+(?:\.\d+)?)\s*(px)?\s*$', value or "")
+    return float(m.group(1)) if m else 0.0
+
+def image_pixel_size(path: str):
+    # (width, height) read from a PNG/GIF/BMP/JPEG header, None when unknown
+    try:
+        with open(path, "rb") as f:
+            head = f.read(26)
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+                return struct.unpack(">II", head[16:24])
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                return struct.unpack("<HH", head[6:10])
+            if head[:2] == b"BM" and len(head) >= 26:
+                w, h = struct.unpack("<ii", head[18:26])
+                return w, abs(h)
+            if head[:2] != b"\xff\xd8":
+                return None
+            f.seek(2)
+            while True:
+                b = f.read(1)
+                while b and b != b"\xff":
+                    b = f.read(1)
+                while b == b"\xff":
+                    b = f.read(1)
+                if not b:
+                    return None
+                marker = b[0]
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    continue
+                seg = f.read(2)
+                if len(seg) < 2:
+                    return None
+                length = struct.unpack(">H", seg)[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    data = f.read(5)
+                    h, w = struct.unpack(">HH", data[1:5])
+                    return w, h
+                f.seek(length - 2, 1)
+    except Exception:
+        return None
+
+def _minimal_styles_xml() -> str:
+    # Stand-in for Normal.dotm when no seed template ships with the app
+    def para(sid, name, based="Normal", ppr="", rpr="", extra=""):
+        return (f'<w:style w:type="paragraph" w:styleId="{sid}"><w:name w:val="{name}"/>'
+                f'<w:basedOn w:val="{based}"/>{extra}<w:qFormat/>'
+                f'{f"<w:pPr>{ppr}</w:pPr>" if ppr else ""}{f"<w:rPr>{rpr}</w:rPr>" if rpr else ""}</w:style>')
+    sizes = (32, 26, 24, 22, 22, 22)
+    headings = "".join(
+        para(f"Heading{n}", f"heading {n}", extra='<w:next w:val="Normal"/>',
+             ppr=f'<w:keepNext/><w:spacing w:before="240" w:after="80"/><w:outlineLvl w:val="{n - 1}"/>',
+             rpr=f'<w:b/><w:sz w:val="{sizes[n - 1]}"/>')
+        for n in range(1, 7))
+    border = "".join(f'<w:{side} w:val="single" w:sz="12" w:space="4" w:color="0021A5"/>'
+                     for side in ("top", "left", "bottom", "right"))
+    return (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:styles xmlns:w="{_W_NS}">'
+        '<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:cs="Calibri"/>'
+        '<w:sz w:val="22"/><w:lang w:val="en-US"/></w:rPr></w:rPrDefault><w:pPrDefault><w:pPr>'
+        '<w:spacing w:after="160" w:line="259" w:lineRule="auto"/></w:pPr></w:pPrDefault></w:docDefaults>'
+        '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/></w:style>'
+        + headings
+        + para("ListParagraph", "List Paragraph", ppr='<w:ind w:left="720"/><w:contextualSpacing/>')
+        + para("BulletedList", "Bulleted List", based="ListParagraph")
+        + para("Note", "Note", ppr=f"<w:pBdr>{border}</w:pBdr>")
+        + '<w:style w:type="character" w:default="1" w:styleId="DefaultParagraphFont">'
+          '<w:name w:val="Default Paragraph Font"/><w:uiPriority w:val="1"/><w:semiHidden/></w:style>'
+          '<w:style w:type="character" w:customStyle="1" w:styleId="ClicksChar"><w:name w:val="Clicks Char"/>'
+          '<w:basedOn w:val="DefaultParagraphFont"/><w:rPr><w:b/><w:color w:val="175C92"/></w:rPr></w:style>'
+          '<w:style w:type="character" w:styleId="Hyperlink"><w:name w:val="Hyperlink"/>'
+          '<w:basedOn w:val="DefaultParagraphFont"/><w:rPr><w:color w:val="0563C1"/><w:u w:val="single"/></w:rPr></w:style>'
+          '<w:style w:type="table" w:default="1" w:styleId="TableNormal"><w:name w:val="Normal Table"/>'
+          '<w:tblPr><w:tblInd w:w="0" w:type="dxa"/><w:tblCellMar><w:top w:w="0" w:type="dxa"/>'
+          '<w:left w:w="108" w:type="dxa"/><w:bottom w:w="0" w:type="dxa"/><w:right w:w="108" w:type="dxa"/>'
+          '</w:tblCellMar></w:tblPr></w:style>'
+          '<w:style w:type="table" w:styleId="TableGrid"><w:name w:val="Table Grid"/><w:basedOn w:val="TableNormal"/>'
+          '<w:pPr><w:spacing w:after="0" w:line="240" w:lineRule="auto"/></w:pPr><w:tblPr><w:tblBorders>'
+        + "".join(f'<w:{side} w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+                  for side in ("top", "left", "bottom", "right", "insideH", "insideV"))
+        + '</w:tblBorders></w:tblPr></w:style></w:styles>'
+    )
+
+def _minimal_template_parts() -> dict:
+    rels = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{_PKG_REL_NS}">'
+            f'<Relationship Id="rId1" Type="{_R_NS}/officeDocument" Target="word/document.xml"/>'
+            '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/'
+            'metadata/core-properties" Target="docProps/core.xml"/></Relationships>')
+    doc_rels = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{_PKG_REL_NS}">'
+                f'<Relationship Id="rId1" Type="{_R_NS}/styles" Target="styles.xml"/>'
+                f'<Relationship Id="rId2" Type="{_R_NS}/settings" Target="settings.xml"/></Relationships>')
+    ct = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Types xmlns="{_CT_NS}">'
+          '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+          '<Default Extension="xml" ContentType="application/xml"/>'
+          f'<Override PartName="/word/document.xml" ContentType="{_MAIN_CT}"/>'
+          '<Override PartName="/word/styles.xml" '
+          'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+          '<Override PartName="/word/settings.xml" '
+          'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.settings+xml"/>'
+          '<Override PartName="/docProps/core.xml" '
+          'ContentType="application/vnd.openxmlformats-package.core-properties+xml"/></Types>')
+    core = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<cp:coreProperties '
+            'xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title></dc:title></cp:coreProperties>')
+    settings = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:settings xmlns:w="{_W_NS}">'
+                '<w:defaultTabStop w:val="720"/><w:compat><w:compatSetting w:name="compatibilityMode" '
+                'w:uri="http://schemas.microsoft.com/office/word" w:val="15"/></w:compat></w:settings>')
+    doc = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document xmlns:w="{_W_NS}" '
+           f'xmlns:r="{_R_NS}"><w:body><w:p/><w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+           '<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="720" '
+           'w:footer="720" w:gutter="0"/><w:cols w:space="720"/></w:sectPr></w:body></w:document>')
+    parts = {
+        "[Content_Types].xml": ct, "_rels/.rels": rels, "word/_rels/document.xml.rels": doc_rels,
+        "word/document.xml": doc, "word/styles.xml": _minimal_styles_xml(), "word/settings.xml": settings,
+        "docProps/core.xml": core,
+    }
+    return {k: v.encode("utf-8") for k, v in parts.items()}
+
+class DocxTemplate:
+    # The parts of a .dotx/.docx seed (everything but its body) plus style and numbering lookups
+    def __init__(self, path: str = ""):
+        self.path = path
+        if path:
+            with zipfile.ZipFile(path) as zf:
+                self.parts = {i.filename: zf.read(i) for i in zf.infolist() if not i.is_dir()}
+        else:
+            self.parts = _minimal_template_parts()
+        self.main = "word/document.xml"
+        for rel in _XML_REL_RE.findall(self._text("_rels/.rels")):
+            if _xml_attr(rel, "Type").endswith("/officeDocument"):
+                self.main = _xml_attr(rel, "Target").lstrip("/")
+        self.main_dir = os.path.dirname(self.main)
+        self.rels_part = f"{self.main_dir}/_rels/{os.path.basename(self.main)}.rels"
+        doc = self._text(self.main)
+        m = re.search(r'<w:document\b[^>]*>', doc)
+        self.root = m.group(0) if m else ""
+        for prefix, uri in _DOC_NAMESPACES.items():
+            if f"xmlns:{prefix}=" not in self.root:
+                self.root = self.root[:-1] + f' xmlns:{prefix}="{uri}">' if self.root else ""
+        if not self.root:
+            self.root = "<w:document " + " ".join(f'xmlns:{p}="{u}"' for p, u in _DOC_NAMESPACES.items()) + ">"
+        m = _XML_SECTPR_RE.search(doc)
+        self.sect_pr = re.sub(r'\s*</w:body>$', "", m.group(0)) if m else ""
+        self.styles = {}       # (type, lower-case name) -> styleId
+        self.style_names = {}  # styleId -> name
+        self.based_on = {}
+        self.style_num = {}
+        for m in _XML_STYLE_RE.finditer(self._text("word/styles.xml")):
+            attrs, body = m.group(1), m.group(2)
+            sid = _xml_attr(attrs, "w:styleId")
+            nm = re.search(r'<w:name\s+w:val="([^"]*)"', body)
+            name = html.unescape(nm.group(1)) if nm else sid
+            self.styles.setdefault((_xml_attr(attrs, "w:type") or "paragraph", name.lower()), sid)
+            self.style_names[sid] = name
+            bm = re.search(r'<w:basedOn\s+w:val="([^"]*)"', body)
+            if bm:
+                self.based_on[sid] = bm.group(1)
+            nm = re.search(r'<w:numId\s+w:val="(\d+)"', body)
+            if nm:
+                self.style_num[sid] = int(nm.group(1))
+        self.numbering_part = ""
+        for rel in _XML_REL_RE.findall(self._text(self.rels_part)):
+            if _xml_attr(rel, "Type").endswith("/numbering"):
+                self.numbering_part = f"{self.main_dir}/{_xml_attr(rel, 'Target')}"
+        numbering = self._text(self.numbering_part) if self.numbering_part else ""
+        self.num_abstract = {int(a): int(b) for a, b in _XML_NUM_RE.findall(numbering)}
+        abstract_ids = [int(a) for a in _XML_ABSTRACT_RE.findall(numbering)]
+        self.max_abstract = max(abstract_ids, default=-1)
+        self.max_num = max(self.num_abstract, default=0)
+
+    def _text(self, part: str) -> str:
+        return self.parts.get(part, b"").decode("utf-8", "ignore")
+
+    def style_id(self, name: str, kind: str = "paragraph"):
+        for candidate in (name.lower(),) + _DOCX_STYLE_FALLBACKS.get(name.lower(), ()):
+            sid = self.styles.get((kind, candidate))
+            if sid:
+                return sid
+        return None
+
+    def style_num_id(self, sid):
+        for _ in range(10):
+            if not sid:
+                return None
+            if sid in self.style_num:
+                return self.style_num[sid]
+            sid = self.based_on.get(sid)
+        return None
+
+_DOCX_TEMPLATES = {}
+
+def docx_template(path: str = "") -> DocxTemplate:
+    # Parsed once per process and reused for every document
+    try:
+        key = (path, os.path.getmtime(path) if path else 0)
+    except OSError:
+        key = ("", 0)
+        path = ""
+    tpl = _DOCX_TEMPLATES.get(key)
+    if tpl is None:
+        tpl = _DOCX_TEMPLATES[key] = DocxTemplate(path)
+    return tpl
+
+class _DocxNumbering:
+    # List instances added for one document on top of the template's numbering part
+    def __init__(self, template: DocxTemplate):
+        self.template = template
+        self.next_abstract = template.max_abstract + 1
+        self.next_num = template.max_num + 1
+        self.own = {}
+        self.abstract_xml = []
+        self.num_xml = []
+        self.bullet_num = None
+
+    def _own_abstract(self, fmt: str) -> int:
+        if fmt not in self.own:
+            aid = self.own[fmt] = self.next_abstract
+            self.next_abstract += 1
+            levels = []
+            for i in range(9):
+                ind = f'<w:pPr><w:ind w:left="{720 * (i + 1)}" w:hanging="360"/></w:pPr>'
+                if fmt == "bullet":
+                    ch = ("•", "o", "▪")[i % 3]
+                    levels.append(f'<w:lvl w:ilvl="{i}"><w:start w:val="1"/><w:numFmt w:val="bullet"/>'
+                                  f'<w:lvlText w:val="{ch}"/><w:lvlJc w:val="left"/>{ind}</w:lvl>')
+                else:
+                    lf = fmt if i == 0 else ("decimal", "lowerLetter", "lowerRoman")[i % 3]
+                    levels.append(f'<w:lvl w:ilvl="{i}"><w:start w:val="1"/><w:numFmt w:val="{lf}"/>'
+                                  f'<w:lvlText w:val="%{i + 1}."/><w:lvlJc w:val="left"/>{ind}</w:lvl>')
+            self.abstract_xml.append(f'<w:abstractNum w:abstractNumId="{aid}">'
+                                     f'<w:multiLevelType w:val="hybridMultilevel"/>{"".join(levels)}</w:abstractNum>')
+        return self.own[fmt]
+
+    def _num(self, abstract_id: int, ilvl: int = 0, start: int = 0) -> int:
+        nid = self.next_num
+        self.next_num += 1
+        override = (f'<w:lvlOverride w:ilvl="{ilvl}"><w:startOverride w:val="{start}"/></w:lvlOverride>'
+                    if start else "")
+        self.num_xml.append(f'<w:num w:numId="{nid}"><w:abstractNumId w:val="{abstract_id}"/>{override}</w:num>')
+        return nid
+
+    def bullets(self, style_id) -> int:
+        nid = self.template.style_num_id(style_id)
+        if nid:
+            return nid
+        if self.bullet_num is None:
+            self.bullet_num = self._num(self._own_abstract("bullet"))
+        return self.bullet_num
+
+    def ordered(self, style_id, fmt: str = "decimal", start: int = 1, ilvl: int = 0) -> int:
+        # Every <ol> is a new list instance so numbering restarts like it does in the HTML
+        aid = None
+        if fmt == "decimal":
+            aid = self.template.num_abstract.get(self.template.style_num_id(style_id))
+        if aid is None:
+            aid = self._own_abstract(fmt)
+        return self._num(aid, ilvl, max(1, start))
+
+    def merged(self) -> str:
+        if not (self.abstract_xml or self.num_xml):
+            return ""
+        tpl = self.template
+        xml = tpl._text(tpl.numbering_part) if tpl.numbering_part else ""
+        abstracts, nums = "".join(self.abstract_xml), "".join(self.num_xml)
+        if not xml:
+            return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    f'<w:numbering xmlns:w="{_W_NS}">{abstracts}{nums}</w:numbering>')
+        tail = xml.find("<w:numIdMacAtCleanup")
+        if tail == -1:
+            tail = xml.rfind("</w:numbering>")
+        first_num = re.search(r'<w:num[\s>]', xml)
+        at = first_num.start() if first_num else tail
+        return xml[:at] + abstracts + xml[at:tail] + nums + xml[tail:]
+
+class DocxBodyStage(HtmlStage):
+    # Builds <w:body> content from cleaned AI HTML tokens; emits nothing downstream
+    def __init__(self, template: DocxTemplate, numbering: _DocxNumbering, html_dir: str):
+        self.t = template
+        self.numbering = numbering
+        self.html_dir = html_dir
+        self.out = []            # block XML of the current container (body or table cell)
+        self.para = None         # [pPr xml, runs, explicit, ends with space]
+        self.fmt = []            # open inline elements: (tag, props)
+        self.lists = []          # open lists: [kind, numId, paragraph style id, pending item pPr]
+        self.tables = []         # open tables: {"parent", "rows", "row", "cell", "text", "images"}
+        self.skip = None
+        self.title = None
+        self.title_text = ""
+        self.rels = []           # (id, type, target, external)
+        self.links = {}
+        self.media = {}          # image path -> (rel id, part name, pixel size)
+        self.images = 0
+        self.missing_images = 0
+        self.paragraphs = 0
+        self.normal = template.style_id("Normal")
+        self.bulleted = template.style_id("Bulleted List")
+        self.list_para = template.style_id("List Paragraph")
+
+    # -- paragraphs and runs --
+    def _ppr(self, style_id=None, num=None) -> str:
+        inner = ""
+        if style_id and style_id != self.normal:
+            inner += f'<w:pStyle w:val="{style_id}"/>'
+        if num:
+            inner += f'<w:numPr><w:ilvl w:val="{num[1]}"/><w:numId w:val="{num[0]}"/></w:numPr>'
+        return f"<w:pPr>{inner}</w:pPr>" if inner else ""
+
+    def _open_para(self, ppr: str, explicit: bool):
+        self._close_para()
+        self.para = [ppr, [], explicit, True]
+
+    def _item_ppr(self, style_id=None):
+        # First paragraph of a list item takes the item's numbering; later ones only its style
+        if self.lists and self.lists[-1][3] is not None:
+            top = self.lists[-1]
+            ppr, top[3] = top[3], None
+            if style_id and style_id not in (self.bulleted, self.list_para):
+                ppr = ppr.replace(f'<w:pStyle w:val="{top[2]}"/>', f'<w:pStyle w:val="{style_id}"/>')
+            return ppr
+        if self.lists and not style_id:
+            return self._ppr(self.lists[-1][2])
+        return self._ppr(style_id)
+
+    def _implicit_para(self):
+        self._open_para(self._item_ppr(), False)
+
+    def _run_props(self):
+        props = {}
+        for _, p in self.fmt:
+            props.update(p)
+        parts = []
+        if "style" in props:
+            parts.append(f'<w:rStyle w:val="{props["style"]}"/>')
+        if props.get("b"):
+            parts.append("<w:b/>")
+        if props.get("i"):
+            parts.append("<w:i/>")
+        if props.get("strike"):
+            parts.append("<w:strike/>")
+        if props.get("u"):
+            parts.append('<w:u w:val="single"/>')
+        if props.get("sup") or props.get("sub"):
+            parts.append(f'<w:vertAlign w:val="{"superscript" if props.get("sup") else "subscript"}"/>')
+        return props.get("link"), f"<w:rPr>{''.join(parts)}</w:rPr>" if parts else ""
+
+    def _text(self, raw: str):
+        text = _HTML_WS_RE.sub(" ", html.unescape(raw))
+        if not text:
+            return
+        if self.para is None:
+            if not text.strip():
+                return
+            self._implicit_para()
+        para = self.para
+        if para[3] and text.startswith(" "):
+            text = text[1:]
+            if not text:
+                return
+        for t in self.tables:
+            t["text"] = True
+        link, rpr = self._run_props()
+        runs = para[1]
+        last = runs[-1] if runs else None
+        if last is not None and last[2] == "t" and last[0] == link and last[1] == rpr:
+            last[3] += text
+        else:
+            runs.append([link, rpr, "t", text])
+        para[3] = text.endswith(" ")
+
+    def _add_run_xml(self, xml: str):
+        if self.para is None:
+            self._implicit_para()
+        link, rpr = self._run_props()
+        self.para[1].append([link, rpr, "x", xml])
+
+    def _close_para(self):
+        para, self.para = self.para, None
+        if para is None:
+            return
+        ppr, runs, explicit, _ = para
+        for r in reversed(runs):
+            if r[2] == "t":
+                r[3] = r[3].rstrip(" ")
+                if r[3]:
+                    break
+            else:
+                break
+        runs = [r for r in runs if r[2] != "t" or r[3]]
+        if not runs and not explicit:
+            return
+        parts = ["<w:p>", ppr]
+        link = None
+        for r in runs:
+            if r[0] != link:
+                if link:
+                    parts.append("</w:hyperlink>")
+                if r[0]:
+                    parts.append(f"<w:hyperlink {r[0]}>")
+                link = r[0]
+            body = f'<w:t xml:space="preserve">{_xml_text(r[3])}</w:t>' if r[2] == "t" else r[3]
+            parts.append(f"<w:r>{r[1]}{body}</w:r>")
+        if link:
+            parts.append("</w:hyperlink>")
+        parts.append("</w:p>")
+        self.out.append("".join(parts))
+        self.paragraphs += 1
+
+    # -- relationships, links and images --
+    def _rel(self, kind: str, target: str, external: bool = False) -> str:
+        rid = f"rIdAda{len(self.rels) + 1}"
+        self.rels.append((rid, kind, target, external))
+        return rid
+
+    def _link_props(self, href: str) -> dict:
+        href = href.strip()
+        if not href:
+            return {}
+        if href.startswith("#"):
+            return {"link": f'w:anchor="{_xml_attr_value(href[1:])}"'}
+        if href not in self.links:
+            self.links[href] = self._rel("hyperlink", href, external=True)
+        props = {"link": f'r:id="{self.links[href]}"'}
+        sid = self.t.style_id("Hyperlink", "character")
+        if sid:
+            props["style"] = sid
+        return props
+
+    def _image_path(self, src: str):
+        src = (src or "").strip()
+        if not src or src.lower().startswith(("data:", "http:", "https:")):
+            return None
+        if src.lower().startswith("file:"):
+            src = urlparse(src).path
+            if re.match(r'^/[A-Za-z]:', src):
+                src = src[1:]
+        src = urllib.parse.unquote(src)
+        path = src if os.path.isabs(src) else os.path.join(self.html_dir, src)
+        return path if os.path.isfile(path) else None
+
+    def _image(self, raw: str):
+        attrs = _html_attrs(raw)
+        path = self._image_path(attrs.get("src", ""))
+        ext = os.path.splitext(path)[1].lower() if path else ""
+        if ext not in _IMAGE_CT:
+            self.missing_images += 1
+            return
+        entry = self.media.get(path)
+        if entry is None:
+            part = f"media/ada_image{len(self.media) + 1}{ext}"
+            entry = self.media[path] = (self._rel("image", part), part, image_pixel_size(path))
+        rid, _, natural = entry
+        w, h = _html_px(attrs.get("width")), _html_px(attrs.get("height"))
+        if natural and natural[0] and natural[1]:
+            if w and not h:
+                h = w * natural[1] / natural[0]
+            elif h and not w:
+                w = h * natural[0] / natural[1]
+            elif not w:
+                w, h = natural
+        if not (w and h):
+            w, h = w or 320, h or 240
+        if w > DOCX_MAX_IMAGE_PX:
+            w, h = DOCX_MAX_IMAGE_PX, h * DOCX_MAX_IMAGE_PX / w
+        self.images += 1
+        for t in self.tables:
+            t["images"] += 1
+        cx, cy = int(w * 9525), int(h * 9525)
+        alt = _xml_attr_value(attrs.get("alt", ""))
+        n = self.images
+        self._add_run_xml(
+            f'<w:drawing><wp:inline distT="0" distB="0" distL="0" distR="0"><wp:extent cx="{cx}" cy="{cy}"/>'
+            f'<wp:docPr id="{n}" name="Picture {n}" descr="{alt}"/><wp:cNvGraphicFramePr>'
+            '<a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr><a:graphic>'
+            '<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture"><pic:pic>'
+            f'<pic:nvPicPr><pic:cNvPr id="{n}" name="Picture {n}" descr="{alt}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip r:embed="{rid}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+            '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr></pic:pic></a:graphicData></a:graphic>'
+            '</wp:inline></w:drawing>')
+
+    # -- tables --
+    def _end_cell(self):
+        t = self.tables[-1]
+        cell = t["cell"]
+        if cell is None:
+            return
+        self._close_para()
+        if cell["th"]:
+            self._pop_inline("th")
+        t["cell"] = None
+        self.out = t["parent"]
+
+    def _end_row(self):
+        t = self.tables[-1]
+        self._end_cell()
+        if t["row"]:
+            t["rows"].append(t["row"])
+        t["row"] = None
+
+    def _end_table(self):
+        self._end_row()
+        t = self.tables.pop()
+        self.out = t["parent"]
+        rows = t["rows"]
+        if not rows:
+            return
+        if not t["text"] and t["images"]:
+            # Image-only layout tables become plain image paragraphs (flatten_image_only_tables)
+            for row in rows:
+                for cell in row:
+                    self.out.extend(b for b in cell["blocks"] if b.startswith("<w:p>"))
+            return
+        cols = max(sum(c["span"] for c in row) for row in rows)
+        col_w = DOCX_TEXT_WIDTH // max(1, cols)
+        tbl_style = self.t.style_id("Table Grid", "table")
+        parts = ["<w:tbl><w:tblPr>", f'<w:tblStyle w:val="{tbl_style}"/>' if tbl_style else "",
+                 '<w:tblW w:w="0" w:type="auto"/><w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" '
+                 'w:firstColumn="1" w:lastColumn="0" w:noHBand="0" w:noVBand="1"/></w:tblPr><w:tblGrid>',
+                 f'<w:gridCol w:w="{col_w}"/>' * cols, "</w:tblGrid>"]
+        for row in rows:
+            parts.append("<w:tr>")
+            if all(c["th"] for c in row):
+                parts.append("<w:trPr><w:tblHeader/></w:trPr>")
+            for cell in row:
+                span = cell["span"]
+                blocks = cell["blocks"]
+                if not blocks or not blocks[-1].startswith("<w:p"):
+                    blocks.append("<w:p/>")
+                grid_span = f'<w:gridSpan w:val="{span}"/>' if span > 1 else ""
+                parts.append(f'<w:tc><w:tcPr><w:tcW w:w="{col_w * span}" w:type="dxa"/>{grid_span}</w:tcPr>'
+                             f'{"".join(blocks)}</w:tc>')
+            parts.append("</w:tr>")
+        parts.append("</w:tbl>")
+        self.out.append("".join(parts))
+
+    # -- token handling --
+    def _pop_inline(self, name: str):
+        for i in range(len(self.fmt) - 1, -1, -1):
+            if self.fmt[i][0] == name:
+                del self.fmt[i:]
+                return
+
+    def feed(self, tok):
+        kind, raw, name = tok
+        if self.skip is not None:
+            if kind == HT_END and name == self.skip:
+                self.skip = None
+            return
+        if kind == HT_TEXT:
+            if self.title is not None:
+                self.title.append(raw)
+            else:
+                self._text(raw)
+        elif kind == HT_START:
+            self._start(raw, name)
+        elif kind == HT_END:
+            self._end(name)
+
+    def _start(self, raw: str, name: str):
+        if name in _SKIP_TAGS:
+            if not raw.endswith("/>"):
+                self.skip = name
+        elif name == "title":
+            self.title = []
+        elif name in _HEADING_TAGS:
+            self._open_para(self._ppr(self.t.style_id(f"heading {name[1]}")), True)
+        elif name == "p":
+            cls = _html_attrs(raw).get("class", "").split()
+            sid = None
+            if "Note" in cls:
+                sid = self.t.style_id("Note")
+            elif "BulletedList" in cls:
+                sid = self.bulleted
+            elif "MsoListParagraph" in cls:
+                sid = self.list_para
+            self._open_para(self._item_ppr(sid), True)
+        elif name in ("ul", "ol"):
+            self._close_para()
+            ilvl = len(self.lists)
+            if name == "ul":
+                num = self.numbering.bullets(self.bulleted)
+                style = self.bulleted
+            else:
+                attrs = _html_attrs(raw)
+                fmt = _OL_FORMATS.get(attrs.get("type", "1"), "decimal")
+                try:
+                    start = int(attrs.get("start", "1"))
+                except ValueError:
+                    start = 1
+                num = self.numbering.ordered(self.list_para, fmt, start, ilvl)
+                style = self.list_para
+            self.lists.append([name, (num, ilvl), style, None])
+        elif name == "li":
+            self._close_para()
+            if self.lists:
+                top = self.lists[-1]
+                top[3] = self._ppr(top[2], top[1])
+        elif name == "table":
+            self._close_para()
+            self.tables.append({"parent": self.out, "rows": [], "row": None, "cell": None,
+                                "text": False, "images": 0})
+        elif name == "tr":
+            if self.tables:
+                self._end_row()
+                self.tables[-1]["row"] = []
+        elif name in ("td", "th"):
+            if self.tables:
+                t = self.tables[-1]
+                self._end_cell()
+                if t["row"] is None:
+                    t["row"] = []
+                try:
+                    span = max(1, int(_html_attrs(raw).get("colspan", "1")))
+                except ValueError:
+                    span = 1
+                cell = {"span": span, "blocks": [], "th": name == "th"}
+                t["row"].append(cell)
+                t["cell"] = cell
+                self.out = cell["blocks"]
+                if cell["th"]:
+                    self.fmt.append(("th", {"b": True}))
+        elif name == "img":
+            self._image(raw)
+        elif name == "br":
+            self._add_run_xml("<w:br/>")
+        elif name == "a":
+            self.fmt.append(("a", self._link_props(_html_attrs(raw).get("href", ""))))
+        elif name in _INLINE_TAGS:
+            if raw.endswith("/>"):
+                return
+            props = {}
+            if name in _INLINE_PROPS:
+                props[_INLINE_PROPS[name]] = True
+            elif name == "span" and "ClicksChar" in _html_attrs(raw).get("class", "").split():
+                sid = self.t.style_id("Clicks Char", "character")
+                if sid:
+                    props["style"] = sid
+                else:
+                    props["b"] = True
+            self.fmt.append((name, props))
+        elif name in _CONTAINER_TAGS or name == "hr":
+            self._close_para()
+
+    def _end(self, name: str):
+        if name == "title":
+            if self.title is not None:
+                self.title_text = _HTML_WS_RE.sub(" ", html.unescape("".join(self.title))).strip()
+            self.title = None
+        elif name in _HEADING_TAGS or name == "p" or name in _CONTAINER_TAGS:
+            self._close_para()
+        elif name == "li":
+            self._close_para()
+            if self.lists:
+                self.lists[-1][3] = None
+        elif name in ("ul", "ol"):
+            self._close_para()
+            if self.lists:
+                self.lists.pop()
+        elif name in ("td", "th"):
+            if self.tables:
+                self._end_cell()
+        elif name == "tr":
+            if self.tables:
+                self._end_row()
+        elif name == "table":
+            if self.tables:
+                self._close_para()
+                self._end_table()
+        elif name == "a" or name in _INLINE_TAGS:
+            self._pop_inline(name)
+
+    def close(self):
+        self._close_para()
+        while self.tables:
+            self._end_table()
+        if not self.out or not self.out[-1].startswith("<w:p"):
+            self.out.append("<w:p/>")
+
+def _settings_with_print_view(xml: str) -> str:
+    if re.search(r'<w:view\b', xml):
+        return re.sub(r'<w:view\b[^>]*/>', '<w:view w:val="print"/>', xml, count=1)
+    m = re.search(r'<w:writeProtection\b[^>]*/>', xml) or re.search(r'<w:settings\b[^>]*>', xml)
+    if not m:
+        return xml
+    return xml[:m.end()] + '<w:view w:val="print"/>' + xml[m.end():]
+
+def _core_with_title(xml: str, title: str) -> str:
+    value = f"<dc:title>{_xml_text(title)}</dc:title>"
+    if re.search(r'<dc:title\s*/>|<dc:title>.*?</dc:title>', xml, re.S):
+        return re.sub(r'<dc:title\s*/>|<dc:title>.*?</dc:title>', lambda m: value, xml, count=1, flags=re.S)
+    return xml.replace("</cp:coreProperties>", value + "</cp:coreProperties>")
+
+def _write_docx_package(zf, tpl: DocxTemplate, stage: DocxBodyStage, numbering_xml: str):
+    main_dir = tpl.main_dir
+    skip = {tpl.main, tpl.rels_part}
+    rels = []
+    for rel in _XML_REL_RE.findall(tpl._text(tpl.rels_part)):
+        rtype = _xml_attr(rel, "Type").rsplit("/", 1)[-1]
+        if rtype in _TEMPLATE_BODY_RELS:
+            if _xml_attr(rel, "TargetMode") != "External":
+                skip.add(f"{main_dir}/{_xml_attr(rel, 'Target')}")
+            continue
+        rels.append(rel)
+    for rid, kind, target, external in stage.rels:
+        mode = ' TargetMode="External"' if external else ""
+        rels.append(f'<Relationship Id="{rid}" Type="{_R_NS}/{kind}" Target="{_xml_attr_value(target)}"{mode}/>')
+    numbering_part = tpl.numbering_part
+    if numbering_xml and not numbering_part:
+        numbering_part = f"{main_dir}/numbering.xml"
+        rels.append(f'<Relationship Id="rIdAdaNumbering" Type="{_R_NS}/numbering" Target="numbering.xml"/>')
+    ct = tpl._text("[Content_Types].xml").replace(_TEMPLATE_MAIN_CT, _MAIN_CT)
+    defaults = set(m.lower() for m in re.findall(r'<Default\s+Extension="([^"]+)"', ct))
+    extra = ""
+    for _, part, _ in stage.media.values():
+        ext = os.path.splitext(part)[1].lower()
+        if ext[1:] not in defaults:
+            defaults.add(ext[1:])
+            extra += f'<Default Extension="{ext[1:]}" ContentType="{_IMAGE_CT[ext]}"/>'
+    if numbering_xml and f'PartName="/{numbering_part}"' not in ct:
+        extra += f'<Override PartName="/{numbering_part}" ContentType="{_NUMBERING_CT}"/>'
+    ct = ct.replace("</Types>", extra + "</Types>")
+    for name, data in tpl.parts.items():
+        if name in skip or name == "[Content_Types].xml" or (numbering_xml and name == numbering_part):
+            continue
+        if name == f"{main_dir}/settings.xml":
+            data = _settings_with_print_view(data.decode("utf-8", "ignore")).encode("utf-8")
+        elif name == "docProps/core.xml" and stage.title_text:
+            data = _core_with_title(data.decode("utf-8", "ignore"), stage.title_text).encode("utf-8")
+        zf.writestr(name, data)
+    zf.writestr("[Content_Types].xml", ct)
+    if numbering_xml:
+        zf.writestr(numbering_part, numbering_xml)
+    zf.writestr(tpl.rels_part, (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                                f'<Relationships xmlns="{_PKG_REL_NS}">{"".join(rels)}</Relationships>'))
+    zf.writestr(tpl.main, (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n{tpl.root}<w:body>'
+                           f'{"".join(stage.out)}{tpl.sect_pr}</w:body></w:document>'))
+    for path, (_, part, _) in stage.media.items():
+        stored = part.lower().endswith(_STORED_EXTS)
+        zf.write(path, f"{main_dir}/{part}", compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+
+def _write_docx(ai_html_path: str, out_docx_path: str, template_path=None):
+    # (saved path, note for the log); template_path None means the seed template, "" the
+    # built-in minimal styles
+    tpl = docx_template(SEED_TEMPLATE_PATH if template_path is None else template_path)
+    numbering = _DocxNumbering(tpl)
+    stage = DocxBodyStage(tpl, numbering, os.path.dirname(norm_path(ai_html_path)))
+    with span("docx_body") as sp:
+        run_html_stages(iter_file_chunks(ai_html_path), [stage])
+        sp.set(paragraphs=stage.paragraphs, images=stage.images)
+    out_norm = norm_path(out_docx_path)
+    out_dir = os.path.dirname(out_norm)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_path = out_norm + ".tmp"
+    try:
+        with span("docx_package"), zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            _write_docx_package(zf, tpl, stage, numbering.merged())
+        os.replace(tmp_path, out_norm)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+    note = ""
+    if stage.missing_images:
+        note = f"Native DOCX writer: {stage.missing_images} image(s) not found next to {ai_html_path}"
+    return out_norm, note
+
+def write_docx_from_html(ai_html_path: str, out_docx_path: str, template_path=None, log_fn=print) -> str:
+    out_norm, note = _write_docx(ai_html_path, out_docx_path, template_path)
+    if note:
+        log_fn(note)
+    return out_norm
+
+class DocxWriterPool:
+    # Same export()/import_html() as WordPool, backed by worker processes running the native
+    # reader and writer; their notes come back with the result and go to log_fn here
+    def __init__(self, size: int = IMPORT_PROCESSES, template_path=None, log_fn=print):
+        self.size = max(1, int(size))
+        self.template_path = SEED_TEMPLATE_PATH if template_path is None else template_path
+        self.log_fn = log_fn
+        self.executor = None
+        self.lock = threading.Lock()
+        self.completed = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.size)
+        return self
+
+    def import_html(self, ai_html_path: str, out_docx_path: str):
+        self.start()
+        saved, note = self.executor.submit(_write_docx, ai_html_path, out_docx_path, self.template_path).result()
+        with self.lock:
+            self.completed += 1
+        if note:
+            self.log_fn(note)
+        return saved
+
+    def export(self, docx_path: str):
+        self.start()
+        *exported, note = self.executor.submit(_export_docx, docx_path).result()
+        with self.lock:
+            self.completed += 1
+        if note:
+            self.log_fn(note)
+        return tuple(exported)
+
+    def shutdown(self):
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+# ---------- Native DOCX reader ----------
+# .docx to the filtered HTML Word's export gives; ADA_EXPORT_BACKEND=native (.doc stays in Word).
+EXPORT_BACKEND = os.environ.get("ADA_EXPORT_BACKEND", "word" if WIN32_AVAILABLE else "native").strip().lower()
+NATIVE_EXPORT_EXTS = (".docx", ".docm", ".dotx")
+MEDIA_COPY_BLOCK = 1024 * 1024
+_EMU_PER_PX = 9525
+
+_W = "{%s}" % _W_NS
+_R = "{%s}" % _R_NS
+_A = "{%s}" % _DOC_NAMESPACES["a"]
+_WP = "{%s}" % _DOC_NAMESPACES["wp"]
+_V = "{urn:schemas-microsoft-com:vml}"
+_MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+_RUN_CONTAINERS = tuple(_W + t for t in ("ins", "smartTag", "fldSimple", "customXml", "dir", "bdo", "moveTo"))
+_OFF_VALUES = ("0", "false", "off", "none")
+_SYMBOL_BULLETS = {"\uf0b7": "·", "\uf0a7": "§", "\uf0d8": "Ø", "\uf076": "v", "\uf0fc": "ü", "\uf06e": "n",
+                   "\uf0a8": "¨", "\uf0e8": "è"}
+_ROMAN_DIGITS = ((1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"), (50, "l"),
+                 (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i"))
+_CHAR_STYLE_TAGS = {"strong": "b", "emphasis": "i"}
+_FORMAT_ORDER = ("b", "i", "u", "s", "sup", "sub")
+_LIST_GAP = "<span style='font:7.0pt \"Times New Roman\"'>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp; </span>"
+_DOCX_HTML_HEAD = ('<html>\n\n<head>\n<meta http-equiv=Content-Type content="text/html; charset=utf-8">\n'
+                   "</head>\n\n<body lang=EN-US style='word-wrap:break-word'>\n\n<div class=WordSection1>\n\n")
+_DOCX_HTML_TAIL = "</div>\n\n</body>\n\n</html>\n"
+
+def _on(el) -> bool:
+    # A w:b/w:i style toggle: present and not switched off
+    return el is not None and el.get(_W + "val", "true").lower() not in _OFF_VALUES
+
+def _list_number(fmt: str, n: int) -> str:
+    if fmt in ("lowerLetter", "upperLetter"):
+        s = chr(97 + (n - 1) % 26) * ((n - 1) // 26 + 1) if n > 0 else ""
+        return s.upper() if fmt == "upperLetter" else s
+    if fmt in ("lowerRoman", "upperRoman"):
+        s = ""
+        for value, digits in _ROMAN_DIGITS:
+            while n >= value:
+                s += digits
+                n -= value
+        return s.upper() if fmt == "upperRoman" else s
+    if fmt == "decimalZero":
+        return f"{n:02d}"
+    if fmt == "none":
+        return ""
+    return str(n)
+
+def _word_class(name: str, custom: bool) -> str:
+    # Word's filtered HTML: built-in styles become MsoListParagraph/MsoToc1, custom ones keep their name
+    if custom:
+        return re.sub(r"[^A-Za-z0-9]", "", name) or "MsoNormal"
+    return "Mso" + re.sub(r"[^A-Za-z0-9]", "", "".join(w[:1].upper() + w[1:].lower() for w in name.split()))
+
+class DocxReader:
+    # Styles, numbering and relationships of one open .docx; blocks() yields body HTML
+    def __init__(self, zf, media_dir: str, media_href: str):
+        self.zf = zf
+        self.names = set(zf.namelist())
+        self.media_dir = media_dir
+        self.media_href = media_href
+        self.media = {}        # part name -> file name in media_dir
+        self.images = 0
+        self.missing_images = 0
+        self.main = "word/document.xml"
+        for rel in self._rels("_rels/.rels").values():
+            if rel[0] == "officeDocument":
+                self.main = rel[1].lstrip("/")
+        self.main_dir = posixpath.dirname(self.main)
+        self.rels = self._rels(f"{self.main_dir}/_rels/{posixpath.basename(self.main)}.rels", self.main_dir)
+        self.style_names = {}
+        self.style_custom = set()
+        self.based_on = {}
+        self.style_num = {}    # styleId -> (numId, ilvl)
+        self.default_style = None
+        styles = self._xml(self._part("styles"))
+        for st in (styles.iter(_W + "style") if styles is not None else ()):
+            sid = st.get(_W + "styleId")
+            nm = st.find(_W + "name")
+            self.style_names[sid] = nm.get(_W + "val") if nm is not None else sid
+            if st.get(_W + "customStyle") in ("1", "true"):
+                self.style_custom.add(sid)
+            if st.get(_W + "type") == "paragraph" and st.get(_W + "default") in ("1", "true"):
+                self.default_style = sid
+            bo = st.find(_W + "basedOn")
+            if bo is not None:
+                self.based_on[sid] = bo.get(_W + "val")
+            num = st.find(f"{_W}pPr/{_W}numPr")
+            if num is not None:
+                self.style_num[sid] = self._num_pr(num)
+        self.levels = {}       # abstractNumId -> {ilvl: (numFmt, lvlText, start, font, margin style)}
+        self.nums = {}         # numId -> (abstractNumId, {ilvl: startOverride})
+        self.counters = {}
+        numbering = self._xml(self._part("numbering"))
+        if numbering is not None:
+            for an in numbering.iter(_W + "abstractNum"):
+                self.levels[an.get(_W + "abstractNumId")] = {
+                    int(lvl.get(_W + "ilvl", "0")): self._level(lvl) for lvl in an.iter(_W + "lvl")}
+            for num in numbering.iter(_W + "num"):
+                aid = num.find(_W + "abstractNumId")
+                overrides = {}
+                for ov in num.iter(_W + "lvlOverride"):
+                    so = ov.find(_W + "startOverride")
+                    if so is not None:
+                        overrides[int(ov.get(_W + "ilvl", "0"))] = int(so.get(_W + "val", "1"))
+                self.nums[num.get(_W + "numId")] = (aid.get(_W + "val") if aid is not None else None, overrides)
+
+    def _rels(self, part: str, base: str = "") -> dict:
+        rels = {}
+        root = self._xml(part)
+        for rel in (root if root is not None else ()):
+            target = rel.get("Target", "")
+            external = rel.get("TargetMode") == "External"
+            if not external:
+                target = posixpath.normpath(posixpath.join(base, target)) if not target.startswith("/") else target[1:]
+            rels[rel.get("Id")] = (rel.get("Type", "").rsplit("/", 1)[-1], target, external)
+        return rels
+
+    def _part(self, kind: str) -> str:
+        for rtype, target, external in self.rels.values():
+            if rtype == kind and not external:
+                return target
+        return ""
+
+    def _xml(self, part: str):
+        if not part or part not in self.names:
+            return None
+        try:
+            return ET.fromstring(self.zf.read(part))
+        except ET.ParseError:
+            return None
+
+    def _num_pr(self, num):
+        nid, ilvl = num.find(_W + "numId"), num.find(_W + "ilvl")
+        return (nid.get(_W + "val") if nid is not None else None,
+                int(ilvl.get(_W + "val", "0")) if ilvl is not None else 0)
+
+    def _level(self, lvl):
+        fmt, text, start = lvl.find(_W + "numFmt"), lvl.find(_W + "lvlText"), lvl.find(_W + "start")
+        fonts = lvl.find(f"{_W}rPr/{_W}rFonts")
+        ind = lvl.find(f"{_W}pPr/{_W}ind")
+        margin = ""
+        if ind is not None and ind.get(_W + "left"):
+            margin = f"margin-left:{int(ind.get(_W + 'left')) / 1440:g}in"
+            hanging = ind.get(_W + "hanging")
+            if hanging:
+                margin += f";text-indent:-{int(hanging) / 1440:g}in"
+        return (fmt.get(_W + "val", "decimal") if fmt is not None else "decimal",
+                text.get(_W + "val", "") if text is not None else "",
+                int(start.get(_W + "val", "1")) if start is not None else 1,
+                fonts.get(_W + "ascii", "") if fonts is not None else "",
+                margin)
+
+    def _style_chain(self, sid):
+        for _ in range(10):
+            if not sid:
+                return
+            yield sid
+            sid = self.based_on.get(sid)
+
+    def _list_marker(self, nid, ilvl: int):
+        # (marker html, margin style) for one numbered paragraph; advances the list counters
+        aid, overrides = self.nums.get(nid, (None, {}))
+        levels = self.levels.get(aid)
+        if not levels or ilvl not in levels:
+            return None
+        # Instances of one abstract list continue each other unless they restart it
+        key = ("num", nid) if overrides else ("abstract", aid)
+        counts = self.counters.get(key)
+        if counts is None:
+            counts = self.counters[key] = [None] * 9
+        ilvl = min(ilvl, 8)
+        for i in range(ilvl + 1):
+            lvl = levels.get(i)
+            start = overrides.get(i, lvl[2] if lvl else 1)
+            if i == ilvl:
+                counts[i] = start if counts[i] is None else counts[i] + 1
+            elif counts[i] is None:
+                counts[i] = start
+        for i in range(ilvl + 1, 9):
+            counts[i] = None
+        fmt, text, _, font, margin = levels[ilvl]
+        if fmt == "bullet":
+            marker = "".join(_SYMBOL_BULLETS.get(ch, ch) for ch in text) or "·"
+        else:
+            def number(m):
+                i = int(m.group(1)) - 1
+                lvl = levels.get(i)
+                return _list_number(lvl[0] if lvl else "decimal", counts[i] or 1)
+            marker = re.sub(r"%([1-9])", number, text)
+        if not marker:
+            return "", margin
+        font_style = f" style='font-family:{font}'" if font else ""
+        return f"<span{font_style}>{html.escape(marker, quote=False)}{_LIST_GAP}</span>", margin
+
+    def _media_src(self, rid):
+        rel = self.rels.get(rid)
+        if rel is None:
+            self.missing_images += 1
+            return None
+        if rel[2]:
+            return rel[1]
+        part = rel[1]
+        name = self.media.get(part)
+        if name is None:
+            if part not in self.names:
+                self.missing_images += 1
+                return None
+            name = f"image{len(self.media) + 1:03d}{posixpath.splitext(part)[1].lower()}"
+            os.makedirs(self.media_dir, exist_ok=True)
+            with self.zf.open(part) as src, open(os.path.join(self.media_dir, name), "wb") as dst:
+                shutil.copyfileobj(src, dst, MEDIA_COPY_BLOCK)
+            self.media[part] = name
+        return f"{self.media_href}/{name}"
+
+    def _img(self, rid, width: float, height: float, alt: str) -> str:
+        src = self._media_src(rid)
+        if src is None:
+            return ""
+        self.images += 1
+        size = f"width={round(width)} height={round(height)} " if width and height else ""
+        return f'<img {size}src="{html.escape(src)}" alt="{html.escape(alt or "")}">'
+
+    def _drawing(self, el) -> str:
+        out = []
+        extent = el.find(f".//{_WP}extent")
+        doc_pr = el.find(f".//{_WP}docPr")
+        alt = (doc_pr.get("descr") or doc_pr.get("title") or "") if doc_pr is not None else ""
+        cx = int(extent.get("cx", "0")) / _EMU_PER_PX if extent is not None else 0
+        cy = int(extent.get("cy", "0")) / _EMU_PER_PX if extent is not None else 0
+        for blip in el.iter(_A + "blip"):
+            rid = blip.get(_R + "embed") or blip.get(_R + "link")
+            if rid:
+                out.append(self._img(rid, cx, cy, alt))
+        return "".join(out)
+
+    def _vml(self, el) -> str:
+        out = []
+        for shape in el.iter(_V + "shape"):
+            size = dict(re.findall(r"(width|height)\s*:\s*([\d.]+)pt", shape.get("style", "")))
+            for data in shape.iter(_V + "imagedata"):
+                rid = data.get(_R + "id")
+                if rid:
+                    out.append(self._img(rid, float(size.get("width", 0)) * 4 / 3,
+                                         float(size.get("height", 0)) * 4 / 3,
+                                         shape.get("alt") or data.get("{urn:schemas-microsoft-com:office:office}title", "")))
+        return "".join(out)
+
+    def _run(self, r, segments):
+        rpr = r.find(_W + "rPr")
+        fmt = []
+        cls = ""
+        if rpr is not None:
+            rs = rpr.find(_W + "rStyle")
+            if rs is not None:
+                sid = rs.get(_W + "val")
+                name = self.style_names.get(sid, sid)
+                tag = _CHAR_STYLE_TAGS.get(name.lower())
+                if tag:
+                    fmt.append(tag)
+                elif sid in self.style_custom:
+                    cls = _word_class(name, True)
+            if _on(rpr.find(_W + "b")):
+                fmt.append("b")
+            if _on(rpr.find(_W + "i")):
+                fmt.append("i")
+            if _on(rpr.find(_W + "u")):
+                fmt.append("u")
+            if _on(rpr.find(_W + "strike")) or _on(rpr.find(_W + "dstrike")):
+                fmt.append("s")
+            va = rpr.find(_W + "vertAlign")
+            if va is not None:
+                fmt.append({"superscript": "sup", "subscript": "sub"}.get(va.get(_W + "val"), ""))
+        key = (cls,) + tuple(t for t in _FORMAT_ORDER if t in fmt)
+        for el in r:
+            tag = el.tag
+            if tag == _W + "t":
+                segments.append((key, html.escape(el.text or "", quote=False)))
+            elif tag == _W + "tab" or tag == _W + "ptab":
+                segments.append((key, " "))
+            elif tag == _W + "br" or tag == _W + "cr":
+                if el.get(_W + "type") == "page":
+                    segments.append((None, "<br clear=all style='page-break-before:always'>"))
+                else:
+                    segments.append((None, "<br>"))
+            elif tag == _W + "noBreakHyphen":
+                segments.append((key, "-"))
+            elif tag == _W + "drawing":
+                segments.append((None, self._drawing(el)))
+            elif tag == _W + "pict" or tag == _W + "object":
+                segments.append((None, self._vml(el)))
+            elif tag == _MC + "AlternateContent":
+                choice = el.find(_MC + "Choice")
+                pick = choice if choice is not None and choice.find(f".//{_A}blip") is not None else el.find(_MC + "Fallback")
+                if pick is not None:
+                    for child in pick:
+                        if child.tag == _W + "drawing":
+                            segments.append((None, self._drawing(child)))
+                        elif child.tag == _W + "pict":
+                            segments.append((None, self._vml(child)))
+
+    def _inline(self, parent, segments):
+        for el in parent:
+            tag = el.tag
+            if tag == _W + "r":
+                self._run(el, segments)
+            elif tag == _W + "hyperlink":
+                rel = self.rels.get(el.get(_R + "id"))
+                href = rel[1] if rel is not None and rel[2] else ""
+                if el.get(_W + "anchor"):
+                    href += "#" + el.get(_W + "anchor")
+                inner = []
+                self._inline(el, inner)
+                body = _merge_segments(inner)
+                segments.append((None, f'<a href="{html.escape(href)}">{body}</a>' if href else body))
+            elif tag == _W + "bookmarkStart":
+                name = el.get(_W + "name", "")
+                if name and name != "_GoBack":
+                    segments.append((None, f'<a name="{html.escape(name)}"></a>'))
+            elif tag == _W + "sdt":
+                content = el.find(_W + "sdtContent")
+                if content is not None:
+                    self._inline(content, segments)
+            elif tag in _RUN_CONTAINERS:
+                self._inline(el, segments)
+
+    def _paragraph(self, p) -> str:
+        ppr = p.find(_W + "pPr")
+        sid, num, align = None, None, ""
+        if ppr is not None:
+            ps = ppr.find(_W + "pStyle")
+            sid = ps.get(_W + "val") if ps is not None else None
+            np_ = ppr.find(_W + "numPr")
+            if np_ is not None:
+                num = self._num_pr(np_)
+            jc = ppr.find(_W + "jc")
+            if jc is not None:
+                align = {"center": "center", "right": "right", "end": "right", "both": "justify"}.get(jc.get(_W + "val"), "")
+        sid = sid or self.default_style
+        if num is None or num[0] is None:
+            for s in self._style_chain(sid):
+                if s in self.style_num:
+                    nid, ilvl = self.style_num[s]
+                    num = (nid, num[1] if num and num[1] else ilvl)
+                    break
+        segments = []
+        self._inline(p, segments)
+        body = _merge_segments(segments)
+        name = self.style_names.get(sid, "Normal") if sid else "Normal"
+        m = re.match(r"(?i)heading ([1-6])$", name)
+        if m and sid not in self.style_custom:
+            return f"<h{m.group(1)}>{body}</h{m.group(1)}>"
+        attrs = f"class={_word_class(name, sid in self.style_custom)}"
+        if align:
+            attrs += f" align={align}"
+        marker = None
+        if num is not None and num[0] not in (None, "0"):
+            marker = self._list_marker(num[0], num[1])
+        if marker is not None:
+            prefix, margin = marker
+            if margin:
+                attrs += f" style='{margin}'"
+            body = prefix + body
+        if not re.sub(r"<a name=[^>]*></a>", "", body).strip():
+            body += "&nbsp;"
+        return f"<p {attrs}>{body}</p>"
+
+    def _cell_blocks(self, tc) -> str:
+        return "\n".join(b for el in tc for b in self._block(el))
+
+    def _table(self, tbl) -> str:
+        # gridSpan becomes colspan; a vMerge restart spans the continue cells below it
+        grid = []
+        for tr in tbl.findall(_W + "tr"):
+            cells, col = [], 0
+            for tc in tr.findall(_W + "tc"):
+                span, merge, width = 1, None, 0
+                tcpr = tc.find(_W + "tcPr")
+                if tcpr is not None:
+                    gs = tcpr.find(_W + "gridSpan")
+                    if gs is not None:
+                        span = max(1, int(gs.get(_W + "val", "1")))
+                    vm = tcpr.find(_W + "vMerge")
+                    if vm is not None:
+                        merge = vm.get(_W + "val", "continue")
+                    tw = tcpr.find(_W + "tcW")
+                    if tw is not None and tw.get(_W + "type", "dxa") == "dxa":
+                        width = int(float(tw.get(_W + "w", "0")))
+                cells.append([tc, col, span, merge, width, 1])
+                col += span
+            grid.append(cells)
+        for r, cells in enumerate(grid):
+            for cell in cells:
+                if cell[3] != "restart":
+                    continue
+                for below in grid[r + 1:]:
+                    nxt = next((c for c in below if c[1] == cell[1]), None)
+                    if nxt is None or nxt[3] != "continue":
                         break
+                    cell[5] += 1
+        ts = tbl.find(f"{_W}tblPr/{_W}tblStyle")
+        sid = ts.get(_W + "val") if ts is not None else None
+        cls = _word_class(self.style_names.get(sid, sid), sid in self.style_custom) if sid else "MsoNormalTable"
+        out = [f"<table class={cls} border=1 cellspacing=0 cellpadding=0>"]
+        for cells in grid:
+            out.append("<tr>")
+            for tc, _, span, merge, width, rowspan in cells:
+                if merge == "continue":
+                    continue
+                attrs = f" width={round(width / 15)}" if width else ""
+                if span > 1:
+                    attrs += f" colspan={span}"
+                if rowspan > 1:
+                    attrs += f" rowspan={rowspan}"
+                out.append(f"<td{attrs} valign=top>\n{self._cell_blocks(tc)}\n</td>")
+            out.append("</tr>")
+        out.append("</table>")
+        return "\n".join(out)
+
+    def _block(self, el):
+        tag = el.tag
+        if tag == _W + "p":
+            yield self._paragraph(el)
+        elif tag == _W + "tbl":
+            yield self._table(el)
+        elif tag == _W + "sdt":
+            content = el.find(_W + "sdtContent")
+            if content is not None:
+                for child in content:
+                    yield from self._block(child)
+        elif tag == _W + "customXml":
+            for child in el:
+                yield from self._block(child)
+
+    def blocks(self):
+        # iterparse holds one body element at a time; it is dropped once its HTML is out
+        depth = 0
+        body = None
+        with self.zf.open(self.main) as f:
+            for event, el in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if depth == 2 and el.tag == _W + "body":
+                        body = el
+                    continue
+                depth -= 1
+                if depth == 2 and body is not None:
+                    yield from self._block(el)
+                    body.remove(el)
+
+def _merge_segments(segments) -> str:
+    # Adjacent runs with the same formatting share one set of tags, as in Word's export
+    out = []
+    i, n = 0, len(segments)
+    while i < n:
+        key, text = segments[i]
+        if key is None:
+            out.append(text)
+            i += 1
+            continue
+        j = i + 1
+        parts = [text]
+        while j < n and segments[j][0] == key:
+            parts.append(segments[j][1])
+            j += 1
+        inner = "".join(parts)
+        cls, tags = key[0], key[1:]
+        if inner.strip():
+            for t in reversed(tags):
+                inner = f"<{t}>{inner}</{t}>"
+            if cls:
+                inner = f"<span class={cls}>{inner}</span>"
+        out.append(inner)
+        i = j
+    return "".join(out)
+
+def _export_docx(docx_path: str):
+    # Word export's (html_path, assets_dir, short_base) plus a note for the log; a fresh
+    # folder per call so worker processes exporting same-named files never share one
+    src = norm_path(docx_path)
+    if not os.path.isfile(src):
+        raise FileNotFoundError(f"Not a file: {src}")
+    base = os.path.splitext(os.path.basename(src))[0]
+    short_base = re.sub(r"[^A-Za-z0-9._-]+", "_", base)[:40] or "doc"
+    out_dir = tempfile.mkdtemp(prefix=f"html_{short_base}_{timestamp()}_")
+    html_path = os.path.join(out_dir, f"{short_base}.html")
+    media_dir = os.path.join(out_dir, f"{short_base}_files")
+    with span("docx_read", src) as sp, zipfile.ZipFile(src) as zf:
+        reader = DocxReader(zf, media_dir, f"{short_base}_files")
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(_DOCX_HTML_HEAD)
+            for block in reader.blocks():
+                f.write(block)
+                f.write("\n\n")
+            f.write(_DOCX_HTML_TAIL)
+        sp.set(bytes_in=os.path.getsize(src), images=reader.images, media=len(reader.media))
+    note = f"Native DOCX reader: {reader.missing_images} image(s) missing from {src}" if reader.missing_images else ""
+    assets_dir = media_dir if os.path.isdir(media_dir) else out_dir
+    return html_path, assets_dir, short_base, note
+
+def export_docx_to_html(docx_path: str, log_fn=print):
+    html_path, assets_dir, short_base, note = _export_docx(docx_path)
+    if note:
+        log_fn(note)
+    return html_path, assets_dir, short_base
+
+def native_export_supported(docx_path: str) -> bool:
+    return docx_path.lower().endswith(NATIVE_EXPORT_EXTS) and zipfile.is_zipfile(docx_path)
+
+# ---------- Word sessions and pool ----------
+# Warm Word instances reused across jobs, recycled after WORD_RECYCLE_AFTER and killed when hung.
+WORD_POOL_SIZE = 2
+WORD_RECYCLE_AFTER = 40
+WORD_CALL_TIMEOUT = 600
+
+class ComWordBackend:
+    name = "com"
+
+    def __init__(self, dedicated: bool = True):
+        # Dispatch attaches to a running Word; a pool needs its own instance per worker
+        self.dedicated = dedicated
+        self.launch_lock = threading.Lock()
+        self.launched_pids = {}
+
+    def thread_init(self):
+        pythoncom.CoInitialize()
+
+    def thread_uninit(self):
+        try:
+            pythoncom.CoUninitialize()
+        except Exception:
+            pass
+
+    def _word_pids(self) -> set:
+        try:
+            import win32api
+            import win32con
+            import win32process
+        except ImportError:
+            return set()
+        pids = set()
+        access = win32con.PROCESS_QUERY_INFORMATION | win32con.PROCESS_VM_READ
+        for pid in win32process.EnumProcesses():
+            try:
+                h = win32api.OpenProcess(access, False, pid)
+                try:
+                    if os.path.basename(win32process.GetModuleFileNameEx(h, 0)).lower() == "winword.exe":
+                        pids.add(pid)
+                finally:
+                    win32api.CloseHandle(h)
             except Exception:
                 pass
-        return frame, input_el, matched_selector
+        return pids
+
+    def launch(self):
+        if not WIN32_AVAILABLE:
+            raise RuntimeError("Word automation needs pywin32 on Windows (pip install pywin32).")
+        # The WINWORD.EXE that appears across the launch is ours; launches are serialized so
+        # two workers starting at once cannot claim each other's process
+        with self.launch_lock:
+            before = self._word_pids()
+            if self.dedicated:
+                word = win32.DispatchEx("Word.Application")
+            else:
+                word = win32.Dispatch("Word.Application")
+            new = self._word_pids() - before
+        if len(new) == 1:
+            self.launched_pids[id(word)] = new.pop()
+        word.Visible = False
+        word.DisplayAlerts = 0
+        return word
+
+    def process_id(self, word):
+        pid = self.launched_pids.pop(id(word), None)
+        if pid:
+            return pid
+        # Attached to a running Word (or the diff was ambiguous): ask its window
+        try:
+            import win32gui
+            import win32process
+        except ImportError:
+            return None
+        try:
+            hwnd = word.ActiveWindow.Hwnd
+            if hwnd:
+                return win32process.GetWindowThreadProcessId(hwnd)[1]
+        except Exception:
+            pass
+        try:
+            tag = f"ADAWordSession_{os.getpid()}_{id(word)}"
+            old_caption = word.Caption
+            word.Caption = tag
+            hwnd = win32gui.FindWindow("OpusApp", tag)
+            word.Caption = old_caption
+            if hwnd:
+                return win32process.GetWindowThreadProcessId(hwnd)[1]
+        except Exception:
+            pass
+        return None
+
+    def kill(self, word, pid):
+        # Called from the watchdog thread, where word's COM proxy cannot be used; the PID is all we have
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except Exception:
+            pass
+
+class WordSession:
+    def __init__(self, backend=None, preload_template: bool = True):
+        self.backend = backend or ComWordBackend(dedicated=False)
+        self.preload_template = preload_template
+        self.word = None
+        self.pid = None
+        self.template_path = ""
+        self.template_doc = None
+        self.jobs = 0
+        self._old_options = {}
+
+    def open(self):
+        self.word = self.backend.launch()
+        self.pid = self.backend.process_id(self.word)
+        for name in ("SaveNormalPrompt", "ConfirmConversions"):
+            try:
+                self._old_options[name] = getattr(self.word.Options, name)
+                setattr(self.word.Options, name, False)
+            except Exception:
+                pass
+        set_high_quality(self.word)
+        self.template_path = resolve_import_template(self.word)
+        if self.preload_template and SEED_TEMPLATE_PATH and self.template_path == SEED_TEMPLATE_PATH:
+            # Keeping the seed open makes each Documents.Add reuse the loaded template
+            try:
+                self.template_doc = with_retry(
+                    self.word.Documents.Open,
+                    FileName=norm_path(self.template_path),
+                    ReadOnly=True,
+                    AddToRecentFiles=False,
+                    Visible=False
+                )
+            except Exception:
+                self.template_doc = None
+        return self
+
+    def export(self, docx_path: str):
+        result = _export_with_word(self.word, docx_path)
+        self.jobs += 1
+        return result
+
+    def import_html(self, ai_html_path: str, out_docx_path: str):
+        result = _import_with_word(self.word, ai_html_path, out_docx_path, self.template_path)
+        self.jobs += 1
+        return result
+
+    def close(self):
+        word = self.word
+        self.word = None
+        if word is None:
+            return
+        try:
+            if self.template_doc is not None:
+                self.template_doc.Close(SaveChanges=False)
+        except Exception:
+            pass
+        self.template_doc = None
+        for name, value in self._old_options.items():
+            try:
+                setattr(word.Options, name, value)
+            except Exception:
+                pass
+        try:
+            word.Quit()
+        except Exception:
+            pass
+
+    def kill(self) -> bool:
+        # False when the process is unknown and so was left running
+        word = self.word
+        self.word = None
+        self.template_doc = None
+        if word is None:
+            return True
+        if not self.pid:
+            return False
+        self.backend.kill(word, self.pid)
+        return True
+
+class _WordWorker:
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.session = None
+        self.thread = None
+        self.job = None
+        self.job_started = 0.0
+        self.retired = False
+
+class WordPool:
+    def __init__(self, size: int = WORD_POOL_SIZE, backend=None, recycle_after: int = WORD_RECYCLE_AFTER,
+                 call_timeout: float = WORD_CALL_TIMEOUT, preload_template: bool = True, log_fn=print):
+        self.size = max(1, int(size))
+        self.backend = backend or ComWordBackend(dedicated=True)
+        self.recycle_after = recycle_after
+        self.call_timeout = call_timeout
+        self.preload_template = preload_template
+        self.log_fn = log_fn
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.closed = False
+        self.launches = 0
+        self.recycles = 0
+        self.hangs = 0
+        self.completed = 0
+        self._watchdog = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def start(self):
+        for slot in range(self.size):
+            self._spawn(slot)
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+        return self
+
+    def _spawn(self, slot: int):
+        w = _WordWorker(slot)
+        w.thread = threading.Thread(target=self._run, args=(w,), daemon=True, name=f"word-{slot}")
+        with self.lock:
+            self.workers.append(w)
+        w.thread.start()
+        return w
+
+    def submit(self, kind: str, *args) -> Future:
+        if self.closed:
+            raise RuntimeError("Word pool is shut down.")
+        fut = Future()
+        self.jobs.put((kind, args, fut))
+        return fut
+
+    def export(self, docx_path: str):
+        return self.submit("export", docx_path).result()
+
+    def import_html(self, ai_html_path: str, out_docx_path: str):
+        return self.submit("import", ai_html_path, out_docx_path).result()
+
+    def _retire_session(self, w: _WordWorker, hung: bool = False):
+        session = w.session
+        w.session = None
+        if session is None:
+            return True
+        if hung:
+            return session.kill()
+        session.close()
+        return True
+
+    def _run(self, w: _WordWorker):
+        self.backend.thread_init()
+        try:
+            while not w.retired:
+                item = self.jobs.get()
+                if item is None:
+                    break
+                kind, args, fut = item
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if w.session is None:
+                        w.session = WordSession(self.backend, self.preload_template).open()
+                        with self.lock:
+                            self.launches += 1
+                    with self.lock:
+                        w.job, w.job_started = fut, time.monotonic()
+                    # Spans on this thread belong to the source document (the output path on import)
+                    with span(f"word_{kind}", args[-1]):
+                        if kind == "export":
+                            result = w.session.export(*args)
+                        else:
+                            result = w.session.import_html(*args)
+                    with self.lock:
+                        w.job = None
+                        self.completed += 1
+                    if not fut.done():
+                        fut.set_result(result)
+                except Exception as e:
+                    with self.lock:
+                        w.job = None
+                    if not fut.done():
+                        fut.set_exception(e)
+                    if isinstance(e, ComError) and com_hresult(e) in (RPC_S_SERVER_UNAVAILABLE, RPC_E_SERVER_DIED):
+                        w.session = None
+                if w.retired:
+                    break
+                if w.session is not None and w.session.jobs >= self.recycle_after:
+                    self._retire_session(w)
+                    with self.lock:
+                        self.recycles += 1
+        finally:
+            if not w.retired:
+                self._retire_session(w)
+            self.backend.thread_uninit()
+
+    def _watch(self):
+        while not self.closed:
+            time.sleep(0.5 if self.call_timeout > 2 else 0.05)
+            now = time.monotonic()
+            hung = []
+            with self.lock:
+                for w in self.workers:
+                    if w.job is not None and not w.retired and now - w.job_started > self.call_timeout:
+                        w.retired = True
+                        hung.append(w)
+                for w in hung:
+                    self.workers.remove(w)
+                    self.hangs += 1
+            for w in hung:
+                fut = w.job
+                if fut is not None and not fut.done():
+                    fut.set_exception(TimeoutError(f"Word call exceeded {self.call_timeout:.0f}s; instance recycled."))
+                try:
+                    self.log_fn(f"Word instance in slot {w.slot} hung; killing it and starting a replacement.")
+                except Exception:
+                    pass
+                if not self._retire_session(w, hung=True):
+                    try:
+                        self.log_fn(f"No process id for the Word instance in slot {w.slot}; "
+                                    "end its WINWORD.EXE in Task Manager.")
+                    except Exception:
+                        pass
+                self._spawn(w.slot)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": self.size,
+                "launches": self.launches,
+                "recycles": self.recycles,
+                "hangs": self.hangs,
+                "completed": self.completed,
+                "queued": self.jobs.qsize(),
+            }
+
+    def shutdown(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.lock:
+            workers = list(self.workers)
+        for _ in workers:
+            self.jobs.put(None)
+        for w in workers:
+            w.thread.join(timeout=30)
+
+# ---------- Browser automation ----------
+# Replies come from the streaming response and a MutationObserver; capture="poll" scrapes instead.
+CAPTURE_QUIET_MS = 500
+CAPTURE_SLICE_MS = 100
+_STREAM_CTYPES = ("event-stream", "ndjson", "json")
+_CAPTURE_WATCH_JS = """() => {
+  const w = window.__adaWatch || (window.__adaWatch = {});
+  if (w.observer) w.observer.disconnect();
+  const last = () => { const b = document.querySelectorAll('pre code, pre, code'); return b.length ? b[b.length - 1] : null; };
+  w.before = last();
+  w.last = performance.now();
+  w.mutations = 0;
+  w.html = false;
+  w.observer = new MutationObserver(() => {
+    w.last = performance.now();
+    w.mutations++;
+    const el = last();
+    w.html = !!el && el !== w.before && /<\\/html/i.test(el.textContent);
+  });
+  w.observer.observe(document.body, {subtree: true, childList: true, characterData: true});
+  return true;
+}"""
+_CAPTURE_DONE_JS = """quiet => {
+  const w = window.__adaWatch;
+  return !!w && w.html && w.mutations > 0 && performance.now() - w.last >= quiet;
+}"""
+_CAPTURE_TEXT_JS = """() => {
+  const b = document.querySelectorAll('pre code, pre, code');
+  return b.length ? b[b.length - 1].textContent : '';
+}"""
+_CAPTURE_PARTIAL_JS = """() => {
+  const w = window.__adaWatch;
+  const b = document.querySelectorAll('pre code, pre, code');
+  const el = b.length ? b[b.length - 1] : null;
+  return el && (!w || el !== w.before) ? el.textContent : '';
+}"""
+
+def _stream_piece(obj):
+    # (text, is a delta) of one streamed event: OpenAI-style choices, or a plain text/content field
+    if isinstance(obj, str):
+        return obj, False
+    if not isinstance(obj, dict):
+        return None, False
+    choices = obj.get("choices")
+    if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+        c = choices[0]
+        for k in ("delta", "message"):
+            v = c.get(k)
+            if isinstance(v, dict) and isinstance(v.get("content"), str):
+                return v["content"], k == "delta"
+        if isinstance(c.get("text"), str):
+            return c["text"], False
+    for k in ("text", "content", "response", "delta"):
+        if isinstance(obj.get(k), str):
+            return obj[k], k == "delta"
+    for k in ("message", "data"):
+        if isinstance(obj.get(k), dict):
+            return _stream_piece(obj[k])
+    return None, False
+
+def add_stream_piece(out: str, data: str, resent: bool = True) -> str:
+    # resent: the source may resend the whole text so far in every event (chat apps seen by
+    # the browser), so a piece that extends what we have replaces it. Deltas always append.
+    if not data or data == "[DONE]":
+        return out
+    try:
+        piece, delta = _stream_piece(json.loads(data))
+    except ValueError:
+        return out
+    if not piece:
+        return out
+    if resent and not delta and out and piece.startswith(out):
+        return piece
+    return out + piece
+
+def text_from_stream_body(body: str, resent: bool = True) -> str:
+    # SSE ("data: {...}"), NDJSON or a single JSON object
+    lines = body.splitlines()
+    payloads = [ln[5:].strip() for ln in lines if ln.startswith("data:")]
+    if not payloads:
+        payloads = [ln.strip() for ln in lines if ln.strip()]
+    out = ""
+    for data in payloads:
+        out = add_stream_piece(out, data, resent)
+    return out
+
+def html_document_in(txt: str) -> str:
+    # The <html>…</html> document in raw model output ("" when incomplete); only unescaped
+    # when the document itself arrived escaped
+    if not txt:
+        return ""
+    t = txt.strip()
+    if t.startswith("```"):
+        nl = t.find("\n")
+        t = t[nl + 1:] if nl != -1 else t[3:]
+        t = t.strip()
+        if t.endswith("```"):
+            t = t[:-3].strip()
+    low = t.lower()
+    if "<html" not in low and "&lt;html" in low:
+        t = html.unescape(t)
+        low = t.lower()
+    s = low.find("<html")
+    e = low.rfind("</html>")
+    if s == -1 or e == -1:
+        return ""
+    doc = t[s:e + 7]
+    low = doc.lower()
+    return doc if "<head" in low and "<body" in low else ""
+
+# ---------- Streaming reply watch ----------
+# Checks the reply as it streams and stops on an unusable one; ADA_STREAM_WATCH=0 turns it off.
+STREAM_WATCH = os.environ.get("ADA_STREAM_WATCH", "1").strip().lower() not in ("0", "false", "no", "off")
+STREAM_RETRIES = 1                  # immediate resubmits after an aborted reply
+STREAM_PREAMBLE_CHARS = 600         # prose before the document that means there will be none
+_STREAM_DOC_RE = re.compile(r'(?i)<!doctype|<html|&lt;html|&lt;!doctype')
+_STREAM_IMG_RE = re.compile(r'(?is)<img\b[^>]*>')
+_STREAM_SRC_RE = re.compile(r'(?is)\bsrc="([^"]+)"')
+_REFUSAL_RE = re.compile(r"(?i)\b(?:i'?m sorry|i am sorry|i apologi[sz]e|i can(?:not|'t|’t) (?:help|assist|comply|do that)"
+                         r"|i(?:'m| am) (?:not able|unable) to|as an ai\b)")
+_ECHO_LINES = tuple(ln.strip() for ln in PROMPT_TEXT.splitlines() if len(ln.strip()) >= 60)
+_ECHO_OVERLAP = max((len(ln) for ln in _ECHO_LINES), default=0)
+
+class ReplyAborted(RuntimeError):
+    pass
+
+class StreamWatch:
+    # feed() takes the whole reply text so far and raises ReplyAborted; images are the src
+    # values of the <img> tags sent, in order
+    def __init__(self, images=(), on_image=None):
+        self.images = list(images)
+        self.on_image = on_image
+        self.started = time.perf_counter()
+        self.pos = 0
+        self.img_pos = 0
+        self.doc_at = -1
+        self.escaped = False
+        self.ended = False
+        self.seen = 0
+        self.reason = ""
+        self.detected_s = None
+
+    def restart(self):
+        # The transport is resending the request; the next reply starts from scratch
+        self.pos = self.img_pos = self.seen = 0
+        self.doc_at = -1
+        self.escaped = self.ended = False
+
+    def _abort(self, reason: str):
+        self.reason = reason
+        self.detected_s = time.perf_counter() - self.started
+        trace_add("stream_abort", self.started, reason=reason)
+        trace_count("stream_aborts")
+        raise ReplyAborted(f"AI reply abandoned while streaming: {reason}")
+
+    def feed(self, text: str):
+        if self.reason:
+            raise ReplyAborted(f"AI reply abandoned while streaming: {self.reason}")
+        n = len(text)
+        if n <= self.pos or self.ended:
+            return
+        if self.doc_at < 0:
+            m = _STREAM_DOC_RE.search(text, max(0, self.pos - 16))
+            if m is None:
+                head = text[:STREAM_PREAMBLE_CHARS]
+                if _REFUSAL_RE.search(head):
+                    self._abort("the model refused")
+                if len(re.sub(r'```\w*|\s', "", text)) > STREAM_PREAMBLE_CHARS:
+                    self._abort("commentary instead of an HTML document")
+            else:
+                self.doc_at = m.start()
+                self.escaped = m.group(0).startswith("&")
+                self.img_pos = self.doc_at
+        window = text[max(0, self.pos - _ECHO_OVERLAP):n]
+        for line in _ECHO_LINES:
+            if line in window:
+                self._abort("the prompt was echoed back")
+        if self.doc_at >= 0 and not self.escaped:
+            for m in _STREAM_IMG_RE.finditer(text, self.img_pos, n):
+                self.img_pos = m.end()
+                src = _STREAM_SRC_RE.search(m.group(0))
+                if src:
+                    self._image(src.group(1).strip())
+            k = text.rfind("<", self.img_pos, n)
+            self.img_pos = k if k != -1 and text.find(">", k, n) == -1 else n
+            if text.lower().find("</html", max(self.doc_at, self.pos - 8), n) != -1:
+                self.close()
+        self.pos = n
+
+    def _image(self, src: str):
+        if self.on_image is not None:
+            try:
+                self.on_image(src)
+            except Exception:
+                pass
+        if self.seen >= len(self.images):
+            return
+        if src == self.images[self.seen]:
+            self.seen += 1
+            return
+        try:
+            j = self.images.index(src, self.seen)
+        except ValueError:
+            return
+        self._abort(f"{j - self.seen} image(s) skipped before {src}")
+
+    def close(self):
+        # The document is complete: every image sent must have come back
+        if self.ended or self.escaped:
+            return
+        self.ended = True
+        if self.doc_at >= 0 and self.seen < len(self.images):
+            self._abort(f"{self.seen} of {len(self.images)} image(s) in the reply")
+
+def payload_images(prompt: str) -> list:
+    # src values of the <img> tags in the HTML a prompt carries (after its last <BEGIN_HTML>)
+    i = prompt.rfind("<BEGIN_HTML>")
+    return _IMG_SRC_RE.findall(prompt[i:] if i != -1 else prompt)
+
+def retry_aborted(ask, retries: int = STREAM_RETRIES):
+    # ask() again at once when a reply was abandoned mid-stream
+    attempt = 0
+    while True:
+        try:
+            return ask()
+        except ReplyAborted:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            trace_count("stream_retries")
+
+class ChatTransport:
+    # What the batch needs from an AI backend. The browser driver serves one conversation at
+    # a time on the thread that started it; thread_safe transports may be called from many.
+    max_parallel = 1
+    thread_safe = False
+    uses_browser = False
+    reconnects = 0
+    # "conversation": follow-up messages in one chat see the earlier ones; "system": each
+    # request carries a system prompt; "": every message must be self-contained
+    session_mode = ""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def ensure_ready(self):
+        pass
+
+    def new_conversation(self):
+        pass
+
+    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3,
+                            watch=None) -> str:
+        # watch: a StreamWatch fed the reply as it arrives (transports that cannot stream
+        # feed it the finished document)
+        raise NotImplementedError
+
+class NavigatorChat(ChatTransport):
+    # One instance can serve a whole batch: start() once, new_conversation() between
+    # documents, and ensure_ready() reconnects only after a crash or an expired login.
+    max_parallel = 1    # one page, so one conversation at a time
+    uses_browser = True
+    session_mode = "conversation"
+    def __init__(self, user_data_dir: str, url: str = NAVIGATOR_CHAT_URL, headless: bool = False,
+                 on_login_required=None, capture: str = "events"):
+        self.user_data_dir = user_data_dir
+        self.url = url
+        self.headless = headless
+        self.on_login_required = on_login_required
+        self.capture = capture
+        self.play = None
+        self.context = None
+        self.page = None
+        self.broken = False
+        self.reconnects = 0
+        self.capturing = False
+        self.net_reply = ""
+        self.captured_via = None
+
+    def start(self):
+        if not PLAYWRIGHT_AVAILABLE:
+            raise RuntimeError("Playwright is not installed (pip install playwright).")
+        self.broken = False
+        self.play = sync_playwright().start()
+        self.context = self.play.chromium.launch_persistent_context(
+            user_data_dir=self.user_data_dir,
+            headless=self.headless,
+            args=["--disable-features=IsolateOrigins,site-per-process"]
+        )
+        self.context.on("close", self._mark_broken)
+        self.page = self.context.new_page()
+        self.page.on("crash", self._mark_broken)
+        self.page.on("close", self._mark_broken)
+        self.page.on("requestfinished", self._on_request_finished)
+        self.page.goto(self.url, wait_until="load")
+        try:
+            self.page.wait_for_load_state("networkidle", timeout=10000)
+        except Exception:
+            pass
+
+    def _mark_broken(self, *_):
+        self.broken = True
+
+    def _on_request_finished(self, request):
+        if not self.capturing:
+            return
+        try:
+            if request.method != "POST":
+                return
+            resp = request.response()
+            if resp is None:
+                return
+            ctype = (resp.headers.get("content-type") or "").lower()
+            if not any(k in ctype for k in _STREAM_CTYPES):
+                return
+            body = resp.text()
+        except Exception:
+            return
+        doc = html_document_in(text_from_stream_body(body))
+        if doc:
+            self.net_reply = doc
+
+    def stop(self):
+        try:
+            if self.context:
+                self.context.close()
+        except Exception:
+            pass
+        try:
+            if self.play:
+                self.play.stop()
+        except Exception:
+            pass
+        self.play = None
+        self.context = None
+        self.page = None
+
+    def is_alive(self) -> bool:
+        if self.broken or self.page is None:
+            return False
+        try:
+            return not self.page.is_closed()
+        except Exception:
+            return False
+
+    def login_expired(self) -> bool:
+        # SSO sends an expired session to another host (the identity provider)
+        try:
+            return (urlparse(self.page.url).hostname or "") != (urlparse(self.url).hostname or "")
+        except Exception:
+            return False
+
+    def ensure_ready(self):
+        if not self.is_alive():
+            if self.page is not None:
+                self.reconnects += 1
+            self.stop()
+            self.start()
+        if self.login_expired():
+            self.page.goto(self.url, wait_until="load")
+            if self.login_expired():
+                if self.on_login_required is None:
+                    raise RuntimeError("Navigator Chat sign-in expired. Sign in again and rerun the batch.")
+                self.on_login_required()
+                self.page.goto(self.url, wait_until="load")
+
+    def new_conversation(self):
+        page = self.page
+        for loc in (page.get_by_role("button", name=re.compile(r"new (chat|conversation)", re.I)),
+                    page.get_by_role("link", name=re.compile(r"new (chat|conversation)", re.I)),
+                    page.locator('a[href$="/c/new"]')):
+            try:
+                if loc.count() > 0:
+                    loc.first.click(timeout=2000)
+                    return
+            except Exception:
+                pass
+        page.goto(self.url, wait_until="domcontentloaded")
+
+    def _find_composer(self):
+        page = self.page
+        frame = page
+        for f in page.frames[::-1]:
+            try:
+                if (urlparse(f.url or "").hostname or "") == urlparse(self.url).hostname:
+                    frame = f
+                    break
+            except Exception:
+                pass
+        selectors = [
+            'textarea',
+            '[contenteditable="true"]',
+            '[role="textbox"]',
+            'div[aria-label*="Message"]',
+            'div[aria-label*="Type"]',
+        ]
+        input_el = None
+        matched_selector = None
+        for sel in selectors:
+            loc = frame.locator(sel)
+            if loc.count() > 0:
+                input_el = loc.first
+                matched_selector = sel
+                try:
+                    input_el.wait_for(state="visible", timeout=5000)
+                except Exception:
+                    pass
+                break
+        if input_el is None:
+            try:
+                frame.locator("body").first.click(timeout=3000)
+                for _ in range(6):
+                    page.keyboard.press("Tab")
+                    time.sleep(0.1)
+                for sel in selectors:
+                    loc = frame.locator(sel)
+                    if loc.count() > 0:
+                        input_el = loc.first
+                        matched_selector = sel
+                        break
+            except Exception:
+                pass
+        return frame, input_el, matched_selector
+
+    def _strip_code_fences_and_unescape(self, txt: str) -> str:
+        if not txt:
+            return txt
+        t = txt.strip()
+        if t.startswith("```"):
+            nl = t.find("\n")
+            if nl != -1:
+                t = t[nl+1:]
+            else:
+                t = t[3:]
+            t = t.strip()
+            if t.endswith("```"):
+                t = t[:-3].strip()
+        if any(e in t for e in ("&lt;", "&gt;", "&amp;")):
+            t = html.unescape(t)
+        return t
+
+    def _watch_dom(self, frame) -> bool:
+        try:
+            return bool(frame.evaluate(_CAPTURE_WATCH_JS))
+        except Exception:
+            return False
+
+    def _wait_for_events(self, frame, deadline: float, watch=None) -> str:
+        # Returns the document as soon as the streaming request finishes or the page goes
+        # quiet with a complete document; "" when neither happened before the deadline.
+        # The code block being written is read for the watch once per slice.
+        while time.time() < deadline:
+            if self.net_reply:
+                self.captured_via = "network"
+                return self.net_reply
+            if self.broken:
+                raise RuntimeError("The Navigator Chat page closed or crashed while waiting for the reply.")
+            try:
+                frame.wait_for_function(_CAPTURE_DONE_JS, arg=CAPTURE_QUIET_MS, polling=50,
+                                        timeout=CAPTURE_SLICE_MS)
+            except Exception:
+                if watch is not None:
+                    try:
+                        partial = frame.evaluate(_CAPTURE_PARTIAL_JS)
+                    except Exception:
+                        partial = ""
+                    if partial:
+                        watch.feed(partial)
+                continue
+            if self.net_reply:
+                continue
+            try:
+                doc = html_document_in(frame.evaluate(_CAPTURE_TEXT_JS))
+            except Exception:
+                doc = ""
+            if doc:
+                self.captured_via = "dom"
+                return doc
+            self._watch_dom(frame)
+        return ""
+
+    def _stop_reply(self, frame):
+        # Best effort: the chat's Stop button, so an abandoned reply stops generating
+        try:
+            frame.get_by_role("button", name=re.compile(r"stop", re.I)).first.click(timeout=1000)
+        except Exception:
+            pass
+
+    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3,
+                            watch=None) -> str:
+        if not content or not content.strip():
+            raise ValueError("Prompt + body HTML is empty. Check the export and packaging steps.")
+        t0 = time.perf_counter()
+        page = self.page
+        page.bring_to_front()
+        try:
+            page.wait_for_load_state("domcontentloaded")
+        except Exception:
+            pass
+        try:
+            page.wait_for_load_state("networkidle", timeout=10000)
+        except Exception:
+            pass
+        frame, input_el, matched = self._find_composer()
+        if input_el is None:
+            page.screenshot(path=f"navigator_no_input_{datetime.datetime.now().strftime('%H%M%S')}.png")
+            raise RuntimeError("Could not find the chat input box. Adjust selectors to your Navigator Chat DOM.")
+        print(f"Chat input matched selector: {matched}")
+        try:
+            input_el.click(timeout=5000)
+        except Exception:
+            pass
+        try:
+            page.keyboard.press("Control+A")
+            page.keyboard.press("Delete")
+        except Exception:
+            pass
+        inserted = False
+        try:
+            tag = input_el.evaluate("el => el.tagName")
+            if str(tag).upper() in ("TEXTAREA", "INPUT"):
+                input_el.fill(content)
+                inserted = True
+                print("Used element.fill to insert content.")
+        except Exception:
+            pass
+        if not inserted:
+            try:
+                page.evaluate("text => navigator.clipboard && navigator.clipboard.writeText(text)", content)
+                time.sleep(0.2)
+                page.keyboard.press("Control+V")
+                inserted = True
+                print("Used clipboard paste (Ctrl+V) to insert content.")
+            except Exception:
+                pass
+        if not inserted:
+            page.keyboard.type(content, delay=0)
+            print("Used page.keyboard.type to insert content.")
+        trace_add("chat_type", t0, bytes_in=len(content))
+        t0 = time.perf_counter()
+        time.sleep(0.3)
+        events = self.capture == "events" and self._watch_dom(frame)
+        self.net_reply = ""
+        self.captured_via = None
+        self.capturing = events
+        sent = False
+        try:
+            frame.get_by_role("button", name=re.compile(r"(send|submit|enter|send message)", re.I)).first.click(timeout=2000)
+            sent = True
+            print("Clicked Send/Submit button.")
+        except Exception:
+            pass
+        if not sent:
+            try:
+                page.keyboard.press("Enter")
+                sent = True
+                print("Pressed Enter to submit.")
+            except Exception:
+                pass
+        if not sent:
+            try:
+                page.keyboard.press("Control+Enter")
+                sent = True
+                print("Pressed Ctrl+Enter to submit.")
+            except Exception:
+                pass
+        if not sent:
+            raise RuntimeError("Could not submit the message.")
+        trace_add("chat_send", t0)
+        t_sent = time.perf_counter()
+
+        def extract_candidate() -> str:
+            for sel in ("pre code", "pre", "code"):
+                loc = frame.locator(sel)
+                n = loc.count()
+                for i in range(n - 1, max(-1, n - 6), -1):
+                    try:
+                        txt = loc.nth(i).inner_text()
+                    except Exception:
+                        continue
+                    if not txt or "<html" not in txt.lower():
+                        continue
+                    t = self._strip_code_fences_and_unescape(txt)
+                    low = t.lower()
+                    s = low.find("<html")
+                    e = low.rfind("</html>")
+                    if s != -1 and e != -1:
+                        return t[s:e+7]
+            try:
+                body_text = frame.inner_text("body")
+            except Exception:
+                body_text = ""
+            t = body_text
+            low = t.lower()
+            s = low.find("<html")
+            e = low.rfind("</html>")
+            if s != -1 and e != -1:
+                return t[s:e+7]
+            return ""
+
+        def looks_complete(doc: str) -> bool:
+            if not doc:
+                return False
+            low = doc.lower()
+            return ("<html" in low and "</html" in low and "<head" in low and "<body" in low)
+
+        deadline = time.time() + wait_seconds
+        if events:
+            try:
+                doc = self._wait_for_events(frame, deadline, watch)
+            except ReplyAborted:
+                self._stop_reply(frame)
+                raise
+            finally:
+                self.capturing = False
+            if doc:
+                trace_add("chat_wait_reply", t_sent, via=self.captured_via or "events", bytes_out=len(doc))
+                if watch is not None:
+                    watch.feed(doc)
+                    watch.close()
+                return doc
+        last = ""
+        stable = 0
+        best = ""
+        changed_at = time.perf_counter()
+        self.captured_via = "poll"
+        while time.time() < deadline:
+            cand = extract_candidate()
+            if cand:
+                best = cand if len(cand) >= len(best) else best
+                if cand == last:
+                    stable += 1
+                else:
+                    stable = 1
+                    last = cand
+                    changed_at = time.perf_counter()
+                if watch is not None and stable == 1:
+                    try:
+                        watch.feed(cand)
+                    except ReplyAborted:
+                        self._stop_reply(frame)
+                        raise
+                if looks_complete(cand) and stable >= stable_checks:
+                    # Time to the final reply text, then the stable_checks wait that confirms it
+                    trace_add("chat_wait_reply", t_sent, end=changed_at, via="poll", bytes_out=len(cand))
+                    trace_add("chat_stable_tail", changed_at, checks=stable)
+                    if watch is not None:
+                        watch.close()
+                    return cand
+            time.sleep(1.0)
+        if looks_complete(best) and len(best) > 200:
+            return best
+        page.screenshot(path=f"navigator_timeout_{datetime.datetime.now().strftime('%H%M%S')}.png")
+        raise TimeoutError("AI response with complete HTML not detected within the timeout window.")
+
+# ---------- HTTP chat transport ----------
+# OpenAI-compatible /chat/completions; ADA_AI_TRANSPORT picks http, tabs or browser (the default).
+AI_TRANSPORT = os.environ.get("ADA_AI_TRANSPORT", "browser").strip().lower()
+AI_HTTP_BASE_URL = os.environ.get("ADA_AI_BASE_URL", "")
+AI_HTTP_API_KEY = os.environ.get("ADA_AI_API_KEY", "")
+AI_HTTP_MODEL = os.environ.get("ADA_AI_MODEL", "")
+AI_HTTP_CONCURRENCY = _env_int("ADA_AI_CONCURRENCY", 4)
+AI_HTTP_RETRIES = 4
+AI_HTTP_BACKOFF = 1.0                 # seconds, doubled per retry with jitter
+AI_HTTP_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+class _RetryableHttpError(Exception):
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+class HttpChatTransport(ChatTransport):
+    thread_safe = True
+    session_mode = "system"
+
+    def __init__(self, base_url: str, api_key: str = "", model: str = "", max_parallel: int = AI_HTTP_CONCURRENCY,
+                 retries: int = AI_HTTP_RETRIES, backoff: float = AI_HTTP_BACKOFF, stream: bool = True,
+                 timeout: float = 600):
+        u = urlparse(base_url)
+        if u.scheme not in ("http", "https") or not u.hostname:
+            raise ValueError(f"Not an http(s) URL: {base_url!r}")
+        self.base_url = base_url
+        self.https = u.scheme == "https"
+        self.host = u.hostname
+        self.port = u.port
+        self.path = u.path.rstrip("/") + "/chat/completions"
+        self.api_key = api_key
+        self.model = model
+        self.max_parallel = max(1, int(max_parallel))
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.stream = stream
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.max_parallel)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.connections = 0
+        self.system_prompt = ""
+
+    def stop(self):
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _connection(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            pass
+        with self.lock:
+            self.connections += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout), False
+
+    def _read_reply(self, resp, watch=None, deadline: float = 0) -> str:
+        # An open stream is cut at the deadline; the socket timeout only bounds each read
+        ctype = (resp.getheader("Content-Type") or "").lower()
+        if "event-stream" not in ctype:
+            out = text_from_stream_body(resp.read().decode("utf-8", "replace"), resent=False)
+            if watch is not None:
+                watch.feed(out)
+                watch.close()
+            return out
+        out = ""
+        for line in resp:
+            if deadline and time.time() > deadline:
+                raise TimeoutError("AI reply was still streaming at the deadline")
+            line = line.decode("utf-8", "replace").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            out = add_stream_piece(out, data, resent=False)
+            if watch is not None:
+                watch.feed(out)
+        resp.read()
+        if watch is not None:
+            watch.close()
+        return out
+
+    def _post_once(self, body: bytes, headers: dict, watch=None, deadline: float = 0) -> str:
+        # A ReplyAborted from the watch closes the connection, which cancels the generation
+        conn, reused = self._connection()
+        keep = False
+        try:
+            conn.request("POST", self.path, body, headers)
+            resp = conn.getresponse()
+            if resp.status in AI_HTTP_RETRY_STATUS:
+                retry_after = resp.getheader("Retry-After")
+                resp.read()
+                keep = not resp.will_close
+                raise _RetryableHttpError(f"AI endpoint returned HTTP {resp.status}", retry_after)
+            if resp.status >= 400:
+                detail = resp.read()[:300].decode("utf-8", "replace")
+                keep = not resp.will_close
+                raise RuntimeError(f"AI endpoint returned HTTP {resp.status}: {detail}")
+            text = self._read_reply(resp, watch, deadline)
+            keep = not resp.will_close
+            return text
+        except (OSError, http.client.HTTPException) as e:
+            # A pooled connection the server already closed fails on first use; not a retry
+            raise _RetryableHttpError(str(e) or type(e).__name__, 0 if reused else None)
+        finally:
+            if keep:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3,
+                            watch=None) -> str:
+        if not content or not content.strip():
+            raise ValueError("Prompt + body HTML is empty. Check the export and packaging steps.")
+        messages = [{"role": "user", "content": content}]
+        if self.system_prompt:
+            messages.insert(0, {"role": "system", "content": self.system_prompt})
+        payload = {"messages": messages, "stream": self.stream}
+        if self.model:
+            payload["model"] = self.model
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json",
+                   "Accept": "text/event-stream" if self.stream else "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        deadline = time.time() + wait_seconds
+        attempt = 0
+        t0 = time.perf_counter()
+        with self.slots:
+            trace_add("ai_slot_wait", t0)
+            while True:
+                with self.lock:
+                    self.requests += 1
+                if watch is not None:
+                    watch.restart()
+                try:
+                    text = self._post_once(body, headers, watch, deadline)
+                    break
+                except _RetryableHttpError as e:
+                    if e.retry_after == 0:
+                        delay = 0.0
+                    else:
+                        if attempt >= self.retries:
+                            raise RuntimeError(f"AI request failed after {attempt + 1} attempt(s): {e}")
+                        try:
+                            delay = float(e.retry_after)
+                        except (TypeError, ValueError):
+                            delay = self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+                        attempt += 1
+                    if time.time() + delay > deadline:
+                        raise TimeoutError(f"AI request did not succeed within {wait_seconds}s: {e}")
+                    with self.lock:
+                        self.retried += 1
+                    trace_count("retries")
+                    time.sleep(delay)
+        doc = html_document_in(text)
+        if not doc:
+            raise ValueError("AI reply did not contain a complete HTML document.")
+        return doc
+
+# ---------- Multi-tab browser transport ----------
+# N tabs of one profile on an asyncio loop thread; a failed tab is replaced on its own.
+CHAT_TABS = _env_int("ADA_AI_TABS", 3)
+
+class _ChatTab:
+    def __init__(self, page):
+        self.page = page
+        self.reply = None       # future the streaming request resolves
+        self.broken = False
+
+class NavigatorChatTabs(ChatTransport):
+    thread_safe = True
+    uses_browser = True
+
+    def __init__(self, user_data_dir: str, url: str = NAVIGATOR_CHAT_URL, tabs: int = CHAT_TABS,
+                 headless: bool = False, on_login_required=None):
+        self.user_data_dir = user_data_dir
+        self.url = url
+        self.max_parallel = max(1, int(tabs))
+        self.headless = headless
+        self.on_login_required = on_login_required
+        self.loop = None
+        self.thread = None
+        self.play = None
+        self.context = None
+        self.free = None
+        self.tabs = []
+        self.login_lock = threading.Lock()
+        self.reconnects = 0
+        self.submitted = 0
+        self.failed = 0
+
+    def _call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def start(self):
+        if not PLAYWRIGHT_AVAILABLE:
+            raise RuntimeError("Playwright is not installed (pip install playwright).")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name="chat-tabs")
+        self.thread.start()
+        try:
+            self._call(self._start())
+        except Exception:
+            self.stop()
+            raise
+
+    async def _start(self):
+        self.play = await async_playwright().start()
+        self.context = await self.play.chromium.launch_persistent_context(
+            user_data_dir=self.user_data_dir,
+            headless=self.headless,
+            args=["--disable-features=IsolateOrigins,site-per-process"]
+        )
+        self.free = asyncio.Queue()
+        self.tabs = []
+        pages = list(self.context.pages)
+        for i in range(self.max_parallel):
+            page = pages[i] if i < len(pages) else await self.context.new_page()
+            tab = await self._open_tab(page)
+            self.tabs.append(tab)
+            self.free.put_nowait(tab)
+
+    async def _open_tab(self, page):
+        tab = _ChatTab(page)
+
+        def mark(*_):
+            tab.broken = True
+
+        page.on("crash", mark)
+        page.on("close", mark)
+        page.on("requestfinished", lambda request: self._on_request_finished(tab, request))
+        await page.goto(self.url, wait_until="load")
+        try:
+            await page.wait_for_load_state("networkidle", timeout=10000)
+        except Exception:
+            pass
+        return tab
+
+    async def _replace(self, tab):
+        try:
+            await tab.page.close()
+        except Exception:
+            pass
+        fresh = await self._open_tab(await self.context.new_page())
+        if tab in self.tabs:
+            self.tabs[self.tabs.index(tab)] = fresh
+        else:
+            self.tabs.append(fresh)
+        self.reconnects += 1
+        return fresh
+
+    def stop(self):
+        if self.loop is None:
+            return
+        try:
+            if self.loop.is_running():
+                self._call(self._stop(), timeout=30)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.loop = None
+        self.thread = None
+
+    async def _stop(self):
+        try:
+            if self.context:
+                await self.context.close()
+        except Exception:
+            pass
+        try:
+            if self.play:
+                await self.play.stop()
+        except Exception:
+            pass
+        self.play = None
+        self.context = None
+        self.tabs = []
+
+    async def _login_expired(self) -> bool:
+        host = urlparse(self.url).hostname or ""
+        for tab in self.tabs:
+            try:
+                if (urlparse(tab.page.url).hostname or "") != host:
+                    return True
+            except Exception:
+                pass
+        return False
+
+    async def _reload_tabs(self):
+        for tab in self.tabs:
+            try:
+                await tab.page.goto(self.url, wait_until="load")
+            except Exception:
+                tab.broken = True
+
+    def ensure_ready(self):
+        if self.loop is None:
+            self.start()
+        with self.login_lock:
+            if not self._call(self._login_expired()):
+                return
+            self._call(self._reload_tabs())
+            if self._call(self._login_expired()):
+                if self.on_login_required is None:
+                    raise RuntimeError("Navigator Chat sign-in expired. Sign in again and rerun the batch.")
+                self.on_login_required()
+                self._call(self._reload_tabs())
+
+    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3,
+                            watch=None) -> str:
+        # The tabs hand back finished replies only, so the watch checks the whole document
+        if not content or not content.strip():
+            raise ValueError("Prompt + body HTML is empty. Check the export and packaging steps.")
+        doc = self._call(self._submit(content, wait_seconds))
+        if watch is not None:
+            watch.feed(doc)
+            watch.close()
+        return doc
+
+    async def _submit(self, content: str, wait_seconds: int) -> str:
+        tab = await self.free.get()
+        try:
+            if tab.broken or tab.page.is_closed():
+                tab = await self._replace(tab)
+            self.submitted += 1
+            return await asyncio.wait_for(self._ask(tab, content), wait_seconds)
+        except Exception:
+            self.failed += 1
+            try:
+                tab = await self._replace(tab)
+            except Exception:
+                tab.broken = True
+            raise
+        finally:
+            self.free.put_nowait(tab)
+
+    async def _on_request_finished(self, tab, request):
+        if tab.reply is None or tab.reply.done():
+            return
+        try:
+            if request.method != "POST":
+                return
+            resp = await request.response()
+            if resp is None:
+                return
+            ctype = (resp.headers.get("content-type") or "").lower()
+            if not any(k in ctype for k in _STREAM_CTYPES):
+                return
+            body = await resp.text()
+        except Exception:
+            return
+        doc = html_document_in(text_from_stream_body(body))
+        if doc and tab.reply is not None and not tab.reply.done():
+            tab.reply.set_result(doc)
+
+    async def _composer(self, page):
+        frame = page
+        host = urlparse(self.url).hostname
+        for f in page.frames[::-1]:
+            if (urlparse(f.url or "").hostname or "") == host:
+                frame = f
+                break
+        for sel in ('textarea', '[contenteditable="true"]', '[role="textbox"]',
+                    'div[aria-label*="Message"]', 'div[aria-label*="Type"]'):
+            loc = frame.locator(sel)
+            if await loc.count() > 0:
+                try:
+                    await loc.first.wait_for(state="visible", timeout=5000)
+                except Exception:
+                    pass
+                return frame, loc.first
+        return frame, None
+
+    async def _new_conversation(self, page):
+        for loc in (page.get_by_role("button", name=re.compile(r"new (chat|conversation)", re.I)),
+                    page.get_by_role("link", name=re.compile(r"new (chat|conversation)", re.I)),
+                    page.locator('a[href$="/c/new"]')):
+            try:
+                if await loc.count() > 0:
+                    await loc.first.click(timeout=2000)
+                    return
+            except Exception:
+                pass
+        await page.goto(self.url, wait_until="domcontentloaded")
+
+    async def _dom_reply(self, frame) -> str:
+        while True:
+            await frame.wait_for_function(_CAPTURE_DONE_JS, arg=CAPTURE_QUIET_MS, polling=50, timeout=0)
+            doc = html_document_in(await frame.evaluate(_CAPTURE_TEXT_JS))
+            if doc:
+                return doc
+            await frame.evaluate(_CAPTURE_WATCH_JS)
+
+    async def _ask(self, tab, content: str) -> str:
+        page = tab.page
+        await self._new_conversation(page)
+        frame, box = await self._composer(page)
+        if box is None:
+            raise RuntimeError("Could not find the chat input box. Adjust selectors to your Navigator Chat DOM.")
+        try:
+            await box.click(timeout=5000)
+        except Exception:
+            pass
+        # Per-page input only: the clipboard is shared between tabs
+        if str(await box.evaluate("el => el.tagName")).upper() in ("TEXTAREA", "INPUT"):
+            await box.fill(content)
+        else:
+            await page.keyboard.insert_text(content)
+        await frame.evaluate(_CAPTURE_WATCH_JS)
+        tab.reply = asyncio.get_running_loop().create_future()
+        dom = asyncio.ensure_future(self._dom_reply(frame))
+        try:
+            try:
+                await frame.get_by_role("button", name=re.compile(r"(send|submit|enter|send message)", re.I)) \
+                    .first.click(timeout=2000)
+            except Exception:
+                await box.press("Enter")
+            await asyncio.wait({tab.reply, dom}, return_when=asyncio.FIRST_COMPLETED)
+            if tab.reply.done():
+                return tab.reply.result()
+            return dom.result()
+        finally:
+            dom.cancel()
+            if not tab.reply.done():
+                tab.reply.cancel()
+            tab.reply = None
+
+def make_chat_transport(kind: str = "", user_data_dir: str = "", on_login_required=None):
+    kind = (kind or AI_TRANSPORT).strip().lower()
+    if kind == "http":
+        if not AI_HTTP_BASE_URL:
+            raise RuntimeError("Set ADA_AI_BASE_URL to the OpenAI-compatible endpoint to use the HTTP transport.")
+        return HttpChatTransport(AI_HTTP_BASE_URL, AI_HTTP_API_KEY, AI_HTTP_MODEL, AI_HTTP_CONCURRENCY)
+    if kind == "tabs":
+        return NavigatorChatTabs(user_data_dir, tabs=CHAT_TABS, on_login_required=on_login_required)
+    if kind == "browser":
+        return NavigatorChat(user_data_dir, on_login_required=on_login_required)
+    raise ValueError(f"Unknown AI transport {kind!r} (use 'browser', 'tabs' or 'http').")
+
+# ---------- Chat sessions ----------
+# Instructions once per chat. Off by default: slower in the browser, no fewer bytes over HTTP.
+AI_SESSION = os.environ.get("ADA_AI_SESSION", "0").strip().lower() not in ("0", "false", "no", "off")
+AI_SESSION_MAX_CHARS = _env_int("ADA_AI_SESSION_MAX_CHARS", 240000)
+SESSION_NOTE = ("Every message after this one holds one document between <BEGIN_HTML> and <END_HTML>. "
+                "Convert each one on its own with the rules above and answer with only its HTML document. "
+                "Reply to this message with exactly: <!DOCTYPE html><html><body><p>READY</p></body></html>")
+
+def build_payload(body_html: str, note: str = "") -> str:
+    return f"{note}\n\n<BEGIN_HTML>\n{body_html}\n</END_HTML>\n" if note else f"<BEGIN_HTML>\n{body_html}\n</END_HTML>\n"
+
+class ChatSession:
+    def __init__(self, chat, instructions: str = PROMPT_TEXT, max_chars: int = AI_SESSION_MAX_CHARS):
+        self.chat = chat
+        self.instructions = instructions
+        self.max_chars = max_chars
+        self.primed = False
+        self.chars = 0
+        self.reconnects = chat.reconnects
+        self.primes = 0
+        self.messages = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        if chat.session_mode == "system":
+            chat.system_prompt = instructions
+
+    def _prime(self, doc: str):
+        prime = f"{self.instructions}\n{SESSION_NOTE}"
+        with span("ai_prime", doc, bytes_in=len(prime)):
+            self.chat.new_conversation()
+            reply = self.chat.submit_and_get_html(prime, wait_seconds=600, stable_checks=3)
+        self.primed = True
+        self.primes += 1
+        self.chars = len(prime) + len(reply)
+        self.reconnects = self.chat.reconnects
+        self.bytes_sent += len(prime.encode("utf-8"))
+
+    def ask(self, payload: str, doc: str = "", watch=None) -> str:
+        chat = self.chat
+        with span("ai_request", doc, bytes_in=len(payload)) as sp:
+            chat.ensure_ready()
+            if chat.session_mode == "conversation" and (not self.primed or chat.reconnects != self.reconnects
+                                                        or self.chars + len(payload) > self.max_chars):
+                self._prime(doc)
+            with self.lock:
+                self.messages += 1
+                self.bytes_sent += len(payload.encode("utf-8"))
+                if chat.session_mode == "system":
+                    self.bytes_sent += len(self.instructions.encode("utf-8"))
+            try:
+                reply = chat.submit_and_get_html(payload, wait_seconds=600, stable_checks=3, watch=watch)
+            except Exception:
+                # What the conversation holds after a failed reply is unknown; start clean
+                self.primed = False
+                raise
+            self.chars += len(payload) + len(reply)
+            sp.set(bytes_out=len(reply), primes=self.primes)
+            return reply
+
+    def summary(self) -> str:
+        if self.chat.session_mode == "system":
+            return f"AI session: {self.messages} document message(s), instructions in the system prompt."
+        return f"AI session: {self.messages} document message(s), instructions sent {self.primes} time(s)."
+
+def make_chat_session(chat):
+    if not AI_SESSION or chat is None or getattr(chat, "session_mode", "") not in ("conversation", "system"):
+        return None
+    return ChatSession(chat)
+
+# ---------- AI conversion cache ----------
+# Keyed by prompt and normalized body; old-prompt entries dropped, eviction by age, then size.
+AI_CACHE_DIR = os.path.join(os.path.expanduser("~"), "ADAUpdateCache")
+AI_CACHE_MAX_BYTES = 512 * 1024 * 1024
+AI_CACHE_MAX_AGE_DAYS = 90
+
+def normalize_body_for_cache(body_html: str) -> str:
+    return re.sub(r"\s+", " ", body_html).strip()
+
+class AiCache:
+    def __init__(self, root: str = AI_CACHE_DIR, max_bytes: int = AI_CACHE_MAX_BYTES,
+                 max_age_days: float = AI_CACHE_MAX_AGE_DAYS, prompt_text: str = PROMPT_TEXT):
+        self.root = root
+        self.entries_dir = os.path.join(root, "entries")
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.prompt_text = prompt_text
+        self.prompt_hash = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.parts = {"hits": 0, "misses": 0, "stores": 0}   # section and chunk entries
+        self.evicted = 0
+        self.invalidated = 0
+        os.makedirs(self.entries_dir, exist_ok=True)
+        self._check_prompt()
+        self.evict()
+
+    def _check_prompt(self):
+        marker = os.path.join(self.root, "prompt.sha256")
+        try:
+            with open(marker, "r", encoding="ascii") as f:
+                old = f.read().strip()
+        except OSError:
+            old = ""
+        if old == self.prompt_hash:
+            return
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+                self.invalidated += 1
+            except OSError:
+                pass
+        with open(marker, "w", encoding="ascii") as f:
+            f.write(self.prompt_hash)
+
+    def key(self, body_html: str) -> str:
+        h = hashlib.sha256()
+        h.update(self.prompt_text.encode("utf-8"))
+        h.update(b"\0")
+        h.update(normalize_body_for_cache(body_html).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.entries_dir, key[:2], f"{key}.json")
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.entries_dir):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def get(self, body_html: str, part: bool = False):
+        # part: a section or chunk of a document, counted apart from whole documents
+        path = self._path(self.key(body_html))
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                if part:
+                    self.parts["misses"] += 1
+                else:
+                    self.misses += 1
+            return None
+        with self.lock:
+            if part:
+                self.parts["hits"] += 1
+            else:
+                self.hits += 1
+        return entry["raw"], entry["clean"]
+
+    def put(self, body_html: str, raw_html: str, clean_html: str, part: bool = False):
+        key = self.key(body_html)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        entry = {"key": key, "prompt": self.prompt_hash, "created": time.time(), "raw": raw_html, "clean": clean_html}
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            if part:
+                self.parts["stores"] += 1
+            else:
+                self.stores += 1
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for path, size, mtime in self._entries():
+            if path.endswith(".tmp") or (self.max_age and now - mtime > self.max_age):
+                try:
+                    os.remove(path)
+                    self.evicted += 1
+                except OSError:
+                    pass
+                continue
+            entries.append((mtime, size, path))
+            total += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evicted += 1
+                total -= size
+            except OSError:
+                pass
+
+    def summary(self) -> str:
+        looked_up = self.hits + self.misses
+        rate = f"{100 * self.hits / looked_up:.0f}%" if looked_up else "n/a"
+        line = (f"AI cache: {self.hits} hit(s), {self.misses} miss(es) ({rate} hit rate), "
+                f"{self.stores} stored, {self.evicted} evicted, {self.invalidated} invalidated by prompt change")
+        parts = self.parts
+        if parts["hits"] or parts["misses"] or parts["stores"]:
+            line += (f"\nAI cache sections/chunks: {parts['hits']} hit(s), {parts['misses']} miss(es), "
+                     f"{parts['stores']} stored")
+        return line
+
+# ---------- Section memoization ----------
+# Each section's converted fragment is cached, so a rerun sends only the changed sections.
+SECTION_MEMO = os.environ.get("ADA_SECTION_MEMO", "1").strip().lower() not in ("0", "false", "no", "off")
+SECTION_NOTE = ("The HTML below is {count} changed section(s) of a longer document whose other sections are "
+                "already converted, so convert only these sections.")
+SECTION_NOTE_AFTER = " They follow the heading {heading}; keep the heading levels consistent with it."
+_DIV_TAG_RE = re.compile(r'(?i)</?div\b[^>]*>')
+_LAST_HEADING_RE = re.compile(r'(?is)<(h[1-6])\b[^>]*>(.*?)</\1\s*>')
+
+def section_heading_key(fragment: str) -> str:
+    # Normalized text of the heading that opens fragment; "" when it does not open with one
+    level = None
+    parts = []
+    for kind, raw, name in iter_html_tokens(fragment):
+        if level is None:
+            if kind == HT_START and name in _HEADING_TAGS:
+                level = name
+            elif not (kind == HT_COMMENT or (kind == HT_TEXT and not raw.strip()) or name == "div"):
+                return ""
+            continue
+        if kind == HT_END and name == level:
+            break
+        if kind == HT_TEXT:
+            parts.append(raw)
+    return " ".join(html.unescape("".join(parts)).split()).lower()
+
+def split_sections(body_html: str) -> list:
+    # [[heading key, html, open <div> start tags]]; a piece without heading text joins the previous one
+    sections = []
+    for piece, divs in _split_html_before(body_html, CHUNK_SPLIT_TAGS):
+        key = section_heading_key(piece)
+        if sections and not key:
+            sections[-1][1] += piece
+        else:
+            sections.append([key, piece, divs])
+    return sections
+
+def _section_cache_key(sections, i: int) -> str:
+    return f"<!-- section {'first' if i == 0 else 'later'} -->\n" + _DIV_TAG_RE.sub("", sections[i][1])
+
+def split_reply_sections(sections, reply_html: str):
+    # The converted document cut at the same headings (matched by text, in order, at any level);
+    # None when a heading cannot be found, so nothing is stored for that document
+    body = extract_relevant_html_for_ai(reply_html)
+    out = [[] for _ in sections]
+    idx = 0
+    for piece, _ in _split_html_before(body, _HEADING_TAGS):
+        if idx + 1 < len(sections) and section_heading_key(piece) == sections[idx + 1][0]:
+            idx += 1
+        out[idx].append(piece)
+    if idx != len(sections) - 1:
+        return None
+    return ["".join(p).strip() for p in out]
+
+def store_sections(sections, reply_html: str, cache) -> int:
+    fragments = split_reply_sections(sections, reply_html)
+    if fragments is None:
+        trace_count("sections_unaligned")
+        return 0
+    for i, frag in enumerate(fragments):
+        cache.put(_section_cache_key(sections, i), frag, frag, part=True)
+    return len(fragments)
+
+def _heading_context(fragment: str) -> str:
+    last = None
+    for last in _LAST_HEADING_RE.finditer(fragment):
+        pass
+    if last is None:
+        return ""
+    text = " ".join(html.unescape(re.sub(r'<[^>]*>', "", last.group(2))).split())
+    return f"<{last.group(1).lower()}>{html.escape(text, quote=False)}</{last.group(1).lower()}>" if text else ""
+
+def convert_sections(sections, cache, submit, workers: int = 1, instructions: bool = True):
+    # (document, sections sent), or None when no section is cached and the whole body should go
+    hits = [cache.get(_section_cache_key(sections, i), part=True) for i in range(len(sections))]
+    if all(h is None for h in hits):
+        return None
+    return resend_sections(sections, [h[1] if h is not None else None for h in hits], submit, workers,
+                           instructions)
+
+def resend_sections(sections, fragments, submit, workers: int = 1, instructions: bool = True):
+    # fragments[i] is section i's converted HTML, or None to send it; (document, sections sent)
+    runs = []
+    for i, frag in enumerate(fragments):
+        if frag is not None:
+            continue
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    chunks = []
+    notes = []
+    for first, last in runs:
+        chunks.append(_DIV_TAG_RE.sub("", "".join(s[1] for s in sections[first:last + 1])).strip())
+        note = SECTION_NOTE.format(count=last - first + 1)
+        if first == 0:
+            note += CHUNK_NOTE_FIRST
+        else:
+            note += CHUNK_NOTE_LATER
+            heading = _heading_context(fragments[first - 1])
+            if heading:
+                note += SECTION_NOTE_AFTER.format(heading=heading)
+        notes.append(note)
+    replies = iter(convert_chunks(chunks, submit, workers, instructions=instructions, notes=notes)[0]
+                   if chunks else ())
+    starts = {first for first, _ in runs}
+    parts = []
+    for i, frag in enumerate(fragments):
+        if frag is not None:
+            parts.append(frag)
+        elif i in starts:
+            parts.append(next(replies))
+    return stitch_chunk_html(parts), sum(last - first + 1 for first, last in runs)
+
+# ---------- Reply validation ----------
+# PROMPT_TEXT's self-check in code: local repairs, resends for lost text or images; ADA_VALIDATE=0 skips.
+VALIDATE = os.environ.get("ADA_VALIDATE", "1").strip().lower() not in ("0", "false", "no", "off")
+VALIDATE_MIN_COVERAGE = 0.9         # share of a section's text the reply must keep
+VALIDATE_SHINGLE = 6                # words per shingle for runs the reply merged or split
+_TAG_RE = re.compile(r'<[^>]*>')
+_SPACES_RE = re.compile(r'  +')
+_ALT_RE = re.compile(r'(?is)\balt="([^"]*)"')
+_HTML_START_RE = re.compile(r'(?is)<html\b[^>]*>')
+_STYLE_EL_RE = re.compile(r'(?is)<style\b[^>]*>(.*?)</style\s*>')
+_TITLE_EL_RE = re.compile(r'(?is)<title\b[^>]*>(.*?)</title\s*>')
+_CHARSET_RE = re.compile(r'(?is)<meta\b[^>]*charset')
+_H1_EL_RE = re.compile(r'(?is)<h1\b[^>]*>(.*?)</h1\s*>')
+_REPAIR_RE = re.compile(r'(?is)<img\b[^>]*>|<(/?)h1\b([^>]*)>')
+
+def text_runs(markup: str) -> list:
+    # Space-collapsed text between tags, one entry per run
+    text = html.unescape(_TAG_RE.sub("\n", markup)).replace("\xa0", " ").replace("\t", " ")
+    return [r for r in map(str.strip, _SPACES_RE.sub(" ", text).split("\n")) if r]
+
+def _img_src(tag: str) -> str:
+    m = _STREAM_SRC_RE.search(tag)
+    return m.group(1).strip() if m else ""
+
+def _plain(fragment: str) -> str:
+    return " ".join(html.unescape(_TAG_RE.sub("", fragment)).split())
+
+class _ReplyShingles:
+    # Hashes of the reply's n-word sequences, one set per n built on first use; coverage()
+    # is linear in the run, so every run of the body gets checked
+    def __init__(self, reply_runs, k: int = VALIDATE_SHINGLE):
+        self.words = " ".join(reply_runs).split()
+        self.k = k
+        self.sets = {}
+
+    def has(self, seq: tuple) -> bool:
+        grams = self.sets.get(len(seq))
+        if grams is None:
+            n = len(seq)
+            grams = self.sets[n] = set(map(hash, zip(*(self.words[i:] for i in range(n)))))
+        return hash(seq) in grams
+
+    def coverage(self, run: str) -> int:
+        # Characters of run whose words are in a k-word sequence the reply also has
+        words, k = run.split(), self.k
+        if len(words) <= k:
+            return len(run) if self.has(tuple(words)) else 0
+        covered = upto = 0
+        for i in range(len(words) - k + 1):
+            if self.has(tuple(words[i:i + k])):
+                covered += sum(len(w) + 1 for w in words[max(i, upto):i + k])
+                upto = i + k
+        return min(covered, len(run))
+
+class _ReplyRepair:
+    # re.sub callback over the body: puts back altered <img> tags (matched by src in order,
+    # or by alt when the src changed) and demotes every <h1> after the first
+    def __init__(self, sent):
+        self.sent = sent
+        self.where = {}
+        for i, tag in enumerate(sent):
+            self.where.setdefault(_img_src(tag), []).append(i)
+        self.k = 0
+        self.missing = []
+        self.restored = 0
+        self.unexpected = 0
+        self.h1 = 0
+        self.demoting = False
+
+    def __call__(self, m):
+        raw = m.group(0)
+        if m.group(1) is not None:
+            if m.group(1):
+                if self.demoting:
+                    self.demoting = False
+                    return "</h2>"
+                return raw
+            self.h1 += 1
+            if self.h1 > 1:
+                self.demoting = True
+                return "<h2" + m.group(2) + ">"
+            return raw
+        sent, k = self.sent, self.k
+        idx = self.where.get(_img_src(raw))
+        j = None
+        if idx:
+            at = bisect.bisect_left(idx, k)
+            j = idx[at] if at < len(idx) else None
+        if j is None and k < len(sent):
+            alt = _ALT_RE.search(raw)
+            want = _ALT_RE.search(sent[k])
+            if alt and want and alt.group(1) and alt.group(1) == want.group(1):
+                j = k
+        if j is None:
+            self.unexpected += 1
+            return raw
+        self.missing.extend(range(k, j))
+        self.k = j + 1
+        if raw != sent[j]:
+            self.restored += 1
+            return sent[j]
+        return raw
+
+def validate_reply(reply_html: str, sent_body: str, sections=None, title: str = ""):
+    # (repaired document, report); report["failing"] lists the sections to send again
+    t0 = time.perf_counter()
+    issues = []
+    repairs = 0
+    styles = _STYLE_EL_RE.findall(reply_html)
+    titles = _TITLE_EL_RE.findall(reply_html)
+    if len(styles) != 1:
+        issues.append(f"{len(styles)} <style> blocks")
+        repairs += 1
+    elif " ".join(styles[0].split()) != " ".join(STYLE_BRIDGES.split()):
+        issues.append("<style> differs from the bridges")
+        repairs += 1
+    doc = _TITLE_EL_RE.sub("", _STYLE_EL_RE.sub("", reply_html)) if styles or titles else reply_html
+    m = _BODY_START_RE.search(doc)
+    head, body = (doc[:m.end()], doc[m.end():]) if m else ("", doc)
+
+    fix = _ReplyRepair(_IMG_TAG_RE.findall(sent_body))
+    body = _REPAIR_RE.sub(fix, body)
+    fix.missing.extend(range(fix.k, len(fix.sent)))
+    h1 = _H1_EL_RE.search(body)
+    if fix.h1 > 1:
+        issues.append(f"{fix.h1} <h1> elements")
+        repairs += 1
+    if h1 is None:
+        issues.append("no <h1>")
+        h1_text = title
+        if title:
+            body = f"\n<h1>{html.escape(title, quote=False)}</h1>" + body
+            repairs += 1
+    else:
+        h1_text = _plain(h1.group(1))
+    if not titles or _plain(titles[0]) != h1_text:
+        issues.append("<title> does not match the <h1>")
+        if h1_text:
+            repairs += 1
+    if fix.restored:
+        issues.append(f"{fix.restored} <img> tag(s) altered")
+        repairs += fix.restored
+    if fix.unexpected:
+        issues.append(f"{fix.unexpected} <img> tag(s) not in the original")
+    if fix.missing:
+        issues.append(f"{len(fix.missing)} <img> tag(s) missing")
+
+    bridge = (f'<title>{html.escape(h1_text, quote=False)}</title>\n<style>\n{STYLE_BRIDGES}\n</style>\n')
+    low = head.lower()
+    if not _CHARSET_RE.search(head):
+        bridge = '<meta charset="utf-8">\n' + bridge
+    if "</head>" in low:
+        i = low.rindex("</head>")
+        head = head[:i] + bridge + head[i:]
+    elif m:
+        head = head[:m.start()] + f"<head>\n{bridge}</head>\n" + head[m.start():]
+    else:
+        head = f"<head>\n{bridge}</head>\n<body>"
+        body += "\n</body>"
+    h = _HTML_START_RE.search(head)
+    if h and " lang=" not in h.group(0).lower():
+        head = head[:h.start() + 5] + ' lang="en"' + head[h.start() + 5:]
+        repairs += 1
 
-    def _strip_code_fences_and_unescape(self, txt: str) -> str:
-        if not txt:
-            return txt
-        t = txt.strip()
-        if t.startswith("```"):
-            nl = t.find("\n")
-            if nl != -1:
-                t = t[nl+1:]
+    # Text coverage and missing images per section of the original body
+    reply_runs = text_runs(body)
+    kept = set(reply_runs)
+    grams = None
+    missing = set(fix.missing)
+    sections = sections or [["", sent_body, ()]]
+    failing = []
+    total = found = 0
+    first_img = 0
+    for i, sec in enumerate(sections):
+        size = hit = 0
+        for run in text_runs(sec[1]):
+            size += len(run)
+            if run in kept:
+                hit += len(run)
             else:
-                t = t[3:]
-            t = t.strip()
-            if t.endswith("```"):
-                t = t[:-3].strip()
-        if any(e in t for e in ("&lt;", "&gt;", "&amp;")):
-            t = html.unescape(t)
-        return t
+                if grams is None:
+                    grams = _ReplyShingles(reply_runs)
+                hit += grams.coverage(run)
+        total += size
+        found += hit
+        n_img = len(_IMG_TAG_RE.findall(sec[1]))
+        lost_img = any(j in missing for j in range(first_img, first_img + n_img))
+        first_img += n_img
+        if lost_img or (size and hit / size < VALIDATE_MIN_COVERAGE):
+            failing.append(i)
+    coverage = found / total if total else 1.0
+    if failing:
+        issues.append(f"text coverage {coverage:.1%}, {len(failing)} section(s) short")
+    report = {"issues": issues, "repairs": repairs, "failing": failing, "coverage": round(coverage, 4),
+              "resent": 0, "ms": round(1000 * (time.perf_counter() - t0), 1)}
+    return head + body, report
 
-    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3) -> str:
-        if not content or not content.strip():
-            raise ValueError("Prompt + body HTML is empty. Check the export and packaging steps.")
-        page = self.page
-        page.bring_to_front()
-        try:
-            page.wait_for_load_state("domcontentloaded")
-        except Exception:
-            pass
-        try:
-            page.wait_for_load_state("networkidle", timeout=10000)
-        except Exception:
-            pass
-        frame, input_el, matched = self._find_composer()
-        if input_el is None:
-            page.screenshot(path=f"navigator_no_input_{datetime.datetime.now().strftime('%H%M%S')}.png")
-            raise RuntimeError("Could not find the chat input box. Adjust selectors to your Navigator Chat DOM.")
-        print(f"Chat input matched selector: {matched}")
-        try:
-            input_el.click(timeout=5000)
-        except Exception:
-            pass
-        try:
-            page.keyboard.press("Control+A")
-            page.keyboard.press("Delete")
-        except Exception:
-            pass
-        inserted = False
+def _resend_body(job, submit, workers: int, instructions: bool, chunk_chars: int) -> str:
+    # The whole body again, sent the way the first attempt was (one message or chunks)
+    chunks = split_body_into_chunks(job.body, chunk_chars)
+    if len(chunks) > 1:
+        fragments, _ = convert_chunks(chunks, submit, workers, instructions=instructions)
+        return stitch_chunk_html(fragments)
+    prompt = build_prompt(job.body) if instructions else build_payload(job.body)
+    raw = retry_aborted(lambda: submit(prompt))
+    return run_html_stages(raw, [leaked_prompt_stage(raw)])
+
+def check_and_repair(job, sections, submit, workers: int = 1, instructions: bool = True,
+                     chunk_chars: int = CHUNK_MAX_CHARS):
+    # Validates job.ai_html_clean, sends the failing sections (or the whole body, when every
+    # section failed or the reply cannot be cut into sections) again once, and returns the
+    # repaired document with the report
+    title = os.path.splitext(os.path.basename(job.docx_path))[0]
+    sections = sections if len(sections) > 1 else [["", job.body, ()]]
+    with span("validate", job.docx_path, bytes_in=len(job.ai_html_clean)) as sp:
+        doc, report = validate_reply(job.ai_html_clean, job.body, sections, title)
+        sp.set(issues=len(report["issues"]), failing=len(report["failing"]), coverage=report["coverage"])
+    failing = report["failing"]
+    if not failing:
+        return doc, report
+    fragments = split_reply_sections(sections, doc) if len(failing) < len(sections) else None
+    if fragments is None:
+        with span("resend_body", job.docx_path, bytes_in=len(job.body)):
+            stitched = _resend_body(job, submit, workers, instructions, chunk_chars)
+        resent = len(sections)
+    else:
+        for i in failing:
+            fragments[i] = None
+        with span("resend_sections", job.docx_path, sections=len(failing)):
+            stitched, _ = resend_sections(sections, fragments, submit, workers, instructions)
+        resent = len(failing)
+    doc, again = validate_reply(stitched, job.body, sections, title)
+    again["issues"] = report["issues"] + [f"after resending: {i}" for i in again["issues"]]
+    again["repairs"] += report["repairs"]
+    again["resent"] = resent
+    again["ms"] += report["ms"]
+    return doc, again
+
+def validation_line(report: dict) -> str:
+    line = f"Validation: {report['coverage']:.1%} text coverage, {report['repairs']} local repair(s)"
+    if report["resent"]:
+        line += f", {report['resent']} section(s) resent"
+    return line + (" - " + "; ".join(report["issues"]) if report["issues"] else "")
+
+# ---------- Batch journal ----------
+# Append-only fsynced JSON Lines per batch; replaying them resumes each document at its last stage.
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), "ADAUpdateJournal")
+JOURNAL_STAGES = {"exported": 1, "ai_returned": 2, "original_moved": 3, "imported": 4}
+JOURNAL_COMPACT_AFTER = 20
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class BatchJournal:
+    def __init__(self, root: str = JOURNAL_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.state = {}
+        self.outputs = {}
+        self.backups = set()
+        os.makedirs(root, exist_ok=True)
+        files = self._journal_files()
+        for path in files:
+            self._replay(path)
+        if len(files) > JOURNAL_COMPACT_AFTER:
+            self._compact(files)
+        self.path = os.path.join(root, f"batch_{timestamp()}_{os.getpid()}.jsonl")
+        self.f = open(self.path, "a", encoding="utf-8")
+
+    @staticmethod
+    def key(path: str) -> str:
+        return os.path.normcase(norm_path(path))
+
+    def _journal_files(self):
+        return sorted(os.path.join(self.root, fn) for fn in os.listdir(self.root) if fn.endswith(".jsonl"))
+
+    def _replay(self, path: str):
         try:
-            tag = input_el.evaluate("el => el.tagName")
-            if str(tag).upper() in ("TEXTAREA", "INPUT"):
-                input_el.fill(content)
-                inserted = True
-                print("Used element.fill to insert content.")
-        except Exception:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn final line from a crash
+                    self._apply(rec)
+        except OSError:
             pass
-        if not inserted:
+
+    def _apply(self, rec: dict):
+        key = rec.get("file")
+        if not key:
+            return
+        merged = self.state.setdefault(key, {})
+        merged.update(rec)
+        if rec.get("stage") == "exported":
+            # a fresh export starts a new attempt; forget the previous attempt's later stages
+            for k in ("ai_raw_path", "pre_path", "out_path", "out_size", "out_mtime", "out_sha256"):
+                if k not in rec:
+                    merged.pop(k, None)
+        if rec.get("pre_path"):
+            self.backups.add(self.key(rec["pre_path"]))
+        if rec.get("stage") == "imported" and rec.get("out_path"):
+            self.outputs[self.key(rec["out_path"])] = merged
+
+    def _compact(self, files):
+        snapshot = os.path.join(self.root, f"batch_{timestamp()}_{os.getpid()}_compact.jsonl")
+        tmp = snapshot + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in self.state.values():
+                f.write(json.dumps(rec) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, snapshot)
+        for path in files:
             try:
-                page.evaluate("text => navigator.clipboard && navigator.clipboard.writeText(text)", content)
-                time.sleep(0.2)
-                page.keyboard.press("Control+V")
-                inserted = True
-                print("Used clipboard paste (Ctrl+V) to insert content.")
-            except Exception:
+                os.remove(path)
+            except OSError:
                 pass
-        if not inserted:
-            page.keyboard.type(content, delay=0)
-            print("Used page.keyboard.type to insert content.")
-        time.sleep(0.3)
-        sent = False
+
+    def record(self, path: str, stage: str, **data):
+        rec = {"file": self.key(path), "path": path, "stage": stage, "t": time.time()}
+        rec.update(data)
+        line = json.dumps(rec) + "\n"
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._apply(rec)
+
+    def record_output(self, path: str, out_path: str):
+        st = os.stat(out_path)
+        self.record(path, "imported", out_path=out_path, out_size=st.st_size, out_mtime=st.st_mtime,
+                    out_sha256=file_sha256(out_path))
+
+    def get(self, path: str):
+        with self.lock:
+            rec = self.state.get(self.key(path))
+            return dict(rec) if rec else None
+
+    def is_backup(self, path: str) -> bool:
+        return self.key(path) in self.backups
+
+    def is_converted_output(self, path: str) -> bool:
+        rec = self.outputs.get(self.key(path))
+        if not rec:
+            return False
         try:
-            frame.get_by_role("button", name=re.compile(r"(send|submit|enter|send message)", re.I)).first.click(timeout=2000)
-            sent = True
-            print("Clicked Send/Submit button.")
-        except Exception:
-            pass
-        if not sent:
-            try:
-                page.keyboard.press("Enter")
-                sent = True
-                print("Pressed Enter to submit.")
-            except Exception:
-                pass
-        if not sent:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size == rec.get("out_size") and st.st_mtime == rec.get("out_mtime"):
+            return True
+        if st.st_size != rec.get("out_size"):
+            return False
+        try:
+            return file_sha256(path) == rec.get("out_sha256")
+        except OSError:
+            return False
+
+    def pending_moved(self, roots):
+        # Originals already moved into the backup folder but never imported: the scan can't see them
+        keys = [self.key(r) for r in roots]
+        found = []
+        for key, rec in self.state.items():
+            if rec.get("stage") != "original_moved" or not rec.get("pre_path") or not os.path.isfile(rec["pre_path"]):
+                continue
+            if any(key == k or key.startswith(k.rstrip(os.sep) + os.sep) for k in keys):
+                found.append(rec.get("path") or rec["file"])
+        return found
+
+    def close(self):
+        with self.lock:
             try:
-                page.keyboard.press("Control+Enter")
-                sent = True
-                print("Pressed Ctrl+Enter to submit.")
+                self.f.close()
             except Exception:
                 pass
-        if not sent:
-            raise RuntimeError("Could not submit the message.")
 
-        def extract_candidate() -> str:
-            for sel in ("pre code", "pre", "code"):
-                loc = frame.locator(sel)
-                n = loc.count()
-                for i in range(n - 1, max(-1, n - 6), -1):
-                    try:
-                        txt = loc.nth(i).inner_text()
-                    except Exception:
-                        continue
-                    if not txt or "<html" not in txt.lower():
-                        continue
-                    t = self._strip_code_fences_and_unescape(txt)
-                    low = t.lower()
-                    s = low.find("<html")
-                    e = low.rfind("</html>")
-                    if s != -1 and e != -1:
-                        return t[s:e+7]
-            try:
-                body_text = frame.inner_text("body")
-            except Exception:
-                body_text = ""
-            t = body_text
-            low = t.lower()
-            s = low.find("<html")
-            e = low.rfind("</html>")
-            if s != -1 and e != -1:
-                return t[s:e+7]
-            return ""
+# ---------- Batch processing ----------
+# process_one_docx runs the stages back to back; BatchPipeline runs them concurrently.
+PIPELINE_QUEUE_SIZE = 2
+PLACEHOLDERS_FILE = "ai_placeholders.json"
 
-        def looks_complete(doc: str) -> bool:
-            if not doc:
-                return False
-            low = doc.lower()
-            return ("<html" in low and "</html" in low and "<head" in low and "<body" in low)
+class DocJob:
+    def __init__(self, docx_path: str):
+        self.docx_path = docx_path
+        self.html_path = None
+        self.assets_dir = None
+        self.short_base = None
+        self.work_dir = None
+        self.body = ""
+        self.prompt = ""
+        self.ai_html_raw = ""
+        self.ai_html_clean = None
+        self.cache_hit = False
+        self.chunks = 1
+        self.chunk_retries = 0
+        self.sections = 0
+        self.sections_reused = 0
+        self.validation = None
+        self.images = None
+        self.placeholders = None
+        self.staged = {}
+        self.minimized = None
+        self.features = None
+        self.route = ""
+        self.resumed_from = None
+        self.saved = None
+        self.pre_path = None
+        self.error = None
+        self.error_trace = ""
+        self.timings = {}
 
-        deadline = time.time() + wait_seconds
-        last = ""
-        stable = 0
-        best = ""
-        while time.time() < deadline:
-            cand = extract_candidate()
-            if cand:
-                best = cand if len(cand) >= len(best) else best
-                if cand == last:
-                    stable += 1
-                else:
-                    stable = 1
-                    last = cand
-                if looks_complete(cand) and stable >= stable_checks:
-                    return cand
-            time.sleep(1.0)
-        if looks_complete(best) and len(best) > 200:
-            return best
-        page.screenshot(path=f"navigator_timeout_{datetime.datetime.now().strftime('%H%M%S')}.png")
-        raise TimeoutError("AI response with complete HTML not detected within the timeout window.")
+def _resume_from_journal(job: DocJob, journal) -> bool:
+    state = journal.get(job.docx_path) if journal is not None else None
+    if not state or not state.get("work_dir") or not os.path.isdir(state["work_dir"]):
+        return False
+    rank = JOURNAL_STAGES.get(state.get("stage"), 0)
+    if rank >= JOURNAL_STAGES["imported"]:
+        return False
+    job.html_path = state.get("html_path")
+    job.assets_dir = state.get("assets_dir") or state["work_dir"]
+    job.short_base = state.get("short_base")
+    job.work_dir = state["work_dir"]
+    raw_path = state.get("ai_raw_path")
+    if rank >= JOURNAL_STAGES["ai_returned"] and raw_path and os.path.isfile(raw_path):
+        with open(raw_path, "r", encoding="utf-8") as f:
+            job.ai_html_raw = f.read()
+        if rank >= JOURNAL_STAGES["original_moved"]:
+            job.pre_path = state.get("pre_path")
+        job.resumed_from = state["stage"]
+        return True
+    if job.html_path and os.path.isfile(job.html_path) and os.path.isfile(job.docx_path):
+        job.resumed_from = "exported"
+        return True
+    return False
 
-# ---------- Batch processing ----------
-def process_one_docx(docx_path: str, user_data_dir: str):
-    html_path, assets_dir, short_base = export_doc_to_filtered_html(docx_path)
-    work_dir = make_work_dir(docx_path, short_base)
-    copy_all(assets_dir, work_dir)
-    with open(html_path, "r", encoding="utf-8", errors="ignore") as f:
-        full_html = f.read()
-    body_only = extract_relevant_html_for_ai(full_html)
-    prompt_plus_body = package_for_ai(body_only, assets_dir, work_dir)
-    chat = NavigatorChat(user_data_dir=user_data_dir)
-    chat.start()
+def prepare_document(job: DocJob, word_pool=None, journal=None, image_store=None, native_pool=None) -> DocJob:
+    if _resume_from_journal(job, journal):
+        if image_store is not None:
+            job.images = image_store.index_existing(job.work_dir, job.assets_dir)
+        if job.ai_html_raw:
+            job.placeholders = _load_placeholders(job.work_dir)
+            return job
+    else:
+        with span("export_html", job.docx_path) as sp:
+            exported = export_doc_to_filtered_html(job.docx_path, word_pool, native_pool)
+            if sp:
+                sp.set(bytes_out=os.path.getsize(exported[0]))
+        job.html_path, job.assets_dir, job.short_base = exported
+        job.work_dir = make_work_dir(job.docx_path, job.short_base)
+        with span("stage_images", job.docx_path) as sp:
+            if image_store is not None:
+                job.images = image_store.stage(job.assets_dir, job.work_dir)
+                sp.set(images=job.images.stats["files"], bytes_copied=job.images.stats["bytes_copied"])
+            else:
+                copy_all(job.assets_dir, job.work_dir)
+        if journal is not None:
+            journal.record(job.docx_path, "exported", html_path=job.html_path, assets_dir=job.assets_dir,
+                           short_base=job.short_base, work_dir=job.work_dir)
+    with span("package", job.docx_path) as sp:
+        minimizer = MinimizeForAiStage() if PROMPT_MINIMIZE else None
+        scorer = ComplexityStage() if AI_ROUTE == "auto" else None
+        with open(job.html_path, "r", encoding="utf-8", errors="ignore") as f:
+            full_html = f.read()
+        job.body = extract_body_for_ai(full_html, job.work_dir, job.assets_dir, job.images,
+                                       minimizer, scorer)
+        job.prompt = build_prompt(job.body)
+        if scorer is not None:
+            job.features = scorer.features
+        if minimizer is not None:
+            job.placeholders = minimizer.placeholders
+            job.minimized = minimizer.stats()
+            # The AI reply may outlive this process (journal resume), so its placeholders must too
+            with open(os.path.join(job.work_dir, PLACEHOLDERS_FILE), "w", encoding="utf-8") as f:
+                json.dump(job.placeholders, f)
+        if sp:
+            sp.set(bytes_in=os.path.getsize(job.html_path), bytes_out=len(job.prompt), images=job.body.count("<img"))
+            if job.minimized:
+                sp.set(minimized_from=job.minimized["bytes_in"], minimized_to=job.minimized["bytes_out"])
+    return job
+
+def _load_placeholders(work_dir: str):
     try:
-        ai_html_raw = chat.submit_and_get_html(prompt_plus_body, wait_seconds=600, stable_checks=3)
-    finally:
-        chat.stop()
-    ai_html_clean = strip_leaked_prompt_from_html(ai_html_raw)
-    ai_html_clean = rebase_img_src_to_existing(ai_html_clean, work_dir, assets_dir)
-    ai_html_processed = preprocess_html_for_word(ai_html_clean)
+        with open(os.path.join(work_dir, PLACEHOLDERS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _ask_chat(chat, prompt: str, doc: str = "", watch=None) -> str:
+    with span("ai_request", doc, bytes_in=len(prompt)) as sp:
+        chat.ensure_ready()
+        chat.new_conversation()
+        reply = chat.submit_and_get_html(prompt, wait_seconds=600, stable_checks=3, watch=watch)
+        sp.set(bytes_out=len(reply))
+        return reply
+
+def convert_document(job: DocJob, chat=None, user_data_dir: str = "", cache=None, journal=None,
+                     chunk_chars: int = CHUNK_MAX_CHARS, session=None) -> DocJob:
+    if job.ai_html_raw:
+        return job
+    job.route = choose_route(job.features)
+    if job.route == "local":
+        with span("local_convert", job.docx_path, bytes_in=len(job.body)) as sp:
+            title = os.path.splitext(os.path.basename(job.docx_path))[0]
+            job.ai_html_raw = job.ai_html_clean = convert_locally(job.body, title)
+            sp.set(bytes_out=len(job.ai_html_raw))
+        _record_ai_reply(job, journal)
+        return job
+    if cache is not None:
+        with span("cache_lookup", job.docx_path) as sp:
+            hit = cache.get(job.body)
+            sp.set(hit=hit is not None)
+        if hit is not None:
+            job.ai_html_raw, job.ai_html_clean = hit
+            job.cache_hit = True
+            job.route = "cache"
+    if not job.cache_hit:
+        own_chat = None
+        if chat is None:
+            chat = own_chat = NavigatorChat(user_data_dir=user_data_dir)
+            chat.start()
+        t0 = time.perf_counter()
+        stage_image = make_image_stager(job)
+        watch_for = lambda prompt: StreamWatch(payload_images(prompt), stage_image) if STREAM_WATCH else None
+        if session is not None:
+            ask = lambda prompt: session.ask(prompt, job.docx_path, watch_for(prompt))
+        else:
+            ask = lambda prompt: _ask_chat(chat, prompt, job.docx_path, watch_for(prompt))
+        sections = split_sections(job.body) if cache is not None and SECTION_MEMO else []
+        job.sections = len(sections) if len(sections) > 1 else 0
+        try:
+            memo = None
+            if job.sections:
+                with span("section_memo", job.docx_path, sections=job.sections) as sp:
+                    memo = convert_sections(sections, cache, ask, getattr(chat, "max_parallel", 1),
+                                            instructions=session is None)
+                    sp.set(sent=job.sections if memo is None else memo[1])
+            chunks = [] if memo is not None else split_body_into_chunks(job.body, chunk_chars)
+            job.chunks = max(1, len(chunks))
+            if memo is not None:
+                job.ai_html_raw = job.ai_html_clean = memo[0]
+                job.sections_reused = job.sections - memo[1]
+            elif len(chunks) > 1:
+                fragments, job.chunk_retries = convert_chunks(
+                    chunks, ask, workers=getattr(chat, "max_parallel", 1), cache=cache,
+                    instructions=session is None)
+                job.ai_html_raw = job.ai_html_clean = stitch_chunk_html(fragments)
+            else:
+                prompt = build_payload(job.body) if session is not None else job.prompt
+                job.ai_html_raw = retry_aborted(lambda: ask(prompt))
+            if job.ai_html_clean is None and (VALIDATE or cache is not None):
+                job.ai_html_clean = run_html_stages(job.ai_html_raw, [leaked_prompt_stage(job.ai_html_raw)])
+            if VALIDATE:
+                job.ai_html_clean, job.validation = check_and_repair(
+                    job, sections or split_sections(job.body), ask, getattr(chat, "max_parallel", 1),
+                    instructions=session is None, chunk_chars=chunk_chars)
+                if job.validation["repairs"] or job.validation["resent"]:
+                    job.ai_html_raw = job.ai_html_clean
+        finally:
+            if own_chat is not None:
+                own_chat.stop()
+            trace_add("ai", t0, job.docx_path, chunks=job.chunks, retries=job.chunk_retries,
+                      bytes_in=len(job.body), bytes_out=len(job.ai_html_raw))
+        if cache is not None:
+            cache.put(job.body, job.ai_html_raw, job.ai_html_clean)
+            if job.sections:
+                with span("section_store", job.docx_path) as sp:
+                    sp.set(stored=store_sections(sections, job.ai_html_clean, cache))
+    _record_ai_reply(job, journal)
+    return job
+
+def make_image_stager(job: DocJob):
+    # on_image for the StreamWatch: resolves (and copies) each image the reply references while
+    # it streams; clean_ai_html starts from these instead of resolving them again
+    if job.images is not None:
+        resolve = job.images.resolve
+    else:
+        resolve = lambda src: _rebased_src(src, job.work_dir, job.assets_dir)
+
+    def stage(src):
+        srcs = [src]
+        m = _PLACEHOLDER_RE.search(f'src="{src}"')
+        if m and job.placeholders and int(m.group(1)) < len(job.placeholders):
+            srcs = _IMG_SRC_RE.findall(job.placeholders[int(m.group(1))])
+        for one in srcs:
+            one = one.strip()
+            if one not in job.staged:
+                job.staged[one] = resolve(one)
+    return stage
+
+def _record_ai_reply(job: DocJob, journal):
+    if journal is not None:
+        raw_path = os.path.join(job.work_dir, "ai_raw.html")
+        with open(raw_path, "w", encoding="utf-8") as f:
+            f.write(job.ai_html_raw)
+        journal.record(job.docx_path, "ai_returned", ai_raw_path=raw_path)
+
+def finish_document(job: DocJob, word_pool=None, journal=None) -> DocJob:
+    docx_path, work_dir, assets_dir = job.docx_path, job.work_dir, job.assets_dir
+    with span("clean_ai_html", docx_path) as sp:
+        if job.ai_html_clean is not None:
+            ai_html_processed = clean_ai_html(job.ai_html_clean, work_dir, assets_dir, strip_prompt=False,
+                                              images=job.images, placeholders=job.placeholders, staged=job.staged)
+        else:
+            ai_html_processed = clean_ai_html(job.ai_html_raw, work_dir, assets_dir, images=job.images,
+                                              placeholders=job.placeholders, staged=job.staged)
+        if sp:
+            sp.set(bytes_in=len(job.ai_html_clean or job.ai_html_raw), bytes_out=len(ai_html_processed),
+                   images=ai_html_processed.count("<img"))
     ai_html_path = os.path.join(work_dir, "ai_output.html")
     with open(ai_html_path, "w", encoding="utf-8") as f:
         f.write(ai_html_processed)
     orig_dir = os.path.dirname(docx_path)
     orig_base = os.path.basename(docx_path)
     base_no_ext, ext = os.path.splitext(orig_base)
-    pre_folder = os.path.join(orig_dir, "Pre ADA Update Docx Files")
-    os.makedirs(pre_folder, exist_ok=True)
-    pre_name = f"PreADA_{orig_base}"
-    pre_path = os.path.join(pre_folder, pre_name)
-    if os.path.exists(pre_path):
-        pre_name = f"PreADA_{base_no_ext}_{timestamp()}{ext}"
+    if not (job.pre_path and os.path.isfile(job.pre_path)):
+        pre_folder = os.path.join(orig_dir, "Pre ADA Update Docx Files")
+        os.makedirs(pre_folder, exist_ok=True)
+        pre_name = f"PreADA_{orig_base}"
         pre_path = os.path.join(pre_folder, pre_name)
-    shutil.move(docx_path, pre_path)
+        if os.path.exists(pre_path):
+            pre_name = f"PreADA_{base_no_ext}_{timestamp()}{ext}"
+            pre_path = os.path.join(pre_folder, pre_name)
+        shutil.move(docx_path, pre_path)
+        job.pre_path = pre_path
+        if journal is not None:
+            journal.record(docx_path, "original_moved", pre_path=pre_path)
     new_name = orig_base if ext.lower() == ".docx" else f"{base_no_ext}.docx"
     out_path = os.path.join(orig_dir, new_name)
-    saved = import_ai_html_to_docx(ai_html_path, out_path)
-    return saved, pre_path
+    with span("import", docx_path, bytes_in=len(ai_html_processed)) as sp:
+        job.saved = import_ai_html_to_docx(ai_html_path, out_path, word_pool)
+        if sp:
+            sp.set(bytes_out=os.path.getsize(job.saved))
+    if journal is not None:
+        journal.record_output(docx_path, job.saved)
+    return job
+
+def process_one_docx(docx_path: str, user_data_dir: str, word_pool=None, chat=None, cache=None, journal=None,
+                     chunk_chars: int = CHUNK_MAX_CHARS, image_store=None, session=None):
+    job = DocJob(docx_path)
+    prepare_document(job, word_pool, journal, image_store)
+    convert_document(job, chat, user_data_dir, cache, journal, chunk_chars, session)
+    finish_document(job, word_pool, journal)
+    return job.saved, job.pre_path
+
+class PipelineStage:
+    def __init__(self, name: str, fn, workers: int = 1, inline: bool = False):
+        # inline: run on the thread that calls BatchPipeline.run (e.g. the thread owning the browser)
+        self.name = name
+        self.fn = fn
+        self.workers = 1 if inline else max(1, int(workers))
+        self.inline = inline
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+
+class BatchPipeline:
+    # Stages are joined by bounded queues: a full queue blocks the stage feeding it (backpressure)
+    def __init__(self, stages, queue_size: int = 2, on_start=None, on_done=None, sample_interval: float = 0.1):
+        self.stages = list(stages)
+        if sum(1 for st in self.stages if st.inline) > 1:
+            raise ValueError("At most one pipeline stage can run inline.")
+        self.queue_size = max(1, int(queue_size))
+        self.on_start = on_start
+        self.on_done = on_done
+        self.sample_interval = sample_interval
+        self.queues = []
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.wall = 0.0
+        self.jobs = []
+
+    def _put(self, st: PipelineStage, q: queue.Queue, item):
+        t0 = time.perf_counter()
+        q.put(item)
+        st.blocked += time.perf_counter() - t0
+
+    def _finish(self, job: DocJob):
+        with self.lock:
+            self.jobs.append(job)
+        if self.on_done is not None:
+            try:
+                self.on_done(job)
+            except Exception:
+                pass
+
+    def _stage_loop(self, idx: int, remaining: list):
+        st = self.stages[idx]
+        q_in = self.queues[idx]
+        q_out = self.queues[idx + 1] if idx + 1 < len(self.stages) else None
+        while True:
+            job = q_in.get()
+            if job is None:
+                with self.lock:
+                    remaining[idx] -= 1
+                    last = remaining[idx] == 0
+                if last and q_out is not None:
+                    for _ in range(self.stages[idx + 1].workers):
+                        self._put(st, q_out, None)
+                return
+            if job.error is None:
+                if idx == 0 and self.on_start is not None:
+                    try:
+                        self.on_start(job)
+                    except Exception:
+                        pass
+                t0 = time.perf_counter()
+                try:
+                    st.fn(job)
+                except Exception as e:
+                    job.error = e
+                    job.error_trace = traceback.format_exc()
+                    st.failed += 1
+                elapsed = time.perf_counter() - t0
+                job.timings[st.name] = elapsed
+                with self.lock:
+                    st.busy += elapsed
+                    st.items += 1
+            if q_out is None or job.error is not None:
+                self._finish(job)
+            else:
+                self._put(st, q_out, job)
+
+    def _sample(self, stop: threading.Event):
+        while not stop.wait(self.sample_interval):
+            with self.lock:
+                self.samples += 1
+                for st, q in zip(self.stages, self.queues):
+                    depth = q.qsize()
+                    st.depth_sum += depth
+                    st.depth_max = max(st.depth_max, depth)
+
+    def run(self, paths):
+        paths = list(paths)
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [st.workers for st in self.stages]
+        t_start = time.perf_counter()
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._sample, args=(stop,), daemon=True)]
+
+        def feed():
+            for p in paths:
+                self.queues[0].put(DocJob(p))
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(None)
+
+        threads.append(threading.Thread(target=feed, daemon=True, name="pipeline-feed"))
+        inline_idx = None
+        for idx, st in enumerate(self.stages):
+            if st.inline:
+                inline_idx = idx
+                continue
+            for n in range(st.workers):
+                threads.append(threading.Thread(target=self._stage_loop, args=(idx, remaining), daemon=True,
+                                                name=f"pipeline-{st.name}-{n}"))
+        for t in threads:
+            t.start()
+        if inline_idx is not None:
+            self._stage_loop(inline_idx, remaining)
+        for t in threads[1:]:
+            t.join()
+        stop.set()
+        threads[0].join()
+        self.wall = time.perf_counter() - t_start
+        return self.jobs
+
+    def stats(self) -> list:
+        rows = []
+        for st in self.stages:
+            capacity = self.wall * st.workers
+            rows.append({
+                "stage": st.name,
+                "workers": st.workers,
+                "items": st.items,
+                "failed": st.failed,
+                "busy_s": round(st.busy, 3),
+                "utilisation": round(st.busy / capacity, 3) if capacity else 0.0,
+                "blocked_s": round(st.blocked, 3),
+                "queue_avg": round(st.depth_sum / self.samples, 2) if self.samples else 0.0,
+                "queue_max": st.depth_max,
+            })
+        return rows
+
+    def report_lines(self) -> list:
+        lines = [f"Pipeline wall time: {self.wall:.1f}s"]
+        for r in self.stats():
+            lines.append(
+                f"  {r['stage']:<8} items={r['items']:<4} busy={r['busy_s']:.1f}s util={100 * r['utilisation']:.0f}% "
+                f"queue avg={r['queue_avg']} max={r['queue_max']} blocked={r['blocked_s']:.1f}s"
+            )
+        routes = route_summary(self.jobs)
+        if routes:
+            lines.append(routes)
+        reused = sum(j.sections_reused for j in self.jobs)
+        if reused:
+            total = sum(j.sections for j in self.jobs if j.sections_reused)
+            lines.append(f"Sections: {reused} of {total} in revised documents reused from earlier runs")
+        return lines
+
+def default_pipeline_stages(word_pool, chat, user_data_dir: str = "", cache=None, journal=None,
+                            chunk_chars: int = CHUNK_MAX_CHARS, image_store=None, import_pool=None,
+                            native_pool=None, workers: int = 0, session=None):
+    # The browser must stay on the thread that started it; a thread-safe transport gets a
+    # worker per allowed request. An import_pool (DocxWriterPool) replaces Word for the
+    # import stage and a native_pool reads .docx exports; each gets one worker per process.
+    # workers, when set, overrides the export/import worker counts (the CLI's --jobs).
+    # The AI stage shares make_chat_session's ChatSession (only with ADA_AI_SESSION=1) unless one is passed.
+    if session is None:
+        session = make_chat_session(chat)
+    ai = lambda job: convert_document(job, chat, user_data_dir, cache, journal, chunk_chars, session)
+    if getattr(chat, "thread_safe", False):
+        ai_stage = PipelineStage("ai", ai, workers=chat.max_parallel)
+    else:
+        ai_stage = PipelineStage("ai", ai, inline=True)
+    return [
+        PipelineStage("export", lambda job: prepare_document(job, word_pool, journal, image_store, native_pool),
+                      workers=workers or (native_pool.size if native_pool is not None else 1)),
+        ai_stage,
+        PipelineStage("import", lambda job: finish_document(job, import_pool or word_pool, journal),
+                      workers=workers or (import_pool.size if import_pool is not None else 1)),
+    ]
+
+# ---------- Folder scanning ----------
+# os.scandir with our own folders pruned, a thread per folder for network shares.
+DOC_EXTENSIONS = (".docx", ".doc")
+SCAN_SKIP_DIRS = ("pre ada update docx files",)
+SCAN_SKIP_DIR_PREFIXES = ("ada_work_",)
+SCAN_SKIP_FILE_PREFIXES = ("~$",)
+SCAN_WORKERS = _env_int("ADA_SCAN_WORKERS", 8)
+
+def _scan_dir(path: str):
+    # (subfolders to enter, [(path, size, mtime)] of the Word files here)
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name.lower()
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if name not in SCAN_SKIP_DIRS and not name.startswith(SCAN_SKIP_DIR_PREFIXES):
+                            dirs.append(entry.path)
+                    elif name.endswith(DOC_EXTENSIONS) and not name.startswith(SCAN_SKIP_FILE_PREFIXES):
+                        st = entry.stat()
+                        files.append((entry.path, st.st_size, st.st_mtime))
+                except OSError:
+                    continue  # vanished or unreadable mid-scan
+    except OSError:
+        pass
+    return dirs, files
+
+def scan_folders(roots, workers: int = SCAN_WORKERS):
+    # Every folder is its own task, so one deep root doesn't keep the other roots waiting
+    found = []
+    with span("scan", "", roots=len(roots), workers=workers) as sp:
+        if workers <= 1:
+            stack = list(roots)
+            while stack:
+                dirs, files = _scan_dir(stack.pop())
+                stack.extend(dirs)
+                found.extend(files)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan") as ex:
+                pending = {ex.submit(_scan_dir, r) for r in roots}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        dirs, files = fut.result()
+                        found.extend(files)
+                        pending.update(ex.submit(_scan_dir, d) for d in dirs)
+        found.sort()
+        if sp:
+            sp.set(files=len(found))
+    return found
 
 def find_docx_files(root_folder: str):
-    for dirpath, _, filenames in os.walk(root_folder):
-        for fn in filenames:
-            if fn.lower().endswith((".docx", ".doc")):
-                yield os.path.join(dirpath, fn)
+    for path, _, _ in scan_folders([root_folder]):
+        yield path
+
+SCAN_INDEX = os.environ.get("ADA_SCAN_INDEX", "1").strip().lower() not in ("0", "false", "no", "off")
+SCAN_INDEX_DIR = os.path.join(os.path.expanduser("~"), "ADAUpdateScan")
+
+class ScanIndex:
+    # One JSON file per root: {path key: [size, mtime, sha256]} of every document that was
+    # settled (converted, or found already converted). A rescan yields only new files and
+    # ones whose size or mtime moved; a same-size file with a new mtime (a copy, a restore)
+    # is hashed before it is sent again. Failures are never committed, so they come back.
+    def __init__(self, roots, root_dir: str = SCAN_INDEX_DIR):
+        self.root_dir = root_dir
+        self.lock = threading.Lock()
+        self.roots = sorted(((BatchJournal.key(r), norm_path(r)) for r in roots), key=lambda r: -len(r[0]))
+        self.entries = {key: self._load(key) for key, _ in self.roots}
+        self.seen = {key: set() for key, _ in self.roots}
+        self.dirty = set()
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0, "hashed": 0}
+
+    def _path(self, root_key: str) -> str:
+        return os.path.join(self.root_dir, hashlib.sha256(root_key.encode("utf-8")).hexdigest()[:20] + ".json")
+
+    def _load(self, root_key: str) -> dict:
+        try:
+            with open(self._path(root_key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data.get("files", {}) if data.get("root") == root_key else {}
+
+    def _root_of(self, key: str):
+        for root_key, _ in self.roots:
+            if key.startswith(root_key.rstrip(os.sep) + os.sep):
+                return root_key
+        return None
+
+    def changed(self, found):
+        # found: [(path, size, mtime)] from scan_folders -> paths that need a run
+        out = []
+        with self.lock:
+            for path, size, mtime in found:
+                key = BatchJournal.key(path)
+                root_key = self._root_of(key)
+                if root_key is None:
+                    out.append(path)
+                    continue
+                self.seen[root_key].add(key)
+                rec = self.entries[root_key].get(key)
+                if rec is None:
+                    self.stats["new"] += 1
+                    out.append(path)
+                    continue
+                if rec[0] == size and rec[1] == mtime:
+                    self.stats["unchanged"] += 1
+                    continue
+                if rec[0] == size and rec[2]:
+                    self.stats["hashed"] += 1
+                    try:
+                        same = file_sha256(path) == rec[2]
+                    except OSError:
+                        same = False
+                    if same:
+                        rec[1] = mtime
+                        self.dirty.add(root_key)
+                        self.stats["unchanged"] += 1
+                        continue
+                self.stats["changed"] += 1
+                out.append(path)
+        return out
+
+    def commit(self, path: str):
+        key = BatchJournal.key(path)
+        root_key = self._root_of(key)
+        if root_key is None:
+            return
+        try:
+            st = os.stat(path)
+            digest = file_sha256(path)
+        except OSError:
+            return
+        with self.lock:
+            self.entries[root_key][key] = [st.st_size, st.st_mtime, digest]
+            self.seen[root_key].add(key)
+            self.dirty.add(root_key)
+
+    def save(self):
+        # Entries for files that have gone (deleted, renamed) are dropped with the rewrite
+        with self.lock:
+            os.makedirs(self.root_dir, exist_ok=True)
+            for root_key in self.dirty | {k for k, _ in self.roots if self.seen[k]}:
+                files = {k: v for k, v in self.entries[root_key].items() if k in self.seen[root_key]}
+                path = self._path(root_key)
+                tmp = f"{path}.{os.getpid()}.tmp"
+                try:
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        json.dump({"root": root_key, "saved": time.time(), "files": files}, f)
+                    os.replace(tmp, path)
+                except OSError:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+            self.dirty.clear()
+
+    def summary(self) -> str:
+        s = self.stats
+        return (f"Scan: {s['new']} new, {s['changed']} changed, {s['unchanged']} unchanged since the last scan"
+                + (f" ({s['hashed']} checked by hash)" if s["hashed"] else ""))
+
+def collect_batch_files(paths, journal, index=None):
+    # (files to run, files already converted in an earlier batch, files resumed after their
+    # original was moved); finished outputs and our own backups are left out, and with an
+    # index only folder files that are new or changed since the last scan are returned
+    file_list = []
+    found = scan_folders([p for p in paths if os.path.isdir(p)])
+    if index is not None:
+        file_list.extend(index.changed(found))
+    else:
+        file_list.extend(path for path, _, _ in found)
+    for p in paths:
+        if not os.path.isdir(p) and os.path.isfile(p) and p.lower().endswith(DOC_EXTENSIONS):
+            file_list.append(p)
+    already = {f for f in file_list if journal.is_converted_output(f) or journal.is_backup(f)}
+    file_list = [f for f in file_list if f not in already]
+    if index is not None:
+        for f in already:
+            index.commit(f)
+    listed = set(file_list)
+    resumed = [f for f in journal.pending_moved(paths) if f not in listed]
+    file_list.extend(resumed)
+    return file_list, sorted(already), resumed
+
+# ---------- Headless batch ----------
+# No Tk: the same stages on BatchPipeline, one JSON line per file.
+def _job_record(job: DocJob) -> dict:
+    return {
+        "path": job.docx_path,
+        "status": "ok" if job.error is None else "failed",
+        "output": job.saved,
+        "pre_path": job.pre_path,
+        "timings": {k: round(v, 3) for k, v in job.timings.items()},
+        "total_s": round(sum(job.timings.values()), 3),
+        "cache_hit": job.cache_hit,
+        "chunks": job.chunks,
+        "sections_reused": job.sections_reused or None,
+        "validation": job.validation,
+        "route": job.route or None,
+        "prompt_bytes": len(job.prompt) or None,
+        "minimized": job.minimized,
+        "resumed_from": job.resumed_from,
+        "error": None if job.error is None else f"{type(job.error).__name__}: {job.error}",
+    }
+
+def run_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="toddocumentupdater batch",
+                                 description="Convert Word files without the GUI; one JSON line per file.")
+    ap.add_argument("paths", nargs="+", help="Word files and/or folders to sweep")
+    ap.add_argument("--jobs", type=int, default=IMPORT_PROCESSES,
+                    help="documents in the export and import stages at once")
+    ap.add_argument("--backend", choices=("word", "native"),
+                    help="export/import backend (default: ADA_EXPORT_BACKEND / ADA_IMPORT_BACKEND)")
+    ap.add_argument("--ai", choices=("browser", "tabs", "http"), default=AI_TRANSPORT,
+                    help="AI transport (default: ADA_AI_TRANSPORT)")
+    ap.add_argument("--report-dir", default="", help="folder for the results file (default: current folder)")
+    ap.add_argument("--profile", default=os.path.join(os.path.expanduser("~"), "NavigatorAutomationProfile"),
+                    help="browser profile with the Navigator Chat sign-in")
+    ap.add_argument("--trace", action="store_true", default=TRACE_ENABLED,
+                    help="write a Chrome/Perfetto trace and print p50/p95 per stage (also ADA_TRACE=1)")
+    args = ap.parse_args(argv)
+    global IMPORT_BACKEND, EXPORT_BACKEND
+    if args.backend:
+        IMPORT_BACKEND = EXPORT_BACKEND = args.backend
+    jobs = max(1, args.jobs)
+    report_dir = norm_path(args.report_dir or os.getcwd())
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = os.path.join(report_dir, f"ADAUpdate_results_{timestamp()}.jsonl")
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+    lock = threading.Lock()
+    journal = BatchJournal()
+    index = ScanIndex([p for p in args.paths if os.path.isdir(p)]) if SCAN_INDEX else None
+    pipeline = None
+    tracer = start_tracing() if args.trace else None
+    with open(report_path, "w", encoding="utf-8") as report:
+        def write(record):
+            with lock:
+                counts[record["status"]] += 1
+                report.write(json.dumps(record, ensure_ascii=False) + "\n")
+                report.flush()
+
+        def on_done(job):
+            write(_job_record(job))
+            if job.error is None:
+                if index is not None:
+                    index.commit(job.saved)
+                print(f"Saved: {job.saved}")
+            else:
+                print(f"Failed: {job.docx_path}\n  Reason: {job.error}")
+
+        file_list, already, resumed = collect_batch_files(args.paths, journal, index)
+        if index is not None and index.roots:
+            print(index.summary())
+        for f in already:
+            write({"path": f, "status": "skipped", "reason": "already converted in an earlier batch"})
+        if resumed:
+            print(f"Resuming {len(resumed)} file(s) interrupted after their original was moved.")
+        chat = cache = image_store = docx_pool = word_pool = session = None
+        try:
+            if file_list:
+                chat = make_chat_transport(args.ai, args.profile)
+                chat.start()
+                cache = AiCache()
+                image_store = ImageStore()
+                session = make_chat_session(chat)
+                docx_pool = DocxWriterPool(jobs) if "native" in (IMPORT_BACKEND, EXPORT_BACKEND) else None
+                if WIN32_AVAILABLE:
+                    both_native = IMPORT_BACKEND == EXPORT_BACKEND == "native"
+                    word_pool = WordPool(size=1 if both_native else jobs).start()
+                stages = default_pipeline_stages(
+                    word_pool, chat, args.profile, cache, journal, image_store=image_store,
+                    import_pool=docx_pool if IMPORT_BACKEND == "native" else None,
+                    native_pool=docx_pool if EXPORT_BACKEND == "native" else None, workers=jobs,
+                    session=session)
+                pipeline = BatchPipeline(stages, queue_size=max(PIPELINE_QUEUE_SIZE, jobs),
+                                         on_start=lambda job: print(f"Processing: {job.docx_path}"),
+                                         on_done=on_done)
+                pipeline.run(file_list)
+        finally:
+            if word_pool is not None:
+                word_pool.shutdown()
+            if docx_pool is not None:
+                docx_pool.shutdown()
+            if image_store is not None:
+                image_store.close()
+            if chat is not None:
+                chat.stop()
+            if cache is not None:
+                cache.evict()
+            if index is not None:
+                index.save()
+            journal.close()
+            stop_tracing()
+    if pipeline is not None:
+        for line in pipeline.report_lines():
+            print(line)
+    if session is not None and session.messages:
+        print(session.summary())
+    if tracer is not None and tracer.events:
+        print("Stage timings:")
+        for line in tracer.summary_lines():
+            print(line)
+        print(f"Trace: {tracer.write(os.path.join(report_dir, f'ADAUpdate_trace_{timestamp()}.json'))}")
+    print(f"Batch complete: {counts['ok']} converted, {counts['failed']} failed, {counts['skipped']} skipped.")
+    print(f"Results: {report_path}")
+    return 1 if counts["failed"] else 0
 
 # ---------- GUI Application ----------
 class App:
@@ -1022,14 +6566,32 @@ class App:
 
         frm.columnconfigure(0, weight=1)
         root.minsize(600, 500)
+        # The batch logs from its stage threads; only the Tk thread touches the widgets
+        self.ui_queue = queue.Queue()
+        self.root.after(50, self._drain_ui)
 
-    def append_log(self, msg):
-        print(msg)
+    def _drain_ui(self):
+        try:
+            while True:
+                fn, arg = self.ui_queue.get_nowait()
+                fn(arg)
+        except queue.Empty:
+            pass
+        self.root.after(50, self._drain_ui)
+
+    def _write_log(self, msg):
         self.log.config(state="normal")
         self.log.insert("end", msg + "\n")
         self.log.see("end")
         self.log.config(state="disabled")
 
+    def append_log(self, msg):
+        print(msg)
+        self.ui_queue.put((self._write_log, msg))
+
+    def set_status(self, text):
+        self.ui_queue.put((lambda t: self.status.config(text=t), text))
+
     def on_drop(self, event):
         try:
             items = self.root.tk.splitlist(event.data)
@@ -1067,7 +6629,7 @@ class App:
 
     def disable_ui(self, working=True):
         state = "disabled" if working else "normal"
-        self.start_btn.config(state=state)
+        self.ui_queue.put((lambda st: self.start_btn.config(state=st), state))
 
     def show_signin_instructions(self):
         messagebox.showinfo(
@@ -1090,42 +6652,130 @@ class App:
         t = threading.Thread(target=self._worker, daemon=True)
         t.start()
 
+    def on_login_required(self):
+        self.append_log("Navigator Chat sign-in expired; waiting for you to sign in again.")
+        messagebox.showinfo("Sign in again", "Your Navigator Chat session expired.\nSign in again in the browser window, then click OK to continue.")
+
     def _worker(self):
+        chat = None
         try:
             self.disable_ui(True)
             self.append_log("Starting…")
-            # Open Navigator so user can sign in and confirm readiness
-            ensure_profile_signed_in_gui(self.user_data_dir, self.append_log)
-
-            # Build a flat list of files
-            file_list = []
-            for p in self.paths:
-                if os.path.isdir(p):
-                    file_list.extend(list(find_docx_files(p)))
-                elif os.path.isfile(p) and p.lower().endswith((".docx", ".doc")):
-                    file_list.append(p)
+            chat = make_chat_transport(AI_TRANSPORT, self.user_data_dir, self.on_login_required)
+            chat.start()
+            if chat.uses_browser:
+                # Open Navigator so user can sign in and confirm readiness; the batch keeps this browser
+                ensure_profile_signed_in_gui(self.user_data_dir, self.append_log, chat)
+            else:
+                self.append_log(f"Using the AI endpoint {chat.base_url} ({chat.max_parallel} requests at a time).")
+
+            # Build a flat list of files, leaving out finished outputs and our own backups
+            journal = BatchJournal()
+            index = ScanIndex([p for p in self.paths if os.path.isdir(p)]) if SCAN_INDEX else None
+            file_list, already, resumed = collect_batch_files(self.paths, journal, index)
+            if index is not None and index.roots:
+                self.append_log(index.summary())
+            if already:
+                self.append_log(f"Skipping {len(already)} file(s) already converted in an earlier batch.")
+            if resumed:
+                self.append_log(f"Resuming {len(resumed)} file(s) interrupted after their original was moved.")
             if not file_list:
-                self.append_log("No .docx/.doc files found.")
-                self.status.config(text="No files found.")
+                if index is not None:
+                    index.save()
+                journal.close()
+                self.append_log("No new or changed .docx/.doc files found.")
+                self.set_status("No files found.")
                 return
 
             successes = 0
             skipped = []
-            for i, f in enumerate(file_list, 1):
-                self.status.config(text=f"Processing {i}/{len(file_list)}: {f}")
-                self.append_log(f"\nProcessing: {f}")
+            started = [0]
+            counts_lock = threading.Lock()
+
+            def on_start(job):
+                with counts_lock:
+                    started[0] += 1
+                    n = started[0]
+                self.set_status(f"Processing {n}/{len(file_list)}: {job.docx_path}")
+                self.append_log(f"\nProcessing: {job.docx_path}")
+
+            def on_done(job):
+                nonlocal successes
+                if job.error is None:
+                    if job.resumed_from:
+                        self.append_log(f"Resumed after stage: {job.resumed_from}")
+                    if job.cache_hit:
+                        self.append_log("Reused cached AI conversion.")
+                    elif job.chunks > 1:
+                        self.append_log(f"Converted in {job.chunks} sections ({job.chunk_retries} section retries).")
+                    if job.images is not None and job.images.stats["files"]:
+                        self.append_log(image_stats_line(job.images.stats))
+                    if job.minimized:
+                        self.append_log(minimize_stats_line(job.minimized))
+                    if job.validation and job.validation["issues"]:
+                        self.append_log(validation_line(job.validation))
+                    if index is not None:
+                        index.commit(job.saved)
+                    self.append_log(f"Saved: {job.saved}")
+                    with counts_lock:
+                        successes += 1
+                else:
+                    self.append_log(f"Skipped: {job.docx_path}\n  Reason: {job.error}")
+                    with counts_lock:
+                        skipped.append(f"{job.docx_path} :: {job.error}\n{job.error_trace}")
+
+            # Export and import each get a warm Word (the native reader/writer worker processes
+            # take .docx export and the import when selected); the browser chat stays on this thread
+            cache = AiCache()
+            image_store = ImageStore()
+            tracer = start_tracing() if TRACE_ENABLED else None
+            docx_pool = DocxWriterPool(log_fn=self.append_log) if "native" in (IMPORT_BACKEND, EXPORT_BACKEND) else None
+            import_pool = docx_pool if IMPORT_BACKEND == "native" else None
+            native_pool = docx_pool if EXPORT_BACKEND == "native" else None
+            session = make_chat_session(chat)
+            if import_pool is not None:
+                self.append_log(f"Import: native DOCX writer, {import_pool.size} processes.")
+            if native_pool is not None:
+                self.append_log(f"Export: native DOCX reader for .docx, {native_pool.size} processes (.doc uses Word).")
+            try:
+                with WordPool(size=1 if docx_pool is not None else 2, log_fn=self.append_log) as word_pool:
+                    stages = default_pipeline_stages(word_pool, chat, self.user_data_dir, cache, journal,
+                                                     image_store=image_store, import_pool=import_pool,
+                                                     native_pool=native_pool, session=session)
+                    pipeline = BatchPipeline(stages, queue_size=PIPELINE_QUEUE_SIZE, on_start=on_start,
+                                             on_done=on_done)
+                    pipeline.run(file_list)
+            finally:
+                image_store.close()
+                if docx_pool is not None:
+                    docx_pool.shutdown()
+                if index is not None:
+                    index.save()
+                stop_tracing()
+            for line in pipeline.report_lines():
+                self.append_log(line)
+            base_dir = os.path.dirname(self.paths[0]) if os.path.isfile(self.paths[0]) else self.paths[0]
+            if tracer is not None and tracer.events:
+                self.append_log("Stage timings:")
+                for line in tracer.summary_lines():
+                    self.append_log(line)
                 try:
-                    saved, pre_path = process_one_docx(f, self.user_data_dir)
-                    self.append_log(f"Saved: {saved}")
-                    successes += 1
-                except Exception as e:
-                    self.append_log(f"Skipped: {f}\n  Reason: {e}")
-                    skipped.append(f"{f} :: {e}\n{traceback.format_exc()}")
+                    trace_path = tracer.write(os.path.join(base_dir, f"ADAUpdate_trace_{timestamp()}.json"))
+                    self.append_log(f"Trace (open in chrome://tracing or ui.perfetto.dev): {trace_path}")
+                except Exception:
+                    self.append_log("Could not write the trace file.")
+            self.append_log(image_store.summary())
+            self.append_log(cache.summary())
+            if session is not None and session.messages:
+                self.append_log(session.summary())
+            cache.evict()
+            journal.close()
 
             self.append_log("\nBatch complete.")
             self.append_log(f"Processed successfully: {successes}")
+            if chat.reconnects:
+                self.append_log(f"Browser reconnects: {chat.reconnects}")
             if skipped:
-                base_dir = os.path.dirname(self.paths[0]) if os.path.isfile(self.paths[0]) else self.paths[0]
                 report_path = os.path.join(base_dir, f"ADAUpdate_skipped_{timestamp()}.txt")
                 try:
                     with open(report_path, "w", encoding="utf-8") as f:
@@ -1133,12 +6783,19 @@ class App:
                     self.append_log(f"Skipped {len(skipped)} files. See report:\n{report_path}")
                 except Exception:
                     self.append_log(f"Skipped {len(skipped)} files. Could not write report.")
-            self.status.config(text="Done.")
+            self.set_status("Done.")
         finally:
+            if chat is not None:
+                chat.stop()
             self.disable_ui(False)
 
 # ---------- Entry point ----------
-def main():
+def main(argv=None):
+    multiprocessing.freeze_support()
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "batch":
+        sys.exit(run_cli(argv[1:]))
+    load_gui()
     if TKDND_AVAILABLE:
         root = TkinterDnD.Tk()
     else:
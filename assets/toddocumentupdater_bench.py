@@ -0,0 +1,2972 @@
+# Benchmarks and stand-in backends for toddocumentupdater.py:
+# - FakeWordBackend: an in-process imitation of the Word COM object model (no Windows needed)
+# - StubChatServer: a local chat page (textarea, Send, New chat) that streams canned cleaned HTML,
+#   plus an OpenAI-compatible /v1/chat/completions endpoint for HttpChatTransport
+# - Benchmarks print a short table and return a dict of timings
+#
+# Usage:
+#   python toddocumentupdater_bench.py wordpool --docs 40 --sizes 1 2 4
+#   python toddocumentupdater_bench.py pipeline --docs 12 --ai-latency 1.0
+#   python toddocumentupdater_bench.py http --docs 16 --concurrency 1 4 8
+#   python toddocumentupdater_bench.py html --sizes 10000 1000000 50000000 [--memory]
+#   python toddocumentupdater_bench.py chunking --size 600000 --chunk-chars 60000 --parallel 4
+#   python toddocumentupdater_bench.py images --docs 6 --images 60 --image-kb 800
+#   python toddocumentupdater_bench.py lists --sizes 100 1000 5000 20000
+#   python toddocumentupdater_bench.py fixups --sizes 100 1000 5000 20000
+#   python toddocumentupdater_bench.py docx --docs 8 --paragraphs 400 --processes 1 2 4
+#   python toddocumentupdater_bench.py docxread --generated 24 --processes 1 2 4 [--corpus DIR]
+#   python toddocumentupdater_bench.py trace --docs 12
+#   python toddocumentupdater_bench.py minimize --sizes 50000 200000 1000000 --image-run 2
+#   python toddocumentupdater_bench.py session --docs 12 --size 30000
+#   python toddocumentupdater_bench.py routing --docs 20 --hard-share 0.3 --ai-latency 1.0
+#   python toddocumentupdater_bench.py memo --size 300000 --changed 1 2 4
+#   python toddocumentupdater_bench.py stream --size 200000 --chars-per-second 20000
+#   python toddocumentupdater_bench.py validate --sizes 200000 1000000 5000000
+#   python toddocumentupdater_bench.py scan --files 100000 --workers 1 8 --latency 0 0.002
+#   python toddocumentupdater_bench.py suite --out before.json [--sizes 100000 1000000] [--image-run 4]
+#   python toddocumentupdater_bench.py compare before.json after.json --threshold 0.1
+#   python toddocumentupdater_bench.py chatsession --docs 10     (needs playwright + chromium)
+#   python toddocumentupdater_bench.py capture --docs 5          (needs playwright + chromium)
+#   python toddocumentupdater_bench.py tabs --docs 12 --tabs 1 2 4 (needs playwright + chromium)
+
+import os
+import re
+import sys
+import time
+import json
+import html
+import shutil
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, str(Path(__file__).parent))
+import toddocumentupdater as tdu
+
+# The fake documents are simple enough for the local converter; the benchmarks measure the
+# AI path, so routing is off unless a benchmark (routing) turns it back on
+tdu.AI_ROUTE = "ai"
+
+# ---------- Fake Word COM object model ----------
+class FakeNamespace:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class FakeCollection:
+    def __init__(self, doc, items):
+        self._doc = doc
+        self._items = items
+
+    @property
+    def Count(self):
+        self._doc._tick()
+        return len(self._items)
+
+    def __call__(self, i):
+        self._doc._tick()
+        return self._items[i - 1]
+
+    def __iter__(self):
+        for item in list(self._items):
+            self._doc._tick()
+            yield item
+
+class FakeStyle:
+    def __init__(self, doc, name):
+        self._doc = doc
+        self._name = name
+
+    @property
+    def NameLocal(self):
+        self._doc._tick()
+        return self._name
+
+class FakeStyles:
+    BUILTIN = ("Normal", "Heading 1", "Heading 2", "Heading 3", "Heading 4", "Heading 5", "Heading 6",
+               "List Paragraph", "Bulleted List", "Note", "Clicks Char", "Normal (Web)")
+
+    def __init__(self, doc):
+        self._doc = doc
+        self._names = set(self.BUILTIN)
+
+    def __call__(self, name):
+        self._doc._tick()
+        if name not in self._names:
+            raise tdu.ComError(-2147352567, "The requested member of the collection does not exist.", None, None)
+        return FakeStyle(self._doc, name)
+
+    def Add(self, name, kind=tdu.WD_STYLE_TYPE_PARAGRAPH):
+        self._doc._tick()
+        self._names.add(name)
+        return FakeStyle(self._doc, name)
+
+class FakeParagraph:
+    def __init__(self, doc, text, style="Normal", list_type=0, images=0):
+        self._doc = doc
+        self.text = text
+        self.style = style
+        self.list_type = list_type
+        self.images = images
+
+    @property
+    def Range(self):
+        self._doc._tick()
+        start, end = self._doc._bounds(self)
+        return FakeRange(self._doc, start, end)
+
+    @property
+    def Style(self):
+        self._doc._tick()
+        return FakeStyle(self._doc, self.style)
+
+    @Style.setter
+    def Style(self, value):
+        self._doc._tick()
+        self.style = value._name if isinstance(value, FakeStyle) else str(value)
+
+class FakeListFormat:
+    def __init__(self, rng):
+        self._rng = rng
+
+    @property
+    def ListType(self):
+        self._rng._doc._tick()
+        paras = self._rng._paragraphs()
+        return paras[0].list_type if paras else 0
+
+    def _apply(self, list_type):
+        self._rng._doc._tick()
+        for p in self._rng._paragraphs():
+            p.list_type = list_type
+
+    def ApplyBulletDefault(self):
+        self._apply(tdu.WD_LIST_BULLET)
+
+    def ApplyNumberDefault(self):
+        self._apply(tdu.WD_LIST_NUMBERED)
+
+class FakeRange:
+    def __init__(self, doc, start, end):
+        self._doc = doc
+        self._start = start
+        self._end = end
+
+    @property
+    def Start(self):
+        self._doc._tick()
+        return self._start
+
+    @property
+    def End(self):
+        self._doc._tick()
+        return self._end
+
+    def _paragraphs(self):
+        return self._doc._paragraphs_between(self._start, self._end)
+
+    @property
+    def Text(self):
+        self._doc._tick()
+        return "".join(p.text + "\r" for p in self._paragraphs())
+
+    @Text.setter
+    def Text(self, value):
+        self._doc._tick()
+        paras = self._paragraphs()
+        if not paras:
+            return
+        p = paras[0]
+        p_start, _ = self._doc._bounds(p)
+        a = self._start - p_start
+        b = min(self._end - p_start, len(p.text))
+        p.text = p.text[:a] + value + p.text[b:]
+        self._doc._dirty = True
+
+    @property
+    def ListFormat(self):
+        self._doc._tick()
+        return FakeListFormat(self)
+
+    @property
+    def Style(self):
+        self._doc._tick()
+        paras = self._paragraphs()
+        return FakeStyle(self._doc, paras[0].style if paras else "Normal")
+
+    @Style.setter
+    def Style(self, value):
+        self._doc._tick()
+        name = value._name if isinstance(value, FakeStyle) else str(value)
+        for p in self._paragraphs():
+            p.style = name
+
+    @property
+    def InlineShapes(self):
+        return FakeCollection(self._doc, [])
+
+    @property
+    def Shapes(self):
+        return FakeCollection(self._doc, [])
+
+    @property
+    def FormattedText(self):
+        self._doc._tick()
+        return [FakeParagraph(None, p.text, p.style, p.list_type, p.images) for p in self._paragraphs()]
+
+    @FormattedText.setter
+    def FormattedText(self, paras):
+        self._doc._tick()
+        self._doc._app._delay(self._doc._app.backend.import_delay)
+        for p in paras:
+            self._doc.paragraphs.append(FakeParagraph(self._doc, p.text, p.style, p.list_type, p.images))
+        self._doc._dirty = True
+
+    def Collapse(self, direction=1):
+        self._doc._tick()
+        if direction == 0:
+            self._start = self._end
+        else:
+            self._end = self._start
+
+    def Paste(self):
+        self._doc._tick()
+
+class FakeInlineShape:
+    def __init__(self, doc):
+        self._doc = doc
+        self.LinkFormat = FakeNamespace(SavePictureWithDocument=False, BreakLink=lambda: None)
+
+_FAKE_BLOCK_RE = re.compile(r'(?is)<(/?)(ul|ol)\b[^>]*>|<(h[1-6]|p|li)\b([^>]*)>(?!\s*<p\b)(.*?)</\3\s*>')
+_FAKE_CLASS_RE = re.compile(r'(?i)\bclass\s*=\s*["\']?([\w-]+)')
+_FAKE_TAIL_TABLE_RE = re.compile(r'(?is)</table\s*>\s*(</body\s*>\s*)?(</html\s*>\s*)?$')
+# Word maps these classes to styles on import; anything else falls back to the defaults below
+_FAKE_CLASS_STYLES = {"msonormal": "Normal", "bulletedlist": "Bulleted List",
+                      "msolistparagraph": "List Paragraph", "note": "Note"}
+
+class FakeDocument:
+    def __init__(self, app, path="", template=""):
+        self._app = app
+        self.path = path
+        self.template = template
+        self.paragraphs = []
+        self.Saved = False
+        self.closed = False
+        self._offsets = None
+        self._dirty = True
+        self.Styles = FakeStyles(self)
+        self.WebOptions = FakeNamespace(AllowPNG=False, PixelsPerInch=96)
+        self.ActiveWindow = FakeNamespace(View=FakeNamespace(Type=1))
+        self.ReadOnlyRecommended = False
+
+    def _tick(self):
+        self._app._tick()
+
+    # -- positions --
+    def _layout(self):
+        if self._dirty or self._offsets is None:
+            offsets = []
+            pos = 0
+            for p in self.paragraphs:
+                offsets.append(pos)
+                pos += len(p.text) + 1
+            self._offsets = offsets
+            self._index = {id(p): i for i, p in enumerate(self.paragraphs)}
+            self._dirty = False
+        return self._offsets
+
+    def _bounds(self, p):
+        offsets = self._layout()
+        i = self._index[id(p)]
+        return offsets[i], offsets[i] + len(p.text) + 1
+
+    def _paragraphs_between(self, start, end):
+        import bisect
+        offsets = self._layout()
+        if not offsets:
+            return []
+        i = max(0, bisect.bisect_right(offsets, start) - 1)
+        j = bisect.bisect_left(offsets, end) if end > start else i + 1
+        return self.paragraphs[i:max(j, i + 1)]
+
+    # -- COM surface --
+    @property
+    def Paragraphs(self):
+        return FakeCollection(self, self.paragraphs)
+
+    @property
+    def Tables(self):
+        return FakeCollection(self, [])
+
+    @property
+    def Fields(self):
+        return FakeCollection(self, [])
+
+    @property
+    def InlineShapes(self):
+        return FakeCollection(self, [FakeInlineShape(self) for p in self.paragraphs for _ in range(p.images)])
+
+    @property
+    def Shapes(self):
+        return FakeCollection(self, [])
+
+    @property
+    def Content(self):
+        self._tick()
+        end = self._layout()[-1] + len(self.paragraphs[-1].text) + 1 if self.paragraphs else 0
+        return FakeRange(self, 0, end)
+
+    def Range(self, Start=0, End=0):
+        self._tick()
+        return FakeRange(self, Start, End)
+
+    def Windows(self, i):
+        return self.ActiveWindow
+
+    def load_html(self, markup: str):
+        kinds = []
+        for m in _FAKE_BLOCK_RE.finditer(markup):
+            if m.group(2):
+                if m.group(1):
+                    if kinds:
+                        kinds.pop()
+                else:
+                    kinds.append(m.group(2).lower())
+                continue
+            tag, attrs, inner = m.group(3).lower(), m.group(4) or "", m.group(5) or ""
+            text = html.unescape(re.sub(r'(?s)<[^>]+>', "", inner)).replace("\r", " ").replace("\n", " ").strip()
+            images = len(re.findall(r'(?i)<img\b', inner))
+            cls = _FAKE_CLASS_RE.search(attrs)
+            style, list_type = _FAKE_CLASS_STYLES.get(cls.group(1).lower()) if cls else None, 0
+            if tag.startswith("h"):
+                style = f"Heading {tag[1]}"
+            elif kinds and tag in ("li", "p"):
+                list_type = tdu.WD_LIST_BULLET if kinds[-1] == "ul" else tdu.WD_LIST_NUMBERED
+                style = style or "List Paragraph"
+            elif tag == "p":
+                style = style or "Normal (Web)"
+            self.paragraphs.append(FakeParagraph(self, text, style or "Normal", list_type, images))
+        if _FAKE_TAIL_TABLE_RE.search(markup):
+            # Word keeps a paragraph after a table that ends the document
+            self.paragraphs.append(FakeParagraph(self, "", "Normal", 0, 0))
+        self._dirty = True
+
+    def to_filtered_html(self, html_path: str) -> str:
+        base = os.path.splitext(os.path.basename(html_path))[0]
+        files_dir = os.path.join(os.path.dirname(html_path), f"{base}_files")
+        parts = []
+        n_img = 0
+        for p in self.paragraphs:
+            inner = html.escape(p.text)
+            for _ in range(p.images):
+                n_img += 1
+                os.makedirs(files_dir, exist_ok=True)
+                name = f"image{n_img:03d}.png"
+                with open(os.path.join(files_dir, name), "wb") as f:
+                    f.write(FAKE_PNG)
+                inner += f'<img width=320 height=200 src="{base}_files/{name}" alt="Figure {n_img}">'
+            if p.style.startswith("Heading"):
+                lvl = p.style[-1]
+                parts.append(f"<h{lvl}>{inner}</h{lvl}>")
+            else:
+                parts.append(f"<p class=MsoNormal style='margin-bottom:0in;line-height:normal'>{inner}</p>")
+        return ("<html>\n<head>\n<meta http-equiv=Content-Type content=\"text/html; charset=utf-8\">\n"
+                "<style>\n<!-- p.MsoNormal {margin:0in;font-size:11.0pt;} -->\n</style>\n</head>\n"
+                "<body lang=EN-US style='word-wrap:break-word'>\n<div class=WordSection1>\n"
+                + "\n\n".join(parts) + "\n\n</div>\n</body>\n</html>\n")
+
+    def SaveAs2(self, FileName="", FileFormat=tdu.WD_FORMAT_XML_DOCUMENT):
+        self._tick()
+        self._app._delay(self._app.backend.save_delay)
+        if FileFormat == tdu.WD_FORMAT_FILTERED_HTML:
+            data = self.to_filtered_html(FileName)
+        else:
+            data = "\n".join(f"[{p.style}|{p.list_type}] {p.text}" for p in self.paragraphs)
+        with open(FileName, "w", encoding="utf-8") as f:
+            f.write(data)
+        self.Saved = True
+
+    SaveAs = SaveAs2
+
+    def Close(self, SaveChanges=False):
+        self._tick()
+        self.closed = True
+        try:
+            self._app.open_docs.remove(self)
+        except ValueError:
+            pass
+
+class FakeDocuments:
+    def __init__(self, app):
+        self._app = app
+
+    def Open(self, FileName="", **kw):
+        app = self._app
+        app._tick()
+        app._maybe_hang(FileName)
+        app._delay(app.backend.open_delay)
+        if not os.path.isfile(FileName):
+            raise tdu.ComError(-2146823114, f"Sorry, we couldn't find your file. ({FileName})", None, None)
+        doc = FakeDocument(app, FileName)
+        with open(FileName, "r", encoding="utf-8", errors="ignore") as f:
+            data = f.read()
+        if "<" in data:
+            doc.load_html(data)
+        else:
+            for line in data.splitlines():
+                m = re.match(r'^(#{1,6})\s+(.*)$', line)
+                if m:
+                    doc.paragraphs.append(FakeParagraph(doc, m.group(2), f"Heading {len(m.group(1))}"))
+                elif line.strip() == "[image]":
+                    doc.paragraphs.append(FakeParagraph(doc, "", "Normal", 0, 1))
+                elif line.strip():
+                    doc.paragraphs.append(FakeParagraph(doc, line.strip()))
+            doc._dirty = True
+        app.open_docs.append(doc)
+        return doc
+
+    def Add(self, Template=""):
+        app = self._app
+        app._tick()
+        if Template and Template not in app.loaded_templates:
+            app._delay(app.backend.template_delay)
+            app.loaded_templates.add(Template)
+        doc = FakeDocument(app, "", Template)
+        app.open_docs.append(doc)
+        return doc
+
+class FakeWordApp:
+    def __init__(self, backend, pid):
+        self.backend = backend
+        self.pid = pid
+        self.Visible = True
+        self.DisplayAlerts = -1
+        self.Caption = "Microsoft Word"
+        self.Options = FakeNamespace(SaveNormalPrompt=True, ConfirmConversions=True,
+                                     DoNotCompressImages=False, DefaultTargetDocumentResolution=220)
+        self.NormalTemplate = FakeNamespace(FullName="Normal.dotm")
+        self.Documents = FakeDocuments(self)
+        self.ProtectedViewWindows = FakeNamespace(Open=self.Documents.Open)
+        self.open_docs = []
+        self.loaded_templates = set()
+        self.calls = 0
+        self.dead = False
+        self.quit = False
+        self._killed = threading.Event()
+
+    def _tick(self):
+        if self.dead:
+            raise tdu.ComError(tdu.RPC_S_SERVER_UNAVAILABLE, "The RPC server is unavailable.", None, None)
+        self.calls += 1
+        if self.backend.call_delay:
+            time.sleep(self.backend.call_delay)
+
+    def _delay(self, seconds):
+        if seconds:
+            time.sleep(seconds)
+
+    def _maybe_hang(self, path):
+        if any(h in os.path.basename(path) for h in self.backend.hang_on):
+            self._killed.wait()
+            raise tdu.ComError(tdu.RPC_S_SERVER_UNAVAILABLE, "The RPC server is unavailable.", None, None)
+
+    def Quit(self):
+        self._tick()
+        self.quit = True
+        self.dead = True
+
+    def _kill(self):
+        self.dead = True
+        self._killed.set()
+
+class FakeWordBackend:
+    name = "fake"
+
+    def __init__(self, launch_delay=1.5, open_delay=0.05, save_delay=0.05, template_delay=0.3,
+                 import_delay=0.05, call_delay=0.0, hang_on=()):
+        self.launch_delay = launch_delay
+        self.open_delay = open_delay
+        self.save_delay = save_delay
+        self.template_delay = template_delay
+        self.import_delay = import_delay
+        self.call_delay = call_delay
+        self.hang_on = tuple(hang_on)
+        self.launches = 0
+        self.kills = 0
+        self.lock = threading.Lock()
+        self.apps = []
+
+    def thread_init(self):
+        pass
+
+    def thread_uninit(self):
+        pass
+
+    def launch(self):
+        time.sleep(self.launch_delay)
+        with self.lock:
+            self.launches += 1
+            app = FakeWordApp(self, 10000 + self.launches)
+            self.apps.append(app)
+        return app
+
+    def process_id(self, word):
+        return word.pid
+
+    def kill(self, word, pid):
+        with self.lock:
+            self.kills += 1
+        word._kill()
+
+FAKE_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+# ---------- Stub chat server ----------
+STYLE_BRIDGES = (
+    'p.Note { mso-style-name:"Note"; }\n'
+    'span.ClicksChar { mso-style-name:"Clicks Char"; }\n'
+    'p.BulletedList { mso-style-name:"Bulleted List"; }\n'
+)
+
+def canned_ai_html(message: str) -> str:
+    # The instructions mention the markers too, so the payload starts at the last one
+    start = message.rfind("<BEGIN_HTML>")
+    body = message[start + len("<BEGIN_HTML>"):] if start != -1 else message
+    body = re.split(r'(?i)</?END_HTML>', body)[0].strip()
+    body = re.sub(r'(?is)\s(?:class|style|lang)=(?:"[^"]*"|\'[^\']*\'|[^\s>]+)', "", body)
+    body = re.sub(r'(?is)</?div[^>]*>', "", body)
+    h1 = re.search(r'(?is)<h1[^>]*>(.*?)</h1>', body)
+    title = html.unescape(re.sub(r'(?s)<[^>]+>', "", h1.group(1))).strip() if h1 else "Document"
+    return (f'<html lang="en">\n<head>\n<meta charset="utf-8">\n<title>{html.escape(title)}</title>\n'
+            f'<style>\n{STYLE_BRIDGES}</style>\n</head>\n<body>\n{body}\n</body>\n</html>')
+
+STUB_CHAT_PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>Stub Chat</title></head>
+<body>
+<nav><button id="new" type="button">New chat</button></nav>
+<main id="messages"></main>
+<form id="composer" onsubmit="return false">
+<textarea id="prompt" aria-label="Message" rows="4" cols="80"></textarea>
+<button id="send" type="button" aria-label="Send message">Send</button>
+</form>
+<script>
+const messages = document.getElementById('messages');
+const prompt = document.getElementById('prompt');
+window.__adaGenerating = false;
+document.getElementById('new').onclick = () => { messages.innerHTML = ''; prompt.value = ''; };
+async function send() {
+  const text = prompt.value;
+  if (!text) return;
+  prompt.value = '';
+  const mine = document.createElement('div');
+  mine.className = 'user';
+  mine.textContent = text.slice(0, 200);
+  messages.appendChild(mine);
+  const pre = document.createElement('pre');
+  const code = document.createElement('code');
+  pre.appendChild(code);
+  messages.appendChild(pre);
+  window.__adaGenerating = true;
+  const r = await fetch('/api/ask', {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                     body: JSON.stringify({text})});
+  const reader = r.body.getReader();
+  const dec = new TextDecoder();
+  let buf = '';
+  for (;;) {
+    const {value, done} = await reader.read();
+    if (done) break;
+    buf += dec.decode(value, {stream: true});
+    let i;
+    while ((i = buf.indexOf('\\n\\n')) >= 0) {
+      const ev = buf.slice(0, i);
+      buf = buf.slice(i + 2);
+      if (!ev.startsWith('data: ')) continue;
+      const d = ev.slice(6);
+      if (d === '[DONE]') continue;
+      code.textContent += JSON.parse(d).text;
+    }
+  }
+  window.__adaGenerating = false;
+}
+document.getElementById('send').onclick = send;
+prompt.addEventListener('keydown', e => { if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); send(); } });
+</script>
+</body></html>
+"""
+
+class _StubChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def handle(self):
+        # A client that abandons a streamed reply resets the connection; not an error here
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send(self, code, body: bytes, ctype="text/html; charset=utf-8", headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b"{}"
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except Exception:
+            return {}
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, pieces, frame):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for piece in pieces:
+                self._chunk(frame(piece))
+            self._chunk(b"data: [DONE]\n\n")
+            self._chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_GET(self):
+        srv = self.server.stub
+        if self.path.split("?")[0] in ("/", "/c/new"):
+            srv.page_loads += 1
+            self._send(200, STUB_CHAT_PAGE.encode("utf-8"))
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        srv = self.server.stub
+        if self.path == "/api/ask":
+            text = self._read_json().get("text", "")
+            srv.requests += 1
+            srv.bytes_received += len(text.encode("utf-8"))
+            frame = lambda piece: ("data: " + json.dumps({"text": piece}) + "\n\n").encode("utf-8")
+            self._stream(srv.stream_pieces(srv.respond(text), len(text)), frame)
+        elif self.path.rstrip("/").endswith("/chat/completions"):
+            self._completions(srv, self._read_json())
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def _completions(self, srv, req):
+        # OpenAI-compatible endpoint for HttpChatTransport; fail_next answers 503s first,
+        # with a Retry-After header when retry_after is set
+        msgs = req.get("messages") or []
+        text = next((m.get("content", "") for m in reversed(msgs) if m.get("role") == "user"), "")
+        system = next((m.get("content", "") for m in msgs if m.get("role") == "system"), "")
+        with srv.lock:
+            srv.requests += 1
+            srv.bytes_received += len(text.encode("utf-8")) + len(system.encode("utf-8"))
+            # A repeated system prompt is a cached prefix: read once, like a provider's prompt cache
+            prefill = len(text) + (0 if system in srv.cached_prefixes else len(system))
+            if system:
+                srv.cached_prefixes.add(system)
+            fail = srv.fail_next > 0
+            if fail:
+                srv.fail_next -= 1
+            srv.active += 1
+            srv.max_active = max(srv.max_active, srv.active)
+        try:
+            if fail:
+                retry = [("Retry-After", str(srv.retry_after))] if srv.retry_after is not None else []
+                self._send(503, b"busy", "text/plain", retry)
+                return
+            reply = srv.respond(text)
+            if req.get("stream"):
+                frame = lambda piece: ("data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": piece}}]})
+                                       + "\n\n").encode("utf-8")
+                self._stream(srv.stream_pieces(reply, prefill), frame)
+            else:
+                "".join(srv.stream_pieces(reply, prefill))
+                body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": reply}}]}
+                self._send(200, json.dumps(body).encode("utf-8"), "application/json")
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+class StubChatServer:
+    # prompt_chars_per_second adds prompt-reading time to the first token, as a real model's
+    # prefill does; 0 keeps the first token delay fixed
+    def __init__(self, first_token_delay=0.5, chars_per_second=20000, chunk_chars=400, respond=None, port=0,
+                 prompt_chars_per_second=0.0):
+        self.first_token_delay = first_token_delay
+        self.chars_per_second = chars_per_second
+        self.prompt_chars_per_second = prompt_chars_per_second
+        self.chunk_chars = chunk_chars
+        self.respond = respond or canned_ai_html
+        self.port = port
+        self.httpd = None
+        self.thread = None
+        self.page_loads = 0
+        self.requests = 0
+        self.bytes_received = 0
+        self.last_token_at = 0.0
+        self.first_token_s = []
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.fail_next = 0
+        self.retry_after = None
+        self.active = 0
+        self.max_active = 0
+        self.cached_prefixes = set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def stream_pieces(self, text: str, prompt_chars: int = 0):
+        delay = self.first_token_delay
+        if self.prompt_chars_per_second:
+            delay += prompt_chars / self.prompt_chars_per_second
+        self.first_token_s.append(delay)
+        time.sleep(delay)
+        step = max(1, self.chunk_chars)
+        for i in range(0, len(text), step):
+            piece = text[i:i + step]
+            if self.chars_per_second:
+                time.sleep(len(piece) / self.chars_per_second)
+            yield piece
+        # Resumed once the last piece has been written to the socket
+        self.last_token_at = time.perf_counter()
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), _StubChatHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class FakeChat:
+    # Stands in for NavigatorChat: fixed latency per message (plus generation time when
+    # chars_per_second is set), canned cleaned HTML back. A reply longer than
+    # max_output_chars times out the way a truncated chat answer does.
+    # input_chars_per_second adds the time to paste and read each message to the first token.
+    session_mode = "conversation"
+
+    def __init__(self, latency: float = 2.0, respond=None, chars_per_second: float = 0.0,
+                 max_output_chars: int = 0, max_parallel: int = 1, input_chars_per_second: float = 0.0):
+        self.latency = latency
+        self.respond = respond or canned_ai_html
+        self.chars_per_second = chars_per_second
+        self.max_output_chars = max_output_chars
+        self.max_parallel = max_parallel
+        self.input_chars_per_second = input_chars_per_second
+        self.lock = threading.Lock()
+        self.reconnects = 0
+        self.messages = 0
+        self.bytes_sent = 0
+        self.conversations = 0
+        self.first_token_s = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def ensure_ready(self):
+        pass
+
+    def new_conversation(self):
+        with self.lock:
+            self.conversations += 1
+
+    def submit_and_get_html(self, content: str, wait_seconds: int = 600, stable_checks: int = 3,
+                            watch=None) -> str:
+        first = self.latency + (len(content) / self.input_chars_per_second if self.input_chars_per_second else 0.0)
+        with self.lock:
+            self.messages += 1
+            self.bytes_sent += len(content.encode("utf-8"))
+            self.first_token_s.append(first)
+        reply = self.respond(content)
+        n = len(reply)
+        if self.max_output_chars and n > self.max_output_chars:
+            n = self.max_output_chars
+        if watch is None:
+            time.sleep(first + (n / self.chars_per_second if self.chars_per_second else 0.0))
+        else:
+            # Streamed to the watch in pieces, so an abandoned reply stops early
+            time.sleep(first)
+            step = max(4000, n // 64)
+            for i in range(0, n, step):
+                if self.chars_per_second:
+                    time.sleep(min(step, n - i) / self.chars_per_second)
+                watch.feed(reply[:i + step])
+            if n == len(reply):
+                watch.close()
+        if n < len(reply):
+            raise TimeoutError("AI response with complete HTML not detected within the timeout window.")
+        return reply
+
+# ---------- Synthetic Word exports ----------
+_WORD_HEAD = """<html>
+
+<head>
+<meta http-equiv=Content-Type content="text/html; charset=utf-8">
+<meta name=Generator content="Microsoft Word 15 (filtered)">
+<style>
+<!--
+ /* Font Definitions */
+ @font-face
+	{font-family:"Cambria Math";
+	panose-1:2 4 5 3 5 4 6 3 2 4;}
+ /* Style Definitions */
+ p.MsoNormal, li.MsoNormal, div.MsoNormal
+	{margin-top:0in;
+	margin-right:0in;
+	margin-bottom:8.0pt;
+	margin-left:0in;
+	line-height:107%%;
+	font-size:11.0pt;
+	font-family:"Calibri",sans-serif;}
+p.MsoListParagraphCxSpFirst
+	{mso-style-name:"List Paragraph";
+	margin-left:.5in;}
+-->
+</style>
+<link rel=File-List href="%(base)s_files/filelist.xml">
+</head>
+
+<body lang=EN-US link="#0563C1" vlink="#954F72" style='word-wrap:break-word'>
+
+<div class=WordSection1>
+"""
+
+_WORD_TAIL = """
+</div>
+
+</body>
+
+</html>
+"""
+
+def make_word_html(target_bytes: int = 100_000, base: str = "doc", images: bool = True, seed: int = 0,
+                   image_run: int = 1) -> str:
+    # image_run > 1 stacks that many image-only tables per section (screenshot-heavy guides)
+    import random
+    rnd = random.Random(seed)
+    words = ("select", "the", "report", "menu", "click", "Save", "training", "record", "student", "course",
+             "approve", "request", "workflow", "department", "enter", "value", "field", "review", "submit")
+    parts = [f"<h1>Training Guide {seed}</h1>"]
+    size = len(_WORD_HEAD) + len(parts[0])
+    n_img = n = 0
+    while size < target_bytes:
+        n += 1
+        sentence = " ".join(rnd.choice(words) for _ in range(rnd.randint(8, 30))).capitalize() + "."
+        r = n % 17
+        if r == 0:
+            block = f"<h2>Section {n // 17}</h2>"
+        elif r == 5:
+            block = (f"<p class=MsoListParagraphCxSpFirst style='text-indent:-.25in'><span style='font-family:Symbol'>"
+                     f"·<span style='font:7.0pt \"Times New Roman\"'>&nbsp;&nbsp;&nbsp; </span></span>{sentence}</p>")
+        elif r == 6:
+            block = (f"<p class=MsoListParagraphCxSpLast style='text-indent:-.25in'>1.<span "
+                     f"style='font:7.0pt \"Times New Roman\"'>&nbsp;&nbsp; </span>{sentence}</p>")
+        elif r == 9 and images:
+            block = "\n\n".join(
+                f"<table class=MsoTableGrid border=1 cellspacing=0 cellpadding=0><tr><td width=623 valign=top "
+                f"style='width:467.5pt;padding:0in 5.4pt 0in 5.4pt'><p class=MsoNormal><img width=624 height=351 "
+                f"src=\"{base}_files/image{n_img + k:03d}.png\" alt=\"Screenshot {n_img + k}\"></p></td></tr></table>"
+                for k in range(1, image_run + 1))
+            n_img += image_run
+        elif r == 12:
+            block = f"<p class=MsoNormal><b><span style='font-size:12.0pt;line-height:107%'>Note:</span></b> {sentence}</p>"
+        elif r == 14:
+            block = f"<!-- comment {n} --><p class=MsoNormal>{sentence}</p>"
+        else:
+            block = (f"<p class=MsoNormal style='margin-bottom:0in;line-height:normal'><span "
+                     f"style='font-family:\"Arial\",sans-serif'>{sentence}</span></p>")
+        parts.append(block)
+        size += len(block) + 2
+    return (_WORD_HEAD % {"base": base}) + "\n\n".join(parts) + _WORD_TAIL
+
+def write_word_export(folder: str, target_bytes: int, base: str = "doc", seed: int = 0, image_run: int = 1):
+    # A filtered-HTML export on disk: <base>.html plus <base>_files/ with every referenced image
+    os.makedirs(folder, exist_ok=True)
+    markup = make_word_html(target_bytes, base, True, seed, image_run)
+    html_path = os.path.join(folder, f"{base}.html")
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(markup)
+    files_dir = os.path.join(folder, f"{base}_files")
+    os.makedirs(files_dir, exist_ok=True)
+    for name in set(re.findall(r'src="[^"/]*/([^"]+)"', markup)):
+        with open(os.path.join(files_dir, name), "wb") as f:
+            f.write(FAKE_PNG)
+    return html_path, files_dir, markup
+
+def make_ai_reply(body_html: str, leak: bool = True) -> str:
+    # What a chat reply tends to look like: the cleaned document, sometimes with prompt echoes
+    doc = canned_ai_html(build_prompt_for(body_html))
+    if leak:
+        doc = doc.replace("<body>\n", "<body>\n<ul>\n<li>Output: one raw HTML5 document</li>\n</ul>\n"
+                                       "<p>Preservation: keep images</p>\n", 1)
+        doc = doc.replace("</h1>", "</h1>\n<p>Self-check: all good</p>\n<ul>\n<li><p>Item one</p></li>\n"
+                                   "<li><p class=\"BulletedList\">Item two</p></li>\n</ul>", 1)
+    return doc
+
+def build_prompt_for(body_html: str) -> str:
+    return tdu.build_prompt(body_html)
+
+# ---------- Synthetic inputs ----------
+def write_fake_docx_inputs(folder: str, count: int, paragraphs: int = 40, images: int = 2):
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for n in range(count):
+        lines = [f"# Training document {n}"]
+        for k in range(paragraphs):
+            if k % 10 == 0:
+                lines.append(f"## Section {k // 10 + 1}")
+            if k % max(1, paragraphs // max(1, images)) == 0 and images:
+                lines.append("[image]")
+            lines.append(f"Paragraph {k} of document {n} describing a step in the procedure.")
+        p = os.path.join(folder, f"doc_{n:04d}.docx")
+        with open(p, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        paths.append(p)
+    return paths
+
+# ---------- Benchmarks ----------
+def _report(title, rows):
+    print(title)
+    for name, value in rows:
+        print(f"  {name:<34} {value}")
+
+def bench_word_pool(docs: int = 40, sizes=(1, 2, 4), launch_delay: float = 1.0):
+    work = tempfile.mkdtemp(prefix="bench_wordpool_")
+    results = {}
+    try:
+        inputs = write_fake_docx_inputs(os.path.join(work, "in"), docs)
+
+        def one_doc(export_fn, import_fn, path):
+            html_path, assets_dir, short_base = export_fn(path)
+            out = os.path.join(work, "out", f"{short_base}.docx")
+            import_fn(html_path, out)
+            shutil.rmtree(os.path.dirname(html_path), ignore_errors=True)
+
+        backend = FakeWordBackend(launch_delay=launch_delay)
+
+        def cold_export(path):
+            s = tdu.WordSession(backend, preload_template=False).open()
+            try:
+                return s.export(path)
+            finally:
+                s.close()
+
+        def cold_import(src, out):
+            s = tdu.WordSession(backend, preload_template=False).open()
+            try:
+                return s.import_html(src, out)
+            finally:
+                s.close()
+
+        t0 = time.perf_counter()
+        for p in inputs:
+            one_doc(cold_export, cold_import, p)
+        cold = time.perf_counter() - t0
+        results["dispatch_per_call"] = {"seconds": cold, "launches": backend.launches}
+
+        from concurrent.futures import ThreadPoolExecutor
+        for size in sizes:
+            backend = FakeWordBackend(launch_delay=launch_delay)
+            t0 = time.perf_counter()
+            with tdu.WordPool(size=size, backend=backend, recycle_after=25, log_fn=lambda m: None) as pool:
+                with ThreadPoolExecutor(max_workers=size) as ex:
+                    list(ex.map(lambda p: one_doc(pool.export, pool.import_html, p), inputs))
+                stats = pool.stats()
+            results[f"pool_{size}"] = {"seconds": time.perf_counter() - t0, "launches": stats["launches"],
+                                       "recycles": stats["recycles"]}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [(k, f"{v['seconds']:.2f}s  launches={v['launches']}  docs/s={docs / v['seconds']:.2f}")
+            for k, v in results.items()]
+    _report(f"Word pool vs Dispatch/Quit per call ({docs} docs, launch {launch_delay}s)", rows)
+    return results
+
+def bench_word_pool_hang(call_timeout: float = 1.0):
+    work = tempfile.mkdtemp(prefix="bench_wordhang_")
+    try:
+        inputs = write_fake_docx_inputs(os.path.join(work, "in"), 4)
+        hang_name = os.path.basename(inputs[1])
+        backend = FakeWordBackend(launch_delay=0.1, hang_on=(hang_name,))
+        errors = []
+        t0 = time.perf_counter()
+        with tdu.WordPool(size=1, backend=backend, call_timeout=call_timeout, log_fn=lambda m: None) as pool:
+            futs = [pool.submit("export", p) for p in inputs]
+            for f in futs:
+                try:
+                    f.result(timeout=call_timeout * 10)
+                except Exception as e:
+                    errors.append(type(e).__name__)
+            stats = pool.stats()
+        elapsed = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    _report("Word pool hang recovery", [
+        ("elapsed", f"{elapsed:.2f}s"),
+        ("errors", ", ".join(errors) or "none"),
+        ("hangs / launches / kills", f"{stats['hangs']} / {stats['launches']} / {backend.kills}"),
+    ])
+    return {"seconds": elapsed, "errors": errors, "stats": stats, "kills": backend.kills}
+
+def sample_prompt(n: int = 0, paragraphs: int = 30) -> str:
+    parts = [f"<h1>Training document {n}</h1>"]
+    for k in range(paragraphs):
+        parts.append(f"<p class=MsoNormal style='margin-bottom:0in'>Paragraph {k} explains step {k} of the process.</p>")
+    return tdu.package_for_ai("\n".join(parts), "", tempfile.gettempdir())
+
+def bench_chat_session(docs: int = 10, first_token_delay: float = 0.2, stable_checks: int = 2):
+    if not tdu.PLAYWRIGHT_AVAILABLE:
+        print("chatsession: playwright is not installed; skipping.")
+        return {}
+    profile = tempfile.mkdtemp(prefix="bench_chat_profile_")
+    results = {}
+    try:
+        with StubChatServer(first_token_delay=first_token_delay) as srv:
+            overhead, total = [], []
+            for n in range(docs):
+                t0 = time.perf_counter()
+                chat = tdu.NavigatorChat(profile, url=srv.url, headless=True)
+                chat.start()
+                overhead.append(time.perf_counter() - t0)
+                try:
+                    chat.submit_and_get_html(sample_prompt(n), wait_seconds=60, stable_checks=stable_checks)
+                finally:
+                    chat.stop()
+                total.append(time.perf_counter() - t0)
+            results["browser_per_document"] = {"overhead": overhead, "total": total}
+
+            overhead, total = [], []
+            chat = tdu.NavigatorChat(profile, url=srv.url, headless=True)
+            chat.start()
+            try:
+                for n in range(docs):
+                    t0 = time.perf_counter()
+                    chat.ensure_ready()
+                    chat.new_conversation()
+                    overhead.append(time.perf_counter() - t0)
+                    chat.submit_and_get_html(sample_prompt(n), wait_seconds=60, stable_checks=stable_checks)
+                    total.append(time.perf_counter() - t0)
+            finally:
+                chat.stop()
+            results["shared_session"] = {"overhead": overhead, "total": total, "reconnects": chat.reconnects}
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+    rows = []
+    for k, v in results.items():
+        rows.append((k, f"overhead/doc={1000 * sum(v['overhead']) / docs:.0f}ms  total/doc={sum(v['total']) / docs:.2f}s"))
+    _report(f"Navigator Chat session reuse ({docs} docs, local stub page)", rows)
+    return results
+
+def bench_response_capture(docs: int = 5, sizes=(20_000, 200_000)):
+    # Last streamed token -> submit_and_get_html returning, DOM polling vs event capture
+    if not tdu.PLAYWRIGHT_AVAILABLE:
+        print("capture: playwright is not installed; skipping.")
+        return {}
+    profile = tempfile.mkdtemp(prefix="bench_capture_profile_")
+    results = {}
+    try:
+        with StubChatServer(first_token_delay=0.2, chars_per_second=200_000) as srv:
+            for mode in ("poll", "events"):
+                chat = tdu.NavigatorChat(profile, url=srv.url, headless=True, capture=mode)
+                chat.start()
+                try:
+                    for size in sizes:
+                        body = tdu.extract_body_for_ai(make_word_html(size, "doc", False, size))
+                        lags, via = [], set()
+                        for _ in range(docs):
+                            chat.new_conversation()
+                            doc = chat.submit_and_get_html(tdu.build_prompt(body), wait_seconds=120)
+                            lags.append(time.perf_counter() - srv.last_token_at)
+                            via.add(chat.captured_via)
+                            if "</html>" not in doc.lower():
+                                raise RuntimeError("incomplete document captured")
+                        results[f"{mode} {size // 1000} KB"] = {"lag_avg": sum(lags) / len(lags), "lag_max": max(lags),
+                                                               "via": sorted(v for v in via if v)}
+                finally:
+                    chat.stop()
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+    rows = [(k, f"last token -> return avg={v['lag_avg'] * 1000:.0f}ms max={v['lag_max'] * 1000:.0f}ms  "
+                f"via={','.join(v['via'])}") for k, v in results.items()]
+    _report(f"AI response capture ({docs} replies per size, local stub chat)", rows)
+    return results
+
+def bench_chat_tabs(docs: int = 12, tabs=(1, 2, 4), first_token_delay: float = 1.0):
+    # N tabs of one browser vs a single page, small documents, local stub chat page. One
+    # document gets a reply with no HTML, so its tab times out and is replaced; the renderer
+    # of the tab asking for another one is crashed mid-reply. The rest must still convert.
+    if not tdu.PLAYWRIGHT_AVAILABLE:
+        print("tabs: playwright is not installed; skipping.")
+        return {}
+    current = {}
+    crash_marker = "[crash this tab]"
+
+    async def crash_tab(marker):
+        chat = current["chat"]
+        for tab in list(chat.tabs):
+            try:
+                if marker in await tab.page.content():
+                    cdp = await chat.context.new_cdp_session(tab.page)
+                    await cdp.send("Page.crash")
+            except Exception:
+                pass    # the crash also kills the CDP call
+
+    def respond(message):
+        if "Training document 3<" in message:
+            return "Sorry, I can't help with that."
+        if message.startswith(crash_marker):
+            tdu.asyncio.run_coroutine_threadsafe(crash_tab(crash_marker), current["chat"].loop)
+        return canned_ai_html(message)
+
+    profile = tempfile.mkdtemp(prefix="bench_tabs_profile_")
+    results = {}
+    try:
+        with StubChatServer(first_token_delay=first_token_delay, respond=respond) as srv:
+            for n in tabs:
+                chat = current["chat"] = tdu.NavigatorChatTabs(profile, url=srv.url, tabs=n, headless=True)
+                chat.start()
+                errors = {}
+
+                def one(k):
+                    t_doc = time.perf_counter()
+                    try:
+                        chat.ensure_ready()
+                        prompt = sample_prompt(k)
+                        chat.submit_and_get_html(f"{crash_marker}\n{prompt}" if k == 7 else prompt, wait_seconds=10)
+                    except Exception:
+                        errors[k] = time.perf_counter() - t_doc
+
+                try:
+                    t0 = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=n) as ex:
+                        list(ex.map(one, range(docs)))
+                    results[f"{n} tab(s)"] = {"seconds": time.perf_counter() - t0, "failed": dict(sorted(errors.items())),
+                                              "replaced_tabs": chat.reconnects}
+                finally:
+                    chat.stop()
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+    base = next(iter(results.values()))["seconds"] if results else 0
+    rows = [(k, f"{v['seconds']:.2f}s  speedup={base / v['seconds']:.1f}x  failed="
+                + ", ".join(f"doc {d} after {t:.1f}s" for d, t in v["failed"].items())
+                + f"  tabs replaced={v['replaced_tabs']}") for k, v in results.items()]
+    _report(f"Multi-tab chat ({docs} small docs, first token {first_token_delay}s, 1 bad reply, 1 tab crash)", rows)
+    return results
+
+def bench_http_transport(docs: int = 16, concurrency=(1, 4, 8), first_token_delay: float = 0.5,
+                         chars_per_second: float = 20_000):
+    # The whole pipeline (fake Word) with the HTTP transport against the stub endpoint
+    work = tempfile.mkdtemp(prefix="bench_http_")
+    results = {}
+    try:
+        inputs_root = os.path.join(work, "in")
+        with StubChatServer(first_token_delay=first_token_delay, chars_per_second=chars_per_second) as srv:
+            backend = FakeWordBackend(launch_delay=0.1)
+            with tdu.WordPool(size=2, backend=backend, log_fn=lambda m: None) as pool:
+                runs = [(f"{c} parallel", c, 0) for c in concurrency] + [(f"{concurrency[-1]} parallel, 3x 503",
+                                                                          concurrency[-1], 3)]
+                for name, c, fail in runs:
+                    inputs = write_fake_docx_inputs(os.path.join(inputs_root, name.replace(" ", "_").replace(",", "")), docs)
+                    srv.connections = srv.max_active = 0
+                    srv.fail_next = fail
+                    chat = tdu.HttpChatTransport(srv.url + "v1", max_parallel=c, backoff=0.2)
+                    t0 = time.perf_counter()
+                    try:
+                        jobs = tdu.BatchPipeline(tdu.default_pipeline_stages(pool, chat)).run(inputs)
+                    finally:
+                        chat.stop()
+                    results[name] = {"seconds": time.perf_counter() - t0,
+                                     "failed": sum(1 for j in jobs if j.error is not None),
+                                     "requests": chat.requests, "retries": chat.retried,
+                                     "connections": srv.connections, "max_in_flight": srv.max_active}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [(k, f"{v['seconds']:.2f}s  failed={v['failed']} requests={v['requests']} retries={v['retries']} "
+                f"connections={v['connections']} in-flight max={v['max_in_flight']}") for k, v in results.items()]
+    _report(f"HTTP transport through the batch pipeline ({docs} docs, first token {first_token_delay}s, fake Word)", rows)
+    return results
+
+def bench_pipeline(docs: int = 12, ai_latency: float = 1.0, launch_delay: float = 0.5, queue_size: int = 2):
+    results = {}
+    for mode in ("sequential", "pipelined"):
+        work = tempfile.mkdtemp(prefix=f"bench_pipeline_{mode}_")
+        try:
+            inputs = write_fake_docx_inputs(os.path.join(work, "in"), docs)
+            backend = FakeWordBackend(launch_delay=launch_delay, open_delay=0.3, save_delay=0.3, import_delay=0.3)
+            chat = FakeChat(latency=ai_latency)
+            t0 = time.perf_counter()
+            with tdu.WordPool(size=2, backend=backend, log_fn=lambda m: None) as pool:
+                if mode == "sequential":
+                    for p in inputs:
+                        tdu.process_one_docx(p, "", pool, chat)
+                    stats = []
+                else:
+                    pipe = tdu.BatchPipeline(tdu.default_pipeline_stages(pool, chat), queue_size=queue_size)
+                    jobs = pipe.run(inputs)
+                    failed = [j for j in jobs if j.error is not None]
+                    if failed:
+                        raise failed[0].error
+                    stats = pipe.stats()
+            results[mode] = {"seconds": time.perf_counter() - t0, "stages": stats}
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    rows = [(k, f"{v['seconds']:.2f}s  docs/s={docs / v['seconds']:.2f}") for k, v in results.items()]
+    for r in results["pipelined"]["stages"]:
+        rows.append((f"  {r['stage']}", f"util={100 * r['utilisation']:.0f}%  queue avg={r['queue_avg']} "
+                                        f"max={r['queue_max']}  blocked={r['blocked_s']:.1f}s"))
+    _report(f"Sequential vs pipelined batch ({docs} docs, AI {ai_latency}s, fake Word)", rows)
+    return results
+
+def bench_ai_cache(docs: int = 8, ai_latency: float = 1.0):
+    work = tempfile.mkdtemp(prefix="bench_aicache_")
+    results = {}
+    try:
+        cache = tdu.AiCache(root=os.path.join(work, "cache"))
+        backend = FakeWordBackend(launch_delay=0.1)
+        with tdu.WordPool(size=2, backend=backend, log_fn=lambda m: None) as pool:
+            for run in ("first_run", "rerun"):
+                inputs = write_fake_docx_inputs(os.path.join(work, run), docs)
+                chat = FakeChat(latency=ai_latency)
+                t0 = time.perf_counter()
+                pipe = tdu.BatchPipeline(tdu.default_pipeline_stages(pool, chat, "", cache))
+                jobs = pipe.run(inputs)
+                results[run] = {"seconds": time.perf_counter() - t0, "chat_messages": chat.messages,
+                                "cache_hits": sum(1 for j in jobs if j.cache_hit)}
+        results["summary"] = cache.summary()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [(k, f"{v['seconds']:.2f}s  chat messages={v['chat_messages']}  hits={v['cache_hits']}")
+            for k, v in results.items() if isinstance(v, dict)]
+    rows += [("", line) for line in results["summary"].split("\n")]
+    _report(f"AI conversion cache ({docs} docs, AI {ai_latency}s)", rows)
+    return results
+
+class _CrashingImportPool:
+    def __init__(self, pool, crash_names):
+        self.pool = pool
+        self.crash_names = set(crash_names)
+
+    def export(self, docx_path):
+        return self.pool.export(docx_path)
+
+    def import_html(self, ai_html_path, out_docx_path):
+        if os.path.basename(out_docx_path) in self.crash_names:
+            raise RuntimeError("simulated crash during import")
+        return self.pool.import_html(ai_html_path, out_docx_path)
+
+def bench_journal(docs: int = 10, ai_latency: float = 0.5):
+    work = tempfile.mkdtemp(prefix="bench_journal_")
+    results = {}
+    try:
+        folder = os.path.join(work, "docs")
+        inputs = write_fake_docx_inputs(folder, docs)
+        crash = {os.path.basename(p) for p in inputs[::2]}
+        backend = FakeWordBackend(launch_delay=0.1)
+        with tdu.WordPool(size=2, backend=backend, log_fn=lambda m: None) as pool:
+            for run in ("interrupted", "resumed"):
+                journal = tdu.BatchJournal(os.path.join(work, "journal"))
+                files = list(tdu.find_docx_files(folder))
+                files = [f for f in files if not (journal.is_converted_output(f) or journal.is_backup(f))]
+                files += [f for f in journal.pending_moved([folder]) if f not in files]
+                chat = FakeChat(latency=ai_latency)
+                use_pool = _CrashingImportPool(pool, crash) if run == "interrupted" else pool
+                t0 = time.perf_counter()
+                jobs = tdu.BatchPipeline(tdu.default_pipeline_stages(use_pool, chat, "", None, journal)).run(files)
+                results[run] = {"seconds": time.perf_counter() - t0, "files": len(files),
+                                "chat_messages": chat.messages, "failed": sum(1 for j in jobs if j.error),
+                                "resumed": sum(1 for j in jobs if j.resumed_from)}
+                journal.close()
+            journal = tdu.BatchJournal(os.path.join(work, "journal"))
+            files = list(tdu.find_docx_files(folder))
+            t0 = time.perf_counter()
+            todo = [f for f in files if not (journal.is_converted_output(f) or journal.is_backup(f))]
+            results["rescan"] = {"seconds": time.perf_counter() - t0, "files": len(files), "todo": len(todo)}
+            journal.close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [(k, f"{v['seconds']:.2f}s  files={v['files']}  chat={v['chat_messages']}  failed={v['failed']}  "
+                f"resumed={v['resumed']}") for k, v in results.items() if k != "rescan"]
+    r = results["rescan"]
+    rows.append(("rescan", f"{1e6 * r['seconds'] / max(1, r['files']):.0f}us/file  files={r['files']}  to do={r['todo']}"))
+    _report(f"Resumable batch journal ({docs} docs, half crash during import)", rows)
+    return results
+
+def _measure(fn, memory: bool):
+    import tracemalloc
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t0
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return out, elapsed, peak
+
+# The regex cleanup chain clean_ai_html replaced, kept as the baseline
+_REGEX_SIGN_RES = [re.compile(rf'(?is)<(p|li)[^>]*>[^<]*{re.escape(sig)}[^<]*</\1>') for sig in tdu._PROMPT_SIGNS]
+_REGEX_LI_P_RE = re.compile(r'(?is)<li>\s*<p(?![^>]*\bclass\s*=\s*["\'][^"\']*\bBulletedList\b)[^>]*>(.*?)</p>\s*</li>')
+
+def regex_strip_leaked_prompt(ai_html):
+    m = re.search(r'(?is)<body[^>]*>(.*)</body>', ai_html)
+    if not m:
+        return ai_html
+    body = m.group(1)
+    h1m = re.search(r'(?is)<h1\b', body)
+    if h1m and any(sig in body[:h1m.start()].lower() for sig in tdu._PROMPT_SIGNS):
+        body = body[h1m.start():]
+    for rx in _REGEX_SIGN_RES:
+        body = rx.sub("", body)
+    body = re.sub(r'(?is)^\s*(<ul>.*?</ul>\s*)+', "", body)
+    return re.sub(r'(?is)(<body[^>]*>).*?(</body>)', rf"\1{body}\2", ai_html)
+
+def regex_rebase_img_src(ai_html, work_dir, original_assets_dir):
+    def repl(m):
+        fname = tdu._rebased_src(m.group(1).strip(), work_dir, original_assets_dir)
+        return m.group(0).replace(m.group(1).strip(), fname) if fname else m.group(0)
+    return tdu._IMG_SRC_RE.sub(repl, ai_html)
+
+def regex_preprocess_for_word(html_in):
+    return _REGEX_LI_P_RE.sub(r"<li>\1</li>", html_in)
+
+def bench_html_transforms(sizes=(10_000, 100_000, 1_000_000, 10_000_000, 50_000_000), memory: bool = False):
+    work = tempfile.mkdtemp(prefix="bench_html_")
+    results = {}
+    try:
+        for size in sizes:
+            folder = os.path.join(work, str(size))
+            # Each variant gets its own empty work dir so both pay the same image copies.
+            old_dir = os.path.join(folder, "work_regex")
+            new_dir = os.path.join(folder, "work_stream")
+            os.makedirs(old_dir, exist_ok=True)
+            os.makedirs(new_dir, exist_ok=True)
+            html_path, files_dir, markup = write_word_export(folder, size, "doc", size % 97)
+
+            def legacy_export():
+                body = tdu.extract_relevant_html_for_ai(markup)
+                return tdu.relativize_img_src_to_folder(body, old_dir, files_dir)
+
+            body_old, t_old, m_old = _measure(legacy_export, memory)
+            body_new, t_new, m_new = _measure(lambda: tdu.extract_body_for_ai(markup, new_dir, files_dir), memory)
+            reply = make_ai_reply(body_old)
+
+            def legacy_import():
+                h = regex_rebase_img_src(regex_strip_leaked_prompt(reply), old_dir, files_dir)
+                return tdu.run_html_stages(regex_preprocess_for_word(h), [tdu.ListMarkerStage()])
+
+            clean_old, ti_old, mi_old = _measure(legacy_import, memory)
+            clean_new, ti_new, mi_new = _measure(lambda: tdu.clean_ai_html(reply, new_dir, files_dir), memory)
+            results[size] = {
+                "export_regex_s": t_old, "export_stream_s": t_new, "export_regex_peak": m_old, "export_stream_peak": m_new,
+                "import_regex_s": ti_old, "import_stream_s": ti_new, "import_regex_peak": mi_old, "import_stream_peak": mi_new,
+                "identical": body_old == body_new and clean_old == clean_new,
+            }
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = []
+    for size, r in results.items():
+        line = (f"extract {r['export_regex_s'] * 1000:.0f}->{r['export_stream_s'] * 1000:.0f}ms  "
+                f"cleanup {r['import_regex_s'] * 1000:.0f}->{r['import_stream_s'] * 1000:.0f}ms  same={r['identical']}")
+        if memory:
+            line += (f"  peak {r['export_regex_peak'] / 1e6:.1f}->{r['export_stream_peak'] / 1e6:.1f}MB / "
+                     f"{r['import_regex_peak'] / 1e6:.1f}->{r['import_stream_peak'] / 1e6:.1f}MB")
+        rows.append((f"{size / 1000:.0f} KB", line))
+    _report("Regex chain vs current (extract: regex, memoized relativize; cleanup: token stages)", rows)
+    return results
+
+def bench_chunking(size: int = 600_000, chunk_chars: int = 60_000, parallel: int = 4, latency: float = 0.5,
+                   chars_per_second: float = 200_000.0, max_output_chars: int = 250_000):
+    # Whole-document submission vs section chunks (sequential, parallel, and with one bad
+    # section that needs a retry). The fake chat times out past max_output_chars.
+    body = tdu.extract_body_for_ai(make_word_html(size, "doc", True, 7))
+    results = {}
+
+    def flaky(message):
+        reply = canned_ai_html(message)
+        if "part 3 of" in message and not flaky.failed:
+            flaky.failed = True
+            return re.sub(r'(?is)<img[^>]*>', "", reply)
+        return reply
+    flaky.failed = False
+
+    runs = [
+        ("whole document", 0, FakeChat(latency, None, chars_per_second, max_output_chars)),
+        ("sections, 1 at a time", chunk_chars, FakeChat(latency, None, chars_per_second, max_output_chars)),
+        (f"sections, {parallel} parallel", chunk_chars,
+         FakeChat(latency, None, chars_per_second, max_output_chars, max_parallel=parallel)),
+        (f"sections, {parallel} parallel, 1 bad", chunk_chars,
+         FakeChat(latency, flaky, chars_per_second, max_output_chars, max_parallel=parallel)),
+    ]
+    for name, budget, chat in runs:
+        job = tdu.DocJob("bench.docx")
+        job.body = body
+        job.prompt = tdu.build_prompt(body)
+        t0 = time.perf_counter()
+        error = None
+        try:
+            tdu.convert_document(job, chat, chunk_chars=budget)
+        except Exception as e:
+            error = e
+        out = job.ai_html_clean or ""
+        results[name] = {
+            "seconds": time.perf_counter() - t0, "ok": error is None, "error": str(error or ""),
+            "sections": job.chunks, "retries": job.chunk_retries, "messages": chat.messages,
+            "bytes_sent": chat.bytes_sent, "h1": out.lower().count("<h1"),
+            "images": len(re.findall(r'(?i)<img', out)),
+        }
+    rows = []
+    for name, r in results.items():
+        if r["ok"]:
+            rows.append((name, f"{r['seconds']:.2f}s  sections={r['sections']} messages={r['messages']} "
+                               f"retries={r['retries']} sent={r['bytes_sent'] / 1e3:.0f}KB h1={r['h1']} "
+                               f"images={r['images']}"))
+        else:
+            rows.append((name, f"FAILED after {r['seconds']:.2f}s ({r['error'][:60]})"))
+    _report(f"Section chunking ({len(body) / 1e3:.0f} KB body, budget {chunk_chars / 1e3:.0f} KB, "
+            f"output limit {max_output_chars / 1e3:.0f} KB)", rows)
+    results["source_images"] = len(re.findall(r'(?i)<img', body))
+    return results
+
+class _FsCounter:
+    # Counts filesystem calls through audit events plus os.stat (isfile/exists go through it),
+    # and bytes passed to shutil.copyfile. Audit hooks cannot be removed, so one is installed
+    # for the process and only counts while a counter is active.
+    EVENTS = {"open", "os.scandir", "os.listdir", "shutil.copyfile", "os.link", "os.remove", "os.mkdir",
+              "os.utime", "os.chmod"}
+    current = None
+    installed = False
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes_copied = 0
+        self._stat = None
+
+    @classmethod
+    def _hook(cls, event, args):
+        c = cls.current
+        if c is None or event not in cls.EVENTS:
+            return
+        c.calls += 1
+        if event == "shutil.copyfile":
+            cls.current = None
+            try:
+                c.bytes_copied += os.path.getsize(args[0])
+            except OSError:
+                pass
+            cls.current = c
+
+    def __enter__(self):
+        if not _FsCounter.installed:
+            sys.addaudithook(_FsCounter._hook)
+            _FsCounter.installed = True
+        self._stat = os.stat
+
+        def counting_stat(*a, **kw):
+            if _FsCounter.current is self:
+                self.calls += 1
+            return self._stat(*a, **kw)
+
+        os.stat = counting_stat
+        _FsCounter.current = self
+        return self
+
+    def __exit__(self, *exc):
+        _FsCounter.current = None
+        os.stat = self._stat
+
+def write_image_exports(folder: str, docs: int, images: int, image_kb: int, shared: float, seed: int = 0):
+    # Word-like exports whose pictures repeat across documents (logos, common screenshots)
+    import random
+    rnd = random.Random(seed)
+    common = [os.urandom(image_kb * 1024) for _ in range(int(images * shared))]
+    out = []
+    for d in range(docs):
+        base = f"doc{d}"
+        exp = os.path.join(folder, f"export{d}")
+        files_dir = os.path.join(exp, f"{base}_files")
+        os.makedirs(files_dir, exist_ok=True)
+        parts = [f"<h1>Manual {d}</h1>"]
+        for i in range(images):
+            data = common[i] if i < len(common) else os.urandom(image_kb * 1024)
+            name = f"image{i + 1:03d}.png"
+            with open(os.path.join(files_dir, name), "wb") as f:
+                f.write(data)
+            parts.append(f"<p class=MsoNormal>Step {i} {rnd.random():.3f}</p>"
+                         f"<p class=MsoNormal><img width=600 height=400 src=\"{base}_files/{name}\" alt=\"Figure {i}\"></p>")
+        markup = (_WORD_HEAD % {"base": base}) + "\n".join(parts) + _WORD_TAIL
+        html_path = os.path.join(exp, f"{base}.html")
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(markup)
+        out.append((html_path, files_dir, markup))
+    return out
+
+def bench_image_store(docs: int = 6, images: int = 60, image_kb: int = 800, shared: float = 0.5):
+    work = tempfile.mkdtemp(prefix="bench_images_")
+    results = {}
+    try:
+        exports = write_image_exports(os.path.join(work, "exports"), docs, images, image_kb, shared)
+        store = tdu.ImageStore(os.path.join(work, "store"))
+        for mode in ("copies", "store"):
+            per_doc = []
+            t0 = time.perf_counter()
+            for n, (html_path, files_dir, markup) in enumerate(exports):
+                target = os.path.join(work, f"{mode}_work{n}")
+                os.makedirs(target, exist_ok=True)
+                with _FsCounter() as fs:
+                    if mode == "copies":
+                        tdu.copy_all(files_dir, target)
+                        body = tdu.extract_body_for_ai(markup, target, files_dir)
+                        tdu.clean_ai_html(make_ai_reply(body, leak=False), target, files_dir)
+                    else:
+                        index = store.stage(files_dir, target)
+                        body = tdu.extract_body_for_ai(markup, target, files_dir, index)
+                        tdu.clean_ai_html(make_ai_reply(body, leak=False), target, files_dir, images=index)
+                per_doc.append({"calls": fs.calls, "bytes_copied": fs.bytes_copied})
+            results[mode] = {"seconds": time.perf_counter() - t0, "per_doc": per_doc}
+        results["store_summary"] = store.summary()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = []
+    for mode in ("copies", "store"):
+        r = results[mode]
+        calls = sum(d["calls"] for d in r["per_doc"]) / docs
+        copied = sum(d["bytes_copied"] for d in r["per_doc"]) / docs
+        rows.append((mode, f"{r['seconds']:.2f}s  per doc: {copied / 1e6:.1f} MB copied, {calls:.0f} filesystem calls"))
+    rows.append(("", results["store_summary"]))
+    _report(f"Image staging ({docs} docs x {images} images of {image_kb} KB, {shared:.0%} shared)", rows)
+    return results
+
+# enforce_lists as it ran in Word before ListMarkerStage took over, kept as the baseline
+def legacy_enforce_lists(doc_out):
+    try:
+        i = 1
+        while i <= doc_out.Paragraphs.Count:
+            p = doc_out.Paragraphs(i)
+            try:
+                if p.Range.ListFormat.ListType in (tdu.WD_LIST_BULLET, tdu.WD_LIST_NUMBERED):
+                    i += 1
+                    continue
+            except Exception:
+                pass
+            kind, prelen = tdu._classify_marker(p.Range.Text)
+            if not kind:
+                i += 1
+                continue
+            start = i
+            j = i + 1
+            while j <= doc_out.Paragraphs.Count:
+                pj = doc_out.Paragraphs(j)
+                try:
+                    if pj.Range.ListFormat.ListType in (tdu.WD_LIST_BULLET, tdu.WD_LIST_NUMBERED):
+                        break
+                except Exception:
+                    pass
+                if tdu._classify_marker(pj.Range.Text)[0] != kind:
+                    break
+                j += 1
+            end = j - 1
+            for k in range(start, end + 1):
+                pk = doc_out.Paragraphs(k)
+                kindk, prelenk = tdu._classify_marker(pk.Range.Text)
+                if kindk and prelenk > 0:
+                    try:
+                        doc_out.Range(Start=pk.Range.Start, End=pk.Range.Start + prelenk).Text = ""
+                    except Exception:
+                        pass
+            try:
+                grp = doc_out.Range(Start=doc_out.Paragraphs(start).Range.Start,
+                                    End=doc_out.Paragraphs(end).Range.End)
+                if kind == "bullet":
+                    grp.ListFormat.ApplyBulletDefault()
+                else:
+                    grp.ListFormat.ApplyNumberDefault()
+            except Exception:
+                pass
+            i = end + 1
+    except Exception:
+        pass
+
+def make_list_html(paragraphs: int, seed: int = 0) -> str:
+    # Cleaned AI output with typed "• " / "1. " runs, real lists and plain paragraphs
+    import random
+    rnd = random.Random(seed)
+    parts = ["<html><head><title>Lists</title></head><body>", "<h1>Lists</h1>"]
+    n = 0
+    while n < paragraphs:
+        roll = rnd.random()
+        run = rnd.randint(2, 6)
+        if roll < 0.3:
+            mark = rnd.choice(["\u2022", "&#8226;", "-", "\u00b7"])
+            parts += [f"<p>{mark} bullet item {n + k} with some words</p>" for k in range(run)]
+        elif roll < 0.5:
+            parts += [f"<p>{k + 1}. numbered step {n + k} to follow</p>" for k in range(run)]
+        elif roll < 0.6:
+            parts.append("<ul>" + "".join(f"<li><p>listed {n + k}</p></li>" for k in range(run)) + "</ul>")
+        elif roll < 0.65:
+            parts.append(f"<h2>Section {n}</h2>")
+            run = 1
+        else:
+            run = 1
+            parts.append(f"<p>Plain paragraph {n} that mentions 1. and - in the middle.</p>")
+        n += run
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+def _paragraph_rows(doc):
+    return [(p.style, p.list_type, p.text) for p in doc.paragraphs]
+
+def bench_lists(sizes=(100, 1_000, 5_000, 20_000)):
+    results = {}
+    for size in sizes:
+        markup = make_list_html(size, size)
+        r = {}
+        for mode in ("com", "html"):
+            app = FakeWordApp(FakeWordBackend(launch_delay=0), 1)
+            doc = FakeDocument(app)
+            t0 = time.perf_counter()
+            if mode == "com":
+                doc.load_html(tdu.run_html_stages(markup, [tdu.UnwrapListParagraphStage()]))
+            else:
+                doc.load_html(tdu.run_html_stages(markup, [tdu.UnwrapListParagraphStage(), tdu.ListMarkerStage()]))
+            t_html = time.perf_counter() - t0
+            calls0 = app.calls
+            t0 = time.perf_counter()
+            if mode == "com":
+                legacy_enforce_lists(doc)
+            tdu.fix_paragraph_styles(doc)
+            r[mode] = {"html_s": t_html, "com_s": time.perf_counter() - t0, "com_calls": app.calls - calls0,
+                       "rows": _paragraph_rows(doc)}
+        r["identical"] = r["com"].pop("rows") == r["html"].pop("rows")
+        r["paragraphs"] = size
+        results[size] = r
+    rows = []
+    for size in sizes:
+        r = results[size]
+        rows.append((f"{size} paragraphs",
+                     f"COM calls {r['com']['com_calls']}->{r['html']['com_calls']}  "
+                     f"COM time {r['com']['com_s'] * 1000:.0f}->{r['html']['com_s'] * 1000:.0f}ms  "
+                     f"html stage +{(r['html']['html_s'] - r['com']['html_s']) * 1000:.0f}ms  "
+                     f"same={r['identical']}"))
+    _report("List detection: Word COM pass vs HTML stage (fake COM)", rows)
+    return results
+
+# The three per-paragraph style passes fix_paragraph_styles replaced, kept as the baseline
+def legacy_style_passes(doc_out):
+    try:
+        s = doc_out.Styles("Bulleted List")
+        for p in doc_out.Paragraphs:
+            try:
+                if p.Range.ListFormat.ListType == tdu.WD_LIST_BULLET:
+                    p.Style = s
+            except Exception:
+                pass
+    except Exception:
+        pass
+    try:
+        list_para = doc_out.Styles("List Paragraph")
+    except Exception:
+        list_para = doc_out.Styles.Add("List Paragraph", tdu.WD_STYLE_TYPE_PARAGRAPH)
+    for p in doc_out.Paragraphs:
+        try:
+            if p.Range.ListFormat.ListType == tdu.WD_LIST_NUMBERED:
+                p.Style = list_para
+        except Exception:
+            pass
+    try:
+        normal_style = doc_out.Styles("Normal")
+    except Exception:
+        return
+    for p in doc_out.Paragraphs:
+        try:
+            try:
+                name = str(p.Style.NameLocal)
+            except Exception:
+                name = ""
+            name_lower = name.lower()
+            try:
+                if p.Range.ListFormat.ListType in (tdu.WD_LIST_BULLET, tdu.WD_LIST_NUMBERED):
+                    continue
+            except Exception:
+                pass
+            if name_lower.startswith("heading") or name in ("List Paragraph", "Note", "Bulleted List"):
+                continue
+            if name != "Normal" and ("normal" in name_lower or name in ("", "HTML Normal", "Normal (Web)")):
+                p.Style = normal_style
+        except Exception:
+            pass
+
+def make_fixup_document(app, paragraphs: int, seed: int = 0):
+    # Paragraphs as Word leaves them after importing cleaned HTML: mostly Normal (Web)
+    # body text, headings, notes and list runs still carrying the default list style
+    import random
+    rnd = random.Random(seed)
+    doc = FakeDocument(app)
+    n = 0
+    while n < paragraphs:
+        roll = rnd.random()
+        if roll < 0.25:
+            lt = rnd.choice((tdu.WD_LIST_BULLET, tdu.WD_LIST_NUMBERED))
+            for _ in range(min(rnd.randint(2, 6), paragraphs - n)):
+                doc.paragraphs.append(FakeParagraph(doc, f"item {n}", "List Paragraph", lt))
+                n += 1
+            continue
+        if roll < 0.3:
+            style = f"Heading {rnd.randint(1, 3)}"
+        elif roll < 0.35:
+            style = "Note"
+        elif roll < 0.45:
+            style = rnd.choice(("Normal", "HTML Normal", "Body Text"))
+        else:
+            style = "Normal (Web)"
+        doc.paragraphs.append(FakeParagraph(doc, f"Paragraph {n} with some body text.", style))
+        n += 1
+    doc._dirty = True
+    return doc
+
+def bench_fixups(sizes=(100, 1_000, 5_000, 20_000), call_us: float = 100.0):
+    # COM calls per fix-up strategy; call_us converts them to an estimate for out-of-process Word
+    results = {}
+    for size in sizes:
+        r = {}
+        for mode in ("passes", "snapshot"):
+            app = FakeWordApp(FakeWordBackend(launch_delay=0), 1)
+            doc = make_fixup_document(app, size, size)
+            t0 = time.perf_counter()
+            if mode == "passes":
+                legacy_style_passes(doc)
+            else:
+                r["stats"] = tdu.fix_paragraph_styles(doc)
+            r[mode] = {"seconds": time.perf_counter() - t0, "calls": app.calls,
+                       "rows": [(p.style, p.list_type) for p in doc.paragraphs]}
+        r["identical"] = r["passes"].pop("rows") == r["snapshot"].pop("rows")
+        results[size] = r
+    rows = []
+    for size, r in results.items():
+        a, b = r["passes"], r["snapshot"]
+        rows.append((f"{size} paragraphs",
+                     f"calls {a['calls']}->{b['calls']}  {a['seconds'] * 1000:.0f}->{b['seconds'] * 1000:.0f}ms  "
+                     f"est. {a['calls'] * call_us / 1e6:.1f}->{b['calls'] * call_us / 1e6:.1f}s  "
+                     f"ranges={r['stats']['runs']}  same={r['identical']}"))
+    _report(f"Post-import style fix-ups: three passes vs one snapshot (fake COM, est. at {call_us:.0f} us/call)", rows)
+    return results
+
+def make_styled_ai_html(paragraphs: int, base: str = "doc", seed: int = 0):
+    # Cleaned AI output using every mapping the import handles: headings, notes, Clicks
+    # spans, bulleted and numbered lists, tables, links and images. Returns (html, images).
+    import random
+    rnd = random.Random(seed)
+    words = ("select", "the", "report", "menu", "click", "save", "training", "record", "course", "review")
+    parts = [f"<h1>Styled Guide {seed}</h1>"]
+    images = []
+    n = 0
+    while n < paragraphs:
+        text = " ".join(rnd.choice(words) for _ in range(rnd.randint(6, 18))).capitalize()
+        r = rnd.random()
+        if r < 0.08:
+            parts.append(f"<h2>Section {n}</h2>")
+        elif r < 0.12:
+            parts.append(f"<h3>Subsection {n}</h3>")
+        elif r < 0.2:
+            parts.append(f'<p class="Note"><strong>Note:</strong> {text}.</p>')
+        elif r < 0.35:
+            k = rnd.randint(2, 5)
+            parts.append("<ul>" + "".join(f'<li><p class="BulletedList">{text} {j}</p></li>' for j in range(k)) + "</ul>")
+            n += k - 1
+        elif r < 0.45:
+            k = rnd.randint(2, 5)
+            parts.append("<ol>" + "".join(f'<li class="MsoListParagraph">Step {j}: {text}</li>' for j in range(k)) + "</ol>")
+            n += k - 1
+        elif r < 0.5:
+            parts.append(f"<table><tr><th><p>Field</p></th><th><p>Value</p></th></tr>"
+                         f"<tr><td><p>{text}</p></td><td><p><strong>{n}</strong></p></td></tr></table>")
+            n += 3
+        elif r < 0.58:
+            name = f"image{len(images) + 1:03d}.png"
+            images.append(name)
+            parts.append(f'<p><img width="{rnd.randint(200, 900)}" height="{rnd.randint(100, 500)}" '
+                         f'src="{name}" alt="Screenshot {len(images)}"></p>')
+        elif r < 0.7:
+            parts.append(f'<p>Open <span class="ClicksChar">File &gt; Save As</span> and {text}. '
+                         f'See <a href="https://example.edu/{n}">the help page</a>.</p>')
+        else:
+            parts.append(f"<p>{text}.</p>")
+        n += 1
+    markup = ('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n'
+              f"<title>Styled Guide {seed}</title>\n<style>\n{tdu.STYLE_BRIDGES}\n</style>\n</head>\n<body>\n"
+              + "\n".join(parts) + "\n</body>\n</html>\n")
+    return markup, images
+
+def _docx_rows(path: str):
+    # (style name, list kind, text) per paragraph of a written .docx, in document order
+    import zipfile
+    import xml.etree.ElementTree as ET
+    w = "{%s}" % tdu._W_NS
+    with zipfile.ZipFile(path) as zf:
+        for name in zf.namelist():
+            if name.endswith((".xml", ".rels")):
+                ET.fromstring(zf.read(name))
+        styles = ET.fromstring(zf.read("word/styles.xml"))
+        names = {st.get(w + "styleId"): st.find(w + "name").get(w + "val") for st in styles.iter(w + "style")}
+        fmts = {}
+        if "word/numbering.xml" in zf.namelist():
+            numbering = ET.fromstring(zf.read("word/numbering.xml"))
+            abstract = {}
+            for an in numbering.iter(w + "abstractNum"):
+                lvl = an.find(w + "lvl")
+                fmt = lvl.find(w + "numFmt") if lvl is not None else None
+                abstract[an.get(w + "abstractNumId")] = fmt.get(w + "val") if fmt is not None else ""
+            for num in numbering.iter(w + "num"):
+                fmts[num.get(w + "numId")] = abstract.get(num.find(w + "abstractNumId").get(w + "val"), "")
+        body = ET.fromstring(zf.read("word/document.xml")).find(w + "body")
+    rows = []
+    for p in body.iter(w + "p"):
+        ppr = p.find(w + "pPr")
+        style, kind = "Normal", 0
+        if ppr is not None:
+            ps = ppr.find(w + "pStyle")
+            if ps is not None:
+                style = names.get(ps.get(w + "val"), ps.get(w + "val"))
+            num = ppr.find(w + "numPr")
+            if num is not None:
+                fmt = fmts.get(num.find(w + "numId").get(w + "val"), "")
+                kind = tdu.WD_LIST_BULLET if fmt == "bullet" else tdu.WD_LIST_NUMBERED
+        text = "".join(t.text or "" for t in p.iter(w + "t"))
+        rows.append((style.lower(), kind, " ".join(text.split())))
+    return rows
+
+def bench_docx_writer(docs: int = 8, paragraphs: int = 400, processes=(1, 2, 4), template: str = ""):
+    # Native writer vs the (fake) COM import: same paragraphs/styles/list kinds, and throughput
+    template = template or tdu.SEED_TEMPLATE_PATH or str(Path(__file__).parent / "Sample ADA IG Document_calibri.docx")
+    if not os.path.isfile(template):
+        template = ""
+    work = tempfile.mkdtemp(prefix="bench_docx_")
+    results = {"template": template or "(built-in styles)"}
+    try:
+        inputs = []
+        for n in range(docs):
+            folder = os.path.join(work, f"doc{n}")
+            os.makedirs(folder)
+            markup, images = make_styled_ai_html(paragraphs, "doc", n)
+            for name in images:
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(FAKE_PNG)
+            path = os.path.join(folder, "ai_output.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(markup)
+            inputs.append((path, markup))
+        matched = total = 0
+        mismatches = []
+        t0 = time.perf_counter()
+        for path, _ in inputs:
+            tdu.write_docx_from_html(path, os.path.splitext(path)[0] + ".docx", template)
+        serial = time.perf_counter() - t0
+        for path, markup in inputs:
+            doc = FakeDocument(FakeWordApp(FakeWordBackend(launch_delay=0), 1))
+            doc.load_html(markup)
+            tdu.fix_paragraph_styles(doc)
+            com_rows = [(p.style.lower(), p.list_type, " ".join(p.text.split())) for p in doc.paragraphs]
+            native_rows = _docx_rows(os.path.splitext(path)[0] + ".docx")
+            total += max(len(com_rows), len(native_rows))
+            if len(com_rows) != len(native_rows) and len(mismatches) < 5:
+                mismatches.append((f"{len(com_rows)} paragraphs", f"{len(native_rows)} paragraphs"))
+            for a, b in zip(com_rows, native_rows):
+                if a == b:
+                    matched += 1
+                elif len(mismatches) < 5:
+                    mismatches.append((a, b))
+        results["fidelity"] = matched / total if total else 1.0
+        results["mismatches"] = mismatches
+        results["serial_s"] = serial
+        for size in processes:
+            with tdu.DocxWriterPool(size, template) as pool:
+                pool.import_html(*_docx_out(inputs[0][0], "warm"))
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(size) as ex:
+                    list(ex.map(lambda item: pool.import_html(*_docx_out(item[0], f"p{size}")), inputs))
+                results[f"pool_{size}_s"] = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [("template", results["template"]),
+            ("style fidelity vs fake COM import", f"{results['fidelity']:.1%} of paragraphs identical"),
+            ("serial", f"{results['serial_s'] / docs * 1000:.0f} ms/doc  {docs / results['serial_s']:.1f} docs/s")]
+    for size in processes:
+        t = results[f"pool_{size}_s"]
+        rows.append((f"{size} processes", f"{docs / t:.1f} docs/s"))
+    for a, b in results["mismatches"]:
+        rows.append(("  mismatch", f"COM {a} / native {b}"))
+    _report(f"Native DOCX writer ({docs} docs x {paragraphs} paragraphs, {os.cpu_count()} CPUs)", rows)
+    return results
+
+def _docx_out(path: str, tag: str):
+    return path, os.path.splitext(path)[0] + f"_{tag}.docx"
+
+def _export_rows(html_path: str):
+    # (heading level, list kind, text) per exported <p>/<hN>, list markers split off the text
+    rows = []
+    tag, text, listed = None, [], False
+    for kind, raw, name in tdu.iter_html_tokens(tdu.iter_file_chunks(html_path)):
+        if kind == tdu.HT_START and name in ("p",) + tdu._HEADING_TAGS:
+            tag, text, listed = name, [], False
+        elif tag is None:
+            continue
+        elif kind == tdu.HT_END and name == tag:
+            t = " ".join(html.unescape("".join(text)).split())
+            marker, n = tdu._classify_marker(t) if listed else (None, 0)
+            rows.append((int(tag[1]) if tag != "p" else 0, marker, t[n:]))
+            tag = None
+        elif kind == tdu.HT_TEXT:
+            text.append(raw)
+        elif kind == tdu.HT_START and "font:7.0pt" in raw:
+            listed = True
+    return rows
+
+def _docx_row_shape(row):
+    style, kind, text = row
+    m = re.match(r"heading ([1-6])$", style)
+    marker = {tdu.WD_LIST_BULLET: "bullet", tdu.WD_LIST_NUMBERED: "numbered"}.get(kind)
+    return (int(m.group(1)) if m else 0, marker, text)
+
+def bench_docx_reader(generated: int = 24, paragraphs: int = 400, processes=(1, 2, 4), corpus: str = "",
+                      big_paragraphs: int = 20_000):
+    # Native .docx -> filtered-HTML reader: paragraph fidelity against the packages it reads,
+    # throughput over a corpus (the given folder or the repo's .docx files plus generated
+    # ones), and peak memory on one large document
+    import zipfile
+    import tracemalloc
+    template = tdu.SEED_TEMPLATE_PATH or str(Path(__file__).parent / "Sample ADA IG Document_calibri.docx")
+    if not os.path.isfile(template):
+        template = ""
+    work = tempfile.mkdtemp(prefix="bench_docxread_")
+    results = {}
+    exported = []
+    try:
+        files = sorted(str(p) for p in Path(corpus or Path(__file__).parent).rglob("*.docx")
+                       if not p.name.startswith("~$"))
+        checked = []
+        for n in range(generated):
+            folder = os.path.join(work, f"doc{n}")
+            os.makedirs(folder)
+            markup, images = make_styled_ai_html(paragraphs, "doc", n)
+            for name in images:
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(FAKE_PNG)
+            src = os.path.join(folder, "ai_output.html")
+            with open(src, "w", encoding="utf-8") as f:
+                f.write(markup)
+            path = tdu.write_docx_from_html(src, os.path.join(folder, f"Guide {n}.docx"), template)
+            files.append(path)
+            checked.append((path, len(images)))
+        in_bytes = sum(os.path.getsize(p) for p in files)
+        xml_bytes = 0
+        for p in files:
+            with zipfile.ZipFile(p) as zf:
+                xml_bytes += zf.getinfo("word/document.xml").file_size
+        t0 = time.perf_counter()
+        for p in files:
+            exported.append(tdu.export_docx_to_html(p)[0])
+        results["serial_s"] = time.perf_counter() - t0
+        matched = total = images_ok = 0
+        mismatches = []
+        by_path = dict(zip(files, exported))
+        for path, image_count in checked:
+            want = [_docx_row_shape(r) for r in _docx_rows(path)]
+            got = _export_rows(by_path[path])
+            total += max(len(want), len(got))
+            for a, b in zip(want, got):
+                if a == b:
+                    matched += 1
+                elif len(mismatches) < 5:
+                    mismatches.append((a, b))
+            with open(by_path[path], encoding="utf-8") as f:
+                images_ok += f.read().count("<img ") == image_count
+        results["fidelity"] = matched / total if total else 1.0
+        results["images_ok"] = images_ok
+        results["mismatches"] = mismatches
+        for size in processes:
+            with tdu.DocxWriterPool(size) as pool:
+                exported.append(pool.export(files[0])[0])
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(size) as ex:
+                    exported.extend(r[0] for r in ex.map(pool.export, files))
+                results[f"pool_{size}_s"] = time.perf_counter() - t0
+        folder = os.path.join(work, "big")
+        os.makedirs(folder)
+        markup, images = make_styled_ai_html(big_paragraphs, "doc", 99)
+        for name in images:
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(FAKE_PNG)
+        src = os.path.join(folder, "ai_output.html")
+        with open(src, "w", encoding="utf-8") as f:
+            f.write(markup)
+        big = tdu.write_docx_from_html(src, os.path.join(folder, "Big.docx"), template)
+        with zipfile.ZipFile(big) as zf:
+            results["big_xml_bytes"] = zf.getinfo("word/document.xml").file_size
+        for key, path in (("small_peak_bytes", checked[0][0]), ("big_peak_bytes", big)):
+            tracemalloc.start()
+            exported.append(tdu.export_docx_to_html(path)[0])
+            results[key] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        for h in exported:
+            shutil.rmtree(os.path.dirname(h), ignore_errors=True)
+    docs = len(files)
+    rows = [("corpus", f"{docs} .docx ({len(checked)} generated), {in_bytes / 1e6:.1f} MB zipped, "
+                       f"{xml_bytes / 1e6:.1f} MB document.xml"),
+            ("paragraph fidelity vs the package", f"{results['fidelity']:.1%} identical  "
+                                                  f"images {results['images_ok']}/{len(checked)} docs"),
+            ("serial", f"{results['serial_s'] / docs * 1000:.0f} ms/doc  {docs / results['serial_s']:.1f} docs/s  "
+                       f"{xml_bytes / 1e6 / results['serial_s']:.1f} MB xml/s")]
+    for size in processes:
+        t = results[f"pool_{size}_s"]
+        rows.append((f"{size} processes", f"{docs / t:.1f} docs/s"))
+    rows.append(("peak Python memory", f"{paragraphs} paragraphs {results['small_peak_bytes'] / 1e6:.1f} MB  "
+                                       f"{big_paragraphs} paragraphs {results['big_peak_bytes'] / 1e6:.1f} MB "
+                                       f"(document.xml {results['big_xml_bytes'] / 1e6:.1f} MB)"))
+    for a, b in results["mismatches"]:
+        rows.append(("  mismatch", f"package {a} / export {b}"))
+    _report(f"Native DOCX reader ({os.cpu_count()} CPUs)", rows)
+    return results
+
+def bench_tracing(docs: int = 12, calls: int = 200_000, ai_latency: float = 0.05):
+    # Span cost disabled vs enabled, then a fake-Word pipeline with tracing on: the Chrome
+    # trace it writes and the p50/p95 table
+    def loop():
+        for _ in range(calls):
+            with tdu.span("bench", bytes_in=1) as sp:
+                sp.set(bytes_out=2)
+
+    results = {}
+    tdu.stop_tracing()
+    t0 = time.perf_counter()
+    loop()
+    results["off_ns"] = (time.perf_counter() - t0) / calls * 1e9
+    tdu.start_tracing()
+    t0 = time.perf_counter()
+    loop()
+    results["on_ns"] = (time.perf_counter() - t0) / calls * 1e9
+    tdu.stop_tracing()
+    work = tempfile.mkdtemp(prefix="bench_trace_")
+    try:
+        for mode in ("off", "on"):
+            inputs = write_fake_docx_inputs(os.path.join(work, mode), docs)
+            backend = FakeWordBackend(launch_delay=0.1, open_delay=0.02, save_delay=0.02, import_delay=0.02)
+            tracer = tdu.start_tracing() if mode == "on" else None
+            try:
+                t0 = time.perf_counter()
+                with tdu.WordPool(size=2, backend=backend, log_fn=lambda m: None) as pool:
+                    jobs = tdu.BatchPipeline(tdu.default_pipeline_stages(pool, FakeChat(latency=ai_latency))).run(inputs)
+                results[f"pipeline_{mode}_s"] = time.perf_counter() - t0
+            finally:
+                tdu.stop_tracing()
+            failed = [j for j in jobs if j.error is not None]
+            if failed:
+                raise failed[0].error
+        path = tracer.write(os.path.join(work, "trace.json"))
+        with open(path, encoding="utf-8") as f:
+            trace = json.load(f)
+        spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        results["spans"] = len(spans)
+        results["docs_traced"] = len({e["args"].get("doc") for e in spans if e["args"].get("doc")})
+        results["summary"] = tracer.summary()
+        summary_lines = tracer.summary_lines()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = [("span() disabled", f"{results['off_ns']:.0f} ns/call"),
+            ("span() enabled", f"{results['on_ns']:.0f} ns/call"),
+            ("pipeline, tracing off", f"{results['pipeline_off_s']:.2f}s"),
+            ("pipeline, tracing on", f"{results['pipeline_on_s']:.2f}s  {results['spans']} spans over "
+                                     f"{results['docs_traced']} docs")]
+    _report(f"Tracing overhead ({docs} docs, fake Word, AI {ai_latency}s)", rows)
+    print("\n".join(summary_lines))
+    return results
+
+def bench_prompt_minimizer(sizes=(50_000, 200_000, 1_000_000), image_run: int = 2, first_token_delay: float = 0.2,
+                           chars_per_second: float = 50_000, prompt_chars_per_second: float = 500_000):
+    # Per document: prompt bytes/tokens with and without the minimizer, the extra extraction
+    # time, the AI round trip against the stub (prefill and generation both scale with size)
+    # and whether the restored image tags match what the full prompt gives back
+    work = tempfile.mkdtemp(prefix="bench_minimize_")
+    results = {}
+    try:
+        with StubChatServer(first_token_delay=first_token_delay, chars_per_second=chars_per_second,
+                            prompt_chars_per_second=prompt_chars_per_second) as srv:
+            chat = tdu.HttpChatTransport(srv.url + "v1", max_parallel=1)
+            chat.start()
+            try:
+                for size in sizes:
+                    folder = os.path.join(work, str(size))
+                    html_path, files_dir, markup = write_word_export(folder, size, "doc", size % 89, image_run)
+                    r = {}
+                    imgs = {}
+                    for mode in ("full", "minimized"):
+                        work_dir = os.path.join(folder, mode)
+                        os.makedirs(work_dir)
+                        minimizer = tdu.MinimizeForAiStage() if mode == "minimized" else None
+                        t0 = time.perf_counter()
+                        body = tdu.extract_body_for_ai(markup, work_dir, files_dir, None, minimizer)
+                        prompt = tdu.build_prompt(body)
+                        t_extract = time.perf_counter() - t0
+                        t0 = time.perf_counter()
+                        reply = tdu._ask_chat(chat, prompt)
+                        t_ai = time.perf_counter() - t0
+                        t0 = time.perf_counter()
+                        clean = tdu.clean_ai_html(reply, work_dir, files_dir,
+                                                  placeholders=minimizer.placeholders if minimizer else None)
+                        t_clean = time.perf_counter() - t0
+                        imgs[mode] = re.findall(r'(?is)<img\b[^>]*>', clean)
+                        r[mode] = {"prompt_bytes": len(prompt), "tokens": len(prompt) // tdu.CHUNK_CHARS_PER_TOKEN,
+                                   "reply_bytes": len(reply), "extract_s": t_extract, "ai_s": t_ai,
+                                   "clean_s": t_clean, "total_s": t_extract + t_ai + t_clean}
+                    r["images"] = len(imgs["full"])
+                    r["images_identical"] = imgs["full"] == imgs["minimized"]
+                    results[size] = r
+                    shutil.rmtree(folder, ignore_errors=True)
+            finally:
+                chat.stop()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = []
+    for size, r in results.items():
+        a, b = r["full"], r["minimized"]
+        rows.append((f"{size / 1000:.0f} KB export",
+                     f"prompt {a['prompt_bytes'] / 1000:.0f}->{b['prompt_bytes'] / 1000:.0f} KB "
+                     f"(-{100 * (1 - b['prompt_bytes'] / a['prompt_bytes']):.0f}%, ~{a['tokens'] - b['tokens']} tokens)  "
+                     f"extract {a['extract_s'] * 1000:.0f}->{b['extract_s'] * 1000:.0f}ms  "
+                     f"AI {a['ai_s']:.2f}->{b['ai_s']:.2f}s  total {a['total_s']:.2f}->{b['total_s']:.2f}s  "
+                     f"images {r['images']} same={r['images_identical']}"))
+    _report(f"Prompt minimizer per document (stub: first token {first_token_delay}s + "
+            f"{prompt_chars_per_second / 1000:.0f}k prompt chars/s, {chars_per_second / 1000:.0f}k chars/s out)", rows)
+    return results
+
+def bench_ai_session(docs: int = 12, size: int = 30_000, latency: float = 0.3, input_chars_per_second: float = 100_000,
+                     prompt_chars_per_second: float = 200_000, max_chars: int = 240_000):
+    # Full prompt per message vs instructions once per session: the browser stand-in (one
+    # conversation, with a reconnect halfway) and the HTTP stub (system prompt, cached prefix).
+    # First-token time here is latency + the time to paste/read what the message carries.
+    bodies = [tdu.extract_body_for_ai(make_word_html(size, "doc", True, n), minimizer=tdu.MinimizeForAiStage())
+              for n in range(docs)]
+    results = {}
+    for mode in ("per_message", "session"):
+        chat = FakeChat(latency=latency, input_chars_per_second=input_chars_per_second)
+        session = tdu.ChatSession(chat, max_chars=max_chars) if mode == "session" else None
+        t0 = time.perf_counter()
+        for n, body in enumerate(bodies):
+            if n == docs // 2:
+                chat.reconnects += 1
+            if session is None:
+                tdu._ask_chat(chat, tdu.build_prompt(body))
+            else:
+                session.ask(tdu.build_payload(body))
+        doc_ttft = chat.first_token_s if session is None else chat.first_token_s[-docs:]
+        results[f"browser_{mode}"] = {
+            "seconds": time.perf_counter() - t0, "messages": chat.messages, "bytes_sent": chat.bytes_sent,
+            "primes": session.primes if session else 0,
+            "ttft_doc_avg": sum(doc_ttft) / len(doc_ttft),
+            "ttft_total": sum(chat.first_token_s),
+        }
+    with StubChatServer(first_token_delay=latency, chars_per_second=0,
+                        prompt_chars_per_second=prompt_chars_per_second) as srv:
+        for mode in ("per_message", "session"):
+            srv.first_token_s = []
+            srv.bytes_received = 0
+            srv.cached_prefixes = set()
+            chat = tdu.HttpChatTransport(srv.url + "v1", max_parallel=1)
+            session = tdu.ChatSession(chat) if mode == "session" else None
+            t0 = time.perf_counter()
+            try:
+                for body in bodies:
+                    if session is None:
+                        tdu._ask_chat(chat, tdu.build_prompt(body))
+                    else:
+                        session.ask(tdu.build_payload(body))
+            finally:
+                chat.stop()
+            results[f"http_{mode}"] = {
+                "seconds": time.perf_counter() - t0, "messages": docs, "bytes_sent": srv.bytes_received,
+                "primes": 0, "ttft_doc_avg": sum(srv.first_token_s) / len(srv.first_token_s),
+                "ttft_total": sum(srv.first_token_s),
+            }
+    rows = []
+    for name, r in results.items():
+        rows.append((name, f"{r['seconds']:.2f}s  messages={r['messages']} primes={r['primes']}  "
+                           f"sent {r['bytes_sent'] / docs / 1000:.1f} KB/doc  "
+                           f"first token {r['ttft_doc_avg'] * 1000:.0f} ms/doc (all {r['ttft_total']:.2f}s)"))
+    _report(f"Instructions per message vs once per session ({docs} docs, {len(tdu.PROMPT_TEXT)} chars of "
+            f"instructions, body ~{sum(map(len, bodies)) // docs // 1000} KB)", rows)
+    return results
+
+_HARD_BLOCKS = (
+    "<table class=MsoTableGrid border=1 cellspacing=0 cellpadding=0><tr><td width=200 valign=top><p class=MsoNormal>"
+    "Field</p></td><td width=400 valign=top><p class=MsoNormal>Enter the course code</p></td></tr></table>",
+    "<p class=MsoListParagraphCxSpMiddle style='margin-left:1.0in;text-indent:-.25in'>o&nbsp;&nbsp; "
+    "A second-level step</p>",
+)
+
+def make_routed_exports(folder: str, docs: int, size: int, hard_share: float, seed: int = 0):
+    # Word exports of which about hard_share carry a text table or a nested list
+    import random
+    rnd = random.Random(seed)
+    out = []
+    for n in range(docs):
+        sub = os.path.join(folder, f"doc{n}")
+        html_path, files_dir, markup = write_word_export(sub, size, "doc", n)
+        hard = rnd.random() < hard_share
+        if hard:
+            markup = markup.replace("</h2>", "</h2>\n" + rnd.choice(_HARD_BLOCKS), 1)
+        out.append((html_path, files_dir, markup, hard))
+    return out
+
+def bench_routing(docs: int = 20, size: int = 20_000, hard_share: float = 0.3, ai_latency: float = 1.0):
+    # Every document through the (fake) chat vs the complexity router: route counts, AI time
+    # saved, and the PROMPT_TEXT self-checks on what the local converter produced
+    work = tempfile.mkdtemp(prefix="bench_routing_")
+    results = {}
+    saved_route = tdu.AI_ROUTE
+    try:
+        exports = make_routed_exports(os.path.join(work, "in"), docs, size, hard_share)
+        for mode in ("ai", "auto"):
+            tdu.AI_ROUTE = mode
+            chat = FakeChat(latency=ai_latency)
+            session = tdu.ChatSession(chat)
+            routes = {}
+            checks = {"h1_title": 0, "one_style": 0, "images": 0, "bullets": 0}
+            misrouted = 0
+            t0 = time.perf_counter()
+            for n, (html_path, files_dir, markup, hard) in enumerate(exports):
+                job = tdu.DocJob(os.path.join(work, f"Guide {n}.docx"))
+                job.work_dir = os.path.join(work, mode, str(n))
+                os.makedirs(job.work_dir)
+                minimizer, scorer = tdu.MinimizeForAiStage(), tdu.ComplexityStage()
+                job.body = tdu.extract_body_for_ai(markup, job.work_dir, files_dir, None, minimizer, scorer)
+                job.features, job.placeholders = scorer.features, minimizer.placeholders
+                tdu.convert_document(job, chat, session=session)
+                routes[job.route] = routes.get(job.route, 0) + 1
+                misrouted += job.route == "local" and hard
+                if job.route != "local":
+                    continue
+                clean = tdu.clean_ai_html(job.ai_html_clean, job.work_dir, files_dir, strip_prompt=False,
+                                          placeholders=job.placeholders)
+                h1 = re.findall(r'(?is)<h1[^>]*>(.*?)</h1>', clean)
+                title = re.search(r'(?is)<title>(.*?)</title>', clean)
+                checks["h1_title"] += len(h1) == 1 and title is not None and h1[0] == title.group(1)
+                checks["one_style"] += clean.count("<style") == 1
+                srcs = [os.path.basename(s) for s in re.findall(r'(?i)<img\b[^>]*\bsrc="([^"]*)"', clean)]
+                checks["images"] += srcs == [os.path.basename(s) for s in re.findall(
+                    r'(?i)<img\b[^>]*\bsrc="?([^"\s>]*)', tdu.extract_relevant_html_for_ai(markup))]
+                checks["bullets"] += "<li><p class=\"BulletedList\">" in clean or "<ul" not in clean
+            results[mode] = {"seconds": time.perf_counter() - t0, "routes": routes, "messages": chat.messages,
+                             "checks": checks, "misrouted": misrouted}
+    finally:
+        tdu.AI_ROUTE = saved_route
+        shutil.rmtree(work, ignore_errors=True)
+    a, b = results["ai"], results["auto"]
+    local = b["routes"].get("local", 0)
+    rows = [("all through the AI", f"{a['seconds']:.2f}s  chat messages={a['messages']}"),
+            ("routed", f"{b['seconds']:.2f}s  chat messages={b['messages']}  "
+                       + "  ".join(f"{k}={v}" for k, v in sorted(b["routes"].items()))),
+            ("time saved", f"{a['seconds'] - b['seconds']:.2f}s ({100 * (1 - b['seconds'] / a['seconds']):.0f}%)"),
+            ("local self-checks", "  ".join(f"{k} {v}/{local}" for k, v in b["checks"].items())
+                                  + f"  hard docs sent local={b['misrouted']}")]
+    _report(f"Complexity routing ({docs} docs, ~{hard_share:.0%} with text tables or nested lists, "
+            f"AI {ai_latency}s)", rows)
+    return results
+
+def _revise_sections(body: str, picks, seed: int = 0) -> str:
+    # The body with one sentence appended to each picked section (by index)
+    sections = tdu.split_sections(body)
+    for i in picks:
+        sections[i][1] = sections[i][1].rstrip() + f"\n<p class=MsoNormal>Revision {seed}: check the new field.</p>\n"
+    return "".join(sec[1] for sec in sections)
+
+def _visible_text(doc: str) -> str:
+    body = tdu.extract_relevant_html_for_ai(doc)
+    return " ".join(html.unescape(re.sub(r'<[^>]*>', " ", body)).split())
+
+def bench_section_memo(size: int = 300_000, changed=(1, 2, 4), ai_latency: float = 0.5,
+                       chars_per_second: float = 50_000):
+    # A revised document through the cache: whole body (or, over CHUNK_MAX_CHARS, every changed
+    # chunk) resent vs only the changed sections.
+    # The cache holds the original's conversion; each revision starts from a copy of it.
+    import random
+    work = tempfile.mkdtemp(prefix="bench_memo_")
+    saved_memo = tdu.SECTION_MEMO
+    rows = []
+    results = {}
+    try:
+        html_path, files_dir, markup = write_word_export(os.path.join(work, "in"), size)
+        body = tdu.extract_body_for_ai(markup, os.path.join(work, "stage"), files_dir, None, tdu.MinimizeForAiStage())
+        total = len(tdu.split_sections(body))
+
+        def run(doc_body, cache_root, memo):
+            tdu.SECTION_MEMO = memo
+            chat = FakeChat(latency=ai_latency, chars_per_second=chars_per_second)
+            job = tdu.DocJob(os.path.join(work, "Guide.docx"))
+            job.body = doc_body
+            t0 = time.perf_counter()
+            tdu.convert_document(job, chat, cache=tdu.AiCache(root=cache_root), session=tdu.ChatSession(chat))
+            return job, chat, time.perf_counter() - t0
+
+        base_cache = os.path.join(work, "cache0")
+        job, chat, secs = run(body, base_cache, True)
+        rows.append(("original (cold cache)", f"{secs:.2f}s  {total} sections  chat {chat.bytes_sent // 1024} KB"))
+        rnd = random.Random(0)
+        for k in changed:
+            picks = sorted(rnd.sample(range(total), min(k, total)))
+            revised = _revise_sections(body, picks, k)
+            out = {}
+            for memo in (False, True):
+                root = os.path.join(work, f"cache_{k}_{int(memo)}")
+                shutil.copytree(base_cache, root)
+                job, chat, secs = run(revised, root, memo)
+                out[memo] = {"seconds": secs, "kb_sent": chat.bytes_sent // 1024, "messages": chat.messages,
+                             "reused": job.sections_reused, "text": _visible_text(job.ai_html_clean)}
+            full, part = out[False], out[True]
+            same = full["text"] == part["text"]
+            results[k] = {"full_s": full["seconds"], "memo_s": part["seconds"], "reused": part["reused"],
+                          "full_kb": full["kb_sent"], "memo_kb": part["kb_sent"], "same_text": same}
+            rows.append((f"{k} of {total} sections changed",
+                         f"chunks {full['seconds']:.2f}s {full['kb_sent']} KB -> sections {part['seconds']:.2f}s "
+                         f"{part['kb_sent']} KB in {part['messages']} message(s)  reused {part['reused']}  "
+                         f"same text={same}"))
+    finally:
+        tdu.SECTION_MEMO = saved_memo
+        shutil.rmtree(work, ignore_errors=True)
+    _report(f"Section memoization ({size // 1000} KB export, AI {ai_latency}s + {chars_per_second:.0f} chars/s)", rows)
+    return results
+
+def _drop_image(reply: str, which: int) -> str:
+    tags = list(re.finditer(r'(?is)<img\b[^>]*>', reply))
+    if not tags:
+        return reply
+    m = tags[which]
+    return reply[:m.start()] + reply[m.end():]
+
+STREAM_FAILURES = {
+    "good reply": canned_ai_html,
+    "refusal": lambda msg: "I'm sorry, but I can't help with converting this document." + " " * 4000,
+    "commentary": lambda msg: ("Here is how I would restructure the document before converting it. " * 40
+                               + "\n```html\n" + canned_ai_html(msg) + "\n```"),
+    "prompt echoed": lambda msg: tdu.PROMPT_TEXT + "\n" + canned_ai_html(msg),
+    "image skipped": lambda msg: _drop_image(canned_ai_html(msg), 1),
+    "last image dropped": lambda msg: _drop_image(canned_ai_html(msg), -1),
+}
+
+def bench_stream_abort(size: int = 200_000, first_token_delay: float = 0.5, chars_per_second: float = 20_000):
+    # Time until a bad reply is recognised: after the whole stream (the reply check that runs
+    # once the document is back) vs mid-stream with the StreamWatch, over HTTP to the stub
+    work = tempfile.mkdtemp(prefix="bench_stream_")
+    results = {}
+    try:
+        html_path, files_dir, markup = write_word_export(os.path.join(work, "in"), size)
+        body = tdu.extract_body_for_ai(markup, os.path.join(work, "stage"), files_dir, None, tdu.MinimizeForAiStage())
+        prompt = tdu.build_chunk_prompt(body, 0, 1)
+        staged = []
+        for name, respond in STREAM_FAILURES.items():
+            with StubChatServer(first_token_delay=first_token_delay, chars_per_second=chars_per_second,
+                                respond=respond) as srv:
+                row = {}
+                for mode in ("end of stream", "watch"):
+                    chat = tdu.HttpChatTransport(srv.url + "v1", retries=0)
+                    watch = tdu.StreamWatch(tdu.payload_images(prompt), staged.append) if mode == "watch" else None
+                    t0 = time.perf_counter()
+                    try:
+                        reply = chat.submit_and_get_html(prompt, watch=watch)
+                        tdu.check_chunk_reply(body, tdu.run_html_stages(reply, [tdu.StripLeakedPromptStage()]))
+                        if tdu._ECHO_LINES[0] in reply:
+                            raise ValueError("the prompt was echoed back")
+                        outcome = "ok"
+                    except Exception as e:
+                        outcome = str(e).replace("AI reply abandoned while streaming: ", "")
+                    finally:
+                        chat.stop()
+                    row[mode] = {"seconds": time.perf_counter() - t0, "outcome": outcome}
+                results[name] = row
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    rows = []
+    for name, row in results.items():
+        a, b = row["end of stream"], row["watch"]
+        rows.append((name, f"end of stream {a['seconds']:.2f}s -> watch {b['seconds']:.2f}s  ({b['outcome'][:60]})"))
+    rows.append(("images staged mid-stream", str(len(staged))))
+    _report(f"Bad replies detected ({size // 1000} KB export, first token {first_token_delay}s, "
+            f"{chars_per_second:.0f} chars/s)", rows)
+    return results
+
+def _damage_reply(reply: str, section: int = 2) -> str:
+    # A second <style>, a wrong <title>, one altered <img> alt and the paragraphs of one section gone
+    out = reply.replace("</style>", "</style>\n<style>p { margin:0; }</style>", 1)
+    out = re.sub(r'(?is)<title>.*?</title>', "<title>Converted document</title>", out, count=1)
+    out = re.sub(r'(?i)(<img\b[^>]*?)(\s*/?>)', r'\1 alt="image"\2', out, count=1)
+    heads = [m.start() for m in re.finditer(r'(?i)<h2\b', out)]
+    if len(heads) > section + 1:
+        a, z = heads[section], heads[section + 1]
+        out = out[:a] + re.sub(r'(?is)<p>(?:(?!<img).)*?</p>', "", out[a:z]) + out[z:]
+    return out
+
+# validate_reply's text coverage before word shingles: whole runs, then at most `searches`
+# substring scans of the joined reply, kept as the baseline
+def legacy_coverage(reply_html: str, sent_body: str, searches: int = 200) -> float:
+    reply_runs = tdu.text_runs(reply_html)
+    kept = set(reply_runs)
+    flat = " ".join(reply_runs)
+    total = found = 0
+    for run in tdu.text_runs(sent_body):
+        total += len(run)
+        if run in kept:
+            found += len(run)
+        elif searches > 0:
+            searches -= 1
+            if run in flat:
+                found += len(run)
+    return found / total if total else 1.0
+
+def bench_validate(sizes=(200_000, 1_000_000, 5_000_000), ai_latency: float = 0.5, chars_per_second: float = 50_000):
+    # validate_reply on good, damaged and merged-paragraph replies, then damaged documents
+    # end to end: the sections that lost text are resent, the whole body when all of them did
+    work = tempfile.mkdtemp(prefix="bench_validate_")
+    results = {}
+    rows = []
+    saved_watch = tdu.STREAM_WATCH
+    try:
+        for size in sizes:
+            html_path, files_dir, markup = write_word_export(os.path.join(work, f"in{size}"), size)
+            body = tdu.extract_body_for_ai(markup, os.path.join(work, f"stage{size}"), files_dir, None,
+                                           tdu.MinimizeForAiStage())
+            sections = tdu.split_sections(body)
+            good = tdu.run_html_stages(canned_ai_html(body), [tdu.StripLeakedPromptStage()])
+            bad = _damage_reply(good)
+            (_, ok), t_good = _timings(lambda: tdu.validate_reply(good, body, sections, "Guide"), 3)
+            (fixed, rep), t_bad = _timings(lambda: tdu.validate_reply(bad, body, sections, "Guide"), 3)
+            _, again = tdu.validate_reply(fixed, body, sections, "Guide")
+            # Same text with every run of paragraphs merged into one: no run is found whole
+            merged = re.sub(r'(?i)</p>\s*<p>', " ", good)
+            old_cov, t_old = _timings(lambda: legacy_coverage(merged, body), 3)
+            (_, new), t_new = _timings(lambda: tdu.validate_reply(merged, body, sections, "Guide"), 3)
+            results[size] = {"good_ms": 1000 * t_good["min_s"], "bad_ms": 1000 * t_bad["min_s"],
+                             "issues": rep["issues"], "left_after_repair": again["issues"],
+                             "merged_coverage": (old_cov, new["coverage"]), "merged_failing": len(new["failing"])}
+            rows.append((f"{len(body) // 1000} KB body, {len(sections)} sections",
+                         f"good {1000 * t_good['min_s']:.1f} ms ({len(ok['issues'])} issues)  damaged "
+                         f"{1000 * t_bad['min_s']:.1f} ms: {rep['repairs']} repaired locally, "
+                         f"{len(rep['failing'])} section(s) to resend"))
+            rows.append(("  paragraphs merged",
+                         f"coverage {old_cov:.1%} ({1000 * t_old['min_s']:.0f} ms, 200 searches) -> "
+                         f"{new['coverage']:.1%} ({1000 * t_new['min_s']:.0f} ms, whole validate)  "
+                         f"{len(new['failing'])} section(s) to resend"))
+        # End to end: the damaged reply comes back once, then the chat answers properly
+        tdu.STREAM_WATCH = False
+        html_path, files_dir, markup = write_word_export(os.path.join(work, "e2e"), 80_000)   # one chunk
+        body = tdu.extract_body_for_ai(markup, os.path.join(work, "stage_e2e"), files_dir, None,
+                                       tdu.MinimizeForAiStage())
+        served = []
+
+        def respond(message):
+            out = canned_ai_html(message)
+            served.append(len(message))
+            return _damage_reply(out) if len(served) == 1 else out
+
+        chat = FakeChat(latency=ai_latency, respond=respond, chars_per_second=chars_per_second)
+        job = tdu.DocJob(os.path.join(work, "Guide.docx"))
+        job.body = body
+        job.prompt = tdu.build_chunk_prompt(body, 0, 1)
+        t0 = time.perf_counter()
+        tdu.convert_document(job, chat)
+        secs = time.perf_counter() - t0
+        results["e2e"] = {"seconds": secs, "messages": chat.messages, "kb_sent": chat.bytes_sent // 1024,
+                          "validation": job.validation}
+        rows.append(("damaged reply, end to end",
+                     f"{secs:.2f}s  {chat.messages} messages, resend {served[-1] // 1024} KB vs "
+                     f"{served[0] // 1024} KB for the whole document"))
+        rows.append(("", tdu.validation_line(job.validation)[:110]))
+        # One section (no subheadings): a reply that lost its text can only be fixed whole
+        one = re.sub(r'(?is)<h([2-6])\b[^>]*>(.*?)</h\1>', r"<p>\2</p>", body)
+        served.clear()
+
+        def respond_one(message):
+            out = canned_ai_html(message)
+            served.append(len(message))
+            return re.sub(r'(?is)<p>(?:(?!<img).)*?</p>', "", out) if len(served) == 1 else out
+
+        chat = FakeChat(latency=ai_latency, respond=respond_one, chars_per_second=chars_per_second)
+        job = tdu.DocJob(os.path.join(work, "Guide.docx"))
+        job.body = one
+        job.prompt = tdu.build_chunk_prompt(one, 0, 1)
+        t0 = time.perf_counter()
+        tdu.convert_document(job, chat)
+        secs = time.perf_counter() - t0
+        results["e2e_one_section"] = {"seconds": secs, "messages": chat.messages, "validation": job.validation}
+        rows.append(("one-section reply lost its text",
+                     f"{secs:.2f}s  {chat.messages} messages, whole body resent ({served[-1] // 1024} KB)"))
+        rows.append(("", tdu.validation_line(job.validation)[:110]))
+    finally:
+        tdu.STREAM_WATCH = saved_watch
+        shutil.rmtree(work, ignore_errors=True)
+    _report("Reply validation (one pass over the reply; damaged = extra <style>, wrong <title>, altered alt, "
+            "lost section)", rows)
+    return results
+
+def _walk_docx_files(root_folder):
+    # find_docx_files as it was before scan_folders: os.walk, nothing pruned, kept as the baseline
+    for dirpath, _, filenames in os.walk(root_folder):
+        for fn in filenames:
+            if fn.lower().endswith((".docx", ".doc")):
+                yield os.path.join(dirpath, fn)
+
+def write_scan_tree(folder: str, files: int = 100_000, roots: int = 4):
+    # roots/dept/course folders of 50 files each: 20 documents, 2 ~$ lock files, 8 PDFs and
+    # images, and the tool's own leftovers (10 backups under "Pre ADA Update Docx Files",
+    # 10 files in an ADA_work_* folder). Returns the root folders.
+    per_course = 50
+    courses = max(1, files // per_course)
+    depts = max(1, int((courses / roots) ** 0.5))
+    paths = [os.path.join(folder, f"share{r}") for r in range(roots)]
+    for c in range(courses):
+        course = os.path.join(paths[c % roots], f"dept{(c // roots) % depts}", f"course{c}")
+        pre = os.path.join(course, "Pre ADA Update Docx Files")
+        work = os.path.join(course, f"ADA_work_syllabus_2024010{c % 10}_120000")
+        for d in (pre, work):
+            os.makedirs(d, exist_ok=True)
+        names = ([os.path.join(course, f"doc{i}.docx" if i % 4 else f"doc{i}.doc") for i in range(20)]
+                 + [os.path.join(course, f"~$doc{i}.docx") for i in range(2)]
+                 + [os.path.join(course, f"handout{i}.pdf" if i % 2 else f"figure{i}.png") for i in range(8)]
+                 + [os.path.join(pre, f"PreADA_doc{i}.docx") for i in range(10)]
+                 + [os.path.join(work, f"image{i:03d}.png") for i in range(9)] + [os.path.join(work, "ai_output.html")])
+        for i, p in enumerate(names):
+            with open(p, "wb") as f:
+                f.write(b"x" * (100 + i))
+    return paths
+
+def bench_scan(files: int = 100_000, roots: int = 4, workers=(1, 8), latency=(0.0, 0.002), changed: int = 200):
+    # os.walk vs the pruned os.scandir scan with 1..N threads (latency = a simulated network
+    # round trip per folder listing), then a rescan against the index after a few edits
+    work = tempfile.mkdtemp(prefix="bench_scan_")
+    results = {}
+    rows = []
+    real_scandir = os.scandir
+    try:
+        t0 = time.perf_counter()
+        paths = write_scan_tree(os.path.join(work, "tree"), files, roots)
+        rows.append(("synthetic tree", f"{files} files in {len(paths)} roots, written in {time.perf_counter() - t0:.1f}s"))
+        for lat in latency:
+            if lat:
+                def slow_scandir(path=".", _real=real_scandir, _lat=lat):
+                    time.sleep(_lat)
+                    return _real(path)
+                os.scandir = slow_scandir
+            repeat = 3 if not lat else 1
+            try:
+                walked, t_walk = _timings(lambda: [f for p in paths for f in _walk_docx_files(p)], repeat)
+                row = {"os.walk": t_walk["min_s"]}
+                rows.append((f"os.walk (before), {1000 * lat:.0f} ms/folder",
+                             f"{t_walk['min_s']:.2f}s  {len(walked)} documents (backups and ~$ files included)"))
+                for n in workers:
+                    found, t_scan = _timings(lambda: tdu.scan_folders(paths, n), repeat)
+                    row[f"scandir x{n}"] = t_scan["min_s"]
+                    rows.append((f"scandir, {n} thread(s), {1000 * lat:.0f} ms/folder",
+                                 f"{t_scan['min_s']:.2f}s  {len(found)} documents  "
+                                 f"({t_walk['min_s'] / max(t_scan['min_s'], 1e-9):.1f}x)"))
+                results[f"latency_{1000 * lat:.0f}ms"] = row
+            finally:
+                os.scandir = real_scandir
+        # Index: settle everything once, then edit, touch and add a few documents
+        index_dir = os.path.join(work, "index")
+        found = tdu.scan_folders(paths, max(workers))
+        index = tdu.ScanIndex(paths, index_dir)
+        t0 = time.perf_counter()
+        for path, _, _ in found:
+            index.commit(path)
+        index.save()
+        t_commit = time.perf_counter() - t0
+        docs = [p for p, _, _ in found]
+        edited = docs[::max(1, len(docs) // changed)][:changed]
+        touched = docs[1::max(1, len(docs) // changed)][:changed]
+        for p in edited:
+            with open(p, "ab") as f:
+                f.write(b"edit")
+        later = time.time() + 60
+        for p in touched:
+            os.utime(p, (later, later))
+        added = [os.path.join(os.path.dirname(p), f"new_syllabus_{i}.docx")
+                 for i, p in enumerate(docs[2::max(1, len(docs) // changed)][:changed])]
+        for p in added:
+            with open(p, "wb") as f:
+                f.write(b"new")
+
+        def rescan():
+            idx = tdu.ScanIndex(paths, index_dir)
+            return idx.changed(tdu.scan_folders(paths, max(workers))), idx
+
+        (todo, idx), t_rescan = _timings(rescan, 1)
+        expected = set(edited) | set(added)
+        results["index"] = {"commit_s": t_commit, "rescan_s": t_rescan["min_s"], "todo": len(todo),
+                            "expected": len(expected), "exact": set(todo) == expected, "stats": idx.stats}
+        rows.append(("index: settle every document", f"{t_commit:.2f}s for {len(found)} documents (stat + sha256)"))
+        rows.append(("index: rescan", f"{t_rescan['min_s']:.2f}s  {len(todo)} to do of {len(found) + len(set(added))} "
+                                      f"({'exactly' if set(todo) == expected else 'NOT'} the {len(edited)} edited "
+                                      f"+ {len(set(added))} added; {len(touched)} touched skipped by hash)"))
+        rows.append(("", idx.summary()))
+    finally:
+        os.scandir = real_scandir
+        shutil.rmtree(work, ignore_errors=True)
+    _report("Folder scan (warm cache; pruned: Pre ADA backups, ADA_work_* folders, ~$ lock files)", rows)
+    return results
+
+# ---------- Regression suite ----------
+# Every hot path at fixed sizes and seeds, written to JSON so two runs can be compared.
+def _timings(fn, repeat: int, setup=None):
+    times = []
+    out = None
+    for _ in range(max(1, repeat)):
+        arg = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        out = fn(arg) if setup is not None else fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return out, {"median_s": times[len(times) // 2], "min_s": times[0], "runs": len(times)}
+
+def _git_rev() -> str:
+    import subprocess
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(Path(__file__).parent),
+                              capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+def _suite_e2e(work: str, backend: str, docs: int, first_token_delay: float, chars_per_second: float):
+    # A whole batch on Linux: fake Word COM, or generated .docx through the native reader and
+    # writer; the AI stage always goes over HTTP to the streaming stub
+    folder = os.path.join(work, f"e2e_{backend}")
+    if backend == "fakeword":
+        inputs = write_fake_docx_inputs(folder, docs)
+    else:
+        os.makedirs(folder)
+        inputs = []
+        for n in range(docs):
+            markup, images = make_styled_ai_html(200, "doc", n)
+            for name in images:
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(FAKE_PNG)
+            src = os.path.join(folder, f"src{n}.html")
+            with open(src, "w", encoding="utf-8") as f:
+                f.write(markup)
+            inputs.append(tdu.write_docx_from_html(src, os.path.join(folder, f"Guide {n}.docx")))
+            os.remove(src)
+    saved = (tdu.IMPORT_BACKEND, tdu.EXPORT_BACKEND)
+    word_pool = docx_pool = None
+    with StubChatServer(first_token_delay=first_token_delay, chars_per_second=chars_per_second) as srv:
+        chat = tdu.HttpChatTransport(srv.url + "v1", max_parallel=4)
+        try:
+            if backend == "fakeword":
+                tdu.IMPORT_BACKEND = tdu.EXPORT_BACKEND = "word"
+                word_pool = tdu.WordPool(size=2, backend=FakeWordBackend(launch_delay=0.1, open_delay=0.02,
+                                                                           save_delay=0.02, import_delay=0.02),
+                                         log_fn=lambda m: None).start()
+                stages = tdu.default_pipeline_stages(word_pool, chat)
+            else:
+                tdu.IMPORT_BACKEND = tdu.EXPORT_BACKEND = "native"
+                docx_pool = tdu.DocxWriterPool(2)
+                stages = tdu.default_pipeline_stages(None, chat, import_pool=docx_pool, native_pool=docx_pool)
+            t0 = time.perf_counter()
+            jobs = tdu.BatchPipeline(stages).run(inputs)
+            elapsed = time.perf_counter() - t0
+        finally:
+            tdu.IMPORT_BACKEND, tdu.EXPORT_BACKEND = saved
+            chat.stop()
+            for pool in (word_pool, docx_pool):
+                if pool is not None:
+                    pool.shutdown()
+    return {"seconds": elapsed, "docs_per_s": docs / elapsed, "docs": docs,
+            "failed": sum(1 for j in jobs if j.error is not None)}
+
+def bench_suite(sizes=(100_000, 1_000_000, 5_000_000), paragraphs=(1_000, 5_000), repeat: int = 5,
+                image_run: int = 1, docs: int = 8, first_token_delay: float = 0.1,
+                chars_per_second: float = 200_000, out: str = ""):
+    work = tempfile.mkdtemp(prefix="bench_suite_")
+    results = {}
+    try:
+        for size in sizes:
+            folder = os.path.join(work, str(size))
+            html_path, files_dir, markup = write_word_export(folder, size, "doc", size % 97, image_run)
+            work_dir = os.path.join(folder, "work")
+            os.makedirs(work_dir)
+            key = f"{size // 1000}KB"
+            body, results[f"extract_relevant_html_for_ai.{key}"] = _timings(
+                lambda: tdu.extract_relevant_html_for_ai(markup), repeat)
+            _, results[f"extract_body_for_ai.{key}"] = _timings(
+                lambda: tdu.extract_body_for_ai(markup, work_dir, files_dir), repeat)
+            reply = make_ai_reply(tdu.relativize_img_src_to_folder(body, work_dir, files_dir))
+            _, results[f"clean_ai_html.{key}"] = _timings(
+                lambda: tdu.clean_ai_html(reply, work_dir, files_dir), repeat)
+            results[f"extract_relevant_html_for_ai.{key}"]["images"] = body.count("<img")
+            shutil.rmtree(folder, ignore_errors=True)
+        for count in paragraphs:
+            markup = make_list_html(count, count)
+            _, results[f"list_marker_stage.{count}p"] = _timings(
+                lambda: tdu.run_html_stages(markup, [tdu.UnwrapListParagraphStage(), tdu.ListMarkerStage()]), repeat)
+
+            def fresh_document():
+                return make_fixup_document(FakeWordApp(FakeWordBackend(launch_delay=0), 1), count, count)
+
+            def fix(doc):
+                calls = doc._app.calls
+                tdu.fix_paragraph_styles(doc)
+                return doc._app.calls - calls
+
+            calls, r = _timings(fix, repeat, fresh_document)
+            r["com_calls"] = calls
+            results[f"fix_paragraph_styles.{count}p"] = r
+        for backend in ("fakeword", "native"):
+            results[f"e2e.{backend}"] = _suite_e2e(work, backend, docs, first_token_delay, chars_per_second)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    import platform
+    report = {
+        "meta": {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": _git_rev(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "repeat": repeat, "sizes": list(sizes),
+                 "paragraphs": list(paragraphs), "image_run": image_run, "docs": docs,
+                 "first_token_delay": first_token_delay, "chars_per_second": chars_per_second},
+        "results": results,
+    }
+    out = out or f"bench_suite_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    rows = []
+    for name, r in results.items():
+        if "median_s" in r:
+            extra = f"  calls={r['com_calls']}" if "com_calls" in r else ""
+            rows.append((name, f"{r['median_s'] * 1000:.1f}ms (min {r['min_s'] * 1000:.1f}){extra}"))
+        else:
+            rows.append((name, f"{r['seconds']:.2f}s  docs/s={r['docs_per_s']:.2f}  failed={r['failed']}"))
+    rows.append(("written", out))
+    _report(f"Regression suite (median of {repeat}, git {report['meta']['git'] or '?'})", rows)
+    return report
+
+def _suite_metric(r: dict):
+    # The fastest run is the least disturbed by other load on the machine
+    return r.get("min_s", r.get("seconds"))
+
+def bench_compare(before: str, after: str, threshold: float = 0.10):
+    # Metric by metric, after / before; slower than 1 + threshold counts as a regression.
+    # Exact counters (COM calls, failures) regress on any increase.
+    with open(before, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(after, encoding="utf-8") as f:
+        b = json.load(f)
+    rows = []
+    regressions = []
+    for name in sorted(set(a["results"]) | set(b["results"])):
+        ra, rb = a["results"].get(name), b["results"].get(name)
+        if ra is None or rb is None:
+            rows.append((name, "only in " + ("after" if ra is None else "before")))
+            continue
+        ta, tb = _suite_metric(ra), _suite_metric(rb)
+        ratio = tb / ta if ta else 1.0
+        line = f"{ta * 1000:.1f} -> {tb * 1000:.1f}ms  x{ratio:.2f}"
+        bad = ratio > 1 + threshold
+        for counter in ("com_calls", "failed"):
+            if counter in ra or counter in rb:
+                line += f"  {counter} {ra.get(counter)} -> {rb.get(counter)}"
+                bad = bad or (rb.get(counter) or 0) > (ra.get(counter) or 0)
+        if bad:
+            regressions.append(name)
+            line += "  REGRESSION"
+        rows.append((name, line))
+    for key in ("git", "python", "cpus"):
+        if a["meta"].get(key) != b["meta"].get(key):
+            rows.append((f"meta {key}", f"{a['meta'].get(key)} -> {b['meta'].get(key)}"))
+    _report(f"{before} -> {after} (threshold {threshold:.0%})", rows)
+    return {"regressions": regressions}
+
+# ---------- Entry point ----------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmarks for toddocumentupdater.py")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("wordpool", help="Word session pool vs Dispatch/Quit per call (fake COM)")
+    p.add_argument("--docs", type=int, default=40)
+    p.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--launch-delay", type=float, default=1.0)
+    sub.add_parser("wordhang", help="Recycle a hung Word instance (fake COM)")
+    p = sub.add_parser("pipeline", help="Sequential loop vs export/AI/import pipeline (fake Word + chat)")
+    p.add_argument("--docs", type=int, default=12)
+    p.add_argument("--ai-latency", type=float, default=1.0)
+    p.add_argument("--queue-size", type=int, default=2)
+    p = sub.add_parser("aicache", help="Rerun a folder with the AI conversion cache (fake Word + chat)")
+    p.add_argument("--docs", type=int, default=8)
+    p = sub.add_parser("journal", help="Interrupt a batch mid-import and resume it from the journal")
+    p.add_argument("--docs", type=int, default=10)
+    p = sub.add_parser("html", help="Regex HTML helpers vs the streaming token stages")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000, 50_000_000])
+    p.add_argument("--memory", action="store_true", help="also record peak allocations (slower)")
+    p = sub.add_parser("chunking", help="Whole-document prompt vs section chunks (fake chat)")
+    p.add_argument("--size", type=int, default=600_000)
+    p.add_argument("--chunk-chars", type=int, default=60_000)
+    p.add_argument("--parallel", type=int, default=4)
+    p = sub.add_parser("capture", help="DOM polling vs event-driven reply capture (stub chat page)")
+    p.add_argument("--docs", type=int, default=5)
+    p.add_argument("--sizes", type=int, nargs="+", default=[20_000, 200_000])
+    p = sub.add_parser("http", help="HTTP transport (keep-alive pool, concurrency, retries) vs the stub endpoint")
+    p.add_argument("--docs", type=int, default=16)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    p = sub.add_parser("tabs", help="Single page vs N async tabs (stub chat page)")
+    p.add_argument("--docs", type=int, default=12)
+    p.add_argument("--tabs", type=int, nargs="+", default=[1, 2, 4])
+    p = sub.add_parser("images", help="Per-document image copies vs the batch image store")
+    p.add_argument("--docs", type=int, default=6)
+    p.add_argument("--images", type=int, default=60)
+    p.add_argument("--image-kb", type=int, default=800)
+    p = sub.add_parser("lists", help="List detection in Word COM vs in the HTML stage (fake COM)")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 5_000, 20_000])
+    p = sub.add_parser("fixups", help="Per-paragraph style passes vs one snapshot (fake COM)")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 5_000, 20_000])
+    p = sub.add_parser("docx", help="Native HTML->DOCX writer: fidelity vs the fake COM import, throughput")
+    p.add_argument("--docs", type=int, default=8)
+    p.add_argument("--paragraphs", type=int, default=400)
+    p.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--template", default="")
+    p = sub.add_parser("docxread", help="Native DOCX->HTML reader: fidelity, corpus throughput, memory")
+    p.add_argument("--generated", type=int, default=24)
+    p.add_argument("--paragraphs", type=int, default=400)
+    p.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--corpus", default="", help="folder of .docx files (default: the repo's own)")
+    p.add_argument("--big-paragraphs", type=int, default=20_000)
+    p = sub.add_parser("trace", help="Span overhead on/off and a traced fake-Word pipeline (p50/p95 table)")
+    p.add_argument("--docs", type=int, default=12)
+    p = sub.add_parser("minimize", help="Prompt bytes/tokens and AI round trip with the prompt minimizer (stub)")
+    p.add_argument("--sizes", type=int, nargs="+", default=[50_000, 200_000, 1_000_000])
+    p.add_argument("--image-run", type=int, default=2)
+    p = sub.add_parser("session", help="Instructions in every message vs once per chat session (fake chat + stub)")
+    p.add_argument("--docs", type=int, default=12)
+    p.add_argument("--size", type=int, default=30_000)
+    p = sub.add_parser("routing", help="All documents through the AI vs the local converter + complexity router")
+    p.add_argument("--docs", type=int, default=20)
+    p.add_argument("--hard-share", type=float, default=0.3)
+    p.add_argument("--ai-latency", type=float, default=1.0)
+    p = sub.add_parser("memo", help="Revised document: whole body resent vs only the changed sections")
+    p.add_argument("--size", type=int, default=300_000)
+    p.add_argument("--changed", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--ai-latency", type=float, default=0.5)
+    p = sub.add_parser("stream", help="Time to recognise a bad AI reply: end of stream vs mid-stream watch")
+    p.add_argument("--size", type=int, default=200_000)
+    p.add_argument("--first-token-delay", type=float, default=0.5)
+    p.add_argument("--chars-per-second", type=float, default=20_000)
+    p = sub.add_parser("validate", help="Reply validation time and section resend vs a whole rerun")
+    p.add_argument("--sizes", type=int, nargs="+", default=[200_000, 1_000_000, 5_000_000])
+    p = sub.add_parser("scan", help="os.walk vs the pruned, threaded scandir scan and an indexed rescan")
+    p.add_argument("--files", type=int, default=100_000)
+    p.add_argument("--roots", type=int, default=4)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.002])
+    p = sub.add_parser("suite", help="Every hot path at fixed sizes plus end-to-end batches, written to JSON")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000])
+    p.add_argument("--paragraphs", type=int, nargs="+", default=[1_000, 5_000])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--image-run", type=int, default=1)
+    p.add_argument("--docs", type=int, default=8)
+    p.add_argument("--first-token-delay", type=float, default=0.1)
+    p.add_argument("--chars-per-second", type=float, default=200_000)
+    p.add_argument("--out", default="")
+    p = sub.add_parser("compare", help="Compare two suite JSON files; exit 1 on a regression")
+    p.add_argument("before")
+    p.add_argument("after")
+    p.add_argument("--threshold", type=float, default=0.10)
+    p = sub.add_parser("chatsession", help="One browser per document vs one per batch (stub chat page)")
+    p.add_argument("--docs", type=int, default=10)
+    args = ap.parse_args(argv)
+    if args.cmd == "wordpool":
+        bench_word_pool(args.docs, args.sizes, args.launch_delay)
+    elif args.cmd == "wordhang":
+        bench_word_pool_hang()
+    elif args.cmd == "pipeline":
+        bench_pipeline(args.docs, args.ai_latency, queue_size=args.queue_size)
+    elif args.cmd == "aicache":
+        bench_ai_cache(args.docs)
+    elif args.cmd == "journal":
+        bench_journal(args.docs)
+    elif args.cmd == "html":
+        bench_html_transforms(args.sizes, args.memory)
+    elif args.cmd == "chunking":
+        bench_chunking(args.size, args.chunk_chars, args.parallel)
+    elif args.cmd == "capture":
+        bench_response_capture(args.docs, args.sizes)
+    elif args.cmd == "http":
+        bench_http_transport(args.docs, args.concurrency)
+    elif args.cmd == "tabs":
+        bench_chat_tabs(args.docs, args.tabs)
+    elif args.cmd == "images":
+        bench_image_store(args.docs, args.images, args.image_kb)
+    elif args.cmd == "lists":
+        bench_lists(args.sizes)
+    elif args.cmd == "fixups":
+        bench_fixups(args.sizes)
+    elif args.cmd == "docx":
+        bench_docx_writer(args.docs, args.paragraphs, args.processes, args.template)
+    elif args.cmd == "docxread":
+        bench_docx_reader(args.generated, args.paragraphs, args.processes, args.corpus, args.big_paragraphs)
+    elif args.cmd == "trace":
+        bench_tracing(args.docs)
+    elif args.cmd == "minimize":
+        bench_prompt_minimizer(tuple(args.sizes), args.image_run)
+    elif args.cmd == "session":
+        bench_ai_session(args.docs, args.size)
+    elif args.cmd == "routing":
+        bench_routing(args.docs, hard_share=args.hard_share, ai_latency=args.ai_latency)
+    elif args.cmd == "memo":
+        bench_section_memo(args.size, tuple(args.changed), ai_latency=args.ai_latency)
+    elif args.cmd == "stream":
+        bench_stream_abort(args.size, args.first_token_delay, args.chars_per_second)
+    elif args.cmd == "validate":
+        bench_validate(tuple(args.sizes))
+    elif args.cmd == "scan":
+        bench_scan(args.files, args.roots, tuple(args.workers), tuple(args.latency))
+    elif args.cmd == "suite":
+        bench_suite(tuple(args.sizes), tuple(args.paragraphs), args.repeat, args.image_run, args.docs,
+                    args.first_token_delay, args.chars_per_second, args.out)
+    elif args.cmd == "compare":
+        if bench_compare(args.before, args.after, args.threshold)["regressions"]:
+            sys.exit(1)
+    elif args.cmd == "chatsession":
+        bench_chat_session(args.docs)
+
+if __name__ == "__main__":
+    main()